@@ -26,6 +26,11 @@ kegbot system.  The process is responsible for several tasks, including:
   - connecting to the kegbot core and registering the individual boards
   - accumulating data if the kegbot core is offline
 
+A single daemon serves any number of boards (see --kegboard_devices), waiting
+on all of them from one thread and sharing one connection to the core.  Each
+board's meters, sensors and relays are named after the board, eg
+"kegboard.flow0".
+
 The kegboard daemon is compatible with any device that speaks the Kegboard
 Serial Protocol. See http://kegbot.org/docs for the complete specification.
 
@@ -36,26 +41,44 @@ and temperature events).  This is a TCP connection, using the Kegnet Protocol to
 exchange data.
 """
 
+import glob
+import logging
+import os
 import Queue
+import re
+import sys
 
 import gflags
 import serial
-import os
 import time
 
 from pykeg.core import importhacks
 from pykeg.core import kb_app
 from pykeg.core import kb_common
+from pykeg.core import kbevent
 from pykeg.core import util
 from pykeg.core.net import kegnet
+from pykeg.core.net import reactor
+from pykeg.core.net import spool
+from pykeg.hw.kegboard import capture
+from pykeg.hw.kegboard import filters
 from pykeg.hw.kegboard import kegboard
 
 FLAGS = gflags.FLAGS
 
 gflags.DEFINE_string('kegboard_name', 'kegboard',
     'Name of this kegboard that will be used when talking to the core. '
-    'If you are using multiple kegboards, you will want to run different '
-    'daemons with different names. Otherwise, the default is fine.')
+    'If several device files are listed in --kegboard_devices, the ones not '
+    'named there are called this name followed by their position in the '
+    'list.')
+
+gflags.DEFINE_list('kegboard_devices', [],
+    'Kegboards to serve, as a comma-separated list of device files or glob '
+    'patterns (eg "/dev/ttyUSB*"). Each may be prefixed with "<name>=" to '
+    'name that board. Unnamed boards found by a glob pattern are called '
+    '--kegboard_name followed by their name in /dev/serial/by-id, which does '
+    'not change when boards are plugged in a different order. If empty, the '
+    'single board at --kegboard_device is served.')
 
 gflags.DEFINE_boolean('show_messages', True,
     'Print all messages going to and from the kegboard. Useful for '
@@ -66,19 +89,80 @@ gflags.DEFINE_integer('required_firmware_version', 7,
     'firmware version, the daemon will refuse to service it.  This '
     'value should probably not be changed.')
 
+gflags.DEFINE_string('kegboard_spool', '',
+    'File in which events are spooled while the kegbot core is unreachable, '
+    'so that they survive a restart of this daemon. If empty, events are '
+    'spooled in memory only.')
+
+gflags.DEFINE_string('kegboard_capture_dir', '',
+    'If set, the raw byte stream of each kegboard is recorded in a new '
+    'capture file in this directory, named after the board and the time. '
+    'Captures can be played back with kegboard_replay.py.')
+
 FLAGS.SetDefault('tap_name', kb_common.ALIAS_ALL_TAPS)
 
+SERIAL_BY_ID_DIR = '/dev/serial/by-id'
+
+def _SerialIds():
+  """Maps the real path of each serial device to its name in by-id."""
+  ret = {}
+  for link in glob.glob(os.path.join(SERIAL_BY_ID_DIR, '*')):
+    ret[os.path.realpath(link)] = os.path.basename(link)
+  return ret
+
+def FindDevices():
+  """Returns a list of (board name, device path) for --kegboard_devices.
+
+  Boards are named in the core's meter names, so a board must keep its name
+  however the devices are enumerated.  The devices a glob pattern matches
+  come and go in any order, so those are named after their stable id in
+  SERIAL_BY_ID_DIR; a ValueError is raised if one has none.
+  """
+  specs = FLAGS.kegboard_devices or [FLAGS.kegboard_device]
+  ret = []
+  listed = []
+  globbed = []
+  for spec in specs:
+    if '=' in spec:
+      ret.append(tuple(spec.split('=', 1)))
+    elif glob.has_magic(spec):
+      globbed.extend(sorted(glob.glob(spec)))
+    else:
+      listed.append(spec)
+  if len(listed) == 1 and not ret and not globbed:
+    ret.append((FLAGS.kegboard_name, listed[0]))
+  else:
+    for i, path in enumerate(listed):
+      ret.append(('%s%i' % (FLAGS.kegboard_name, i), path))
+  serial_ids = _SerialIds()
+  for path in globbed:
+    serial_id = serial_ids.get(os.path.realpath(path))
+    if serial_id is None:
+      raise ValueError('Kegboard at %s has no id in %s; name it in '
+          '--kegboard_devices as "<name>=%s".' % (path, SERIAL_BY_ID_DIR,
+          path))
+    ret.append(('%s-%s' % (FLAGS.kegboard_name,
+        re.sub(r'[^\w-]', '_', serial_id)), path))
+  return ret
+
+
 class KegboardKegnetClient(kegnet.SimpleKegnetClient):
-  def __init__(self, reader, addr=None):
-    kegnet.SimpleKegnetClient.__init__(self, addr)
-    self._reader = reader
+  def __init__(self, devices, addr=None, spool=None):
+    kegnet.SimpleKegnetClient.__init__(self, addr, spool=spool)
+    self._devices = dict((d.name, d) for d in devices)
+    self.Subscribe([kbevent.SetRelayOutputEvent],
+        names=['%s.*' % name for name in self._devices])
 
   def onSetRelayOutput(self, event):
     self._logger.debug('Responding to relay event: %s' % event)
-    if not event.output_name:
+    if not event.output_name or '.' not in event.output_name:
+      return
+    board_name, output_name = event.output_name.rsplit('.', 1)
+    device = self._devices.get(board_name)
+    if not device:
       return
     try:
-      output_id = int(event.output_name[-1])
+      output_id = int(output_name[-1])
     except ValueError:
       return
     if event.output_mode == event.Mode.ENABLED:
@@ -91,7 +175,7 @@ class KegboardKegnetClient(kegnet.SimpleKegnetClient):
     message = kegboard.SetOutputCommand()
     message.SetValue('output_id', output_id)
     message.SetValue('output_mode', output_mode)
-    self._reader.WriteMessage(message)
+    device.WriteMessage(message)
 
 class KegboardManagerApp(kb_app.App):
   def __init__(self, name='core'):
@@ -100,33 +184,61 @@ class KegboardManagerApp(kb_app.App):
   def _Setup(self):
     kb_app.App._Setup(self)
 
-    serial_fd = serial.Serial(FLAGS.kegboard_device, FLAGS.kegboard_speed)
-    reader = kegboard.KegboardReader(serial_fd)
-
-    self._client = KegboardKegnetClient(reader=reader)
+    try:
+      found = FindDevices()
+    except ValueError, e:
+      self._logger.error(str(e))
+      sys.exit(1)
+    devices = []
+    for name, path in found:
+      self._logger.info('Serving kegboard "%s" at %s' % (name, path))
+      devices.append(KegboardDevice(name, path))
+
+    event_spool = spool.EventSpool(FLAGS.kegboard_spool or None)
+    self._client = KegboardKegnetClient(devices=devices, spool=event_spool)
 
     self._manager_thr = KegboardManagerThread('kegboard-manager',
         self._client)
     self._AddAppThread(self._manager_thr)
 
     self._device_io_thr = KegboardDeviceIoThread('device-io', self._manager_thr,
-        reader)
+        devices)
     self._AddAppThread(self._device_io_thr)
 
     self._client_thr = kegnet.KegnetClientThread('kegnet', self._client)
     self._AddAppThread(self._client_thr)
 
+  def _MainLoop(self):
+    while not self._do_quit:
+      self._device_io_thr.join(1.0)
+      if self._device_io_thr.no_devices_left:
+        # Exit with an error, so that a supervisor restarts the daemon once
+        # boards are back.
+        self._logger.error('No kegboards left to serve, quitting.')
+        self.Quit()
+        self._Teardown()
+        sys.exit(1)
+
 
 class KegboardManagerThread(util.KegbotThread):
-  """Manager of local kegboard devices."""
+  """Manager of local kegboard devices.
+
+  Meter and temperature readings are passed through a filters.MeterFilter and
+  filters.ThermoFilter, so that an idle board sends the core next to nothing.
+  """
 
   def __init__(self, name, client):
     util.KegbotThread.__init__(self, name)
     self._client = client
     self._message_queue = Queue.Queue()
+    self._meter_filter = filters.MeterFilter()
+    self._thermo_filter = filters.ThermoFilter()
+
+  def GetStatus(self):
+    return self._meter_filter.GetStatus() + self._thermo_filter.GetStatus()
 
-  def _DeviceName(self, base_name):
-    return '%s.%s' % (FLAGS.kegboard_name, base_name)
+  def _DeviceName(self, board_name, base_name):
+    return '%s.%s' % (board_name, base_name)
 
   def PostDeviceMessage(self, device_name, device_message):
     """Receive a message from a device, for processing."""
@@ -150,14 +262,17 @@ class KegboardManagerThread(util.KegbotThread):
 
   def _HandleDeviceMessage(self, device_name, msg):
     if isinstance(msg, kegboard.MeterStatusMessage):
-      meter_name = self._DeviceName(msg.meter_name)
+      meter_name = self._DeviceName(device_name, msg.meter_name)
       curr_val = msg.meter_reading
-      self._client.SendMeterUpdate(meter_name, curr_val)
+      if self._meter_filter.Filter(meter_name, curr_val):
+        self._client.SendMeterUpdate(meter_name, curr_val)
 
     elif isinstance(msg, kegboard.TemperatureReadingMessage):
-      sensor_name = self._DeviceName(msg.sensor_name)
-      sensor_value = msg.sensor_reading
-      self._client.SendThermoUpdate(sensor_name, sensor_value)
+      sensor_name = self._DeviceName(device_name, msg.sensor_name)
+      sensor_value = self._thermo_filter.Filter(sensor_name,
+          msg.sensor_reading)
+      if sensor_value is not None:
+        self._client.SendThermoUpdate(sensor_name, sensor_value)
 
     elif isinstance(msg, kegboard.OnewirePresenceMessage):
       strval = '%016x' % msg.device_id
@@ -188,58 +303,143 @@ class KegboardManagerThread(util.KegbotThread):
         self._client.SendAuthTokenRemove(FLAGS.tap_name, device, bytes_le)
 
 
-class KegboardDeviceIoThread(util.KegbotThread):
-  """Manages all device I/O.
+class KegboardDevice:
+  """A kegboard served by this daemon.
 
-  This thread continuously reads from attached kegboard devices and passes
-  messages to the KegboardManagerThread.
+  Implements the reactor.Reactor handler interface for the board's serial
+  port.
   """
-  def __init__(self, name, manager, reader):
-    util.KegbotThread.__init__(self, name)
+  def __init__(self, name, path):
+    self.name = name
+    self.path = path
+    self._logger = logging.getLogger('kegboard.%s' % name)
+    self._serial_fd = serial.Serial(path, FLAGS.kegboard_speed)
+    self._capture_port = None
+    if FLAGS.kegboard_capture_dir:
+      capture_path = capture.NewCapturePath(FLAGS.kegboard_capture_dir, name)
+      self._logger.info('Capturing to %s' % capture_path)
+      self._capture_port = capture.CapturingPort(self._serial_fd, capture_path)
+      self._serial_fd = self._capture_port
+    self._reader = kegboard.KegboardReader(self._serial_fd)
+    self._manager = None
+    self._reactor = None
+    self.initialized = False
+    self.disabled = False
+
+  def Attach(self, reactor, manager):
+    self._reactor = reactor
     self._manager = manager
-    self._reader = reader
+    self._reactor.AddHandler(self)
+
+  def Detach(self):
+    self.disabled = True
+    self._reactor.RemoveHandler(self)
+    if self._capture_port:
+      self._capture_port.StopCapture()
+
+  def WriteMessage(self, message):
+    self._reader.WriteMessage(message)
 
   def Ping(self):
-    ping_message = kegboard.PingCommand()
-    self._reader.WriteMessage(ping_message)
+    self.WriteMessage(kegboard.PingCommand())
 
-  def ThreadMain(self):
-    self._logger.info('Starting reader loop...')
+  ### reactor.Reactor handler methods
+  def fileno(self):
+    return self._serial_fd.fileno()
 
-    # Ping the board a couple of times before going into the listen loop.
-    for i in xrange(2):
-      self.Ping()
+  def WantsRead(self):
+    return True
 
-    initialized = False
-    while not self._quit:
-      try:
-        msg = self._reader.GetNextMessage()
-      except kegboard.UnknownMessageError:
-        self._logger.warning('Read unknown message, skipping')
-        continue
+  def WantsWrite(self):
+    return False
 
+  def HandleRead(self):
+    for msg in self._reader.ReadMessages():
       # Check the reported firmware version. If it is not acceptable, then
-      # drop all messages until it is updated.
-      # TODO(mikey): kill the application when this happens? It isn't strictly
-      # necessary, but is probably the most obvious way to get the point across.
+      # stop serving the board until it is updated.
       if isinstance(msg, kegboard.HelloMessage):
         version = msg.firmware_version
-        if version >= FLAGS.required_firmware_version:
-          if not initialized:
-            self._logger.info('Found a Kegboard! Firmware version %i' % version)
-            initialized = True
-        else:
+        if version < FLAGS.required_firmware_version:
           self._logger.error('Attached kegboard firmware version (%s) is '
               'less than the required version (%s); please update this '
               'kegboard.' % (version, FLAGS.required_firmware_version))
-          os._exit(1)
+          self.Detach()
+          return
+        if not self.initialized:
+          self._logger.info('Found a Kegboard! Firmware version %i' % version)
+          self.initialized = True
 
-      if not initialized:
-        self.Ping()
-        time.sleep(0.1)
-        continue
+      if self.initialized:
+        self._manager.PostDeviceMessage(self.name, msg)
+
+  def HandleWrite(self):
+    pass
+
+  def HandleClose(self):
+    self._logger.error('Lost connection to kegboard at %s.' % self.path)
+    self.Detach()
+
+
+class KegboardDeviceIoThread(util.KegbotThread):
+  """Manages all device I/O.
 
-      self._manager.PostDeviceMessage('kegboard', msg)
+  This thread waits on the serial ports of all attached kegboard devices at
+  once, and passes the messages read from them to the KegboardManagerThread.
+  Boards which have not yet said hello are pinged every PING_INTERVAL seconds.
+  """
+  PING_INTERVAL = 0.5
+
+  def __init__(self, name, manager, devices):
+    util.KegbotThread.__init__(self, name)
+    self._manager = manager
+    self._devices = devices
+    self._reactor = reactor.Reactor()
+    self.no_devices_left = False
+
+  def Quit(self):
+    util.KegbotThread.Quit(self)
+    self._reactor.Wakeup()
+
+  def GetStatus(self):
+    ret = []
+    for device in self._devices:
+      if device.disabled:
+        state = 'disabled'
+      elif device.initialized:
+        state = 'ok'
+      else:
+        state = 'waiting for hello'
+      ret.append('%s (%s): %s' % (device.name, device.path, state))
+    return ret
+
+  def _PingUninitialized(self):
+    for device in self._devices:
+      if not device.initialized and not device.disabled:
+        device.Ping()
+
+  def ThreadMain(self):
+    self._logger.info('Starting reader loop...')
+    for device in self._devices:
+      device.Attach(self._reactor, self._manager)
+
+    # Ping the boards a couple of times before going into the listen loop.
+    for i in xrange(2):
+      self._PingUninitialized()
+    last_ping = time.time()
+
+    while not self._quit:
+      if not [d for d in self._devices if not d.disabled]:
+        self.no_devices_left = True
+        break
+      self._reactor.RunOnce(self.PING_INTERVAL)
+      now = time.time()
+      if now - last_ping >= self.PING_INTERVAL:
+        self._PingUninitialized()
+        last_ping = now
+    for device in self._devices:
+      if not device.disabled:
+        device.Detach()
+    self._reactor.Close()
     self._logger.info('Reader loop ended.')
 
 
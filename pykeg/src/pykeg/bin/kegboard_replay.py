@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Replays a kegboard capture, as recorded with --kegboard_capture_dir.
+
+By default, the capture is decoded with KegboardReader, and the messages found
+and decoding throughput are reported.  With --replay_pty, the bytes are
+instead played into a pseudo-terminal, which kegboard_daemon can be pointed
+at to push the capture through the daemon and the core.
+
+--speed sets the replay speed, as a multiple of the original; 0 replays as
+fast as the reader will take it.
+"""
+
+import errno
+import os
+import select
+import time
+
+import gflags
+
+from pykeg.core import importhacks
+from pykeg.core import kb_app
+from pykeg.hw.kegboard import capture
+from pykeg.hw.kegboard import kegboard
+from pykeg.hw.kegboard import simulator
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string('capture_file', '',
+    'Capture file to replay.')
+
+gflags.DEFINE_float('speed', 1.0,
+    'Replay speed, as a multiple of the original. If 0, replay as fast as '
+    'possible.',
+    lower_bound=0)
+
+gflags.DEFINE_boolean('replay_pty', False,
+    'If true, replay into a pseudo-terminal for kegboard_daemon to read, '
+    'rather than decoding the capture here.')
+
+gflags.DEFINE_string('link_path', '/tmp/kegboard-replay',
+    'With --replay_pty, link the pty here. If empty, no link is made.')
+
+
+class KegboardReplayApp(kb_app.App):
+  def _MainLoop(self):
+    if not FLAGS.capture_file:
+      self._logger.error('No --capture_file given.')
+      return
+    fd = open(FLAGS.capture_file, 'rb')
+    start_time = capture.ReadCaptureHeader(fd)
+    fd.seek(0)
+    if FLAGS.speed:
+      speed = '%gx' % FLAGS.speed
+    else:
+      speed = 'maximum'
+    self._logger.info('Replaying capture started %s at %s speed.' %
+        (time.ctime(start_time), speed))
+    port = capture.ReplayPort(fd, speed=FLAGS.speed)
+    try:
+      if FLAGS.replay_pty:
+        self._ReplayToPty(port)
+      else:
+        self._Decode(port)
+    finally:
+      fd.close()
+
+  def _Decode(self, port):
+    reader = kegboard.KegboardReader(port)
+    counts = {}
+    start = time.time()
+    while not self._do_quit:
+      try:
+        messages = reader.ReadMessages()
+      except EOFError:
+        break
+      for message in messages:
+        name = message.__class__.__name__
+        counts[name] = counts.get(name, 0) + 1
+    elapsed = time.time() - start
+
+    num_frames, num_bad_frames = reader.GetStats()
+    self._logger.info('Read %i frames (%i bad) in %.2fs: %.0f frames/sec' %
+        (num_frames, num_bad_frames, elapsed, num_frames / max(elapsed, 1e-6)))
+    for name, count in sorted(counts.iteritems()):
+      self._logger.info('  %s: %i' % (name, count))
+
+  def _ReplayToPty(self, port):
+    master_fd, slave_fd, path = simulator.OpenPty()
+    if FLAGS.link_path:
+      if os.path.islink(FLAGS.link_path):
+        os.unlink(FLAGS.link_path)
+      os.symlink(path, FLAGS.link_path)
+      path = FLAGS.link_path
+    self._logger.info('Run kegboard_daemon with --kegboard_devices=%s' % path)
+    try:
+      self._WaitForPing(master_fd)
+      if self._do_quit:
+        return
+      self._logger.info('Pinged, starting replay.')
+      hello = kegboard.HelloMessage()
+      hello.SetValue('firmware_version', simulator.FIRMWARE_VERSION)
+      self._WriteAll(master_fd, hello.ToBytes())
+
+      num_bytes = 0
+      start = time.time()
+      while not self._do_quit:
+        data = port.read(kegboard.KegboardReader.READ_SIZE)
+        if not data:
+          break
+        self._WriteAll(master_fd, data)
+        num_bytes += len(data)
+      elapsed = time.time() - start
+      self._logger.info('Replayed %i bytes in %.2fs.' % (num_bytes, elapsed))
+    finally:
+      os.close(master_fd)
+      os.close(slave_fd)
+      if FLAGS.link_path:
+        os.unlink(FLAGS.link_path)
+
+  def _WaitForPing(self, master_fd):
+    while not self._do_quit:
+      if select.select([master_fd], [], [], 1.0)[0] and self._Drain(master_fd):
+        return
+
+  def _Drain(self, master_fd):
+    """Reads and discards what the daemon has sent; returns True if any."""
+    try:
+      return bool(os.read(master_fd, 4096))
+    except OSError, e:
+      if e.errno in (errno.EAGAIN, errno.EIO):
+        return False
+      raise
+
+  def _WriteAll(self, master_fd, data):
+    """Writes |data|, waiting while the daemon is behind."""
+    while data and not self._do_quit:
+      readable, writable, _ = select.select([master_fd], [master_fd], [], 1.0)
+      if readable:
+        self._Drain(master_fd)
+      if writable:
+        try:
+          data = data[os.write(master_fd, data):]
+        except OSError, e:
+          if e.errno != errno.EAGAIN:
+            raise
+
+
+if __name__ == '__main__':
+  KegboardReplayApp.BuildAndRun(name='kegboard_replay')
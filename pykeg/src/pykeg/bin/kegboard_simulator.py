@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Simulated kegboards, for load and latency testing without hardware.
+
+Each simulated board is a pseudo-terminal speaking the Kegboard Serial
+Protocol; run kegboard_daemon with the --kegboard_devices value that is logged
+at startup.  A board starts playing its script when the daemon first pings it.
+
+The script is read from --script (see hw/kegboard/simulator.py for the format),
+or generated from the --num_meters, --pour_* and --temp_interval flags.  Noise
+can be injected with --garbage_rate, --corrupt_rate and --truncate_rate.
+
+With --measure_latency, the simulator also connects to the kegbot core and
+reports the time from the start of each pour to the first FlowUpdate for its
+tap.  The taps must be configured in the core, named like "kegboard0.flow0".
+"""
+
+import os
+import time
+
+import gflags
+
+from pykeg.core import importhacks
+from pykeg.core import kb_app
+from pykeg.core import kbevent
+from pykeg.core.net import kegnet
+from pykeg.core.net import reactor
+from pykeg.hw.kegboard import simulator
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('num_boards', 1,
+    'Number of kegboards to simulate.',
+    lower_bound=1)
+
+gflags.DEFINE_string('script', '',
+    'Script of pours, temperature readings and auth tokens to play on each '
+    'board. If empty, a random script is generated.')
+
+gflags.DEFINE_integer('num_meters', 2,
+    'Number of meters per board, for a generated script.',
+    lower_bound=0)
+
+gflags.DEFINE_float('duration', 60.0,
+    'Length of a generated script, in seconds.',
+    lower_bound=0)
+
+gflags.DEFINE_float('pour_interval', 30.0,
+    'Average time between pours on each meter, in seconds, for a generated '
+    'script.',
+    lower_bound=0.1)
+
+gflags.DEFINE_integer('pour_ticks', 2200,
+    'Average size of a pour, in meter ticks, for a generated script.',
+    lower_bound=1)
+
+gflags.DEFINE_float('pour_seconds', 10.0,
+    'Average length of a pour, in seconds, for a generated script.',
+    lower_bound=0.1)
+
+gflags.DEFINE_float('temp_interval', 5.0,
+    'Interval between temperature readings, in seconds, for a generated '
+    'script. If 0, no readings are sent.',
+    lower_bound=0)
+
+gflags.DEFINE_float('token_rate', 0.0,
+    'Fraction of pours preceded by an auth token, for a generated script.',
+    lower_bound=0, upper_bound=1)
+
+gflags.DEFINE_float('update_interval', 0.1,
+    'Interval between meter readings while a meter is moving, in seconds.',
+    lower_bound=0.001)
+
+gflags.DEFINE_float('garbage_rate', 0.0,
+    'Fraction of frames preceded by random garbage.',
+    lower_bound=0, upper_bound=1)
+
+gflags.DEFINE_float('corrupt_rate', 0.0,
+    'Fraction of frames sent with a flipped bit.',
+    lower_bound=0, upper_bound=1)
+
+gflags.DEFINE_float('truncate_rate', 0.0,
+    'Fraction of frames sent truncated.',
+    lower_bound=0, upper_bound=1)
+
+gflags.DEFINE_integer('seed', None,
+    'Random seed, for repeatable scripts and noise.')
+
+gflags.DEFINE_string('link_dir', '/tmp',
+    'Directory in which to link each board\'s pty as "kegboard-sim<n>". '
+    'If empty, no links are made.')
+
+gflags.DEFINE_boolean('exit_when_done', True,
+    'If true, exit once every board has finished its script.')
+
+gflags.DEFINE_boolean('measure_latency', False,
+    'If true, connect to the kegbot core and measure the time from the start '
+    'of each pour to the first FlowUpdate for its tap.')
+
+
+class LatencyClient(kegnet.SimpleKegnetClient):
+  """Times the FlowUpdate following each simulated pour."""
+  def __init__(self, boards, addr=None):
+    kegnet.SimpleKegnetClient.__init__(self, addr)
+    self._boards = dict((b.name, b) for b in boards)
+    self._matched = {}  # maps tap name to the pour start already timed
+    self.latencies = []
+    self.Subscribe([kbevent.FlowUpdate],
+        names=['%s.*' % name for name in self._boards])
+
+  def onFlowUpdate(self, event):
+    now = time.time()
+    if not event.tap_name or '.' not in event.tap_name:
+      return
+    board_name, meter_name = event.tap_name.rsplit('.', 1)
+    board = self._boards.get(board_name)
+    if not board:
+      return
+    start = board.pour_start_times.get(meter_name)
+    if start is None or self._matched.get(event.tap_name) == start:
+      return
+    self._matched[event.tap_name] = start
+    self.latencies.append(now - start)
+
+
+class KegboardSimulatorApp(kb_app.App):
+  def _Setup(self):
+    kb_app.App._Setup(self)
+    self._reactor = reactor.Reactor()
+    self._boards = []
+    self._ptys = []
+    self._links = []
+    self._latency_client = None
+
+    devices = []
+    for i in xrange(FLAGS.num_boards):
+      # The names kegboard_daemon would give the boards by default.
+      if FLAGS.num_boards == 1:
+        name = 'kegboard'
+      else:
+        name = 'kegboard%i' % i
+      master_fd, slave_fd, path = simulator.OpenPty()
+      self._ptys.append((master_fd, slave_fd))
+      if FLAGS.link_dir:
+        link = os.path.join(FLAGS.link_dir, 'kegboard-sim%i' % i)
+        if os.path.islink(link):
+          os.unlink(link)
+        os.symlink(path, link)
+        self._links.append(link)
+        path = link
+      seed = FLAGS.seed
+      if seed is not None:
+        seed += i
+      board = simulator.SimulatedKegboard(master_fd, self._BuildScript(seed),
+          name=name, update_interval=FLAGS.update_interval,
+          garbage_rate=FLAGS.garbage_rate, corrupt_rate=FLAGS.corrupt_rate,
+          truncate_rate=FLAGS.truncate_rate, seed=seed)
+      self._boards.append(board)
+      self._reactor.AddHandler(board)
+      devices.append('%s=%s' % (name, path))
+    self._logger.info('Simulating %i kegboard(s); run kegboard_daemon with '
+        '--kegboard_devices=%s' % (len(devices), ','.join(devices)))
+
+    if FLAGS.measure_latency:
+      self._latency_client = LatencyClient(self._boards)
+      self._AddAppThread(kegnet.KegnetClientThread('kegnet',
+          self._latency_client))
+
+  def _BuildScript(self, seed):
+    if FLAGS.script:
+      return simulator.ParseScript(open(FLAGS.script))
+    return simulator.RandomScript(FLAGS.num_meters, FLAGS.duration,
+        pour_interval=FLAGS.pour_interval, pour_ticks=FLAGS.pour_ticks,
+        pour_seconds=FLAGS.pour_seconds, temp_interval=FLAGS.temp_interval,
+        token_rate=FLAGS.token_rate, seed=seed)
+
+  def _MainLoop(self):
+    while not self._do_quit:
+      now = time.time()
+      next_update = now + 1.0
+      for board in self._boards:
+        if board.pinged and not board.IsStarted():
+          self._logger.info('%s: pinged, starting script.' % board.name)
+          board.Start(now)
+        board.Update(now)
+        board_update = board.GetNextUpdateTime()
+        if board_update is not None:
+          next_update = min(next_update, board_update)
+      if FLAGS.exit_when_done and all(b.IsDone() for b in self._boards):
+        self._logger.info('All scripts done.')
+        break
+      self._reactor.RunOnce(max(0, next_update - now))
+    self._DumpStats()
+
+  def _DumpStats(self):
+    for board in self._boards:
+      for line in board.GetStatus():
+        self._logger.info(line)
+    if self._latency_client:
+      latencies = sorted(self._latency_client.latencies)
+      if latencies:
+        pct = lambda p: latencies[min(len(latencies) - 1,
+            int(len(latencies) * p / 100.0))] * 1000
+        self._logger.info('Pour to FlowUpdate latency over %i pours: median '
+            '%.1fms, p99 %.1fms, max %.1fms' % (len(latencies), pct(50),
+            pct(99), latencies[-1] * 1000))
+      else:
+        self._logger.info('No FlowUpdates were received.')
+
+  def _Teardown(self):
+    for board in self._boards:
+      self._reactor.RemoveHandler(board)
+    self._reactor.Close()
+    for master_fd, slave_fd in self._ptys:
+      os.close(master_fd)
+      os.close(slave_fd)
+    for link in self._links:
+      os.unlink(link)
+    if self._latency_client:
+      self._latency_client.stop()
+    kb_app.App._Teardown(self)
+
+
+if __name__ == '__main__':
+  KegboardSimulatorApp.BuildAndRun(name='kegboard_simulator')
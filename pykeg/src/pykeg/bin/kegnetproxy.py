@@ -31,6 +31,7 @@ import time
 from BaseHTTPServer import BaseHTTPRequestHandler
 from BaseHTTPServer import HTTPServer
 
+from pykeg.core import kbevent
 from pykeg.core import kbjson
 from pykeg.core import kb_app
 from pykeg.core import kb_common
@@ -48,6 +49,7 @@ class ProxyKegnetClient(kegnet.SimpleKegnetClient):
   def __init__(self, addr=None):
     kegnet.SimpleKegnetClient.__init__(self, addr)
     self.flows = {}
+    self.Subscribe([kbevent.FlowUpdate])
 
   def onFlowUpdate(self, event):
     self.flows[event.tap_name] = event
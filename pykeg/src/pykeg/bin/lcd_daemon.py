@@ -28,6 +28,7 @@ import sys
 import time
 
 from pykeg.core import kb_app
+from pykeg.core import kbevent
 from pykeg.core import units
 from pykeg.core import util
 from pykeg.core.net import kegnet
@@ -297,6 +298,7 @@ class LcdKegnetClient(kegnet.SimpleKegnetClient):
   def __init__(self, kb_lcdui, addr=FLAGS.kb_core_addr):
     kegnet.KegnetClient.__init__(self, addr)
     self._kb_lcdui = kb_lcdui
+    self.Subscribe([kbevent.FlowUpdate])
 
   def onFlowUpdate(self, event):
     self._kb_lcdui.HandleFlowStatus(event)
@@ -21,11 +21,16 @@
 """Post-drink Facebook annoy-o-matic."""
 
 from pykeg.core import kb_app
+from pykeg.core import kbevent
 from pykeg.core import models
 from pykeg.core.net import kegnet
 from pykeg.contrib.facebook import fbutil
 
 class FBKegnetClient(kegnet.SimpleKegnetClient):
+  def __init__(self, addr=None):
+    kegnet.SimpleKegnetClient.__init__(self, addr)
+    self.Subscribe([kbevent.DrinkCreatedEvent])
+
   def onDrinkCreated(self, event):
     self._logger.info('Drink created: %s' % event)
 
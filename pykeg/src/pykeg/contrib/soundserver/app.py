@@ -31,6 +31,7 @@ import gflags
 import mad
 
 from pykeg.core import kb_app
+from pykeg.core import kbevent
 from pykeg.core import units
 from pykeg.core import util
 from pykeg.core.net import kegnet
@@ -105,6 +106,7 @@ class SoundClient(kegnet.SimpleKegnetClient):
     self._sound_file_map = {}
     self._tempdir = FLAGS.cache_dir
     self._flows = {}
+    self.Subscribe([kbevent.FlowUpdate, kbevent.CreditAddedEvent])
 
   def PlaySoundFile(self, sound_url):
     local_sound = self._sound_file_map.get(sound_url)
@@ -30,6 +30,7 @@ import random
 
 from pykeg.core import backend
 from pykeg.core import kb_app
+from pykeg.core import kbevent
 from pykeg.core import models as core_models
 from pykeg.core.net import kegnet
 from pykeg.contrib.twitter import models
@@ -49,6 +50,7 @@ class TwitterKegnetClient(kegnet.SimpleKegnetClient):
   def __init__(self, addr=None):
     kegnet.SimpleKegnetClient.__init__(self, addr)
     self._backend = backend.KegbotBackend()
+    self.Subscribe([kbevent.DrinkCreatedEvent])
 
   def onDrinkCreated(self, event):
     self._logger.info('Processing new drink %i for user %s' % (event.drink_id,
@@ -19,20 +19,24 @@
 """A general purpose timer/alarm manager."""
 
 import heapq
+import itertools
 import threading
 import time
 
-# TODO(mikey): add docstrings
-
 class Alarm(object):
+  """A named event, to be handed out by the AlarmManager at fire_time."""
   def __init__(self, name, event, fire_time):
     self._name = name
     self._event = event
     self._fire_time = fire_time
+    self._entry = None
 
   def __cmp__(self, other):
     return cmp(self.fire_time(), other.fire_time())
 
+  def __str__(self):
+    return '<Alarm %s fire_time=%s>' % (self._name, self._fire_time)
+
   def name(self):
     return self._name
 
@@ -40,6 +44,7 @@ class Alarm(object):
     return self._fire_time
 
   def set_fire_time(self, fire_time):
+    """Sets the fire time.  Use AlarmManager.UpdateAlarm for pending alarms."""
     self._fire_time = fire_time
 
   def event(self):
@@ -47,117 +52,154 @@ class Alarm(object):
 
 
 class AlarmManager(object):
+  """Keeps a set of named alarms, and returns each one when it is due.
+
+  Pending alarms are kept in a heap of [fire_time, sequence, alarm] entries.
+  Cancelling or rescheduling an alarm never searches the heap: the alarm's
+  current entry is marked dead (its alarm slot is cleared) and, when
+  rescheduling, a fresh entry is pushed.  Dead entries are discarded when they
+  reach the top of the heap, and the heap is compacted whenever they come to
+  outnumber the live alarms.
+  """
+
+  # The heap is compacted when it holds more than this many dead entries, and
+  # more than COMPACT_RATIO dead entries for each live alarm.
+  COMPACT_MIN_DEAD = 64
+  COMPACT_RATIO = 2
+
   def __init__(self):
     self._alarm_heap = []
     self._alarms_by_name = {}
-    self._wake_event = threading.Event()
-    self._wake_event.clear()
-    self._heap_lock = threading.RLock()
-
-  def _WakeEventWait(self, amt):
-    self._wake_event.wait(amt)
-    self._heap_lock.acquire()
-    if self._wake_event.isSet():
-      self._wake_event.clear()
-    self._heap_lock.release()
+    self._sequence = itertools.count()
+    self._num_dead = 0
+    self._interrupted = False
+    self._cond = threading.Condition(threading.RLock())
+
+  def GetAlarmCount(self):
+    """Returns the number of pending alarms."""
+    return len(self._alarms_by_name)
+
+  def _PushEntry(self, alarm):
+    entry = [alarm.fire_time(), self._sequence.next(), alarm]
+    alarm._entry = entry
+    heapq.heappush(self._alarm_heap, entry)
+    if self._alarm_heap[0] is entry:
+      # New earliest alarm; waiters must recompute their deadline.
+      self._cond.notifyAll()
+
+  def _KillEntry(self, alarm):
+    alarm._entry[2] = None
+    alarm._entry = None
+    self._num_dead += 1
+    if (self._num_dead > self.COMPACT_MIN_DEAD and
+        self._num_dead > self.COMPACT_RATIO * len(self._alarms_by_name)):
+      self._alarm_heap = [e for e in self._alarm_heap if e[2] is not None]
+      heapq.heapify(self._alarm_heap)
+      self._num_dead = 0
+
+  def _PopDeadEntries(self):
+    heap = self._alarm_heap
+    while heap and heap[0][2] is None:
+      heapq.heappop(heap)
+      self._num_dead -= 1
+
+  def NextAlarm(self):
+    """Returns the next pending alarm without removing it, or None."""
+    self._cond.acquire()
+    try:
+      self._PopDeadEntries()
+      if not self._alarm_heap:
+        return None
+      return self._alarm_heap[0][2]
+    finally:
+      self._cond.release()
 
   def WaitForNextAlarm(self, timeout=None):
-    start = time.time()
-
-    if timeout:
-      wait_remain = timeout
-      end = start + timeout
-    else:
-      wait_remain = None
-      end = None
-
-    while True:
-      now = time.time()
-      if timeout is not None:
-        wait_remain = max(0, timeout - (now - start))
-
-      # If there are no alarms, wait until we are notified
-      self._heap_lock.acquire()
-
-      if len(self._alarm_heap) == 0:
-        self._heap_lock.release()
-        if (timeout is None or wait_remain > 0):
-          self._WakeEventWait(wait_remain)
-          continue
-        if (timeout is not None and wait_remain <= 0):
-          # Ran out of time.
-          return
-
-      # Grab the next alarm.
-      next_alarm = self._alarm_heap[0]
-      now = time.time()
-
-      # Now, we wait until the nearest alarm is due to fire. We can wake up
-      # early if the wake_event gets set (which indicates the alarm list has
-      # changed, meaning we should start over again).
-      sleep_amt = max(0, next_alarm.fire_time() - now)
-
-      # An alarm is ready now; remove it from the heap and process it.
-      if sleep_amt == 0:
-        popped = heapq.heappop(self._alarm_heap)
-        self._heap_lock.release()
-        assert(popped == next_alarm)
-        return next_alarm
-
-      self._heap_lock.release()
-
-      # An alarm is not ready now; go to sleep and fetch it on the next
-      # iteration of the loop.
-
-      if timeout is not None:
-        if wait_remain <= 0:
+    """Waits for the next alarm to become due, then removes and returns it.
+
+    Returns None if |timeout| seconds pass with no alarm due, or if Wakeup is
+    called while waiting.  With no timeout, waits indefinitely.
+    """
+    end = None
+    if timeout is not None:
+      end = time.time() + timeout
+
+    self._cond.acquire()
+    try:
+      while True:
+        if self._interrupted:
+          self._interrupted = False
           return None
-        wait_remain = max(0, timeout - (now - start))
-        sleep_amt = min(sleep_amt, wait_remain)
-
-      self._WakeEventWait(sleep_amt)
 
-  def _DoAddAlarm(self, alarm):
-    self._heap_lock.acquire()
-    heapq.heappush(self._alarm_heap, alarm)
-    self._alarms_by_name[alarm.name()] = alarm
-    self._wake_event.set()
-    self._heap_lock.release()
+        self._PopDeadEntries()
+        now = time.time()
+        sleep_amt = None
+        if self._alarm_heap:
+          fire_time, seq, alarm = self._alarm_heap[0]
+          if fire_time <= now:
+            heapq.heappop(self._alarm_heap)
+            del self._alarms_by_name[alarm.name()]
+            alarm._entry = None
+            return alarm
+          sleep_amt = fire_time - now
+
+        if end is not None:
+          if now >= end:
+            return None
+          if sleep_amt is None or (end - now) < sleep_amt:
+            sleep_amt = end - now
+
+        # Sleep until the earliest alarm is due; changes to the heap which
+        # affect the earliest alarm wake us early.
+        self._cond.wait(sleep_amt)
+    finally:
+      self._cond.release()
+
+  def Wakeup(self):
+    """Causes a pending (or the next) WaitForNextAlarm call to return None."""
+    self._cond.acquire()
+    try:
+      self._interrupted = True
+      self._cond.notifyAll()
+    finally:
+      self._cond.release()
 
   def AddAlarm(self, name, expires_at, fire_event):
-    """Add a new alarm that posts |fire_event| at |expires_at| time"""
+    """Add a new alarm that posts |fire_event| at |expires_at| time.
+
+    Any pending alarm with the same name is replaced.
+    """
     a = Alarm(name, fire_event, expires_at)
-    self._DoAddAlarm(a)
+    self._cond.acquire()
+    try:
+      existing = self._alarms_by_name.get(name)
+      self._alarms_by_name[name] = a
+      if existing:
+        self._KillEntry(existing)
+      self._PushEntry(a)
+    finally:
+      self._cond.release()
     return a
 
   def CancelAlarm(self, name):
-    self._heap_lock.acquire()
-    match = None
-    for alarm in self._alarm_heap:
-      if alarm.name() == name:
-        match = alarm
-        break
-    if match:
-      del self._alarms_by_name[name]
-      self._alarm_heap.remove(match)
-      self._SortAlarms()
-      self._wake_event.set()
-    self._heap_lock.release()
+    """Cancels the pending alarm |name|, if any."""
+    self._cond.acquire()
+    try:
+      alarm = self._alarms_by_name.pop(name, None)
+      if alarm:
+        self._KillEntry(alarm)
+    finally:
+      self._cond.release()
 
   def UpdateAlarm(self, name, new_expires_at):
     """Replace an alarm's expiry with new time"""
-    self._heap_lock.acquire()
-    if name not in self._alarms_by_name:
-      self._heap_lock.release()
-      return
-    alarm = self._alarms_by_name[name]
-    alarm.set_fire_time(new_expires_at)
-    self._SortAlarms()
-    self._heap_lock.release()
-
-  def _SortAlarms(self):
-    self._heap_lock.acquire()
-    heapq.heapify(self._alarm_heap)
-    self._wake_event.set()
-    self._heap_lock.release()
-
+    self._cond.acquire()
+    try:
+      alarm = self._alarms_by_name.get(name)
+      if not alarm:
+        return
+      self._KillEntry(alarm)
+      alarm.set_fire_time(new_expires_at)
+      self._PushEntry(alarm)
+    finally:
+      self._cond.release()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""Benchmark for alarm.AlarmManager.
+
+Keeps NUM_ALARMS alarms live while re-arming them continuously, as the core
+does for flow idle timers, and reports the update, cancel and fire rates.
+"""
+
+import random
+import time
+
+from pykeg.core import alarm
+
+NUM_ALARMS = 10000
+NUM_UPDATES = 200000
+
+def main():
+  am = alarm.AlarmManager()
+  now = time.time()
+  rand = random.Random(0)
+
+  start = time.time()
+  for i in xrange(NUM_ALARMS):
+    am.AddAlarm(i, now + 60 + rand.random() * 60, None)
+  elapsed = time.time() - start
+  print '       add: %10.0f alarms/sec' % (NUM_ALARMS / elapsed)
+
+  start = time.time()
+  for i in xrange(NUM_UPDATES):
+    am.UpdateAlarm(rand.randrange(NUM_ALARMS), now + 60 + rand.random() * 60)
+  elapsed = time.time() - start
+  print '    update: %10.0f updates/sec (%i alarms live, heap size %i)' % (
+      NUM_UPDATES / elapsed, am.GetAlarmCount(), len(am._alarm_heap))
+
+  start = time.time()
+  for i in xrange(0, NUM_ALARMS, 2):
+    am.CancelAlarm(i)
+  elapsed = time.time() - start
+  print '    cancel: %10.0f cancels/sec' % ((NUM_ALARMS / 2) / elapsed)
+
+  for i in xrange(1, NUM_ALARMS, 2):
+    am.UpdateAlarm(i, now - 1)
+  start = time.time()
+  fired = 0
+  while am.WaitForNextAlarm(0) is not None:
+    fired += 1
+  elapsed = time.time() - start
+  print '      fire: %10.0f alarms/sec (%i fired)' % (fired / elapsed, fired)
+
+if __name__ == '__main__':
+  main()
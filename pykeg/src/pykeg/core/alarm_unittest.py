@@ -27,8 +27,6 @@ class MainTestCase(unittest.TestCase):
     ret = self.am.WaitForNextAlarm(4.0)
     self.assertEqual(ret, a3)
 
-    print ret
-
   def testTimerEmptyList(self):
     """Verify an empty alarm manager waits appropriately."""
     start = time.time()
@@ -40,10 +38,46 @@ class MainTestCase(unittest.TestCase):
     a1 = self.am.AddAlarm("test1", now + 10.0, None)
     a2 = self.am.AddAlarm("test2", now + 20.0, None)
 
-    self.assertEqual(a1, self.am._alarm_heap[0])
+    self.assertEqual(a1, self.am.NextAlarm())
 
     self.am.UpdateAlarm("test2", now + 5.0)
-    self.assertEqual(a2, self.am._alarm_heap[0])
+    self.assertEqual(a2, self.am.NextAlarm())
+
+  def testAlarmCancel(self):
+    now = time.time()
+    a1 = self.am.AddAlarm("test1", now - 1.0, None)
+    a2 = self.am.AddAlarm("test2", now - 0.5, None)
+    self.am.CancelAlarm("test1")
+    self.assert_(self.am.NextAlarm() is a2)
+    self.assert_(self.am.WaitForNextAlarm(0) is a2)
+    self.assertEqual(self.am.WaitForNextAlarm(0), None)
+    self.assertEqual(self.am.GetAlarmCount(), 0)
+
+  def testAlarmReplace(self):
+    now = time.time()
+    self.am.AddAlarm("test1", now - 1.0, None)
+    a2 = self.am.AddAlarm("test1", now - 0.5, None)
+    self.assertEqual(self.am.GetAlarmCount(), 1)
+    self.assert_(self.am.WaitForNextAlarm(0) is a2)
+    self.assertEqual(self.am.WaitForNextAlarm(0), None)
+
+  def testManyUpdates(self):
+    """Repeated updates keep the heap compact and ordered."""
+    now = time.time()
+    for i in xrange(100):
+      self.am.AddAlarm(i, now + 100 + i, None)
+    for n in xrange(20):
+      for i in xrange(100):
+        self.am.UpdateAlarm(i, now - 100 + n - i)
+    self.assert_(len(self.am._alarm_heap) <= 100 * (1 + self.am.COMPACT_RATIO))
+    fired = [self.am.WaitForNextAlarm(0).name() for i in xrange(100)]
+    self.assertEqual(fired, range(99, -1, -1))
+
+  def testWakeup(self):
+    self.am.Wakeup()
+    start = time.time()
+    self.assertEqual(self.am.WaitForNextAlarm(5.0), None)
+    self.assert_(time.time() - start < 1.0)
 
 
 if __name__ == '__main__':
@@ -21,8 +21,13 @@
 import datetime
 import logging
 import socket
+import threading
+import time
 
+from django.db import transaction
+from django.db.models import F
 from django.db.utils import DatabaseError
+import gflags
 
 from pykeg.core import kb_common
 from pykeg.core import config
@@ -31,6 +36,28 @@ from pykeg.proto import protolib
 
 from pykeg.web.api import krest
 
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_float('web_backend_batch_window', 0.05,
+    'The web backend sends drinks and temperature readings made within this '
+    'many seconds of each other in one request to the batch API.  If 0, '
+    'each is sent in its own request.',
+    lower_bound=0)
+
+def _commit_on_success(f):
+  """Like transaction.commit_on_success, but joins any enclosing transaction.
+
+  Django's commit_on_success commits when it returns even if it is nested,
+  which would commit part of a batch (see web/api/views.py) early.
+  """
+  def new_f(*args, **kwargs):
+    if transaction.is_managed():
+      return f(*args, **kwargs)
+    return transaction.commit_on_success(f)(*args, **kwargs)
+  new_f.__name__ = f.__name__
+  new_f.__doc__ = f.__doc__
+  return new_f
+
 class BackendError(Exception):
   """Base backend error exception."""
 
@@ -66,6 +93,25 @@ class Backend:
     """Records a new drink with the given parameters."""
     raise NotImplementedError
 
+  def RecordDrinks(self, drinks):
+    """Records several drinks, each given as a dict of RecordDrink arguments.
+
+    Returns a list with, for each drink in turn, what RecordDrink returned or
+    the error it raised.  The list stops after the first drink which failed
+    with an error other than a BackendError, if the later drinks were not
+    attempted.
+    """
+    ret = []
+    for drink_args in drinks:
+      try:
+        ret.append(self.RecordDrink(**drink_args))
+      except BackendError, e:
+        ret.append(e)
+      except Exception, e:
+        ret.append(e)
+        break
+    return ret
+
   def CancelDrink(self, seqn, spilled=False):
     """Cancels the given drink.
 
@@ -83,6 +129,10 @@ class Backend:
     """Returns an AuthenticationToken instance."""
     raise NotImplementedError
 
+  def GetAllAuthTokens(self):
+    """Returns a list of AuthenticationToken instances for every token."""
+    raise NotImplementedError
+
 
 class KegbotBackend(Backend):
   """Django models backed Backend."""
@@ -94,9 +144,21 @@ class KegbotBackend(Backend):
     else:
       self._site = models.KegbotSite.objects.get(name=sitename)
 
+  def _LockSite(self):
+    """Locks the site's row until the end of the transaction.
+
+    Every drink updates the site's SystemStats row and takes the next drink and
+    event seqns, so concurrent pours are serialized anyway; taking this lock
+    first makes each one wait at the start for the pour ahead of it.  On
+    SQLite, the update takes the database's write lock instead.
+    """
+    models.KegbotSite.objects.filter(pk=self._site.pk).update(
+        is_active=F('is_active'))
+
   def _GetTapFromName(self, tap_name):
     try:
-      return models.KegTap.objects.get(site=self._site, meter_name=tap_name)
+      return models.KegTap.objects.select_related('current_keg').get(
+          site=self._site, meter_name=tap_name)
     except models.KegTap.DoesNotExist:
       return None
 
@@ -151,10 +213,18 @@ class KegbotBackend(Backend):
   def GetAllTaps(self):
     return protolib.ToProto(list(models.KegTap.objects.all()))
 
+  @_commit_on_success
   def RecordDrink(self, tap_name, ticks, volume_ml=None, username=None,
       pour_time=None, duration=0, auth_token=None, spilled=False,
       do_postprocess=True):
+    """Records a drink along with its session, stats and events.
 
+    Everything is written in one transaction, in a fixed order: the site (see
+    _LockSite), the session and its chunks, the drink, the system, user, keg
+    and session stats, and last the events.  The number of queries does not
+    depend on how many drinks have been recorded before.
+    """
+    self._LockSite()
     tap = self._GetTapFromName(tap_name)
     if not tap:
       raise BackendError, "Tap unknown"
@@ -191,49 +261,39 @@ class KegbotBackend(Backend):
 
     return protolib.ToProto(d)
 
+  @_commit_on_success
   def CancelDrink(self, seqn, spilled=False):
+    """Cancels a drink, taking it out of its session, stats and events.
+
+    Each of these is adjusted in place rather than rebuilt, so the number of
+    queries does not depend on how many drinks have been recorded.  Rows are
+    written in the same order as RecordDrink writes them.
+    """
+    self._LockSite()
     try:
-      d = self._site.drinks.get(seqn=seqn)
+      d = self._site.drinks.select_related('user', 'keg', 'session').get(
+          seqn=seqn)
     except models.Drink.DoesNotExist:
       return
 
-    keg = d.keg
-    user = d.user
-    session = d.session
+    # A drink which is not valid has already been taken out of everything.
+    if d.status != 'valid':
+      return protolib.ToProto(d)
 
     # Transfer volume to spillage if requested.
     if spilled and d.volume_ml and d.keg:
       d.keg.spilled_ml += d.volume_ml
       d.keg.save()
 
+    if d.session:
+      d.session.RemoveDrink(d)
     d.status = 'deleted'
-    d.save()
-
-    # Invalidate all statistics.
-    models.SystemStats.objects.filter(site=self._site).delete()
-    models.KegStats.objects.filter(site=self._site, keg=d.keg).delete()
-    models.UserStats.objects.filter(site=self._site, user=d.user).delete()
-    models.SessionStats.objects.filter(site=self._site, session=d.session).delete()
+    d.save(force_update=True)
+    d._RemoveFromStats()
 
     # Delete any SystemEvents for this drink.
     models.SystemEvent.objects.filter(site=self._site, drink=d).delete()
 
-    # Regenerate new statistics, based on the most recent drink
-    # post-cancellation.
-    last_qs = self._site.drinks.valid().order_by('-seqn')
-    if last_qs:
-      last_drink = last_qs[0]
-      last_drink._UpdateSystemStats()
-
-    if keg:
-      keg.RecomputeStats()
-    if user and user.get_profile():
-      user.get_profile().RecomputeStats()
-    if session:
-      session.Rebuild()
-      session.RecomputeStats()
-
-    # TODO(mikey): recompute session.
     return protolib.ToProto(d)
 
   def LogSensorReading(self, sensor_name, temperature, when=None):
@@ -278,11 +338,112 @@ class KegbotBackend(Backend):
       raise NoTokenError
     return protolib.ToProto(tok)
 
+  def GetAllAuthTokens(self):
+    tokens = models.AuthenticationToken.objects.filter(site=self._site)
+    return [protolib.ToProto(t) for t in tokens.select_related('user')]
+
+
+class _PendingOp:
+  def __init__(self, op, wait):
+    self.op = op
+    self.wait = wait
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+
+class _WriteBatcher:
+  """Sends operations made within a short window in one batch request.
+
+  Operations are queued, and sent by a thread of the batcher once |window|
+  seconds have passed since the first one was queued.  Post does not wait for
+  the result of an operation, and only logs its errors.  Call waits for it;
+  a Call is sent at once, with whatever was posted before it, rather than
+  wait out the window.
+  """
+  def __init__(self, client, window):
+    self._client = client
+    self._window = window
+    self._cond = threading.Condition()
+    self._pending = []
+    self._thread = None
+    self._logger = logging.getLogger('api-backend')
+
+  def Call(self, op):
+    """Returns the result of |op|, or raises its error."""
+    pending = self._Queue(op, True)
+    pending.done.wait()
+    if pending.error is not None:
+      raise pending.error
+    return pending.result
+
+  def Post(self, op):
+    self._Queue(op, False)
+
+  def _Queue(self, op, wait):
+    pending = _PendingOp(op, wait)
+    self._cond.acquire()
+    try:
+      self._pending.append(pending)
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._Run,
+            name='api-batch-thread')
+        self._thread.setDaemon(True)
+        self._thread.start()
+      self._cond.notify()
+    finally:
+      self._cond.release()
+    return pending
+
+  def _HasWaiter(self):
+    for pending in self._pending:
+      if pending.wait:
+        return True
+    return False
+
+  def _Run(self):
+    while True:
+      self._cond.acquire()
+      try:
+        while not self._pending:
+          self._cond.wait()
+        deadline = time.time() + self._window
+        while not self._HasWaiter():
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            break
+          self._cond.wait(remaining)
+        batch = self._pending[:krest.MAX_BATCH_OPS]
+        del self._pending[:krest.MAX_BATCH_OPS]
+      finally:
+        self._cond.release()
+      self._Send(batch)
+
+  def _Send(self, batch):
+    try:
+      results = self._client.Batch([pending.op for pending in batch])
+    except Exception, e:
+      results = [e] * len(batch)
+    for pending, result in zip(batch, results):
+      if isinstance(result, Exception):
+        pending.error = result
+        if not pending.wait:
+          self._logger.warning('Error from %s: %s; dropping it.' % (
+              pending.op[0], result))
+      else:
+        pending.result = result
+      pending.done.set()
+
 
 class WebBackend(Backend):
-  def __init__(self, api_url=None, api_key=None):
+  def __init__(self, api_url=None, api_key=None, batch_window=None):
     self._logger = logging.getLogger('api-backend')
     self._client = krest.KrestClient(api_url=api_url, api_key=api_key)
+    if batch_window is None:
+      batch_window = FLAGS.web_backend_batch_window
+    self._batcher = None
+    if batch_window:
+      self._batcher = _WriteBatcher(self._client, batch_window)
 
   def CreateNewUser(self, username, gender=kb_common.DEFAULT_NEW_USER_GENDER,
       weight=kb_common.DEFAULT_NEW_USER_WEIGHT):
@@ -297,11 +458,54 @@ class WebBackend(Backend):
 
   def RecordDrink(self, tap_name, ticks, volume_ml=None, username=None,
       pour_time=None, duration=0, auth_token=None, spilled=False):
-    return self._client.RecordDrink(tap_name=tap_name, ticks=ticks,
-        volume_ml=volume_ml, username=username, pour_time=pour_time,
-        duration=duration, auth_token=auth_token, spilled=spilled)
+    args = {
+      'tap_name': tap_name,
+      'ticks': ticks,
+      'volume_ml': volume_ml,
+      'username': username,
+      'pour_time': pour_time,
+      'duration': duration,
+      'auth_token': auth_token,
+      'spilled': spilled,
+    }
+    try:
+      if self._batcher:
+        return self._batcher.Call(self._client.RecordDrinkOp(**args))
+      return self._client.RecordDrink(**args)
+    except (krest.NotFoundError, krest.BadRequestError), e:
+      # The server understood the request and refused it; retrying is futile.
+      raise BackendError(e)
+
+  def RecordDrinks(self, drinks):
+    if not self._batcher:
+      return Backend.RecordDrinks(self, drinks)
+    # One batch request for the lot, rather than a round trip per drink.  The
+    # server stops at the first drink which fails, so that none is recorded
+    # ahead of an earlier one; the rest are sent again after a rejection.
+    ret = []
+    while len(ret) < len(drinks):
+      start = len(ret)
+      ops = [self._client.RecordDrinkOp(**drink_args)
+          for drink_args in drinks[start:start + krest.MAX_BATCH_OPS]]
+      try:
+        results = self._client.Batch(ops, stop_on_error=True)
+      except Exception, e:
+        ret.append(e)
+        break
+      if not results:
+        break
+      for result in results:
+        if isinstance(result, (krest.NotFoundError, krest.BadRequestError)):
+          result = BackendError(result)
+        ret.append(result)
+      if isinstance(result, Exception) and not isinstance(result,
+          BackendError):
+        break
+    return ret
 
   def CancelDrink(self, seqn, spilled=False):
+    if self._batcher:
+      return self._batcher.Call(self._client.CancelDrinkOp(seqn, spilled))
     return self._client.CancelDrink(seqn, spilled)
 
   def LogSensorReading(self, sensor_name, temperature, when=None):
@@ -311,6 +515,12 @@ class WebBackend(Backend):
     if temperature < min_val or temperature > max_val:
       raise ValueError, 'Temperature out of bounds'
 
+    if self._batcher:
+      # Nothing needs the new record; let readings from several sensors
+      # share a request.
+      self._batcher.Post(self._client.LogSensorReadingOp(sensor_name,
+          temperature, when))
+      return None
     try:
       return self._client.LogSensorReading(sensor_name, temperature, when)
     except krest.NotFoundError:
@@ -328,6 +538,7 @@ class WebBackend(Backend):
       return self._client.GetToken(auth_device, token_value)
     except krest.NotFoundError:
       raise NoTokenError
-    except socket.error:
-      self._logger.warning('Socket error fetching token; ignoring.')
-      raise NoTokenError
+    except (krest.ServerError, socket.error), e:
+      # Not the same as an unknown token: callers may fall back to what they
+      # last knew of it.
+      raise BackendError(e)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""Unittest for backend module"""
+
+import datetime
+import socket
+import time
+import unittest
+
+from django import test
+
+from pykeg.beerdb import models as bdb_models
+from pykeg.core import backend
+from pykeg.core import models
+from pykeg.core import stats
+from pykeg.web.api import krest
+from pykeg.web.api import krest_unittest
+
+
+class _FakeClient:
+  """Answers each batched op with its args, or fails ops named 'bad'."""
+  def __init__(self):
+    self.batches = []
+    self.down = False
+
+  def Batch(self, ops):
+    self.batches.append([op[0] for op in ops])
+    if self.down:
+      raise socket.error('down')
+    ret = []
+    for name, args, out_msg in ops:
+      if name == 'bad':
+        ret.append(krest.NotFoundError())
+      else:
+        ret.append(args)
+    return ret
+
+
+class WriteBatcherTestCase(unittest.TestCase):
+  def setUp(self):
+    self.client = _FakeClient()
+    self.batcher = backend._WriteBatcher(self.client, 0.05)
+
+  def testCoalescing(self):
+    self.batcher.Post(('thermo', 1, None))
+    self.batcher.Post(('bad', 2, None))
+    self.assertEqual(self.batcher.Call(('drink', 3, None)), 3)
+    self.assertEqual(self.client.batches, [['thermo', 'bad', 'drink']])
+
+  def testErrors(self):
+    self.assertRaises(krest.NotFoundError, self.batcher.Call,
+        ('bad', 1, None))
+    self.client.down = True
+    self.assertRaises(socket.error, self.batcher.Call, ('drink', 1, None))
+
+  def testCallNotDelayed(self):
+    batcher = backend._WriteBatcher(self.client, 10.0)
+    batcher.Post(('thermo', 1, None))
+    start = time.time()
+    self.assertEqual(batcher.Call(('drink', 2, None)), 2)
+    self.assert_(time.time() - start < 5.0)
+    self.assertEqual(self.client.batches, [['thermo', 'drink']])
+
+
+class WebBackendTestCase(unittest.TestCase):
+  def setUp(self):
+    self.server = krest_unittest.StubServer()
+    self.backend = backend.WebBackend(api_url=self.server.GetURL(),
+        api_key='key', batch_window=10.0)
+
+  def tearDown(self):
+    self.backend._client._pool.Close()
+    self.server.Stop()
+
+  def testGetAuthTokenErrors(self):
+    self.assertRaises(backend.NoTokenError, self.backend.GetAuthToken,
+        'rfid', 'missing')
+    # A server which cannot say is not the same as an unassigned token.
+    try:
+      self.backend.GetAuthToken('rfid', 'broken')
+      self.fail('No error raised')
+    except backend.BackendError, e:
+      self.assertFalse(isinstance(e, backend.NoTokenError))
+
+  def testRecordDrinks(self):
+    drinks = [{'tap_name': tap_name, 'ticks': 100}
+        for tap_name in ('flow0', 'missing', 'flow1')]
+    results = self.backend.RecordDrinks(drinks)
+    self.assertEqual(len(results), 3)
+    self.assertEqual(results[0].ticks, 100)
+    self.assert_(isinstance(results[1], backend.BackendError))
+    self.assertEqual(results[2].ticks, 100)
+    # The server stopped at the rejected drink; the rest were sent again.
+    self.assertEqual(len(self.server.batches), 2)
+    self.assertEqual(len(self.server.batches[1]), 1)
+
+  def testRecordDrinksStopsAtFailure(self):
+    drinks = [{'tap_name': tap_name, 'ticks': 100}
+        for tap_name in ('flow0', 'broken', 'flow1')]
+    results = self.backend.RecordDrinks(drinks)
+    self.assertEqual(len(self.server.batches), 1)
+    self.assertEqual(len(results), 2)
+    self.assertFalse(isinstance(results[1], backend.BackendError))
+    self.assert_(isinstance(results[1], krest.ServerError))
+
+
+def CreateTestSite(name, tap_names):
+  """Creates a site with a user 'alice' and taps sharing one online keg."""
+  site = models.KegbotSite.objects.create(name=name)
+  brewer = bdb_models.Brewer.objects.create(name='Brewer',
+      production='retail')
+  style = bdb_models.BeerStyle.objects.create(name='Porter')
+  beer_type = bdb_models.BeerType.objects.create(name='Porter',
+      brewer=brewer, style=style, abv=5.0)
+  size = models.KegSize.objects.create(name='Keg', volume_ml=58000.0)
+  keg = models.Keg.objects.create(site=site, type=beer_type, size=size,
+      status='online', startdate=datetime.datetime(2011, 1, 1))
+  for tap_name in tap_names:
+    models.KegTap.objects.create(site=site, name=tap_name,
+        meter_name=tap_name, current_keg=keg)
+  models.User.objects.get_or_create(username='alice')
+  return site, keg
+
+
+class RecordDrinkTestCase(test.TestCase):
+  # Taking the site lock, then reading the tap, user and session; updating the
+  # session and its three chunks; inserting the drink; updating four stats
+  # rows; and finding and inserting events.
+  QUERIES_PER_DRINK = 24
+  # Taking the site lock and reading the drink; recomputing the session and
+  # its three chunks; updating the drink and four stats rows; and finding and
+  # deleting events.
+  QUERIES_PER_CANCEL = 21
+
+  def setUp(self):
+    self.site, self.keg = CreateTestSite('record_drink_test', ['flow0'])
+    self.backend = backend.KegbotBackend(site=self.site)
+    self.pour_time = datetime.datetime(2011, 1, 1, 18, 0)
+
+  def _Pour(self, username='alice', volume_ml=10.0):
+    self.pour_time += datetime.timedelta(minutes=1)
+    return self.backend.RecordDrink('flow0', 100, volume_ml=volume_ml,
+        username=username, pour_time=self.pour_time)
+
+
+  def testQueryCount(self):
+    self._Pour()
+    self._Pour(username=None)
+    self.assertNumQueries(self.QUERIES_PER_DRINK, self._Pour)
+    for i in xrange(20):
+      self._Pour()
+    self.assertNumQueries(self.QUERIES_PER_DRINK, self._Pour)
+
+    session = models.DrinkingSession.objects.get(site=self.site)
+    self.assertEqual(session.volume_ml, 240.0)
+    self.assertEqual(session.name, 'Session 1')
+    chunk = session.user_chunks.get(user__username='alice')
+    self.assertEqual(chunk.volume_ml, 230.0)
+    self.assertEqual(chunk.endtime, self.pour_time)
+    stats = self.keg.stats.get().stats
+    self.assertEqual(stats['total_pours'], 24)
+    self.assertEqual(stats['last_drink_id'], '24')
+
+    kinds = self.site.events.order_by('seqn').values_list('kind', flat=True)
+    self.assertEqual(list(kinds[:5]), ['keg_tapped', 'session_started',
+        'session_joined', 'drink_poured', 'drink_poured'])
+    self.assertEqual(len(kinds), 27)
+
+  def testCancelDrink(self):
+    self._Pour(volume_ml=10.0)
+    guest_drink = self._Pour(username=None, volume_ml=30.0)
+    drink = self._Pour(volume_ml=5.0)
+    self.assertNumQueries(self.QUERIES_PER_CANCEL, self.backend.CancelDrink,
+        int(drink.id))
+    for i in xrange(20):
+      drink = self._Pour()
+    self.assertNumQueries(self.QUERIES_PER_CANCEL, self.backend.CancelDrink,
+        int(drink.id) - 1)
+    # The greatest drink is found again, and the guest's chunks deleted.
+    self.backend.CancelDrink(int(guest_drink.id))
+    # Cancelling again changes nothing.
+    self.backend.CancelDrink(int(guest_drink.id))
+
+    session = models.DrinkingSession.objects.get(site=self.site)
+    self.assertEqual(session.volume_ml, 200.0)
+    self.assertEqual(session.user_chunks.count(), 1)
+    self.assertEqual(session.chunks.get().volume_ml, 200.0)
+    self.assertEqual(self.site.events.filter(kind='drink_poured').count(), 20)
+
+    # The stats are the same as if they were built from the remaining drinks.
+    last_drink = models.Drink.objects.get(site=self.site, seqn=int(drink.id))
+    rows = (
+      (stats.SystemStatsBuilder, self.site.systemstats_set.get()),
+      (stats.DrinkerStatsBuilder, last_drink.user.stats.get()),
+      (stats.KegStatsBuilder, self.keg.stats.get()),
+      (stats.SessionStatsBuilder, session.stats.get()),
+    )
+    for builder, row in rows:
+      self.assertEqual(row.stats, builder(last_drink).Build())
+    self.assertEqual(self.keg.stats.get().stats['greatest_volume_ml'], 10.0)
+
+  def testSpilled(self):
+    self.assertEqual(self.backend.RecordDrink('flow0', 100, volume_ml=10.0,
+        spilled=True), None)
+    self.assertEqual(models.Keg.objects.get(pk=self.keg.pk).spilled_ml, 10.0)
+    self.assertEqual(self.site.drinks.count(), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
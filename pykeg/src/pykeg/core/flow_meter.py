@@ -18,18 +18,100 @@
 
 """Utility module for summing flows."""
 
+import array
 import datetime
 import logging
 
+from pykeg.core import kb_common
+from pykeg.core import util
+
+# Number of readings kept by a FlowRateRing.  This should comfortably exceed
+# the number of readings a meter reports in FLOW_RATE_WINDOW_SECS; if it does
+# not, rates are measured over the readings kept.
+RATE_RING_SIZE = 64
+
+
+class FlowRateRing(object):
+  """Fixed-size ring buffer of (time, delta ticks) readings of a meter.
+
+  Gives the rate over the last |window_secs| seconds, and the rate of the last
+  reading, in ticks per second.  The sum of the deltas in the window is kept
+  as readings come and go, so both take constant time, and the memory used
+  does not grow however long a flow runs.  Times are in seconds, from
+  util.MonotonicTime.
+  """
+  def __init__(self, window_secs=kb_common.FLOW_RATE_WINDOW_SECS,
+      size=RATE_RING_SIZE):
+    self._window_secs = float(window_secs)
+    self._size = size
+    self._times = array.array('d', [0.0]) * size
+    self._deltas = array.array('l', [0]) * size
+    self._head = 0  # where the next reading goes
+    self._count = 0  # readings in the window
+    self._window_sum = 0
+    self._overflow_time = None  # time of the newest reading pushed out early
+    self._last_time = None
+    self._last_interval = None
+
+  def Add(self, delta, now):
+    """Records a reading which added |delta| ticks at time |now|."""
+    self._Expire(now)
+    if self._count == self._size:
+      tail = (self._head - self._count) % self._size
+      self._window_sum -= self._deltas[tail]
+      self._overflow_time = self._times[tail]
+      self._count -= 1
+    self._times[self._head] = now
+    self._deltas[self._head] = delta
+    self._head = (self._head + 1) % self._size
+    self._count += 1
+    self._window_sum += delta
+    if self._last_time is not None:
+      self._last_interval = now - self._last_time
+    self._last_time = now
+
+  def _Expire(self, now):
+    cutoff = now - self._window_secs
+    while self._count:
+      tail = (self._head - self._count) % self._size
+      if self._times[tail] > cutoff:
+        break
+      self._window_sum -= self._deltas[tail]
+      self._count -= 1
+
+  def GetRate(self, now):
+    """Returns the ticks per second over the window ending at |now|."""
+    self._Expire(now)
+    span = self._window_secs
+    if self._overflow_time is not None and \
+        self._overflow_time > now - self._window_secs:
+      span = now - self._overflow_time
+    if not self._count or span <= 0:
+      return 0.0
+    return self._window_sum / span
+
+  def GetInstantRate(self, now):
+    """Returns the ticks per second of the last reading, or 0 if there has not
+    been one within the window."""
+    if not self._last_interval:
+      return 0.0
+    if now - self._last_time > self._window_secs:
+      return 0.0
+    tail = (self._head - 1) % self._size
+    return self._deltas[tail] / self._last_interval
+
+
 class FlowMeter(object):
   """Represents a path of fluid volume."""
-  def __init__(self, name, max_delta=0, start_ticks=None):
+  def __init__(self, name, max_delta=0, start_ticks=None, clock=None):
     self._name = name
     self._max_delta = max_delta
     self._last_ticks = start_ticks
     self._total_ticks = 0
     self._last_activity = datetime.datetime.fromtimestamp(0)
     self._logger = logging.getLogger('flowmeter-%s' % self._name)
+    self._clock = clock or util.MonotonicTime
+    self._rates = FlowRateRing()
 
   def __str__(self):
     return "<FlowMeter %s ticks=%i>" % (self._name, self.GetTicks())
@@ -85,6 +167,8 @@ class FlowMeter(object):
       # some other means..?
       return 0
 
+    self._rates.Add(delta, self._clock())
+
     # If there was actually a change, increment total ticks and update activity
     # time.
     if delta > 0:
@@ -95,6 +179,14 @@ class FlowMeter(object):
     # No activity
     return 0
 
+  def RestoreReading(self, ticks):
+    """Sets the last reported reading, as if SetTicks had been called earlier.
+
+    Used when recovering meter state, so that ticks reported after the
+    recovery are counted against the old reading.
+    """
+    self._last_ticks = long(ticks)
+
   def _SetActivity(self, when=None):
     """Internal method to update the last activity timestamp."""
     if not when:
@@ -114,6 +206,14 @@ class FlowMeter(object):
   def GetLastActivity(self):
     return self._last_activity
 
+  def GetRate(self):
+    """Returns the ticks per second over the last FLOW_RATE_WINDOW_SECS."""
+    return self._rates.GetRate(self._clock())
+
+  def GetInstantRate(self):
+    """Returns the ticks per second of the last reading."""
+    return self._rates.GetInstantRate(self._clock())
+
   def GetIdleTime(self, now=None):
     if not now:
       now = datetime.datetime.now()
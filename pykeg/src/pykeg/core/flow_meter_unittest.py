@@ -139,6 +139,52 @@ class FlowMeterTestCase(unittest.TestCase):
     idle_time = self.meter.GetIdleTime(now=d(1080))
     self.assertEqual(idle_time, datetime.timedelta(seconds=65))
 
+  def testRates(self):
+    clock = [100.0]
+    meter = flow_meter.FlowMeter('test_meter', max_delta=MAX_DELTA,
+        clock=lambda: clock[0])
+    self.assertEqual(meter.GetRate(), 0)
+    meter.SetTicks(1000)
+    for i in xrange(1, 11):
+      clock[0] += 0.5
+      meter.SetTicks(1000 + i * 50)
+    self.assertAlmostEqual(meter.GetRate(), 100.0)
+    self.assertAlmostEqual(meter.GetInstantRate(), 100.0)
+
+    clock[0] += 0.5
+    meter.SetTicks(1700)
+    self.assertAlmostEqual(meter.GetInstantRate(), 400.0)
+
+    # Dropped readings are not counted.
+    clock[0] += 0.5
+    meter.SetTicks(1700 + MAX_DELTA + 1)
+    self.assertAlmostEqual(meter.GetInstantRate(), 400.0)
+
+    clock[0] += 10
+    self.assertEqual(meter.GetRate(), 0)
+    self.assertEqual(meter.GetInstantRate(), 0)
+
+
+class FlowRateRingTestCase(unittest.TestCase):
+  def testWindow(self):
+    ring = flow_meter.FlowRateRing(window_secs=2.0, size=64)
+    for i in xrange(100):
+      ring.Add(10, i * 0.1)
+    # Readings in (7.9, 9.9]: 20 of them.
+    self.assertAlmostEqual(ring.GetRate(9.9), 100.0)
+    self.assertAlmostEqual(ring.GetRate(10.9), 50.0)
+    self.assertEqual(ring.GetRate(12.0), 0)
+    ring.Add(5, 13.0)
+    self.assertAlmostEqual(ring.GetRate(13.0), 2.5)
+    self.assertAlmostEqual(ring.GetInstantRate(13.0), 5 / 3.1)
+
+  def testOverflow(self):
+    ring = flow_meter.FlowRateRing(window_secs=2.0, size=8)
+    for i in xrange(20):
+      ring.Add(1, i * 0.1)
+    # Only the last 8 readings are kept; the rate is over the time they span.
+    self.assertAlmostEqual(ring.GetRate(1.9), 10.0)
+
 
 if __name__ == '__main__':
   unittest.main()
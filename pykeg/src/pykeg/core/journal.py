@@ -0,0 +1,374 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Append-only journal of core events, used to recover from crashes.
+
+The journal records the events needed to rebuild the core's in-flight state:
+meter readings, flow updates, token events and drink creations.  Events are
+appended to an in-memory list by the core's event thread, and written out in
+batches (with a single fsync per batch) by a separate writer thread.
+
+On disk, the journal is a directory of numbered segment files.  Each segment
+begins with a snapshot of the journal state at the time it was created,
+followed by the events committed to it.  When a segment grows past
+--journal_segment_size, a new segment is started and the older ones are
+deleted.  Each record is a (length, crc32) header followed by a pickled
+(type code, field values) tuple.  Within each batch, events which are
+overwritten by later ones (such as older readings of the same meter) are
+dropped before being written.
+
+Note that the journal trails the core by up to --journal_commit_interval
+seconds: events in the last, uncommitted batch are lost on a crash.  The
+DrinkManager therefore commits each drink's DrinkCreatedEvent itself, before
+the drink leaves the outbox, and the journal remembers the flows of the most
+recent drinks so that recovery neither publishes them again nor sends their
+outbox entries twice.
+"""
+
+import cPickle
+import logging
+import os
+import struct
+import threading
+import zlib
+
+import gflags
+
+from pykeg.core import kb_common
+from pykeg.core import kbevent
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string('journal_dir', '',
+    'Directory in which the core keeps its event journal, used to recover '
+    'active flows after a crash. If empty, the journal is disabled.')
+
+gflags.DEFINE_float('journal_commit_interval', 0.2,
+    'Maximum time, in seconds, that journaled events are buffered before '
+    'being written and synced to disk.')
+
+gflags.DEFINE_integer('journal_segment_size', 1024*1024,
+    'Size, in bytes, after which the journal starts a new segment.')
+
+SEGMENT_MAGIC = 'KBJ1'
+SEGMENT_PREFIX = 'journal.'
+
+RECORD_HEADER = struct.Struct('<II')
+
+# Record type codes.  These are stored on disk and must never be reused.
+RECORD_SNAPSHOT = 0
+EVENT_TYPE_CODES = {
+  kbevent.MeterUpdate: 1,
+  kbevent.FlowUpdate: 2,
+  kbevent.TokenAuthEvent: 3,
+  kbevent.DrinkCreatedEvent: 4,
+  kbevent.FlowDiscardedEvent: 5,
+}
+CODE_TO_EVENT_TYPE = dict((v, k) for k, v in EVENT_TYPE_CODES.iteritems())
+
+# Number of recorded flows remembered by a JournalState.  Flows are only in
+# doubt between the DrinkManager committing their drink and removing them from
+# the outbox, so this need only cover a few outbox batches.
+MAX_RECORDED_FLOWS = 256
+
+# Fields added since the record layout was fixed which are not needed for
+# recovery.  They are not journaled, so existing journals stay readable.
+UNJOURNALED_FIELDS = {
+  kbevent.FlowUpdate: ('instant_rate_ml_per_sec', 'rate_ml_per_sec'),
+  kbevent.MeterUpdate: ('event_time',),
+}
+
+# Field values are stored positionally, in this order.
+EVENT_FIELDS = dict((cls, tuple(sorted(f for f in cls.class_fields.keys()
+    if f not in UNJOURNALED_FIELDS.get(cls, ())))) for cls in EVENT_TYPE_CODES)
+
+
+class JournalError(Exception):
+  """Raised on unrecoverable journal errors."""
+
+
+def EncodeEvent(event):
+  """Returns the (code, values) tuple for a journaled event."""
+  cls = event.__class__
+  values = tuple(getattr(event, f) for f in EVENT_FIELDS[cls])
+  return (EVENT_TYPE_CODES[cls], values)
+
+def DecodeEvent(code, values):
+  """Builds an event from a (code, values) tuple."""
+  cls = CODE_TO_EVENT_TYPE[code]
+  return cls(dict(zip(EVENT_FIELDS[cls], values)))
+
+def EncodeRecord(code, values):
+  payload = cPickle.dumps((code, values), cPickle.HIGHEST_PROTOCOL)
+  crc = zlib.crc32(payload) & 0xffffffff
+  return RECORD_HEADER.pack(len(payload), crc) + payload
+
+
+def DropSupersededEvents(events):
+  """Removes events whose effect on a JournalState is overwritten later.
+
+  A MeterUpdate is superseded by any later MeterUpdate for the same tap, and
+  a FlowUpdate other than COMPLETED by any later FlowUpdate for the same tap.
+  Applying the result to a JournalState gives the same state as applying all
+  of |events|.
+  """
+  ret = []
+  seen_meters = set()
+  seen_flows = set()
+  for event in reversed(events):
+    if isinstance(event, kbevent.MeterUpdate):
+      if event.tap_name in seen_meters:
+        continue
+      seen_meters.add(event.tap_name)
+    elif isinstance(event, kbevent.FlowUpdate):
+      if (event.tap_name in seen_flows and
+          event.state != event.FlowState.COMPLETED):
+        continue
+      seen_flows.add(event.tap_name)
+    ret.append(event)
+  ret.reverse()
+  return ret
+
+
+class JournalState(object):
+  """The in-flight core state, as reconstructed from journaled events.
+
+  Attributes:
+    meter_readings: maps tap name to its last meter reading
+    tokens: maps tap name to the TokenAuthEvent of its attached token
+    active_flows: maps tap name to the last FlowUpdate of its active flow
+    completed_flows: maps flow id to the final FlowUpdate of each completed
+        flow for which no drink has been created yet, and which has not been
+        discarded
+    recorded_flows: ids of the flows of the last MAX_RECORDED_FLOWS drinks
+        created, oldest first
+  """
+  def __init__(self):
+    self.meter_readings = {}
+    self.tokens = {}
+    self.active_flows = {}
+    self.completed_flows = {}
+    self.recorded_flows = []
+
+  def Apply(self, event):
+    if isinstance(event, kbevent.MeterUpdate):
+      self.meter_readings[event.tap_name] = event.reading
+    elif isinstance(event, kbevent.TokenAuthEvent):
+      if event.status == event.TokenState.ADDED:
+        self.tokens[event.tap_name] = event
+      else:
+        self.tokens.pop(event.tap_name, None)
+    elif isinstance(event, kbevent.FlowUpdate):
+      if event.state == event.FlowState.COMPLETED:
+        self.active_flows.pop(event.tap_name, None)
+        # The drink may be journaled before the flow it came from.
+        if (event.volume_ml > kb_common.MIN_VOLUME_TO_RECORD and
+            event.flow_id not in self.recorded_flows):
+          self.completed_flows[event.flow_id] = event
+      else:
+        self.active_flows[event.tap_name] = event
+    elif isinstance(event, kbevent.DrinkCreatedEvent):
+      self.completed_flows.pop(event.flow_id, None)
+      if event.flow_id not in self.recorded_flows:
+        self.recorded_flows.append(event.flow_id)
+        del self.recorded_flows[:-MAX_RECORDED_FLOWS]
+    elif isinstance(event, kbevent.FlowDiscardedEvent):
+      self.completed_flows.pop(event.flow_id, None)
+
+  def AsEvents(self):
+    """Returns a list of events which rebuild this state when applied."""
+    ret = []
+    for tap_name, reading in self.meter_readings.iteritems():
+      ret.append(kbevent.MeterUpdate(tap_name=tap_name, reading=reading))
+    ret.extend(self.tokens.values())
+    ret.extend(self.active_flows.values())
+    ret.extend(self.completed_flows.values())
+    for flow_id in self.recorded_flows:
+      ret.append(kbevent.DrinkCreatedEvent(flow_id=flow_id))
+    return ret
+
+
+class EventJournal(object):
+  """A segmented, append-only journal of core events."""
+
+  def __init__(self, path, segment_size=None):
+    if segment_size is None:
+      segment_size = FLAGS.journal_segment_size
+    self._path = path
+    self._segment_size = segment_size
+    self._logger = logging.getLogger('journal')
+    self._lock = threading.Lock()
+    # Held while writing, since the DrinkManager commits from its own thread.
+    self._commit_lock = threading.Lock()
+    self._pending = []
+    self._state = JournalState()
+    self._fd = None
+    self._segment_num = None
+    self._segment_bytes = 0
+    self._num_commits = 0
+    self._num_events = 0
+
+  def GetStatus(self):
+    ret = []
+    ret.append('Segment: %s (%i bytes)' % (self._segment_num,
+        self._segment_bytes))
+    ret.append('Events committed: %i in %i batches' % (self._num_events,
+        self._num_commits))
+    ret.append('Active flows: %i, unrecorded flows: %i' % (
+        len(self._state.active_flows), len(self._state.completed_flows)))
+    return ret
+
+  def _SegmentPath(self, num):
+    return os.path.join(self._path, '%s%08i' % (SEGMENT_PREFIX, num))
+
+  def _ListSegments(self):
+    if not os.path.isdir(self._path):
+      return []
+    ret = []
+    for name in os.listdir(self._path):
+      if not name.startswith(SEGMENT_PREFIX):
+        continue
+      try:
+        ret.append(int(name[len(SEGMENT_PREFIX):]))
+      except ValueError:
+        continue
+    ret.sort()
+    return ret
+
+  def _ReadSegment(self, num):
+    """Yields (code, values) tuples for all intact records in a segment."""
+    fd = open(self._SegmentPath(num), 'rb')
+    try:
+      if fd.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+        self._logger.warning('Segment %i has a bad header, skipping.' % num)
+        return
+      while True:
+        header = fd.read(RECORD_HEADER.size)
+        if not header:
+          return
+        if len(header) < RECORD_HEADER.size:
+          self._logger.warning('Segment %i is truncated.' % num)
+          return
+        length, crc = RECORD_HEADER.unpack(header)
+        payload = fd.read(length)
+        if len(payload) < length or (zlib.crc32(payload) & 0xffffffff) != crc:
+          self._logger.warning('Segment %i has a corrupt record; ignoring '
+              'the rest of it.' % num)
+          return
+        yield cPickle.loads(payload)
+    finally:
+      fd.close()
+
+  def Replay(self):
+    """Reads all segments on disk and returns the resulting JournalState."""
+    state = JournalState()
+    num_events = 0
+    for num in self._ListSegments():
+      for code, values in self._ReadSegment(num):
+        if code == RECORD_SNAPSHOT:
+          state = JournalState()
+          for snap_code, snap_values in values:
+            state.Apply(DecodeEvent(snap_code, snap_values))
+        else:
+          state.Apply(DecodeEvent(code, values))
+          num_events += 1
+    self._logger.info('Replayed %i journaled event(s): %i active flow(s), '
+        '%i unrecorded flow(s).' % (num_events, len(state.active_flows),
+        len(state.completed_flows)))
+    return state
+
+  def Open(self, state=None):
+    """Starts a new segment, checkpointed with |state|.
+
+    Any existing segments are deleted once the new one is on disk, so callers
+    wanting to recover from them must call Replay first.
+    """
+    if not os.path.isdir(self._path):
+      os.makedirs(self._path)
+    if state is not None:
+      self._state = state
+    old_segments = self._ListSegments()
+    next_num = 0
+    if old_segments:
+      next_num = old_segments[-1] + 1
+    self._StartSegment(next_num)
+    for num in old_segments:
+      os.unlink(self._SegmentPath(num))
+
+  def _StartSegment(self, num):
+    snapshot = [EncodeEvent(e) for e in self._state.AsEvents()]
+    data = SEGMENT_MAGIC + EncodeRecord(RECORD_SNAPSHOT, snapshot)
+    fd = open(self._SegmentPath(num), 'wb')
+    fd.write(data)
+    fd.flush()
+    os.fsync(fd.fileno())
+    if self._fd:
+      self._fd.close()
+    self._fd = fd
+    self._segment_num = num
+    self._segment_bytes = len(data)
+
+  def Append(self, event):
+    """Queues an event to be written by the next Commit."""
+    self._lock.acquire()
+    self._pending.append(event)
+    self._lock.release()
+
+  def Commit(self):
+    """Writes and syncs all pending events.  Returns the number written."""
+    self._commit_lock.acquire()
+    try:
+      return self._Commit()
+    finally:
+      self._commit_lock.release()
+
+  def _Commit(self):
+    self._lock.acquire()
+    pending = self._pending
+    self._pending = []
+    self._lock.release()
+
+    if not pending:
+      return 0
+    if not self._fd:
+      raise JournalError('Journal is not open.')
+
+    records = []
+    for event in DropSupersededEvents(pending):
+      self._state.Apply(event)
+      code, values = EncodeEvent(event)
+      records.append(EncodeRecord(code, values))
+    data = ''.join(records)
+    self._fd.write(data)
+    self._fd.flush()
+    os.fsync(self._fd.fileno())
+    self._segment_bytes += len(data)
+    self._num_commits += 1
+    self._num_events += len(records)
+
+    if self._segment_bytes > self._segment_size:
+      old_num = self._segment_num
+      self._StartSegment(old_num + 1)
+      os.unlink(self._SegmentPath(old_num))
+    return len(pending)
+
+  def Close(self):
+    self.Commit()
+    if self._fd:
+      self._fd.close()
+      self._fd = None
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""Benchmark for the core event journal.
+
+Runs a stream of meter updates through the FlowManager, with and without a
+JournalManager attached, and reports events/sec for each.  With the journal
+on, a writer thread commits in the background every --journal_commit_interval
+seconds, as in the core.
+"""
+
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import gflags
+
+from pykeg.core import importhacks
+from pykeg.core import alarm
+from pykeg.core import journal
+from pykeg.core import kbevent
+from pykeg.core import manager
+
+FLAGS = gflags.FLAGS
+
+NUM_TAPS = 8
+NUM_EVENTS = 50000
+
+def _Run(journal_dir):
+  hub = kbevent.EventHub()
+  tap_manager = manager.TapManager('tap-manager', hub)
+  flow_manager = manager.FlowManager('flow-manager', hub, tap_manager,
+      alarm.AlarmManager())
+  for i in xrange(NUM_TAPS):
+    tap_manager.RegisterTap('flow%i' % i, 1000.0/2200, 2200)
+
+  handlers = [flow_manager.HandleFlowActivityEvent]
+  writer = None
+  done = threading.Event()
+  if journal_dir:
+    j = journal.EventJournal(journal_dir)
+    j.Open()
+    journal_manager = manager.JournalManager('journal', hub, j)
+    handlers.append(journal_manager.JournalEvent)
+    def _Writer():
+      while not done.isSet():
+        time.sleep(FLAGS.journal_commit_interval)
+        j.Commit()
+      j.Close()
+    writer = threading.Thread(target=_Writer)
+    writer.start()
+
+  start = time.time()
+  for n in xrange(NUM_EVENTS):
+    event = kbevent.MeterUpdate(tap_name='flow%i' % (n % NUM_TAPS),
+        reading=n)
+    for handler in handlers:
+      handler(event)
+    # Drain (and journal) the FlowUpdates published by the FlowManager.
+    while True:
+      published = hub._WaitForEvent(timeout=0)
+      if published is None:
+        break
+      if journal_dir:
+        journal_manager.JournalEvent(published)
+  done.set()
+  if writer:
+    writer.join()
+  return NUM_EVENTS / (time.time() - start)
+
+def main():
+  FLAGS(sys.argv)
+  off = _Run(None)
+  path = tempfile.mkdtemp()
+  try:
+    on = _Run(path)
+  finally:
+    shutil.rmtree(path)
+  print 'journal off: %10.0f events/sec' % off
+  print ' journal on: %10.0f events/sec (%.1f%% overhead)' % (on,
+      100.0 * (off - on) / off)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""Unittest for journal module"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from pykeg.core import journal
+from pykeg.core import kbevent
+
+def _FlowUpdate(flow_id, state, ticks, volume_ml, tap_name='flow0'):
+  now = datetime.datetime(2010, 1, 1, 12, 0, 0)
+  return kbevent.FlowUpdate(flow_id=flow_id, tap_name=tap_name, state=state,
+      username='user1', start_time=now, last_activity_time=now, ticks=ticks,
+      volume_ml=volume_ml)
+
+class JournalTestCase(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.journal = journal.EventJournal(self.path, segment_size=1024)
+    self.journal.Open()
+
+  def tearDown(self):
+    self.journal.Close()
+    shutil.rmtree(self.path)
+
+  def _Reopen(self):
+    self.journal.Close()
+    self.journal = journal.EventJournal(self.path, segment_size=1024)
+    state = self.journal.Replay()
+    self.journal.Open(state)
+    return state
+
+  def testReplayActiveFlow(self):
+    FlowState = kbevent.FlowUpdate.FlowState
+    self.journal.Append(kbevent.MeterUpdate(tap_name='flow0', reading=100))
+    self.journal.Append(_FlowUpdate(1, FlowState.ACTIVE, 50, 100.0))
+    self.journal.Append(kbevent.MeterUpdate(tap_name='flow0', reading=150))
+    self.journal.Commit()
+
+    state = self._Reopen()
+    self.assertEqual(state.meter_readings, {'flow0': 150})
+    flow = state.active_flows['flow0']
+    self.assertEqual(flow.flow_id, 1)
+    self.assertEqual(flow.ticks, 50)
+    self.assertEqual(flow.start_time, datetime.datetime(2010, 1, 1, 12, 0, 0))
+
+  def testRecordLayout(self):
+    # Changing these breaks existing journals.
+    self.assertEqual(journal.EVENT_FIELDS[kbevent.FlowUpdate], ('flow_id',
+        'last_activity_time', 'start_time', 'state', 'tap_name', 'ticks',
+        'username', 'volume_ml'))
+    event = _FlowUpdate(1, kbevent.FlowUpdate.FlowState.ACTIVE, 50, 100.0)
+    event.rate_ml_per_sec = 40.0
+    decoded = journal.DecodeEvent(*journal.EncodeEvent(event))
+    self.assertEqual(decoded.volume_ml, 100.0)
+    self.assertEqual(decoded.rate_ml_per_sec, None)
+
+  def testUnrecordedFlow(self):
+    FlowState = kbevent.FlowUpdate.FlowState
+    self.journal.Append(_FlowUpdate(1, FlowState.COMPLETED, 500, 250.0))
+    self.journal.Append(_FlowUpdate(2, FlowState.COMPLETED, 500, 250.0,
+        tap_name='flow1'))
+    self.journal.Append(_FlowUpdate(3, FlowState.COMPLETED, 500, 250.0,
+        tap_name='flow2'))
+    self.journal.Append(kbevent.DrinkCreatedEvent(flow_id=1, drink_id=10))
+    # The backend rejected flow 3's drink.
+    self.journal.Append(kbevent.FlowDiscardedEvent(flow_id=3,
+        tap_name='flow2'))
+    self.journal.Commit()
+
+    state = self._Reopen()
+    self.assertEqual(state.active_flows, {})
+    self.assertEqual(state.completed_flows.keys(), [2])
+
+  def testDrinkBeforeFlow(self):
+    FlowState = kbevent.FlowUpdate.FlowState
+    # The DrinkManager may commit the drink before the flow is journaled.
+    self.journal.Append(kbevent.DrinkCreatedEvent(flow_id=1, drink_id=10))
+    self.journal.Commit()
+    self.journal.Append(_FlowUpdate(1, FlowState.COMPLETED, 500, 250.0))
+    self.journal.Commit()
+
+    state = self._Reopen()
+    self.assertEqual(state.completed_flows, {})
+    # Recorded flows are kept in the snapshot of the new segment.
+    state = self._Reopen()
+    self.assertEqual(state.recorded_flows, [1])
+
+  def testRotationKeepsState(self):
+    FlowState = kbevent.FlowUpdate.FlowState
+    self.journal.Append(_FlowUpdate(1, FlowState.ACTIVE, 0, 0.0))
+    self.journal.Commit()
+    for i in xrange(200):
+      self.journal.Append(kbevent.MeterUpdate(tap_name='flow0', reading=i))
+      self.journal.Commit()
+    self.assertEqual(len(self.journal._ListSegments()), 1)
+
+    state = self._Reopen()
+    self.assertEqual(state.meter_readings, {'flow0': 199})
+    self.assertEqual(state.active_flows['flow0'].flow_id, 1)
+
+  def testTruncatedRecord(self):
+    self.journal.Append(kbevent.MeterUpdate(tap_name='flow0', reading=100))
+    self.journal.Commit()
+    self.journal.Append(kbevent.MeterUpdate(tap_name='flow0', reading=200))
+    self.journal.Commit()
+
+    # Chop the last record in half, as if the core died mid-write.
+    self.journal.Close()
+    segment = self.journal._SegmentPath(self.journal._ListSegments()[-1])
+    size = os.path.getsize(segment)
+    fd = open(segment, 'r+b')
+    fd.truncate(size - 4)
+    fd.close()
+
+    state = self._Reopen()
+    self.assertEqual(state.meter_readings, {'flow0': 100})
+
+  def testDropSupersededEvents(self):
+    FlowState = kbevent.FlowUpdate.FlowState
+    events = [
+      kbevent.MeterUpdate(tap_name='flow0', reading=100),
+      _FlowUpdate(1, FlowState.ACTIVE, 50, 100.0),
+      kbevent.MeterUpdate(tap_name='flow1', reading=7),
+      kbevent.MeterUpdate(tap_name='flow0', reading=200),
+      _FlowUpdate(1, FlowState.ACTIVE, 150, 300.0),
+      _FlowUpdate(1, FlowState.COMPLETED, 150, 300.0),
+      _FlowUpdate(2, FlowState.ACTIVE, 10, 20.0),
+    ]
+    kept = journal.DropSupersededEvents(events)
+    self.assertEqual(kept, [events[2], events[3], events[5], events[6]])
+
+    full = journal.JournalState()
+    for event in events:
+      full.Apply(event)
+    partial = journal.JournalState()
+    for event in kept:
+      partial.Apply(event)
+    self.assertEqual(full.meter_readings, partial.meter_readings)
+    self.assertEqual(full.active_flows, partial.active_flows)
+    self.assertEqual(full.completed_flows, partial.completed_flows)
+
+if __name__ == '__main__':
+  unittest.main()
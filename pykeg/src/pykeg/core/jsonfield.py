@@ -77,7 +77,9 @@ class JSONField(models.TextField):
     if not value:
       return super(JSONField, self).get_db_prep_save("")
     else:
-      return super(JSONField, self).get_db_prep_save(kbjson.dumps(value))
+      # Without indentation, the json module can use its C encoder.
+      return super(JSONField, self).get_db_prep_save(kbjson.dumps(value,
+          indent=None))
 
 try:
   from south.modelsinspector import add_introspection_rules
@@ -29,6 +29,9 @@ THERMO_SENSOR_RANGE = (-20.0, 80.0)
 # Address the kegnet server should bind to.
 KB_CORE_DEFAULT_ADDR = 'localhost:9805'
 
+# Directory holding the kegnet server's Unix domain sockets.
+KB_CORE_DEFAULT_UNIX_SOCKET_DIR = '/tmp'
+
 DEFAULT_NEW_USER_WEIGHT = 140
 DEFAULT_NEW_USER_GENDER = 'male'
 
@@ -65,6 +68,30 @@ AUTH_DEVICE_MAX_IDLE_SECS = {
   'default': 10
 }
 
+# The AuthenticationManager caches the user each token is assigned to for
+# AUTH_TOKEN_CACHE_SECS, and the tokens not assigned to anyone for
+# AUTH_TOKEN_NEGATIVE_CACHE_SECS.  Kegweb tells the core when a token changes,
+# so these only bound how stale a token missed by that can be.  An expired
+# entry is still used if the backend cannot be reached.
+AUTH_TOKEN_CACHE_SECS = 600
+AUTH_TOKEN_NEGATIVE_CACHE_SECS = 60
+
+# Flow rates are measured over the meter readings of this many seconds.
+FLOW_RATE_WINDOW_SECS = 2.0
+
+# An anonymous flow which has poured at FLOW_END_MIN_RATE_ML_PER_SEC or more
+# ends once it has poured slower than that for FLOW_END_SECS, rather than
+# waiting for its maximum idle time; a trickle from a closed tap does not keep
+# it open.  Flows started by an auth token keep their maximum idle time, so the
+# user can pause between pours.
+FLOW_END_MIN_RATE_ML_PER_SEC = 5.0
+FLOW_END_SECS = 3.0
+
+# How often to renew an enabled relay output while its flow is active.  The
+# kegboard firmware disables any relay that has not been touched for
+# KB_RELAY_WATCHDOG_MS (10 seconds), so this must be comfortably below that.
+RELAY_KEEPALIVE_SECS = 5
+
 # How often to record a thermo reading?
 THERMO_RECORD_DELTA_SECONDS = 60
 
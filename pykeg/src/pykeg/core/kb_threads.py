@@ -1,17 +1,68 @@
-import asyncore
 import datetime
 import Queue
+import threading
 import time
 
 import gflags
 
+from pykeg.core import journal
 from pykeg.core import kb_common
 from pykeg.core import kbevent
+from pykeg.core import outbox
 from pykeg.core import util
 from pykeg.core.net import kegnet
 
 FLAGS = gflags.FLAGS
 
+gflags.DEFINE_boolean('event_batch_drain', True,
+    'If true, event handler threads drain all pending events at once and '
+    'collapse stale MeterUpdate events before dispatching them.')
+
+gflags.DEFINE_integer('event_handler_lanes', 8,
+    'Number of threads used to run event handlers for tap events. Events for '
+    'any one tap are always handled in order by the same thread, so a slow '
+    'handler only delays the taps sharing its thread.')
+
+def CoalesceMeterUpdates(events):
+  """Collapses runs of MeterUpdate events to the newest reading per tap.
+
+  Only consecutive MeterUpdates (those not separated by any other type of
+  event) are collapsed, so ordering relative to other events is preserved. A
+  reading lower than the previous one for the same tap (a meter reset or
+  wraparound) is always kept, and later readings are only collapsed into
+  each other, so the FlowMeter still sees the reset and the ticks after it.
+
+  Returns a tuple of (new event list, number of events dropped).
+  """
+  result = []
+  run = []
+  run_index = {}
+  last_reading = {}
+  dropped = 0
+  for event in events:
+    if not isinstance(event, kbevent.MeterUpdate):
+      result.extend(e for e in run if e is not None)
+      run = []
+      run_index = {}
+      last_reading = {}
+      result.append(event)
+      continue
+    tap_name = event.tap_name
+    if tap_name in last_reading and event.reading < last_reading[tap_name]:
+      # Reset: keep this reading, and begin a new run after it.
+      run_index.pop(tap_name, None)
+      run.append(event)
+    else:
+      pos = run_index.get(tap_name)
+      if pos is not None:
+        run[pos] = None
+        dropped += 1
+      run_index[tap_name] = len(run)
+      run.append(event)
+    last_reading[tap_name] = event.reading
+  result.extend(e for e in run if e is not None)
+  return result, dropped
+
 ### Base kegbot thread class
 
 class CoreThread(util.KegbotThread):
@@ -21,6 +72,10 @@ class CoreThread(util.KegbotThread):
     self._kb_env = kb_env
 
   ### Event listener methods
+  def GetEventTypes(self):
+    """Returns the event classes this thread wants posted to it."""
+    return (kbevent.QuitEvent,)
+
   def PostEvent(self, event):
     if isinstance(event, kbevent.QuitEvent):
       self._logger.info('got quit event, quitting')
@@ -76,24 +131,83 @@ class HeartbeatThread(CoreThread):
 
 
 class AlarmManagerThread(CoreThread):
+  """Publishes the event of each alarm as it comes due."""
+
+  def Quit(self):
+    CoreThread.Quit(self)
+    self._kb_env.GetAlarmManager().Wakeup()
 
   def ThreadMain(self):
     am = self._kb_env.GetAlarmManager()
     while not self._quit:
-      alarm = am.WaitForNextAlarm(1.0)
+      alarm = am.WaitForNextAlarm()
       if alarm is not None:
         self._logger.info('firing alarm: %s' % alarm)
         event = alarm.event()
         self._kb_env.GetEventHub().PublishEvent(event)
 
 
+class JournalWriterThread(CoreThread):
+  """Periodically commits the event journal to disk."""
+
+  def GetStatus(self):
+    return self._kb_env.GetJournal().GetStatus()
+
+  def ThreadMain(self):
+    journal = self._kb_env.GetJournal()
+    while not self._quit:
+      time.sleep(FLAGS.journal_commit_interval)
+      journal.Commit()
+    journal.Close()
+
+
+class DrinkOutboxThread(CoreThread):
+  """Records queued drinks with the backend, backing off while it fails."""
+
+  # Delay before the first retry of a failed drink; doubled on each failure.
+  MIN_BACKOFF_SECS = 1.0
+
+  def Quit(self):
+    CoreThread.Quit(self)
+    self._kb_env.GetDrinkOutbox().Wakeup()
+
+  def _Sleep(self, secs):
+    end = time.time() + secs
+    while not self._quit and time.time() < end:
+      time.sleep(min(0.5, max(0, end - time.time())))
+
+  def ThreadMain(self):
+    outbox = self._kb_env.GetDrinkOutbox()
+    drink_manager = self._kb_env.GetDrinkManager()
+    backoff = 0
+    while not self._quit:
+      if not outbox.WaitForEntries():
+        continue
+      if drink_manager.SendQueuedDrinks():
+        backoff = 0
+        continue
+      backoff = min(max(backoff * 2, self.MIN_BACKOFF_SECS),
+          FLAGS.drink_outbox_max_backoff)
+      self._logger.info('Backend failed; retrying in %.1fs' % backoff)
+      self._Sleep(backoff)
+
+
 class EventHandlerThread(CoreThread):
   """ Basic event handling thread. """
+
+  # Upper bound on the number of events drained per step in batch mode.
+  MAX_BATCH_SIZE = 512
+
   def __init__(self, kb_env, name):
     CoreThread.__init__(self, kb_env, name)
     self._event_queue = Queue.Queue()
     self._event_handlers = set()
     self._all_event_map = {}
+    self._num_events = 0
+    self._num_batches = 0
+    self._num_batched_events = 0
+    self._num_coalesced = 0
+    self._max_batch_size = 0
 
   def AddEventHandler(self, event_handler):
     self._event_handlers.add(event_handler)
@@ -107,8 +221,12 @@ class EventHandlerThread(CoreThread):
         for cb in callback_list:
           self._all_event_map[event_type].add(cb)
 
+  def GetEventTypes(self):
+    return tuple(self._all_event_map.keys()) + (kbevent.QuitEvent,)
+
   def GetStatus(self):
-    lines = []
+    lines = self._GetEventStatus()
+    lines.append('')
     for handler in self._event_handlers:
       handler_lines = handler.GetStatus()
       if handler_lines:
@@ -119,16 +237,50 @@ class EventHandlerThread(CoreThread):
         lines.append('')
     return lines
 
+  def _GetEventStatus(self):
+    lines = []
+    lines.append('Events processed: %i' % self._num_events)
+    if self._num_batches:
+      lines.append('Batches: %i (average size %.1f, max size %i)' % (
+          self._num_batches,
+          float(self._num_batched_events) / self._num_batches,
+          self._max_batch_size))
+      lines.append('MeterUpdates coalesced: %i' % self._num_coalesced)
+    return lines
+
   def ThreadMain(self):
     while not self._quit:
       self._Step(timeout=0.5)
 
   def _Step(self, timeout=0.5):
+    if FLAGS.event_batch_drain:
+      return self._StepBatch(timeout)
     event = self._WaitForEvent(timeout)
     if event is not None:
+      self._num_events += 1
       self._ProcessEvent(event)
     return event
 
+  def _StepBatch(self, timeout=0.5):
+    """Drains all pending events, coalesces them, and processes the result.
+
+    Returns the list of events received (which is empty on timeout).
+    """
+    events = self._DrainEvents(timeout)
+    if not events:
+      return events
+    self._num_batches += 1
+    self._num_batched_events += len(events)
+    self._max_batch_size = max(self._max_batch_size, len(events))
+    batch, dropped = CoalesceMeterUpdates(events)
+    self._num_coalesced += dropped
+    for event in batch:
+      self._num_events += 1
+      self._ProcessEvent(event)
+      if self._quit:
+        break
+    return events
+
   def PostEvent(self, event):
     self._event_queue.put(event)
 
@@ -143,6 +295,19 @@ class EventHandlerThread(CoreThread):
     except Queue.Empty:
       return None
 
+  def _DrainEvents(self, timeout=0.5):
+    """Blocks until an event is posted, then returns all pending events."""
+    ev = self._WaitForEvent(timeout)
+    if ev is None:
+      return []
+    events = [ev]
+    while len(events) < self.MAX_BATCH_SIZE:
+      try:
+        events.append(self._event_queue.get_nowait())
+      except Queue.Empty:
+        break
+    return events
+
   def _ProcessEvent(self, event):
     """ Execute the event callback associated with the event, if present. """
     if FLAGS.debug_events:
@@ -159,16 +324,125 @@ class EventHandlerThread(CoreThread):
     """ Process all events in the Queue immediately """
     while True:
       ev = self._Step(timeout=0.5)
-      if ev is None:
+      if not ev:
+        break
+
+
+class EventHandlerLane(EventHandlerThread):
+  """An EventHandlerThread fed by an EventHandlerPool.
+
+  Lanes only listen for QuitEvent on the event hub; all other events are
+  posted to them by their pool.
+  """
+
+  def __init__(self, kb_env, name):
+    EventHandlerThread.__init__(self, kb_env, name)
+    self._tap_names = []
+
+  def AddTapName(self, tap_name):
+    self._tap_names.append(tap_name)
+
+  def GetHandledEventTypes(self):
+    return tuple(self._all_event_map.keys())
+
+  def GetEventTypes(self):
+    return (kbevent.QuitEvent,)
+
+  def GetStatus(self):
+    lines = self._GetEventStatus()
+    if self._tap_names:
+      lines.append('Taps: %s' % ', '.join(sorted(self._tap_names)))
+    return lines
+
+
+class EventHandlerPool(object):
+  """Runs a set of event handlers on several threads, partitioned by tap.
+
+  Events with a tap_name are always posted to the same lane for a given tap,
+  so each tap's events are handled in order while different taps proceed
+  concurrently.  Taps are assigned to lanes round-robin as they are first
+  seen.  Events with no tap (thermo readings, heartbeats, and so on), and
+  events for all taps at once (kb_common.ALIAS_ALL_TAPS), are handled by a
+  separate shared lane.
+
+  Since handlers are called from several threads at once, any state they share
+  between taps must be locked.
+  """
+
+  def __init__(self, kb_env, name, num_lanes=None):
+    if num_lanes is None:
+      num_lanes = FLAGS.event_handler_lanes
+    num_lanes = max(1, num_lanes)
+    self._shared_lane = EventHandlerLane(kb_env, '%s-shared' % name)
+    self._tap_lanes = [EventHandlerLane(kb_env, '%s-%i' % (name, i))
+        for i in xrange(num_lanes)]
+    self._lane_by_tap = {}
+    self._lock = threading.Lock()
+
+  def AddEventHandler(self, event_handler):
+    for lane in self.GetThreads():
+      lane.AddEventHandler(event_handler)
+
+  def GetThreads(self):
+    return [self._shared_lane] + self._tap_lanes
+
+  def GetEventTypes(self):
+    return self._shared_lane.GetHandledEventTypes()
+
+  def GetStatus(self):
+    return self._shared_lane.GetStatus()
+
+  @util.synchronized
+  def _AssignLane(self, tap_name):
+    lane = self._lane_by_tap.get(tap_name)
+    if lane is None:
+      lane = self._tap_lanes[len(self._lane_by_tap) % len(self._tap_lanes)]
+      lane.AddTapName(tap_name)
+      self._lane_by_tap[tap_name] = lane
+    return lane
+
+  def GetLaneForEvent(self, event):
+    tap_name = None
+    if 'tap_name' in event.class_fields:
+      tap_name = event.tap_name
+    if tap_name is None or tap_name == kb_common.ALIAS_ALL_TAPS:
+      return self._shared_lane
+    lane = self._lane_by_tap.get(tap_name)
+    if lane is None:
+      lane = self._AssignLane(tap_name)
+    return lane
+
+  def PostEvent(self, event):
+    self.GetLaneForEvent(event).PostEvent(event)
+
+  def _FlushEvents(self):
+    """Processes all pending events, on the calling thread.
+
+    Since handling an event in one lane may post events to another, this
+    repeats until a full pass over the lanes finds nothing to do.
+    """
+    while True:
+      busy = False
+      for lane in self.GetThreads():
+        while lane._Step(timeout=0):
+          busy = True
+      if not busy:
         break
 
 
 ### Service threads
 class NetProtocolThread(CoreThread):
+  def Quit(self):
+    CoreThread.Quit(self)
+    self._kb_env.GetKegnetServer().Wakeup()
+
+  def GetStatus(self):
+    return self._kb_env.GetKegnetServer().GetStatus()
+
   def ThreadMain(self):
     self._logger.info("network thread started")
     server = self._kb_env.GetKegnetServer()
     server.StartServer()
     while not self._quit:
-      asyncore.loop(timeout=0.5, count=1)
+      server.Serve(timeout=server.SERVE_TIMEOUT)
     server.StopServer()
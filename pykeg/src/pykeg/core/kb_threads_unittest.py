@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""Unittest for kb_threads module"""
+
+import unittest
+
+from pykeg.core import flow_meter
+from pykeg.core import kb_common
+from pykeg.core import kb_threads
+from pykeg.core import kbevent
+
+def _Meter(tap_name, reading):
+  return kbevent.MeterUpdate(tap_name=tap_name, reading=reading)
+
+class CoalesceMeterUpdatesTestCase(unittest.TestCase):
+  def testCollapsesPerTap(self):
+    events = [
+        _Meter('flow0', 10),
+        _Meter('flow1', 5),
+        _Meter('flow0', 20),
+        _Meter('flow0', 30),
+    ]
+    result, dropped = kb_threads.CoalesceMeterUpdates(events)
+    self.assertEqual(dropped, 2)
+    self.assertEqual([(e.tap_name, e.reading) for e in result],
+        [('flow1', 5), ('flow0', 30)])
+
+  def testPreservesOrderAroundOtherEvents(self):
+    token = kbevent.TokenAuthEvent(tap_name='flow0')
+    events = [
+        _Meter('flow0', 10),
+        _Meter('flow0', 20),
+        token,
+        _Meter('flow0', 30),
+    ]
+    result, dropped = kb_threads.CoalesceMeterUpdates(events)
+    self.assertEqual(dropped, 1)
+    self.assertEqual(len(result), 3)
+    self.assertEqual(result[0].reading, 20)
+    self.assert_(result[1] is token)
+    self.assertEqual(result[2].reading, 30)
+
+  def testKeepsMeterResets(self):
+    events = [
+        _Meter('flow0', 100),
+        _Meter('flow0', 5),
+        _Meter('flow0', 10),
+        _Meter('flow0', 20),
+    ]
+    result, dropped = kb_threads.CoalesceMeterUpdates(events)
+    self.assertEqual(dropped, 1)
+    self.assertEqual([e.reading for e in result], [100, 5, 20])
+
+  def testResetTicksCounted(self):
+    events = [
+        _Meter('flow0', 100),
+        _Meter('flow0', 5),
+        _Meter('flow0', 150),
+    ]
+    result, dropped = kb_threads.CoalesceMeterUpdates(events)
+    self.assertEqual(dropped, 0)
+    meter = flow_meter.FlowMeter('flow0', max_delta=1000)
+    for event in result:
+      meter.SetTicks(event.reading)
+    self.assertEqual(meter.GetTicks(), 150)
+
+class _RecordingHandler:
+  """Minimal event handler which records the events it handles."""
+  def __init__(self):
+    self.calls = []
+
+  def GetEventHandlers(self):
+    return {
+      kbevent.MeterUpdate: [self._Record],
+      kbevent.ThermoEvent: [self._Record],
+    }
+
+  def GetStatus(self):
+    return []
+
+  def _Record(self, event):
+    self.calls.append(event)
+
+class EventHandlerPoolTestCase(unittest.TestCase):
+  def setUp(self):
+    self.pool = kb_threads.EventHandlerPool(None, 'pool', num_lanes=2)
+    self.handler = _RecordingHandler()
+    self.pool.AddEventHandler(self.handler)
+
+  def testEventTypes(self):
+    self.assertEqual(set(self.pool.GetEventTypes()),
+        set([kbevent.MeterUpdate, kbevent.ThermoEvent]))
+    for lane in self.pool.GetThreads():
+      self.assertEqual(lane.GetEventTypes(), (kbevent.QuitEvent,))
+
+  def testTapsAssignedRoundRobin(self):
+    lane0 = self.pool.GetLaneForEvent(_Meter('flow0', 1))
+    lane1 = self.pool.GetLaneForEvent(_Meter('flow1', 1))
+    lane2 = self.pool.GetLaneForEvent(_Meter('flow2', 1))
+    self.assert_(lane0 is not lane1)
+    self.assert_(lane0 is lane2)
+    self.assert_(self.pool.GetLaneForEvent(_Meter('flow1', 2)) is lane1)
+
+  def testTaplessEventsUseSharedLane(self):
+    shared = self.pool.GetLaneForEvent(kbevent.ThermoEvent())
+    self.assert_(shared is self.pool.GetLaneForEvent(kbevent.Ping()))
+    self.assert_(shared is not self.pool.GetLaneForEvent(_Meter('flow0', 1)))
+    event = kbevent.TokenAuthEvent(tap_name=kb_common.ALIAS_ALL_TAPS)
+    self.assert_(shared is self.pool.GetLaneForEvent(event))
+
+  def testPerTapOrdering(self):
+    for reading in xrange(5):
+      self.pool.PostEvent(_Meter('flow0', reading))
+      self.pool.PostEvent(_Meter('flow1', reading * 10))
+    self.pool.PostEvent(kbevent.ThermoEvent(sensor_name='t0'))
+    self.pool._FlushEvents()
+    self.assertEqual(len(self.handler.calls), 3)
+    by_tap = {}
+    for event in self.handler.calls:
+      if isinstance(event, kbevent.MeterUpdate):
+        by_tap[event.tap_name] = event.reading
+    self.assertEqual(by_tap, {'flow0': 4, 'flow1': 40})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -24,6 +24,7 @@ This module implements a very simple inter-process event passing system
 
 import logging
 import Queue
+import threading
 
 import gflags
 
@@ -36,6 +37,10 @@ gflags.DEFINE_boolean('debug_events', False,
     'If true, logs debugging information about internal events.')
 
 class Event(util.BaseMessage):
+  # Fields left out of the JSON encoding while unset, so that peers which
+  # predate them can still decode the event.
+  optional_fields = ()
+
   def __init__(self, initial=None, encoded=None, **kwargs):
     util.BaseMessage.__init__(self, initial, **kwargs)
     if encoded is not None:
@@ -44,6 +49,8 @@ class Event(util.BaseMessage):
   def ToDict(self):
     data = {}
     for field_name, value in self._values.iteritems():
+      if value is None and field_name in self.optional_fields:
+        continue
       data[field_name] = value
 
     ret = {
@@ -67,8 +74,12 @@ class StartCompleteEvent(Event):
   pass
 
 class MeterUpdate(Event):
+  # event_time is only set on readings replayed from a client's spool, and
+  # gives the time the reading was taken.
+  optional_fields = ('event_time',)
   tap_name = EventField()
   reading = EventField()
+  event_time = EventField()
 
 class FlowUpdate(Event):
   class FlowState:
@@ -85,9 +96,16 @@ class FlowUpdate(Event):
   last_activity_time = EventField()
   ticks = EventField()
   volume_ml = EventField()
+  rate_ml_per_sec = EventField()
+  instant_rate_ml_per_sec = EventField()
 
 class TapIdleEvent(Event):
   tap_name = EventField()
+  flow_id = EventField()
+
+class RelayKeepaliveEvent(Event):
+  tap_name = EventField()
+  flow_id = EventField()
 
 class DrinkCreatedEvent(Event):
   flow_id = EventField()
@@ -97,6 +115,14 @@ class DrinkCreatedEvent(Event):
   end_time = EventField()
   username = EventField()
 
+class FlowDiscardedEvent(Event):
+  """Sent when a completed flow will never become a drink.
+
+  The backend either rejected the flow's drink, or recorded no drink for it.
+  """
+  flow_id = EventField()
+  tap_name = EventField()
+
 class TokenAuthEvent(Event):
   class TokenState:
     ADDED = "added"
@@ -106,9 +132,18 @@ class TokenAuthEvent(Event):
   token_value = EventField()
   status = EventField()
 
+class TokenChangedEvent(Event):
+  # Sent by kegweb when a token is assigned, changed or deleted.  If both
+  # fields are empty, any token may have changed.
+  auth_device_name = EventField()
+  token_value = EventField()
+
 class ThermoEvent(Event):
+  # As for MeterUpdate.
+  optional_fields = ('event_time',)
   sensor_name = EventField()
   sensor_value = EventField()
+  event_time = EventField()
 
 class FlowRequest(Event):
   class Action:
@@ -138,6 +173,13 @@ class CreditAddedEvent(Event):
   amount = EventField()
   username = EventField()
 
+class SubscribeEvent(Event):
+  # Sent by a kegnet client to choose which events the server sends it.  Both
+  # fields are comma-separated lists: event class names, and fnmatch patterns
+  # for the tap or output name of each event (empty matches every name).
+  event_types = EventField()
+  names = EventField()
+
 EVENT_NAME_TO_CLASS = {}
 for cls in Event.__subclasses__():
   name = cls.__name__
@@ -155,24 +197,40 @@ def DecodeEvent(msg):
   return inst
 
 class EventHub(object):
-  """Central sink and publish of events."""
+  """Central sink and publish of events.
+
+  Listeners may register interest in a set of event classes; each published
+  event is only delivered to listeners interested in its class (or one of its
+  base classes).  Listeners registered without any event types receive every
+  event.
+  """
   def __init__(self):
-    self._event_listeners = set()
+    self._event_listeners = {}
     self._event_queue = Queue.Queue()
     self._logger = logging.getLogger('eventhub')
+    self._lock = threading.Lock()
+    self._routes = {}
 
-  def AddListener(self, listener):
+  @util.synchronized
+  def AddListener(self, listener, event_types=None):
     """Attach a listener, to be notified on receipt of a new event.
 
-    The listener must implement the PostEvent(event) method.
+    The listener must implement the PostEvent(event) method.  If event_types is
+    given, it should be a sequence of Event subclasses; the listener will only
+    be notified of events of those types.  Otherwise, the listener will be
+    notified of all events.
     """
-    if listener not in self._event_listeners:
-      self._event_listeners.add(listener)
+    if event_types is not None:
+      event_types = frozenset(event_types)
+    self._event_listeners[listener] = event_types
+    self._routes = {}
 
+  @util.synchronized
   def RemoveListener(self, listener):
     """Remove (by reference) an already-listening listener."""
     if listener in self._event_listeners:
-      self._event_listeners.remove(listener)
+      del self._event_listeners[listener]
+      self._routes = {}
 
   def PublishEvent(self, event):
     """Add a new event to the queue of events to publish.
@@ -181,10 +239,28 @@ class EventHub(object):
     """
     self._event_queue.put(event)
 
-  def _IterEventListeners(self):
-    """Iterate through all listeners."""
-    for listener in self._event_listeners:
-      yield listener
+  @util.synchronized
+  def _BuildRoute(self, event_cls):
+    """Computes and caches the tuple of listeners for an event class."""
+    route = []
+    for listener, event_types in self._event_listeners.iteritems():
+      if event_types is None:
+        route.append(listener)
+        continue
+      for cls in event_cls.__mro__:
+        if cls in event_types:
+          route.append(listener)
+          break
+    route = tuple(route)
+    self._routes[event_cls] = route
+    return route
+
+  def _IterEventListeners(self, event):
+    """Iterate through all listeners interested in |event|."""
+    route = self._routes.get(event.__class__)
+    if route is None:
+      route = self._BuildRoute(event.__class__)
+    return route
 
   def _WaitForEvent(self, timeout=None):
     """Wait for a new event to be enqueued."""
@@ -195,11 +271,10 @@ class EventHub(object):
     return ev
 
   def DispatchNextEvent(self, timeout=None):
-    """Wait for an event, and dispatch it to all listeners."""
+    """Wait for an event, and dispatch it to all interested listeners."""
     ev = self._WaitForEvent(timeout)
     if ev:
       if FLAGS.debug_events:
         self._logger.debug('Publishing event: %s ' % ev)
-      for listener in self._IterEventListeners():
+      for listener in self._IterEventListeners(ev):
         listener.PostEvent(ev)
-
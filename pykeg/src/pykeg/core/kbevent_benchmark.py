@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""Benchmark for kbevent.EventHub dispatch.
+
+Compares EventHub throughput when every listener receives every event
+(broadcast) against per-type routing, using a listener mix similar to the one
+found in the kegbot core: one event handling thread interested in meter and
+heartbeat events, plus several threads only interested in QuitEvent.
+"""
+
+import Queue
+import sys
+import time
+
+import gflags
+
+from pykeg.core import kbevent
+
+FLAGS = gflags.FLAGS
+
+NUM_EVENTS = 100000
+NUM_QUIT_ONLY_LISTENERS = 4
+
+class _QueueListener(object):
+  def __init__(self):
+    self._queue = Queue.Queue()
+
+  def PostEvent(self, event):
+    self._queue.put(event)
+
+def _BuildHub(typed):
+  hub = kbevent.EventHub()
+  if typed:
+    handler_types = (kbevent.MeterUpdate, kbevent.HeartbeatSecondEvent,
+        kbevent.QuitEvent)
+    quit_types = (kbevent.QuitEvent,)
+  else:
+    handler_types = quit_types = None
+  hub.AddListener(_QueueListener(), handler_types)
+  for i in xrange(NUM_QUIT_ONLY_LISTENERS):
+    hub.AddListener(_QueueListener(), quit_types)
+  return hub
+
+def _Run(typed):
+  hub = _BuildHub(typed)
+  events = []
+  for i in xrange(NUM_EVENTS):
+    if i % 10:
+      events.append(kbevent.MeterUpdate(tap_name='flow%i' % (i % 8), reading=i))
+    else:
+      events.append(kbevent.HeartbeatSecondEvent())
+
+  start = time.time()
+  for event in events:
+    hub.PublishEvent(event)
+    hub.DispatchNextEvent(timeout=0)
+  return NUM_EVENTS / (time.time() - start)
+
+def main():
+  FLAGS(sys.argv)
+  broadcast = _Run(typed=False)
+  routed = _Run(typed=True)
+  print 'broadcast: %10.0f events/sec' % broadcast
+  print '   routed: %10.0f events/sec (%.2fx)' % (routed, routed / broadcast)
+
+if __name__ == '__main__':
+  main()
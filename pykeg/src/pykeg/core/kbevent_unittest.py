@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""Unittest for kbevent module"""
+
+import datetime
+import unittest
+
+from pykeg.core import kbevent
+
+class _RecordingListener(object):
+  def __init__(self):
+    self.events = []
+
+  def PostEvent(self, event):
+    self.events.append(event)
+
+class EventTestCase(unittest.TestCase):
+  def testOptionalFieldsOmitted(self):
+    event = kbevent.MeterUpdate(tap_name='flow0', reading=10)
+    self.assertEqual(event.ToDict()['data'], {'tap_name': 'flow0',
+        'reading': 10})
+    event.event_time = datetime.datetime(2010, 6, 1, 18, 30, 15)
+    self.assertEqual(event.ToDict()['data']['event_time'], event.event_time)
+    decoded = kbevent.DecodeEvent(event.ToJson())
+    self.assert_(isinstance(decoded.event_time, datetime.datetime))
+
+class EventHubTestCase(unittest.TestCase):
+  def setUp(self):
+    self.hub = kbevent.EventHub()
+
+  def _Dispatch(self, event):
+    self.hub.PublishEvent(event)
+    self.hub.DispatchNextEvent(timeout=0)
+
+  def testBroadcastListener(self):
+    listener = _RecordingListener()
+    self.hub.AddListener(listener)
+    self._Dispatch(kbevent.HeartbeatSecondEvent())
+    self._Dispatch(kbevent.MeterUpdate(tap_name='flow0', reading=10))
+    self.assertEqual(len(listener.events), 2)
+
+  def testTypedListener(self):
+    meters = _RecordingListener()
+    quitters = _RecordingListener()
+    self.hub.AddListener(meters, (kbevent.MeterUpdate,))
+    self.hub.AddListener(quitters, (kbevent.QuitEvent,))
+
+    self._Dispatch(kbevent.HeartbeatSecondEvent())
+    self._Dispatch(kbevent.MeterUpdate(tap_name='flow0', reading=10))
+    self.assertEqual(len(meters.events), 1)
+    self.assertEqual(len(quitters.events), 0)
+
+    self._Dispatch(kbevent.QuitEvent())
+    self.assertEqual(len(meters.events), 1)
+    self.assertEqual(len(quitters.events), 1)
+
+  def testBaseClassListener(self):
+    listener = _RecordingListener()
+    self.hub.AddListener(listener, (kbevent.Event,))
+    self._Dispatch(kbevent.HeartbeatSecondEvent())
+    self.assertEqual(len(listener.events), 1)
+
+  def testRoutesUpdatedOnChange(self):
+    listener = _RecordingListener()
+    self.hub.AddListener(listener, (kbevent.ThermoEvent,))
+    self._Dispatch(kbevent.MeterUpdate(tap_name='flow0', reading=10))
+    self.assertEqual(len(listener.events), 0)
+
+    # Re-registering replaces the listener's interest.
+    self.hub.AddListener(listener, (kbevent.MeterUpdate,))
+    self._Dispatch(kbevent.MeterUpdate(tap_name='flow0', reading=20))
+    self.assertEqual(len(listener.events), 1)
+
+    self.hub.RemoveListener(listener)
+    self._Dispatch(kbevent.MeterUpdate(tap_name='flow0', reading=30))
+    self.assertEqual(len(listener.events), 1)
+
+if __name__ == '__main__':
+  unittest.main()
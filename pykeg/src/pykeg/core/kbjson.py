@@ -67,6 +67,9 @@ def _ToAttrDict(obj):
     # Try to convert any "time" or "date" fields into datetime objects.  If the
     # format doesn't match, just leave it alone.
     for k, v in obj.iteritems():
+      # Only strings can hold times; keyed maps (eg of usernames) hold others.
+      if not isinstance(v, basestring):
+        continue
       if k.endswith('date') or k.endswith('time') or k.startswith('date') or k.startswith('last_login'):
         try:
           obj[k] = util.iso8601str_to_datetime(v, TIME_ZONE)
@@ -38,10 +38,12 @@ import gflags
 
 from pykeg.core import alarm
 from pykeg.core import backend
+from pykeg.core import journal
 from pykeg.core import kbevent
 from pykeg.core import kb_app
 from pykeg.core import kb_threads
 from pykeg.core import manager
+from pykeg.core import outbox
 from pykeg.core.net import kegnet
 from pykeg.web.api import krest
 
@@ -51,6 +53,11 @@ gflags.DEFINE_boolean('web_backend', True,
     'If true, uses the web backend implementation rather than a local '
     'database connection.')
 
+gflags.DEFINE_boolean('prefetch_auth_tokens', True,
+    'If true, loads every auth token into the token cache at startup, so '
+    'that even the first use of a token needs no backend lookup.  Only the '
+    'database backend supports this.')
+
 class KegbotEnv(object):
   """ A class that wraps the context of the kegbot core.
 
@@ -61,7 +68,7 @@ class KegbotEnv(object):
     self._event_hub = kbevent.EventHub()
     self._logger = logging.getLogger('env')
 
-    self._kegnet_server = kegnet.KegnetServer(name='kegnet', kb_env=self,
+    self._kegnet_server = kegnet.NewKegnetServer(name='kegnet', kb_env=self,
         addr=FLAGS.kb_core_bind_addr)
 
     if FLAGS.web_backend:
@@ -77,11 +84,21 @@ class KegbotEnv(object):
     self._alarm_manager = alarm.AlarmManager()
     self._tap_manager = manager.TapManager('tap-manager', self._event_hub)
     self._flow_manager = manager.FlowManager('flow-manager', self._event_hub,
-        self._tap_manager)
+        self._tap_manager, self._alarm_manager)
     self._authentication_manager = manager.AuthenticationManager('auth-manager',
         self._event_hub, self._flow_manager, self._tap_manager, self._backend)
+
+    self._journal = None
+    self._journal_manager = None
+    if FLAGS.journal_dir:
+      self._logger.info('Using event journal: %s' % FLAGS.journal_dir)
+      self._journal = journal.EventJournal(FLAGS.journal_dir)
+      self._journal_manager = manager.JournalManager('journal',
+          self._event_hub, self._journal)
+
+    self._drink_outbox = outbox.DrinkOutbox(FLAGS.drink_outbox_dir)
     self._drink_manager = manager.DrinkManager('drink-manager', self._event_hub,
-        self._backend)
+        self._backend, self._drink_outbox, self._journal)
     self._thermo_manager = manager.ThermoManager('thermo-manager',
         self._event_hub, self._backend)
     self._subscription_manager = manager.SubscriptionManager('pubsub',
@@ -89,15 +106,23 @@ class KegbotEnv(object):
 
     # Build threads
     self._threads = set()
-    self._service_thread = kb_threads.EventHandlerThread(self, 'service-thread')
-    self._service_thread.AddEventHandler(self._tap_manager)
-    self._service_thread.AddEventHandler(self._flow_manager)
-    self._service_thread.AddEventHandler(self._drink_manager)
-    self._service_thread.AddEventHandler(self._thermo_manager)
-    self._service_thread.AddEventHandler(self._authentication_manager)
-    self._service_thread.AddEventHandler(self._subscription_manager)
-
-    self.AddThread(self._service_thread)
+    self._handler_pool = kb_threads.EventHandlerPool(self, 'service-thread')
+    self._handler_pool.AddEventHandler(self._tap_manager)
+    self._handler_pool.AddEventHandler(self._flow_manager)
+    self._handler_pool.AddEventHandler(self._drink_manager)
+    self._handler_pool.AddEventHandler(self._thermo_manager)
+    self._handler_pool.AddEventHandler(self._authentication_manager)
+    self._handler_pool.AddEventHandler(self._subscription_manager)
+    if self._journal_manager:
+      self._handler_pool.AddEventHandler(self._journal_manager)
+
+    self._event_hub.AddListener(self._handler_pool,
+        self._handler_pool.GetEventTypes())
+    for thr in self._handler_pool.GetThreads():
+      self.AddThread(thr)
+    self.AddThread(kb_threads.DrinkOutboxThread(self, 'outbox-thread'))
+    if self._journal:
+      self.AddThread(kb_threads.JournalWriterThread(self, 'journal-thread'))
 
     self.AddThread(kb_threads.EventHubServiceThread(self, 'eventhub-thread'))
     self.AddThread(kb_threads.NetProtocolThread(self, 'net-thread'))
@@ -110,7 +135,7 @@ class KegbotEnv(object):
   def AddThread(self, thr):
     self._threads.add(thr)
     if isinstance(thr, kb_threads.CoreThread):
-      self.GetEventHub().AddListener(thr)
+      self.GetEventHub().AddListener(thr, thr.GetEventTypes())
 
   def GetWatchdogThread(self):
     return self._watchdog_thread
@@ -118,6 +143,15 @@ class KegbotEnv(object):
   def GetAlarmManager(self):
     return self._alarm_manager
 
+  def GetJournal(self):
+    return self._journal
+
+  def GetDrinkOutbox(self):
+    return self._drink_outbox
+
+  def GetDrinkManager(self):
+    return self._drink_manager
+
   def GetBackend(self):
     return self._backend
 
@@ -187,9 +221,46 @@ class KegbotCoreApp(kb_app.App):
       self._env.GetTapManager().RegisterTap(tap.meter_name, tap.ml_per_tick,
           (1/tap.ml_per_tick*500), relay_name=tap.relay_name)
 
+    if FLAGS.prefetch_auth_tokens:
+      self._env.GetAuthenticationManager().PrefetchTokens()
+
+    if self._env.GetJournal():
+      self._RecoverFromJournal()
+
     for thr in self._env.GetThreads():
       self._AddAppThread(thr)
 
+  def _RecoverFromJournal(self):
+    """Rebuilds meter, token and flow state from the event journal.
+
+    Flows which completed without a drink being recorded are published again,
+    so that the DrinkManager records them once the core is running, and queued
+    drinks which were recorded just before the core stopped are dropped.
+    """
+    journal = self._env.GetJournal()
+    state = journal.Replay()
+    self._env.GetDrinkManager().DropRecordedDrinks(state.recorded_flows)
+
+    tap_manager = self._env.GetTapManager()
+    for tap_name, reading in state.meter_readings.iteritems():
+      if tap_manager.TapExists(tap_name):
+        tap_manager.GetTap(tap_name).GetMeter().RestoreReading(reading)
+
+    auth_manager = self._env.GetAuthenticationManager()
+    for event in state.tokens.values():
+      auth_manager.RestoreToken(event)
+
+    flow_manager = self._env.GetFlowManager()
+    for event in state.active_flows.values():
+      flow_manager.RestoreFlow(event)
+
+    for event in state.completed_flows.values():
+      self._logger.info('Re-publishing unrecorded flow: flow_id=0x%08x' %
+          event.flow_id)
+      self._env.GetEventHub().PublishEvent(event)
+
+    journal.Open(state)
+
   def Quit(self):
     self._do_quit = True
     event = kbevent.QuitEvent()
@@ -16,6 +16,7 @@ from pykeg.core import defaults
 from pykeg.core import kbevent
 from pykeg.core import models
 from pykeg.core import kb_common
+from pykeg.core import kb_threads
 from pykeg.core import units
 from pykeg.core.net import kegnet
 
@@ -63,9 +64,14 @@ class KegbotTestCase(TestCase):
         'baadcafebeeff00d', 'tester_2')
     kb_common.AUTH_TOKEN_MAX_IDLE['core.onewire'] = 2
 
-    # Kill the kegbot flow processing thread so we can single step it.
-    self.service_thread = self.env._service_thread
-    self.env._threads.remove(self.service_thread)
+    # Kill the kegbot event handler threads so we can single step them.
+    self.service_thread = self.env._handler_pool
+    for thr in self.service_thread.GetThreads():
+      self.env._threads.remove(thr)
+    # Likewise record queued drinks from the test thread.
+    for thr in list(self.env._threads):
+      if isinstance(thr, kb_threads.DrinkOutboxThread):
+        self.env._threads.remove(thr)
 
     self.kegbot._Setup()
     self.kegbot._StartThreads()
@@ -97,6 +103,7 @@ class KegbotTestCase(TestCase):
 
     self.client.SendFlowStop(meter_name)
     self.service_thread._FlushEvents()
+    self.env.GetDrinkManager().SendQueuedDrinks()
 
     drinks = self.test_keg.drinks.valid()
     self.assertEquals(len(drinks), 1)
@@ -152,6 +159,7 @@ class KegbotTestCase(TestCase):
     self.client.SendFlowStop(meter_name)
     time.sleep(1.0) # TODO(mikey): need a synchronous wait
     self.service_thread._FlushEvents()
+    self.env.GetDrinkManager().SendQueuedDrinks()
 
     drinks = self.test_keg.drinks.valid().order_by('id')
     self.assertEquals(len(drinks), 2)
@@ -169,11 +177,14 @@ class KegbotTestCase(TestCase):
     flows = self.env.GetFlowManager().GetActiveFlows()
     self.assertEquals(len(flows), 1)
 
-    # Rewind the flow activity clocks to simulate idleness.
+    # Rewind the flow activity clocks to simulate idleness, and pull in the
+    # flow's idle alarm.
     flows[0]._start_time -= datetime.timedelta(minutes=10)
     flows[0]._end_time = flows[0]._start_time
+    self.env.GetAlarmManager().UpdateAlarm('flow-idle:%s' % meter_name,
+        time.time())
 
-    # Wait for the heartbeat event to kick in.
+    # Wait for the alarm to fire.
     time.sleep(1.0)
     self.service_thread._FlushEvents()
 
@@ -28,6 +28,7 @@ from pykeg.core import backend
 from pykeg.core import flow_meter
 from pykeg.core import kb_common
 from pykeg.core import kbevent
+from pykeg.core import token_cache
 from pykeg.core import util
 
 
@@ -153,16 +154,20 @@ class TapManager(Manager):
 
 
 class Flow:
-  def __init__(self, tap, flow_id, username=None, max_idle_secs=10):
+  def __init__(self, tap, flow_id, username=None, max_idle_secs=10,
+      start_time=None):
+    if start_time is None:
+      start_time = datetime.datetime.now()
     self._tap = tap
     self._flow_id = flow_id
     self._bound_username = username
     self._max_idle = datetime.timedelta(seconds=max_idle_secs)
     self._state = kbevent.FlowUpdate.FlowState.INITIAL
-    self._start_time = datetime.datetime.now()
+    self._start_time = start_time
     self._end_time = None
     self._last_log_time = None
     self._total_ticks = 0L
+    self._last_pour_time = None
 
   def __str__(self):
     return '<Flow 0x%08x: tap=%s ticks=%s username=%s max_idle=%s>' % (self._flow_id,
@@ -186,6 +191,8 @@ class Flow:
     event.last_activity_time = end
     event.ticks = self.GetTicks()
     event.volume_ml = self.GetVolumeMl()
+    event.rate_ml_per_sec = self.GetRateMlPerSec()
+    event.instant_rate_ml_per_sec = self.GetInstantRateMlPerSec()
 
     return event
 
@@ -194,6 +201,8 @@ class Flow:
     if when is None:
       when = datetime.datetime.now()
     self._end_time = when
+    if self.GetRateMlPerSec() >= kb_common.FLOW_END_MIN_RATE_ML_PER_SEC:
+      self._last_pour_time = when
 
   def GetId(self):
     return self._flow_id
@@ -213,6 +222,12 @@ class Flow:
   def GetVolumeMl(self):
     return self._tap.TicksToMilliliters(self._total_ticks)
 
+  def GetRateMlPerSec(self):
+    return self._tap.TicksToMilliliters(self._tap.GetMeter().GetRate())
+
+  def GetInstantRateMlPerSec(self):
+    return self._tap.TicksToMilliliters(self._tap.GetMeter().GetInstantRate())
+
   def GetUsername(self):
     return self._bound_username
 
@@ -225,20 +240,38 @@ class Flow:
   def GetEndTime(self):
     return self._end_time
 
-  def GetIdleTime(self):
+  def GetIdleTime(self, now=None):
+    if now is None:
+      now = datetime.datetime.now()
     end_time = self._end_time
     if end_time is None:
       end_time = self._start_time
-    return datetime.datetime.now() - end_time
+    return now - end_time
 
   def GetMaxIdleTime(self):
     return self._max_idle
 
+  def GetIdleTimeRemaining(self):
+    """Returns the number of seconds until this flow becomes idle.
+
+    That is its maximum idle time after its last activity or, for an anonymous
+    flow, FLOW_END_SECS after it last poured at FLOW_END_MIN_RATE_ML_PER_SEC,
+    if that is sooner.
+    """
+    remain = self.GetMaxIdleTime() - self.GetIdleTime()
+    remain = remain.days * 86400 + remain.seconds + remain.microseconds / 1e6
+    if self._last_pour_time and not self._bound_username:
+      since_pour = datetime.datetime.now() - self._last_pour_time
+      pour_remain = kb_common.FLOW_END_SECS - (since_pour.days * 86400 +
+          since_pour.seconds + since_pour.microseconds / 1e6)
+      remain = min(remain, pour_remain)
+    return remain
+
   def GetTap(self):
     return self._tap
 
   def IsIdle(self):
-    return self.GetIdleTime() > self.GetMaxIdleTime()
+    return self.GetIdleTimeRemaining() < 0
 
 
 class FlowManager(Manager):
@@ -251,14 +284,23 @@ class FlowManager(Manager):
   Flows can be started in multiple ways:
     - Explicitly, by a call to StartFlow
     - Implicitly, by a call to HandleTapActivity
+
+  Each active flow has an idle alarm in the AlarmManager, which is re-armed
+  whenever the flow sees activity; the flow is ended when the alarm fires.
+
+  Flows are started and stopped from several event handler lanes at once (the
+  tap's own lane, and the shared lane for authentication on all taps), so the
+  flow map is only accessed with the lock held.
   """
-  def __init__(self, name, event_hub, tap_manager):
+  def __init__(self, name, event_hub, tap_manager, alarm_manager):
     Manager.__init__(self, name, event_hub)
     self._tap_manager = tap_manager
+    self._alarm_manager = alarm_manager
     self._flow_map = {}
+    self._relay_state = {}
     self._logger = logging.getLogger("flowmanager")
     self._next_flow_id = int(time.time())
-    self._lock = threading.Lock()
+    self._lock = threading.RLock()
 
   @util.synchronized
   def _GetNextFlowId(self):
@@ -288,13 +330,16 @@ class FlowManager(Manager):
 
     return ret
 
+  @util.synchronized
   def GetActiveFlows(self):
     return self._flow_map.values()
 
+  @util.synchronized
   def GetFlow(self, tap_name):
     return self._flow_map.get(tap_name)
 
-  def StartFlow(self, tap_name, username='', max_idle_secs=10):
+  @util.synchronized
+  def StartFlow(self, tap_name, username='', max_idle_secs=10, when=None):
     try:
       tap = self._tap_manager.GetTap(tap_name)
     except UnknownTapError:
@@ -317,25 +362,55 @@ class FlowManager(Manager):
     if current and current.GetUsername() == username:
       # Existing flow owned by this username.  Just poke it.
       current.SetMaxIdle(max_idle_secs)
+      self._ArmIdleAlarm(current)
       self._PublishUpdate(current)
       return current
     else:
       # No existing flow; start a new one.
       new_flow = Flow(tap, flow_id=self._GetNextFlowId(), username=username,
-          max_idle_secs=max_idle_secs)
+          max_idle_secs=max_idle_secs, start_time=when)
       self._flow_map[tap_name] = new_flow
       self._logger.info('Starting flow: %s' % new_flow)
+      self._ArmIdleAlarm(new_flow)
       self._PublishUpdate(new_flow)
 
       # Open up the relay if the flow is authenticated.
       if username:
-        self._PublishRelayEvent(new_flow, enable=True)
+        self._SetRelay(new_flow, enable=True)
       return new_flow
 
+  @util.synchronized
+  def RestoreFlow(self, event):
+    """Re-creates an active flow from its last FlowUpdate event.
+
+    Used to recover flows after a restart.  The restored flow keeps its
+    original id, owner, ticks and times, and gets the default idle timeout.
+    """
+    try:
+      tap = self._tap_manager.GetTap(event.tap_name)
+    except UnknownTapError:
+      self._logger.warning('Not restoring flow for unknown tap: %s' %
+          event.tap_name)
+      return None
+    flow = Flow(tap, flow_id=event.flow_id, username=event.username or '')
+    flow.AddTicks(event.ticks or 0, event.last_activity_time)
+    flow._start_time = event.start_time
+    flow.SetState(event.state)
+    self._flow_map[tap.GetName()] = flow
+    self._logger.info('Restored flow: %s' % flow)
+    self._ArmIdleAlarm(flow)
+    if flow.GetUsername():
+      self._SetRelay(flow, enable=True)
+    return flow
+
+  @util.synchronized
   def SetUsername(self, flow, username):
     flow.SetUsername(username)
     self._PublishUpdate(flow)
+    if username:
+      self._SetRelay(flow, enable=True)
 
+  @util.synchronized
   def StopFlow(self, tap_name, disable_relay=True):
     try:
       flow = self.GetFlow(tap_name)
@@ -345,13 +420,23 @@ class FlowManager(Manager):
       return None
 
     self._logger.info('Stopping flow: %s' % flow)
-    self._PublishRelayEvent(flow, enable=False)
-    tap = flow.GetTap()
+    self._alarm_manager.CancelAlarm(self._IdleAlarmName(tap_name))
+    if disable_relay:
+      self._SetRelay(flow, enable=False)
     del self._flow_map[tap_name]
     self._StateChange(flow, kbevent.FlowUpdate.FlowState.COMPLETED)
     return flow
 
-  def UpdateFlow(self, tap_name, meter_reading):
+  @util.synchronized
+  def UpdateFlow(self, tap_name, meter_reading, when=None):
+    """Adds a meter reading, taken at |when| (by default, now), to the tap's
+    flow, starting one if needed.
+
+    A reading taken after the flow had gone idle ends it and starts another,
+    so that readings replayed late still fall in separate flows.
+    """
+    if when is None:
+      when = datetime.datetime.now()
     try:
       tap = self._tap_manager.GetTap(tap_name)
     except TapManagerError:
@@ -368,11 +453,17 @@ class FlowManager(Manager):
 
     is_new = False
     flow = self.GetFlow(tap_name)
+    if flow is not None and flow.GetIdleTime(when) > flow.GetMaxIdleTime():
+      self._logger.info('Flow was idle before reading, ending: %s' % flow)
+      self._StateChange(flow, kbevent.FlowUpdate.FlowState.IDLE)
+      self.StopFlow(tap_name)
+      flow = None
     if flow is None:
       self._logger.debug('Starting flow implicitly due to activity.')
-      flow = self.StartFlow(tap_name)
+      flow = self.StartFlow(tap_name, when=when)
       is_new = True
-    flow.AddTicks(delta, datetime.datetime.now())
+    flow.AddTicks(delta, when)
+    self._ArmIdleAlarm(flow)
 
     if flow.GetState() != kbevent.FlowUpdate.FlowState.ACTIVE:
       self._StateChange(flow, kbevent.FlowUpdate.FlowState.ACTIVE)
@@ -402,22 +493,73 @@ class FlowManager(Manager):
         are emitted.
     """
     try:
-      flow_instance, is_new = self.UpdateFlow(event.tap_name, event.reading)
+      flow_instance, is_new = self.UpdateFlow(event.tap_name, event.reading,
+          event.event_time)
     except UnknownTapError:
       return None
 
-  @EventHandler(kbevent.HeartbeatSecondEvent)
-  def _HandleHeartbeatEvent(self, event):
-    for flow in self.GetActiveFlows():
-      tap = flow.GetTap()
-      if flow.IsIdle():
-        self._logger.info('Flow has become too idle, ending: %s' % flow)
-        self._StateChange(flow, kbevent.FlowUpdate.FlowState.IDLE)
-        self.StopFlow(flow.GetTap().GetName())
-      else:
-        if tap.GetRelayName():
-          if flow.GetUsername():
-            self._PublishRelayEvent(flow, enable=True)
+  def _IdleAlarmName(self, tap_name):
+    return 'flow-idle:%s' % tap_name
+
+  def _RelayAlarmName(self, relay_name):
+    return 'relay-keepalive:%s' % relay_name
+
+  def _ArmIdleAlarm(self, flow):
+    """(Re)schedules the idle alarm for |flow|."""
+    tap_name = flow.GetTap().GetName()
+    name = self._IdleAlarmName(tap_name)
+    expires_at = time.time() + max(0, flow.GetIdleTimeRemaining())
+    event = kbevent.TapIdleEvent(tap_name=tap_name, flow_id=flow.GetId())
+    self._alarm_manager.AddAlarm(name, expires_at, event)
+
+  @EventHandler(kbevent.TapIdleEvent)
+  @util.synchronized
+  def _HandleTapIdleEvent(self, event):
+    flow = self.GetFlow(event.tap_name)
+    if not flow or flow.GetId() != event.flow_id:
+      return
+    if flow.GetIdleTimeRemaining() > 0:
+      # Activity raced with the alarm; wait for the new deadline.
+      self._ArmIdleAlarm(flow)
+      return
+    self._logger.info('Flow has become too idle, ending: %s' % flow)
+    self._StateChange(flow, kbevent.FlowUpdate.FlowState.IDLE)
+    self.StopFlow(event.tap_name)
+
+  def _SetRelay(self, flow, enable=True):
+    """Sets the relay for |flow|'s tap, if any, to the requested state.
+
+    A SetRelayOutputEvent is only published when the state changes.  While the
+    relay is enabled, a keepalive alarm renews it every RELAY_KEEPALIVE_SECS.
+    """
+    relay = flow.GetTap().GetRelayName()
+    if not relay:
+      return
+    name = self._RelayAlarmName(relay)
+    if enable:
+      event = kbevent.RelayKeepaliveEvent(tap_name=flow.GetTap().GetName(),
+          flow_id=flow.GetId())
+      self._alarm_manager.AddAlarm(name,
+          time.time() + kb_common.RELAY_KEEPALIVE_SECS, event)
+    else:
+      self._alarm_manager.CancelAlarm(name)
+    if self._relay_state.get(relay) == enable:
+      return
+    self._relay_state[relay] = enable
+    self._PublishRelayEvent(flow, enable)
+
+  @EventHandler(kbevent.RelayKeepaliveEvent)
+  @util.synchronized
+  def _HandleRelayKeepaliveEvent(self, event):
+    flow = self.GetFlow(event.tap_name)
+    if not flow or flow.GetId() != event.flow_id:
+      return
+    relay = flow.GetTap().GetRelayName()
+    if not self._relay_state.get(relay):
+      return
+    self._PublishRelayEvent(flow, enable=True)
+    self._alarm_manager.AddAlarm(self._RelayAlarmName(relay),
+        time.time() + kb_common.RELAY_KEEPALIVE_SECS, event)
 
   def _PublishRelayEvent(self, flow, enable=True):
     self._logger.debug('Publishing relay event: flow=%s, enable=%s' % (flow,
@@ -445,14 +587,31 @@ class FlowManager(Manager):
 
 
 class DrinkManager(Manager):
-  def __init__(self, name, event_hub, backend):
+  """Records completed flows as drinks.
+
+  Completed flows are put in a DrinkOutbox, and recorded with the backend by
+  SendQueuedDrinks, which the core calls from its own thread.  A slow or
+  unavailable backend therefore never delays flow processing, and drinks are
+  retried until the backend accepts them.
+
+  If an EventJournal is given, the outcome of each drink is committed to it
+  before the drink leaves the outbox, so that a crash in between can never
+  cause the drink to be recorded twice.
+  """
+  def __init__(self, name, event_hub, backend, outbox, journal=None):
     Manager.__init__(self, name, event_hub)
     self._backend = backend
+    self._outbox = outbox
+    self._journal = journal
     self._last_drink = None
+    self._last_error = None
 
   def GetStatus(self):
     ret = []
     ret.append('Last drink: %s' % self._last_drink)
+    ret.extend(self._outbox.GetStatus())
+    if self._last_error:
+      ret.append('Last error: %s' % self._last_error)
     return ret
 
   @EventHandler(kbevent.FlowUpdate)
@@ -464,36 +623,108 @@ class DrinkManager(Manager):
   def _HandleFlowEnded(self, event):
     self._logger.info('Flow completed: flow_id=0x%08x' % event.flow_id)
 
-    ticks = event.ticks
-    username = event.username
     volume_ml = event.volume_ml
-    tap_name = event.tap_name
-    pour_time = event.last_activity_time
-    duration = (event.last_activity_time - event.start_time).seconds
-    flow_id = event.flow_id
-
-    # TODO: add to flow event
-    auth_token = None
 
     if volume_ml <= kb_common.MIN_VOLUME_TO_RECORD:
         self._logger.info('Not recording flow: volume (%i mL) <= '
             'MIN_VOLUME_TO_RECORD (%i)' % (volume_ml, kb_common.MIN_VOLUME_TO_RECORD))
         return
 
+    # TODO: add to flow event
+    auth_token = None
+
     # XXX mikey
     spilled = False
 
-    # Log the drink.  If the username is empty or invalid, the backend will
+    # Queue the drink.  If the username is empty or invalid, the backend will
     # assign it to the default (anonymous) user.  The backend will assign the
     # drink to a keg.
-    d = self._backend.RecordDrink(tap_name, ticks=ticks, username=username,
-        pour_time=pour_time, duration=duration, auth_token=auth_token,
-        spilled=spilled)
+    drink_args = {
+      'tap_name': event.tap_name,
+      'ticks': event.ticks,
+      'username': event.username,
+      'pour_time': event.last_activity_time,
+      'duration': (event.last_activity_time - event.start_time).seconds,
+      'auth_token': auth_token,
+      'spilled': spilled,
+    }
+    self._outbox.Put(event.flow_id, drink_args)
+
+  def SendQueuedDrinks(self):
+    """Records a batch of queued drinks with the backend, oldest first.
+
+    Stops at the first drink which fails with a (possibly) transient error, so
+    that drinks are always recorded in the order they were poured: that drink
+    and every later one stay queued, even if the backend returned results for
+    them.
+
+    The drinks are handed to the backend together, so that the web backend
+    can send them in one request.
+
+    Returns:
+      True if every drink attempted was recorded or rejected, False if the
+      backend failed and should be retried later.
+    """
+    entries = self._outbox.Peek()
+    if not entries:
+      return True
+    try:
+      results = self._backend.RecordDrinks([e.drink_args for e in entries])
+    except Exception, e:
+      results = [e]
+    ok = len(results) == len(entries)
+    done = []
+    for entry, result in zip(entries, results):
+      if isinstance(result, backend.BackendError):
+        self._logger.error('Backend rejected %s: %s; dropping it.' % (entry,
+            result))
+        self._last_error = result
+        done.append((entry, self._DiscardedEvent(entry), False))
+      elif isinstance(result, Exception):
+        entry.attempts += 1
+        self._logger.warning('Error recording %s (attempt %i): %s' % (entry,
+            entry.attempts, result))
+        self._last_error = result
+        ok = False
+        break
+      elif not result:
+        self._logger.warning('No drink recorded (spillage?).')
+        done.append((entry, self._DiscardedEvent(entry), True))
+      else:
+        done.append((entry, self._DrinkRecorded(entry, result), True))
+
+    if self._journal and done:
+      for entry, event, recorded in done:
+        self._journal.Append(event)
+      self._journal.Commit()
+    for entry, event, recorded in done:
+      if recorded:
+        self._outbox.Ack(entry)
+      else:
+        self._outbox.Reject(entry)
+      self._PublishEvent(event)
+    return ok
 
-    if not d:
-      self._logger.warning('No drink recorded (spillage?).')
-      return
+  def DropRecordedDrinks(self, flow_ids):
+    """Removes queued drinks whose flows the backend has already recorded.
 
+    Used on recovery, with the recorded flows from the journal: the core may
+    have stopped after committing a drink but before removing it from the
+    outbox.
+    """
+    flow_ids = set(flow_ids)
+    depth, age = self._outbox.GetDepthAndAge()
+    for entry in self._outbox.Peek(depth):
+      if entry.flow_id in flow_ids:
+        self._logger.info('Already recorded, dropping: %s' % entry)
+        self._outbox.Ack(entry)
+
+  def _DiscardedEvent(self, entry):
+    return kbevent.FlowDiscardedEvent(flow_id=entry.flow_id,
+        tap_name=entry.drink_args['tap_name'])
+
+  def _DrinkRecorded(self, entry, d):
+    """Returns the DrinkCreatedEvent for a recorded drink."""
     keg_id = d.keg_id or None
     username = d.user_id or '<None>'
 
@@ -502,23 +733,22 @@ class DrinkManager(Manager):
 
     self._last_drink = d
 
-    # notify listeners
     created = kbevent.DrinkCreatedEvent()
-    created.flow_id = flow_id
+    created.flow_id = entry.flow_id
     created.drink_id = d.id
-    created.tap_name = tap_name
+    created.tap_name = entry.drink_args['tap_name']
     created.start_time = d.pour_time
     created.end_time = d.pour_time
     if d.user_id:
       created.username = d.user_id
-    self._PublishEvent(created)
+    return created
 
 
 class ThermoManager(Manager):
   def __init__(self, name, event_hub, backend):
     Manager.__init__(self, name, event_hub)
     self._backend = backend
-    self._name_to_last_record = {}
+    self._name_to_last_record = {}  # maps sensor to (record time, value)
     self._sensor_log = {}
     seconds = kb_common.THERMO_RECORD_DELTA_SECONDS
     self._record_interval = datetime.timedelta(seconds=seconds)
@@ -529,7 +759,7 @@ class ThermoManager(Manager):
       ret.append('No readings.')
       return ret
     ret.append('Last recorded temperature(s):')
-    for sensor, value in self._name_to_last_record.iteritems():
+    for sensor, (record_time, value) in self._name_to_last_record.iteritems():
       ret.append('  %s: %.2f' % (sensor, value))
     return ret
 
@@ -548,7 +778,9 @@ class ThermoManager(Manager):
   def _HandleThermoUpdateEvent(self, event):
     sensor_name = event.sensor_name
     sensor_value = event.sensor_value
-    now = datetime.datetime.now()
+    received = datetime.datetime.now()
+    # Readings replayed from a client's spool carry the time they were taken.
+    now = event.event_time or received
 
     # Round down to nearest minute.
     now = now.replace(second=0, microsecond=0)
@@ -557,7 +789,7 @@ class ThermoManager(Manager):
     # Note: the backend may also be performing this check.
     last_record = self._name_to_last_record.get(sensor_name)
     if last_record:
-      last_time = last_record.record_time
+      last_time, last_value = last_record
       if last_time == now:
         self._logger.debug('Dropping excessive temp event')
         return
@@ -577,11 +809,13 @@ class ThermoManager(Manager):
       self._logger.info('Additional readings will only be shown with --verbose')
     else:
       self._logger.debug(log_message)
-    self._sensor_log[sensor_name] = now
+    self._sensor_log[sensor_name] = received
 
+    # The backend may not return the new record (the web backend sends readings
+    # in the background), so remember the time here.
     try:
-      new_record = self._backend.LogSensorReading(sensor_name, sensor_value, now)
-      self._name_to_last_record[sensor_name] = new_record
+      self._backend.LogSensorReading(sensor_name, sensor_value, now)
+      self._name_to_last_record[sensor_name] = (now, sensor_value)
     except ValueError:
       # Value was rejected by the backend; ignore.
       pass
@@ -634,9 +868,31 @@ class AuthenticationManager(Manager):
     self._flow_manager = flow_manager
     self._tap_manager = tap_manager
     self._backend = backend
+    self._token_cache = token_cache.TokenCache(backend)
     self._tokens = {}  # maps tap name to currently active token
     self._lock = threading.RLock()
 
+  def GetStatus(self):
+    return self._token_cache.GetStatus()
+
+  def PrefetchTokens(self):
+    """Loads every token from the backend into the token cache."""
+    count = self._token_cache.Prefetch()
+    if count is None:
+      self._logger.info('Backend cannot list tokens; not prefetching.')
+    else:
+      self._logger.info('Prefetched %i token(s).' % count)
+
+  @EventHandler(kbevent.TokenChangedEvent)
+  def HandleTokenChangedEvent(self, event):
+    if not event.auth_device_name and not event.token_value:
+      self._logger.info('Tokens changed; clearing token cache.')
+      self._token_cache.Invalidate()
+    else:
+      self._logger.info('Token changed: %s=%s' % (event.auth_device_name,
+          event.token_value))
+      self._token_cache.Invalidate(event.auth_device_name, event.token_value)
+
   @EventHandler(kbevent.TokenAuthEvent)
   def HandleAuthTokenEvent(self, event):
     for tap in self._GetTapsForTapName(event.tap_name):
@@ -658,14 +914,9 @@ class AuthenticationManager(Manager):
     """Called when the given token has been added.
 
     This will either start or renew a flow on the FlowManager."""
-    username = None
     tap_name = record.tap_name
-    try:
-      token = self._backend.GetAuthToken(record.auth_device, record.token_value)
-      username = token.username
-    except backend.NoTokenError:
-      pass
-
+    username = self._token_cache.GetUsername(record.auth_device,
+        record.token_value)
     if not username:
       self._logger.info('Token not assigned: %s' % record)
       return
@@ -690,23 +941,34 @@ class AuthenticationManager(Manager):
     else:
       self._logger.debug('Non-captive auth device, not ending flow.')
 
-  @util.synchronized
   def _TokenAdded(self, record):
     """Processes a record when a token is added."""
+    if self._AttachToken(record):
+      # The backend lookup may be slow, so it is made without holding the
+      # lock; events for other taps are handled concurrently meanwhile.
+      self._MaybeStartFlow(record)
+
+  @util.synchronized
+  def _AttachToken(self, record):
+    """Records |record| as the active token on its tap.
+
+    Returns True if the token is new to the tap, or False if it was already
+    attached.
+    """
     self._logger.info('Token attached: %s' % record)
     existing = self._tokens.get(record.tap_name)
 
     if existing == record:
       # Token is already known; nothing to do except update it.
       record.UpdateLastSeen()
-      return
+      return False
 
     if existing:
       self._logger.info('Removing previous token')
       self._TokenRemoved(existing)
 
     self._tokens[record.tap_name] = record
-    self._MaybeStartFlow(record)
+    return True
 
   @util.synchronized
   def _TokenRemoved(self, record):
@@ -719,6 +981,18 @@ class AuthenticationManager(Manager):
     del self._tokens[record.tap_name]
     self._MaybeEndFlow(record)
 
+  @util.synchronized
+  def RestoreToken(self, event):
+    """Marks the token in a TokenAuthEvent as attached, without starting a flow.
+
+    Used to recover token state after a restart.
+    """
+    for tap in self._GetTapsForTapName(event.tap_name):
+      record = TokenRecord(event.auth_device_name, event.token_value,
+          tap.GetName())
+      self._logger.info('Restored token: %s' % record)
+      self._tokens[tap.GetName()] = record
+
   def _GetTapsForTapName(self, tap_name):
     if tap_name == kb_common.ALIAS_ALL_TAPS:
       return self._tap_manager.GetAllTaps()
@@ -729,6 +1003,25 @@ class AuthenticationManager(Manager):
         return []
 
 
+class JournalManager(Manager):
+  """Appends the events needed for crash recovery to an EventJournal.
+
+  DrinkCreatedEvent and FlowDiscardedEvent are journaled by the DrinkManager.
+  """
+  def __init__(self, name, event_hub, journal):
+    Manager.__init__(self, name, event_hub)
+    self._journal = journal
+
+  def GetStatus(self):
+    return self._journal.GetStatus()
+
+  @EventHandler(kbevent.FlowUpdate)
+  @EventHandler(kbevent.MeterUpdate)
+  @EventHandler(kbevent.TokenAuthEvent)
+  def JournalEvent(self, event):
+    self._journal.Append(event)
+
+
 class SubscriptionManager(Manager):
   def __init__(self, name, event_hub, server):
     Manager.__init__(self, name, event_hub)
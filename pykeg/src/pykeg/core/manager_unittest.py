@@ -2,11 +2,18 @@
 
 """Unittest for manager module"""
 
+import datetime
+import shutil
+import tempfile
 import unittest
 
+from pykeg.core import alarm
+from pykeg.core import backend
+from pykeg.core import journal
 from pykeg.core import kbevent
 from pykeg.core import kb_common
 from pykeg.core import manager
+from pykeg.core import outbox
 
 class _MockKegbotCore(object):
   pass
@@ -15,7 +22,9 @@ class FlowManagerTestCase(unittest.TestCase):
   def setUp(self):
     event_hub = kbevent.EventHub()
     self.tap_manager = manager.TapManager("tap-manager", event_hub)
-    self.flow_manager = manager.FlowManager("flow-manager", event_hub, self.tap_manager)
+    self.alarm_manager = alarm.AlarmManager()
+    self.flow_manager = manager.FlowManager("flow-manager", event_hub,
+        self.tap_manager, self.alarm_manager)
     self.tap_manager.RegisterTap(name='flow0', ml_per_tick=1/2200.0,
         max_tick_delta=1100)
 
@@ -29,9 +38,9 @@ class FlowManagerTestCase(unittest.TestCase):
                       self.tap_manager.RegisterTap, 'flow0', 0, 0)
 
     # ...as should operations on an unknown device.
-    self.assertRaises(manager.UnknownDeviceError,
+    self.assertRaises(manager.UnknownTapError,
                       self.tap_manager.GetTap, 'flow_unknown')
-    self.assertRaises(manager.UnknownDeviceError,
+    self.assertRaises(manager.UnknownTapError,
                       self.tap_manager.UpdateDeviceReading, 'flow_unknown', 123)
 
     # Our new device should have accumulated 0 volume thus far.
@@ -52,76 +61,311 @@ class FlowManagerTestCase(unittest.TestCase):
     self.assertEqual(meter.GetLastReading(), 2100)
 
     # Report a reading that is much larger than the last reading. Values larger
-    # than the constant kb_common.MAX_METER_READING_DELTA should be ignored by
-    # the FlowManager.
-    illegal_delta = kb_common.MAX_METER_READING_DELTA + 100
-    new_reading = last_reading + illegal_delta
+    # than the tap's max_tick_delta should be ignored.
+    new_reading = 2100 + 1100 + 100
     self.tap_manager.UpdateDeviceReading(name='flow0', value=new_reading)
     # The illegal update should not affect the volume.
-    vol = self.flow_manager.GetDeviceVolume(name='flow0')
-    self.assertEqual(vol, 100L)
+    self.assertEqual(meter.GetTicks(), 100L)
     # The value of the last update should be recorded, however.
-    last_reading = self.flow_manager.GetDeviceLastReading(name='flow0')
-    self.assertEqual(last_reading, new_reading)
+    self.assertEqual(meter.GetLastReading(), new_reading)
 
   def testOverflowHandling(self):
     first_reading = 2**32 - 100    # start with very large number
     second_reading = 2**32 - 50    # increment by 50
-    overflow_reading = 10          # increment by 50+10 (overflow)
+    overflow_reading = 10          # overflow; only the 10 ticks after it count
 
+    meter = self.tap_manager.GetTap('flow0').GetMeter()
     self.tap_manager.UpdateDeviceReading('flow0', first_reading)
-    curr_reading = self.flow_manager.GetDeviceVolume('flow0')
-    self.assertEqual(curr_reading, 0)
+    self.assertEqual(meter.GetTicks(), 0)
 
     self.tap_manager.UpdateDeviceReading('flow0', second_reading)
-    curr_reading = self.flow_manager.GetDeviceVolume('flow0')
-    self.assertEqual(curr_reading, 50)
+    self.assertEqual(meter.GetTicks(), 50)
 
     self.tap_manager.UpdateDeviceReading('flow0', overflow_reading)
-    curr_reading = self.flow_manager.GetDeviceVolume('flow0')
-    self.assertEqual(curr_reading, 110)
+    self.assertEqual(meter.GetTicks(), 60)
 
   def testNoOverflow(self):
-    self.tap_manager.UpdateDeviceReading('flow0', 0)
-    curr_reading = self.flow_manager.GetDeviceVolume('flow0')
-    self.assertEqual(curr_reading, 0)
-
-    self.tap_manager.UpdateDeviceReading('flow0', 100)
-    curr_reading = self.flow_manager.GetDeviceVolume('flow0')
-    self.assertEqual(curr_reading, 100)
+    meter = self.tap_manager.GetTap('flow0').GetMeter()
+    self.tap_manager.UpdateDeviceReading('flow0', 5000)
+    self.tap_manager.UpdateDeviceReading('flow0', 5100)
+    self.assertEqual(meter.GetTicks(), 100)
 
-    self.tap_manager.UpdateDeviceReading('flow0', 10)
-    curr_reading = self.flow_manager.GetDeviceVolume('flow0')
-    self.assertEqual(curr_reading, 100)
+    # A drop too large to be a wraparound or reset is ignored...
+    self.tap_manager.UpdateDeviceReading('flow0', 3000)
+    self.assertEqual(meter.GetTicks(), 100)
 
-    self.tap_manager.UpdateDeviceReading('flow0', 20)
-    curr_reading = self.flow_manager.GetDeviceVolume('flow0')
-    self.assertEqual(curr_reading, 110)
+    # ...and counting resumes from it.
+    self.tap_manager.UpdateDeviceReading('flow0', 3020)
+    self.assertEqual(meter.GetTicks(), 120)
 
   def testActivityMonitoring(self):
-    self.tap_manager.UpdateDeviceReading('flow0', 0, when=0)
+    # The first reading only sets the meter's baseline.
+    self.assertEqual(self.flow_manager.UpdateFlow('flow0', 0), (None, None))
+    self.assertEqual(self.flow_manager.GetFlow('flow0'), None)
+
+    # Activity starts a flow...
+    flow, is_new = self.flow_manager.UpdateFlow('flow0', 10)
+    self.assert_(is_new)
+    self.assertEqual(flow.GetTicks(), 10)
+
+    # ...which later activity adds to.
+    self.assertEqual(self.flow_manager.UpdateFlow('flow0', 30), (flow, False))
+    self.assertEqual(flow.GetTicks(), 30)
+
+    # Updating the device again with zero delta changes nothing.
+    self.assertEqual(self.flow_manager.UpdateFlow('flow0', 30), (None, None))
+    self.assertEqual(flow.GetTicks(), 30)
+
+    # Unknown taps are ignored.
+    self.assertEqual(self.flow_manager.UpdateFlow('flow_unknown', 10),
+        (None, None))
+
+  def testReplayedReadings(self):
+    # Readings replayed after an outage: two pours, a minute apart.
+    poured = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    self.flow_manager.UpdateFlow('flow0', 0, poured)
+    first, is_new = self.flow_manager.UpdateFlow('flow0', 100, poured)
+    self.flow_manager.UpdateFlow('flow0', 200,
+        poured + datetime.timedelta(seconds=2))
+    self.assertEqual(first.GetStartTime(), poured)
+
+    poured += datetime.timedelta(minutes=1)
+    second, is_new = self.flow_manager.UpdateFlow('flow0', 300, poured)
+    self.assert_(is_new)
+    self.assertNotEqual(second.GetId(), first.GetId())
+    self.assertEqual(first.GetTicks(), 200)
+    self.assertEqual(first.GetEndTime(),
+        poured - datetime.timedelta(seconds=58))
+    self.assertEqual(second.GetTicks(), 100)
+    self.assertEqual(second.GetStartTime(), poured)
+
+
+class FlowIdleAlarmTestCase(unittest.TestCase):
+  def setUp(self):
+    self.event_hub = kbevent.EventHub()
+    self.alarm_manager = alarm.AlarmManager()
+    self.tap_manager = manager.TapManager("tap-manager", self.event_hub)
+    self.flow_manager = manager.FlowManager("flow-manager", self.event_hub,
+        self.tap_manager, self.alarm_manager)
+    self.tap_manager.RegisterTap(name='flow0', ml_per_tick=1/2200.0,
+        max_tick_delta=1100, relay_name='relay0')
+
+  def _PublishedEvents(self, event_type):
+    ret = []
+    while True:
+      ev = self.event_hub._WaitForEvent(timeout=0)
+      if ev is None:
+        return ret
+      if isinstance(ev, event_type):
+        ret.append(ev)
+
+  def testIdleAlarmEndsFlow(self):
+    flow = self.flow_manager.StartFlow('flow0', max_idle_secs=0.2)
+    alarm = self.alarm_manager.WaitForNextAlarm(2.0)
+    self.assert_(alarm is not None)
+    event = alarm.event()
+    self.assertEqual(event.flow_id, flow.GetId())
+    self.flow_manager._HandleTapIdleEvent(event)
+    self.assertEqual(self.flow_manager.GetFlow('flow0'), None)
+
+  def testActivityRearmsIdleAlarm(self):
+    flow = self.flow_manager.StartFlow('flow0', max_idle_secs=10)
+    first = self.alarm_manager._alarms_by_name['flow-idle:flow0'].fire_time()
+    self.flow_manager.UpdateFlow('flow0', 100)
+    self.flow_manager.UpdateFlow('flow0', 200)
+    second = self.alarm_manager._alarms_by_name['flow-idle:flow0'].fire_time()
+    self.assert_(second >= first)
+
+    # A stale alarm for an active flow does not end it.
+    event = kbevent.TapIdleEvent(tap_name='flow0', flow_id=flow.GetId())
+    self.flow_manager._HandleTapIdleEvent(event)
+    self.assertEqual(self.flow_manager.GetFlow('flow0'), flow)
+
+  def testRelayEventsOnlyOnChange(self):
+    self._PublishedEvents(kbevent.SetRelayOutputEvent)
+    self.flow_manager.StartFlow('flow0', username='user1')
+    self.flow_manager.StartFlow('flow0', username='user1')
+    events = self._PublishedEvents(kbevent.SetRelayOutputEvent)
+    self.assertEqual(len(events), 1)
+    self.assertEqual(events[0].output_mode, events[0].Mode.ENABLED)
+
+    self.flow_manager.StopFlow('flow0')
+    events = self._PublishedEvents(kbevent.SetRelayOutputEvent)
+    self.assertEqual(len(events), 1)
+    self.assertEqual(events[0].output_mode, events[0].Mode.DISABLED)
+
+
+class _FakeDrink(object):
+  def __init__(self, drink_id):
+    self.id = drink_id
+    self.keg_id = None
+    self.user_id = None
+    self.volume_ml = 100.0
+    self.ticks = 220
+    self.pour_time = datetime.datetime(2010, 1, 1, 12, 0, 0)
+
+class _FlakyBackend(backend.Backend):
+  """Backend whose RecordDrink fails while |self.error| is set.
+
+  If |fail_tap| is set, only drinks on that tap fail.
+  """
+  def __init__(self):
+    self.error = None
+    self.fail_tap = None
+    self.recorded = []
+
+  def RecordDrink(self, tap_name, **kwargs):
+    if self.error and self.fail_tap in (None, tap_name):
+      raise self.error
+    self.recorded.append(tap_name)
+    return _FakeDrink(len(self.recorded))
+
+class DrinkOutboxTestCase(unittest.TestCase):
+  def setUp(self):
+    self.event_hub = kbevent.EventHub()
+    self.backend = _FlakyBackend()
+    self.outbox = outbox.DrinkOutbox()
+    self.drink_manager = manager.DrinkManager('drink-manager',
+        self.event_hub, self.backend, self.outbox)
+
+  def _EndFlow(self, flow_id, tap_name='flow0'):
+    now = datetime.datetime(2010, 1, 1, 12, 0, 0)
+    event = kbevent.FlowUpdate(flow_id=flow_id, tap_name=tap_name,
+        state=kbevent.FlowUpdate.FlowState.COMPLETED, username='',
+        start_time=now, last_activity_time=now, ticks=220, volume_ml=100.0)
+    self.drink_manager.HandleFlowUpdateEvent(event)
+
+  def _CreatedEvents(self, event_type=kbevent.DrinkCreatedEvent):
+    ret = []
+    while True:
+      ev = self.event_hub._WaitForEvent(timeout=0)
+      if ev is None:
+        return ret
+      if isinstance(ev, event_type):
+        ret.append(ev)
+
+  def testFlowEndOnlyQueues(self):
+    self._EndFlow(1)
+    self.assertEqual(self.backend.recorded, [])
+    self.assertEqual(self.outbox.GetDepthAndAge()[0], 1)
+
+  def testRetryUntilRecorded(self):
+    self.backend.error = IOError('connection refused')
+    self._EndFlow(1, 'flow0')
+    self._EndFlow(2, 'flow1')
+    self.assertFalse(self.drink_manager.SendQueuedDrinks())
+    self.assertEqual(self.outbox.GetDepthAndAge()[0], 2)
+    self.assertEqual(self._CreatedEvents(), [])
+
+    self.backend.error = None
+    self.assert_(self.drink_manager.SendQueuedDrinks())
+    self.assertEqual(self.backend.recorded, ['flow0', 'flow1'])
+    self.assertEqual(self.outbox.GetDepthAndAge()[0], 0)
+    self.assertEqual([e.flow_id for e in self._CreatedEvents()], [1, 2])
+
+  def testLaterDrinksWaitForFailedOne(self):
+    self.backend.error = IOError('connection refused')
+    self.backend.fail_tap = 'flow1'
+    for flow_id, tap_name in enumerate(['flow0', 'flow1', 'flow2']):
+      self._EndFlow(flow_id, tap_name)
+    self.assertFalse(self.drink_manager.SendQueuedDrinks())
+    self.assertEqual(self.backend.recorded, ['flow0'])
+    self.assertEqual(self.outbox.GetDepthAndAge()[0], 2)
+
+  def testResultsAfterFailureIgnored(self):
+    # A backend which carried on past the failed drink.
+    self.backend.RecordDrinks = lambda drinks: [_FakeDrink(1),
+        IOError('timed out'), _FakeDrink(2)]
+    for flow_id, tap_name in enumerate(['flow0', 'flow1', 'flow2']):
+      self._EndFlow(flow_id, tap_name)
+    self.assertFalse(self.drink_manager.SendQueuedDrinks())
+    self.assertEqual([e.flow_id for e in self.outbox.Peek()], [1, 2])
+    self.assertEqual([e.flow_id for e in self._CreatedEvents()], [0])
+
+  def testRejectedDrinkIsDropped(self):
+    self.backend.error = backend.BackendError('Tap unknown')
+    self._EndFlow(1)
+    self.assert_(self.drink_manager.SendQueuedDrinks())
+    self.assertEqual(self.outbox.GetDepthAndAge()[0], 0)
+    # The journal is told that the flow will never become a drink.
+    events = self._CreatedEvents(kbevent.Event)
+    self.assertEqual([(e.__class__, e.flow_id) for e in events],
+        [(kbevent.FlowDiscardedEvent, 1)])
+
+
+class _Crash(Exception):
+  """Stands in for the core dying."""
+
+class DrinkJournalTestCase(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.backend = _FlakyBackend()
+    self._Start()
+
+  def tearDown(self):
+    self.journal.Close()
+    shutil.rmtree(self.path)
+
+  def _Start(self):
+    """Starts the drink manager as the core does, recovering from the journal.
+
+    Returns the recovered JournalState.
+    """
+    self.journal = journal.EventJournal(self.path + '/journal')
+    self.outbox = outbox.DrinkOutbox(self.path + '/outbox')
+    self.drink_manager = manager.DrinkManager('drink-manager',
+        kbevent.EventHub(), self.backend, self.outbox, self.journal)
+    state = self.journal.Replay()
+    self.drink_manager.DropRecordedDrinks(state.recorded_flows)
+    self.journal.Open(state)
+    return state
+
+  def _Crash(self, *args):
+    raise _Crash()
+
+  def testCrashBeforeAck(self):
+    now = datetime.datetime(2010, 1, 1, 12, 0, 0)
+    event = kbevent.FlowUpdate(flow_id=1, tap_name='flow0',
+        state=kbevent.FlowUpdate.FlowState.COMPLETED, username='',
+        start_time=now, last_activity_time=now, ticks=220, volume_ml=100.0)
+    self.drink_manager.HandleFlowUpdateEvent(event)
+    self.journal.Append(event)
+
+    # The drink is recorded, but the core dies before removing it from the
+    # outbox.
+    self.outbox.Ack = self._Crash
+    self.assertRaises(_Crash, self.drink_manager.SendQueuedDrinks)
+    self.assertEqual(self.backend.recorded, ['flow0'])
+    self.journal.Close()
 
-    # initial idle time should be infinite (should return `now`)
-    idle_time = self.flow_manager.GetDeviceIdleSeconds('flow0', now=1000)
-    self.assertEqual(idle_time, 1000)
+    state = self._Start()
+    self.assertEqual(state.completed_flows, {})
+    self.assertEqual(self.outbox.GetDepthAndAge()[0], 0)
+    self.assert_(self.drink_manager.SendQueuedDrinks())
+    self.assertEqual(self.backend.recorded, ['flow0'])
 
-    self.tap_manager.UpdateDeviceReading('flow0', 10, when=10)
-    self.tap_manager.UpdateDeviceReading('flow0', 30, when=15)
 
-    idle_time = self.flow_manager.GetDeviceIdleSeconds('flow0', now=20)
-    self.assertEqual(idle_time, 5)
+class _ThermoBackend(backend.Backend):
+  """Backend which logs readings without returning a record."""
+  def __init__(self):
+    self.readings = []
 
-    # Updating the device again with zero delta should not clear existing idle
-    # time.
-    self.tap_manager.UpdateDeviceReading('flow0', 30, when=30)
-    idle_time = self.flow_manager.GetDeviceIdleSeconds('flow0', now=40)
-    self.assertEqual(idle_time, 25)
+  def LogSensorReading(self, sensor_name, temperature, when=None):
+    self.readings.append((sensor_name, temperature))
+    return None
 
-    # Updating the device with negative delta should also leave idle time
-    # unchanged.
-    self.tap_manager.UpdateDeviceReading('flow0', 10, when=50)
-    idle_time = self.flow_manager.GetDeviceIdleSeconds('flow0', now=60)
-    self.assertEqual(idle_time, 45)
+class ThermoManagerTestCase(unittest.TestCase):
+  def testOneReadingPerMinute(self):
+    thermo_backend = _ThermoBackend()
+    thermo_manager = manager.ThermoManager('thermo-manager',
+        kbevent.EventHub(), thermo_backend)
+    for i in xrange(3):
+      for sensor_name in ('t0', 't1'):
+        thermo_manager._HandleThermoUpdateEvent(kbevent.ThermoEvent(
+            sensor_name=sensor_name, sensor_value=4.0 + i))
+    # Each sensor is logged once, or twice if the minute changed meanwhile.
+    self.assert_(len(thermo_backend.readings) <= 4)
+    self.assertEqual(thermo_backend.readings[:2], [('t0', 4.0), ('t1', 4.0)])
 
 
 if __name__ == '__main__':
@@ -37,8 +37,6 @@ from pykeg.core import stats
 from pykeg.core import units
 from pykeg.core import util
 
-from pykeg.proto import models_pb2
-from pykeg.proto import protoutil
 
 from pykeg.web.api.apikey import ApiKey
 
@@ -56,15 +54,14 @@ def misc_file_name(instance, filename):
   new_filename = '%04x-%s' % (rand_salt, filename)
   return os.path.join('misc', new_filename)
 
+def _next_seqn(model, site):
+  last = model.objects.filter(site=site).aggregate(models.Max('seqn'))
+  return (last['seqn__max'] or 0) + 1
+
 def _set_seqn_pre_save(sender, instance, **kwargs):
   if instance.seqn:
     return
-  prev = sender.objects.filter(site=instance.site).order_by('-seqn')
-  if not prev.count():
-    seqn = 1
-  else:
-    seqn = prev[0].seqn + 1
-  instance.seqn = seqn
+  instance.seqn = _next_seqn(sender, instance.site)
 
 
 class KegbotSite(models.Model):
@@ -131,7 +128,7 @@ class UserProfile(models.Model):
       self._stats = qs[0].stats
     else:
       self._stats = {}
-    self._stats = protoutil.DictToProtoMessage(self._stats, models_pb2.Stats())
+    self._stats = stats.StatsToProto(self._stats)
     return self._stats
 
   def RecomputeStats(self):
@@ -268,7 +265,7 @@ class Keg(models.Model):
       self._stats = qs[0].stats
     else:
       self._stats = {}
-    self._stats = protoutil.DictToProtoMessage(self._stats, models_pb2.Stats())
+    self._stats = stats.StatsToProto(self._stats)
     return self._stats
 
   def RecomputeStats(self):
@@ -443,6 +440,18 @@ class Drink(models.Model):
       stats, created = self.session.stats.get_or_create(defaults=defaults)
       stats.Update(self)
 
+  def _RemoveFromStats(self):
+    querysets = [SystemStats.objects.filter(site=self.site_id)]
+    if self.user:
+      querysets.append(self.user.stats.all())
+    if self.keg:
+      querysets.append(self.keg.stats.all())
+    if self.session:
+      querysets.append(self.session.stats.all())
+    for qs in querysets:
+      for stats in qs:
+        stats.RemoveDrink(self)
+
   def PostProcess(self):
     self._UpdateSystemStats()
     self._UpdateUserStats()
@@ -546,32 +555,14 @@ class BAC(models.Model):
 
 
 def find_session_in_window(qset, when, window):
+  # Every session which ends just before |when|, or starts just after it, also
+  # overlaps the window around it, so a single query finds them all.
   matching = qset.filter(
       starttime__lte=when + window,
       endtime__gte=when - window
-  )
-
+  )[:1]
   if matching:
     return matching[0]
-
-  # Match objects ending just before the start
-  earlier = qset.filter(
-      endtime__gte=(when - window),
-      starttime__lt=when,
-  )
-
-  if earlier:
-    return earlier[0]
-
-  # Match objects occuring just after the end
-  newer = qset.filter(
-      starttime__lte=(when - window),
-      endtime__gt=when,
-  )
-
-  if newer:
-    return newer[0]
-
   return None
 
 
@@ -604,7 +595,9 @@ class AbstractChunk(models.Model):
 
   def AddDrink(self, drink):
     self._AddDrinkNoSave(drink)
-    self.save()
+    # The chunk always exists by now; forcing an update saves the query Django
+    # would make to find that out.
+    self.save(force_update=True)
 
 
 class DrinkingSession(AbstractChunk):
@@ -651,7 +644,7 @@ class DrinkingSession(AbstractChunk):
       self._stats = qs[0].stats
     else:
       self._stats = {}
-    self._stats = protoutil.DictToProtoMessage(self._stats, models_pb2.Stats())
+    self._stats = stats.StatsToProto(self._stats)
     return self._stats
 
   def summarize_drinkers(self):
@@ -697,23 +690,41 @@ class DrinkingSession(AbstractChunk):
     return self.endtime - self.startime
 
   def AddDrink(self, drink):
-    super(DrinkingSession, self).AddDrink(drink)
-    defaults = {'starttime': drink.starttime, 'endtime': drink.starttime}
+    self._AddDrinkNoSave(drink)
+    # Only the times and volume change.  Saving the instance would run the
+    # pre_save handlers, which recompute the slug.
+    DrinkingSession.objects.filter(pk=self.pk).update(
+        starttime=self.starttime, endtime=self.endtime,
+        volume_ml=self.volume_ml)
 
     # Update or create a SessionChunk.
-    chunk, created = SessionChunk.objects.get_or_create(session=self,
-        user=drink.user, keg=drink.keg, defaults=defaults)
-    chunk.AddDrink(drink)
+    _add_drink_to_chunk(SessionChunk, drink, session=self, user=drink.user,
+        keg=drink.keg)
 
     # Update or create a UserSessionChunk.
-    chunk, created = UserSessionChunk.objects.get_or_create(session=self,
-        user=drink.user, defaults=defaults)
-    chunk.AddDrink(drink)
+    _add_drink_to_chunk(UserSessionChunk, drink, session=self,
+        user=drink.user)
 
     # Update or create a KegSessionChunk.
-    chunk, created = KegSessionChunk.objects.get_or_create(session=self,
-        keg=drink.keg, defaults=defaults)
-    chunk.AddDrink(drink)
+    _add_drink_to_chunk(KegSessionChunk, drink, session=self, keg=drink.keg)
+
+  def RemoveDrink(self, drink):
+    """Takes a cancelled |drink| out of the session and its chunks.
+
+    Each is recomputed from its remaining drinks with a single aggregate
+    query, rather than rebuilt drink by drink.  Chunks left without drinks
+    are deleted; the session is kept.
+    """
+    drinks = self.drinks.valid().exclude(pk=drink.pk)
+    _recompute_chunks(DrinkingSession.objects.filter(pk=self.pk), drinks,
+        delete_empty=False)
+    _recompute_chunks(SessionChunk.objects.filter(session=self,
+        user=drink.user, keg=drink.keg),
+        drinks.filter(user=drink.user, keg=drink.keg))
+    _recompute_chunks(UserSessionChunk.objects.filter(session=self,
+        user=drink.user), drinks.filter(user=drink.user))
+    _recompute_chunks(KegSessionChunk.objects.filter(session=self,
+        keg=drink.keg), drinks.filter(keg=drink.keg))
 
   def UserChunksByVolume(self):
     chunks = self.user_chunks.all().order_by('-volume_ml')
@@ -753,19 +764,17 @@ class DrinkingSession(AbstractChunk):
     q = drink.site.sessions.all()
     window = datetime.timedelta(minutes=kb_common.DRINK_SESSION_TIME_MINUTES)
     session = find_session_in_window(q, drink.starttime, window)
-    if session:
-      session.AddDrink(drink)
-      drink.session = session
-      drink.save()
-      return session
+    if not session:
+      # Create a new session
+      session = cls(starttime=drink.starttime, endtime=drink.starttime,
+          site=drink.site)
+      session.save()
 
-    # Create a new session
-    session = cls(starttime=drink.starttime, endtime=drink.starttime,
-        site=drink.site)
-    session.save()
     session.AddDrink(drink)
     drink.session = session
-    drink.save()
+    # A new drink is left for the caller to save, so it is inserted just once.
+    if drink.pk is not None:
+      drink.save()
     return session
 
 def _DrinkingSessionPreSave(sender, instance, **kwargs):
@@ -780,6 +789,27 @@ def _DrinkingSessionPreSave(sender, instance, **kwargs):
 pre_save.connect(_set_seqn_pre_save, sender=DrinkingSession)
 pre_save.connect(_DrinkingSessionPreSave, sender=DrinkingSession)
 
+def _recompute_chunks(chunks, drinks, delete_empty=True):
+  agg = drinks.aggregate(models.Min('starttime'), models.Max('starttime'),
+      models.Sum('volume_ml'))
+  if agg['volume_ml__sum'] is not None:
+    chunks.update(starttime=agg['starttime__min'],
+        endtime=agg['starttime__max'], volume_ml=agg['volume_ml__sum'])
+  elif delete_empty:
+    chunks.delete()
+  else:
+    chunks.update(volume_ml=0)
+
+def _add_drink_to_chunk(model, drink, **kwargs):
+  defaults = {
+    'starttime': drink.starttime,
+    'endtime': drink.starttime,
+    'volume_ml': drink.volume_ml,
+  }
+  chunk, created = model.objects.get_or_create(defaults=defaults, **kwargs)
+  if not created:
+    chunk.AddDrink(drink)
+
 
 class SessionChunk(AbstractChunk):
   """A specific user and keg contribution to a session."""
@@ -1021,10 +1051,19 @@ class _StatsModel(models.Model):
   def Update(self, drink, force=False):
     previous = None
     if not force and self.stats:
-      previous = protoutil.DictToProtoMessage(self.stats, models_pb2.Stats())
+      previous = self.stats
     builder = self.STATS_BUILDER(drink, previous)
-    self.stats = protoutil.ProtoMessageToDict(builder.Build())
-    self.save()
+    self.stats = builder.Build()
+    self.save(force_update=self.pk is not None)
+
+  def RemoveDrink(self, drink):
+    """Takes |drink| out of the stats, if they include it."""
+    last_drink_id = self.stats and self.stats.get('last_drink_id')
+    if not last_drink_id or drink.seqn > int(last_drink_id):
+      return
+    builder = self.STATS_BUILDER(drink, self.stats)
+    self.stats = builder.Subtract()
+    self.save(force_update=True)
 
 
 class SystemStats(_StatsModel):
@@ -1130,32 +1169,39 @@ class SystemEvent(models.Model):
     site = drink.site
     user = drink.user
 
+    # Find which of the drink's events already exist in a single query.
+    q = models.Q(kind='drink_poured', drink=drink)
     if keg:
-      q = keg.events.filter(kind='keg_tapped')
-      if q.count() == 0:
-        e = keg.events.create(site=site, kind='keg_tapped', when=drink.starttime,
-            keg=keg, user=user, drink=drink, session=session)
-        e.save()
-
+      q |= models.Q(kind='keg_tapped', keg=keg)
     if session:
-      q = session.events.filter(kind='session_started')
-      if q.count() == 0:
-        e = session.events.create(site=site, kind='session_started',
-            when=session.starttime, drink=drink, user=user)
-        e.save()
-
+      q |= models.Q(kind='session_started', session=session)
     if user:
-      q = user.events.filter(kind='session_joined', session=session)
-      if q.count() == 0:
-        e = user.events.create(site=site, kind='session_joined',
-            when=drink.starttime, session=session, drink=drink, user=user)
+      q |= models.Q(kind='session_joined', session=session, user=user)
+    existing = set(cls.objects.filter(q).values_list('kind', flat=True))
+
+    events = []
+    if keg and 'keg_tapped' not in existing:
+      events.append(cls(kind='keg_tapped', when=drink.starttime,
+          keg=keg, user=user, drink=drink, session=session))
+
+    if session and 'session_started' not in existing:
+      events.append(cls(kind='session_started', when=session.starttime,
+          session=session, drink=drink, user=user))
+
+    if user and 'session_joined' not in existing:
+      events.append(cls(kind='session_joined', when=drink.starttime,
+          session=session, drink=drink, user=user))
+
+    if 'drink_poured' not in existing:
+      events.append(cls(kind='drink_poured', when=drink.starttime,
+          drink=drink, user=user, keg=keg, session=session))
+
+    if events:
+      seqn = _next_seqn(cls, site)
+      for e in events:
+        e.site = site
+        e.seqn = seqn
         e.save()
-
-    q = drink.events.filter(kind='drink_poured')
-    if q.count() == 0:
-      e = drink.events.create(site=site, kind='drink_poured',
-          when=drink.starttime, drink=drink, user=user, keg=keg,
-          session=session)
-      e.save()
+        seqn += 1
 
 pre_save.connect(_set_seqn_pre_save, sender=SystemEvent)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""Benchmark comparing kegnet message decoding with JSON and binary framing.
+
+Reports the number of MeterUpdate and FlowUpdate messages decoded per second
+on each path, including the conversion to a kbevent.Event.
+"""
+
+import datetime
+import sys
+import time
+
+import gflags
+
+from pykeg.core import kbevent
+from pykeg.core import kbjson
+from pykeg.core.net import binproto
+
+FLAGS = gflags.FLAGS
+
+NUM_MESSAGES = 50000
+
+def _DecodeJson(data):
+  return kbevent.DecodeEvent(kbjson.loads(data))
+
+def _DecodeBinary(data):
+  return binproto.DecodeEvent(data)
+
+def _Time(decoder, data):
+  start = time.time()
+  for i in xrange(NUM_MESSAGES):
+    decoder(data)
+  return NUM_MESSAGES / (time.time() - start)
+
+def main():
+  FLAGS(sys.argv)
+  now = datetime.datetime(2010, 6, 1, 18, 30, 15)
+  events = [
+    kbevent.MeterUpdate(tap_name='kegboard.flow0', reading=123456),
+    kbevent.FlowUpdate(flow_id=1275421815, tap_name='kegboard.flow0',
+        state=kbevent.FlowUpdate.FlowState.ACTIVE, username='guest',
+        start_time=now, last_activity_time=now, ticks=2200,
+        volume_ml=1000.0),
+  ]
+  for event in events:
+    json_rate = _Time(_DecodeJson, event.ToJson(indent=None))
+    binary_rate = _Time(_DecodeBinary, binproto.EncodeEvent(event))
+    print '%12s: json %8.0f msgs/sec, binary %8.0f msgs/sec (%.1fx)' % (
+        event.__class__.__name__, json_rate, binary_rate,
+        binary_rate / json_rate)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""Unittest for binproto module"""
+
+import datetime
+import marshal
+import unittest
+
+from pykeg.core import kbevent
+from pykeg.core.net import binproto
+
+class BinprotoTestCase(unittest.TestCase):
+  def testRoundTrip(self):
+    now = datetime.datetime(2010, 6, 1, 18, 30, 15, 123456)
+    event = kbevent.FlowUpdate(flow_id=0x1234, tap_name=u'kegboard.flow0',
+        state=kbevent.FlowUpdate.FlowState.ACTIVE, username='',
+        start_time=now, last_activity_time=None, ticks=2200, volume_ml=1000.5)
+    decoded = binproto.DecodeEvent(binproto.EncodeEvent(event))
+    self.assert_(isinstance(decoded, kbevent.FlowUpdate))
+    self.assertEqual(decoded.AsDict(), event.AsDict())
+
+  def testAllEventTypesEncodable(self):
+    for cls in kbevent.EVENT_NAME_TO_CLASS.values():
+      self.assert_(cls in binproto.EVENT_TYPE_CODES, cls.__name__)
+      decoded = binproto.DecodeEvent(binproto.EncodeEvent(cls()))
+      self.assert_(isinstance(decoded, cls))
+
+  def testSmallerThanJson(self):
+    event = kbevent.MeterUpdate(tap_name='kegboard.flow0', reading=123456)
+    self.assert_(len(binproto.EncodeEvent(event)) <
+        len(event.ToJson(indent=None)))
+
+  def testBadFrames(self):
+    frame = binproto.EncodeEvent(kbevent.MeterUpdate(tap_name='t', reading=1))
+    self.assertRaises(binproto.FrameError, binproto.DecodeEvent, frame[:-1])
+    self.assertRaises(binproto.FrameError, binproto.DecodeFrame, 9999, '')
+    self.assertRaises(binproto.FrameError, binproto.DecodeFrame, 4, 'junk')
+
+    # Too few fields.
+    payload = marshal.dumps((1,))
+    self.assertRaises(binproto.FrameError, binproto.DecodeFrame, 4, payload)
+
+    # Only scalar values are accepted.
+    payload = marshal.dumps(([1], 'tap'))
+    self.assertRaises(binproto.FrameError, binproto.DecodeFrame, 4, payload)
+
+  def testAddedFields(self):
+    # The rate fields follow the fields FlowUpdate had when its layout was
+    # fixed, so frames without them still decode.
+    fields = binproto.EVENT_FIELDS[kbevent.FlowUpdate]
+    self.assertEqual(fields[-2:], ('instant_rate_ml_per_sec',
+        'rate_ml_per_sec'))
+    self.assertEqual(list(fields[:-2]), sorted(fields[:-2]))
+
+    now = datetime.datetime(2010, 6, 1, 18, 30, 15)
+    values = dict((name, None) for name in fields)
+    values.update(flow_id=1, tap_name='flow0', ticks=10,
+        start_time=binproto._DatetimeToMicros(now), rate_ml_per_sec=4.5)
+    payload = tuple(values[name] for name in fields)
+    code = binproto.EVENT_TYPE_CODES[kbevent.FlowUpdate]
+
+    event = binproto.DecodeFrame(code, marshal.dumps(payload[:-2]))
+    self.assertEqual(event.ticks, 10)
+    self.assertEqual(event.start_time, now)
+    self.assertEqual(event.rate_ml_per_sec, None)
+
+    # Values added by a newer layout are ignored.
+    event = binproto.DecodeFrame(code, marshal.dumps(payload + (1, 2)))
+    self.assertEqual(event.rate_ml_per_sec, 4.5)
+
+  def testEventTime(self):
+    now = datetime.datetime(2010, 6, 1, 18, 30, 15)
+    event = kbevent.MeterUpdate(tap_name='flow0', reading=10, event_time=now)
+    self.assertEqual(binproto.DecodeEvent(binproto.EncodeEvent(event)),
+        event)
+    # Frames from peers which predate event_time still decode.
+    code = binproto.EVENT_TYPE_CODES[kbevent.MeterUpdate]
+    event = binproto.DecodeFrame(code, marshal.dumps((10, 'flow0')))
+    self.assertEqual(event.reading, 10)
+    self.assertEqual(event.event_time, None)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -25,10 +25,17 @@
 
 import asyncore
 import asynchat
+import collections
 import cStringIO
+import datetime
+import errno
+import fnmatch
 import logging
+import os
 import Queue
+import re
 import socket
+import stat
 import struct
 import sys
 import threading
@@ -40,6 +47,8 @@ from pykeg.core import kbevent
 from pykeg.core import kbjson
 from pykeg.core import kb_common
 from pykeg.core import util
+from pykeg.core.net import binproto
+from pykeg.core.net import reactor
 
 FLAGS = gflags.FLAGS
 
@@ -54,8 +63,90 @@ gflags.DEFINE_string('kb_core_bind_addr', kb_common.KB_CORE_DEFAULT_ADDR,
 gflags.DEFINE_string('tap_name', 'kegboard.flow0',
     'Default tap name.')
 
+gflags.DEFINE_enum('kegnet_transport', 'poll', ['poll', 'asyncore'],
+    'Socket implementation used by kegnet servers and clients. "poll" uses '
+    'a poll()-based reactor; "asyncore" is the original implementation.')
+
+gflags.DEFINE_integer('kegnet_max_output_buffer', 256*1024,
+    'Maximum number of bytes queued for sending on a kegnet connection. A '
+    'server disconnects clients which fall further behind than this; a '
+    'client drops messages.')
+
+gflags.DEFINE_boolean('kegnet_binary_framing', True,
+    'If true, kegnet connections using the poll transport negotiate the '
+    'binary message framing (see binproto.py) in place of JSON when the '
+    'other end supports it.')
+
+gflags.DEFINE_string('kegnet_unix_socket_dir',
+    kb_common.KB_CORE_DEFAULT_UNIX_SOCKET_DIR,
+    'Directory in which the kegnet server also listens on a Unix domain '
+    'socket, named after its TCP port. Clients connecting to a core on the '
+    'local host use it in place of TCP, if the socket is owned by the same '
+    'user as the client or by root. If empty, only TCP is used.')
+
 MESSAGE_TERMINATOR = '\n\n'
 
+# Framing negotiation messages, sent as JSON-framed messages.  A client offers
+# binary framing with BINARY_OFFER; each end then sends BINARY_SWITCH to mark
+# that everything it sends afterwards is binary.  Peers without binary support
+# drop both as malformed messages, and the connection stays on JSON.  The
+# version is bumped whenever binproto's layout changes in a way older peers
+# cannot decode (version 2 added the FlowUpdate rate fields), so that peers of
+# different versions fall back to JSON.
+BINARY_OFFER = 'KBN2?'
+BINARY_SWITCH = 'KBN2'
+
+# Errors from a non-blocking socket which just mean "try again later".
+_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Host names for which clients prefer the Unix domain socket.
+LOCAL_HOSTS = frozenset(['localhost', '127.0.0.1', ''])
+
+
+def UnixSocketPath(port, socket_dir=None):
+  """Returns the path of the Unix domain socket for a kegnet port, or None."""
+  if socket_dir is None:
+    socket_dir = FLAGS.kegnet_unix_socket_dir
+  if not socket_dir:
+    return None
+  return os.path.join(socket_dir, 'kegnet-%i.sock' % port)
+
+
+def IsTrustedUnixSocket(path):
+  """Returns True if |path| is a socket owned by this user or by root.
+
+  The socket directory may be writable by anyone, as /tmp is; another local
+  user could then create the socket before the core does, and pose as it.
+  """
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return False
+  return stat.S_ISSOCK(st.st_mode) and st.st_uid in (0, os.getuid())
+
+
+def NotifyCore(event, addr=None, timeout=1.0):
+  """Connects to the core, sends it |event| and disconnects.
+
+  For processes, such as kegweb, which tell the core of the odd change rather
+  than keep a connection to it.  Returns False if the core could not be
+  reached within |timeout| seconds.
+  """
+  if not addr:
+    addr = FLAGS.kb_core_addr
+  data = event.ToJson(indent=None) + MESSAGE_TERMINATOR
+  try:
+    sock = socket.create_connection(util.str_to_addr(addr), timeout)
+    try:
+      sock.sendall(data)
+    finally:
+      sock.close()
+  except socket.error, e:
+    logging.getLogger('kegnet').warning('Could not send %s to core at %s: '
+        '%s' % (event.__class__.__name__, addr, e))
+    return False
+  return True
+
 
 class KegnetProtocolHandler(asynchat.async_chat):
   """A general purpose request handler for the Kegnet protocol.
@@ -150,19 +241,347 @@ class KegnetServerHandler(KegnetProtocolHandler):
 
   def HandleNotification(self, message_dict):
     KegnetProtocolHandler.HandleNotification(self, message_dict)
-    event_hub = self._server._kb_env.GetEventHub()
-    event_hub.PublishEvent(self.PopNotification())
+    event = self.PopNotification()
+    if isinstance(event, kbevent.SubscribeEvent):
+      self._server.Subscribe(self, event)
+      return
+    self._server._kb_env.GetEventHub().PublishEvent(event)
+
+
+class KegnetConnection:
+  """A kegnet protocol connection driven by a reactor.Reactor.
+
+  Incoming events are passed to HandleEvent on the reactor thread.  SendEvent
+  and SendData may be called from any thread: data is sent right away if the
+  socket has room, and queued otherwise, up to max_output_buffer bytes.  While
+  more than half of that is queued the connection stops reading, so a peer
+  which does not read what it is sent is throttled.
+
+  Messages are JSON-framed until binary framing is negotiated (see
+  BINARY_OFFER); each direction switches independently.
+  """
+  READ_SIZE = 65536
+
+  def __init__(self, reactor, sock, max_output_buffer=None):
+    if max_output_buffer is None:
+      max_output_buffer = FLAGS.kegnet_max_output_buffer
+    sock.setblocking(0)
+    self._reactor = reactor
+    self._sock = sock
+    self._fileno = sock.fileno()
+    self._max_output_buffer = max_output_buffer
+    self._logger = logging.getLogger('kegnet')
+    self._lock = threading.Lock()
+    self._ibuffer = ''
+    self._obuffer = collections.deque()
+    self._obuffer_len = 0
+    self._closed = False
+    self._update_pending = False
+    self._num_dropped = 0
+    self._binary_offered = False
+    self._binary_in = False
+    self._binary_out = False
+
+  def fileno(self):
+    return self._fileno
+
+  def IsConnected(self):
+    return not self._closed
+
+  def GetSocketFamily(self):
+    return self._sock.family
 
+  def GetDroppedCount(self):
+    return self._num_dropped
 
-class KegnetClient(KegnetProtocolHandler):
+  def WantsRead(self):
+    return not self._closed and self._obuffer_len <= self._max_output_buffer / 2
+
+  def WantsWrite(self):
+    return not self._closed and self._obuffer_len > 0
+
+  def HandleRead(self):
+    try:
+      data = self._sock.recv(self.READ_SIZE)
+    except socket.error, e:
+      if e.args[0] in _RETRY_ERRNOS:
+        return
+      self._logger.info('Read error: %s' % e)
+      self.Close()
+      return
+    if not data:
+      self.Close()
+      return
+    buf = self._ibuffer + data
+    pos = 0
+    header_size = binproto.FRAME_HEADER.size
+    while not self._closed:
+      if self._binary_in:
+        if len(buf) - pos < header_size:
+          break
+        length, code = binproto.FRAME_HEADER.unpack_from(buf, pos)
+        end = pos + header_size + length
+        if end > len(buf):
+          break
+        try:
+          event = binproto.DecodeFrame(code, buf[pos + header_size:end])
+        except binproto.FrameError, e:
+          self._logger.warning('Received bad frame, dropping: %s' % e)
+        else:
+          self.HandleEvent(event)
+        pos = end
+      else:
+        end = buf.find(MESSAGE_TERMINATOR, pos)
+        if end < 0:
+          break
+        self._HandleMessage(buf[pos:end])
+        pos = end + len(MESSAGE_TERMINATOR)
+    self._ibuffer = buf[pos:]
+    if len(self._ibuffer) > self._max_output_buffer:
+      self._logger.warning('Message too long, closing connection.')
+      self.Close()
+
+  def _HandleMessage(self, strbuf):
+    if not strbuf:
+      self._logger.warning('Received empty message')
+      return
+    if strbuf == BINARY_OFFER:
+      if FLAGS.kegnet_binary_framing:
+        self._SwitchToBinary()
+      return
+    elif strbuf == BINARY_SWITCH:
+      self._binary_in = True
+      if self._binary_offered:
+        self._SwitchToBinary()
+      return
+    try:
+      message_dict = kbjson.loads(strbuf)
+    except ValueError:
+      self._logger.warning('Received malformed message, dropping.')
+      return
+    self._logger.debug('Received message: %s' % message_dict)
+    self.HandleNotification(message_dict)
+
+  def OfferBinaryFraming(self):
+    """Asks the other end to switch to binary framing."""
+    self._binary_offered = True
+    self.SendData(BINARY_OFFER + MESSAGE_TERMINATOR)
+
+  @util.synchronized
+  def _SwitchToBinary(self):
+    if not self._binary_out:
+      self._SendData(BINARY_SWITCH + MESSAGE_TERMINATOR)
+      self._binary_out = True
+
+  def IsBinary(self):
+    """Returns True once both directions have switched to binary framing."""
+    return self._binary_in and self._binary_out
+
+  @util.synchronized
+  def HandleWrite(self):
+    self._Flush()
+
+  def HandleClose(self):
+    self.Close()
+
+  def _Flush(self):
+    """Sends as much queued data as the socket accepts.  Requires _lock."""
+    while self._obuffer:
+      data = self._obuffer[0]
+      try:
+        sent = self._sock.send(data)
+      except socket.error, e:
+        if e.args[0] in _RETRY_ERRNOS:
+          return
+        self._logger.info('Write error: %s' % e)
+        self.Close()
+        return
+      self._obuffer_len -= sent
+      if sent < len(data):
+        self._obuffer[0] = data[sent:]
+        return
+      self._obuffer.popleft()
+
+  @util.synchronized
+  def SendEvent(self, event, encodings=None):
+    """Sends or queues |event|, in this connection's current framing.
+
+    If |encodings| is given, it is a dict used to share encoded messages
+    between connections, keyed by framing.
+
+    Returns False if the event was dropped, as for SendData.
+    """
+    binary = self._binary_out
+    data = None
+    if encodings is not None:
+      data = encodings.get(binary)
+    if data is None:
+      if binary:
+        data = binproto.EncodeEvent(event)
+      else:
+        data = event.ToJson(indent=None) + MESSAGE_TERMINATOR
+      if encodings is not None:
+        encodings[binary] = data
+    return self._SendData(data)
+
+  @util.synchronized
+  def SendData(self, data):
+    """Sends or queues |data|.
+
+    Returns False if the data was dropped, because the connection is closed or
+    its output buffer is full.
+    """
+    return self._SendData(data)
+
+  def _SendData(self, data):
+    if self._closed:
+      return False
+    if self._obuffer_len + len(data) > self._max_output_buffer:
+      self._num_dropped += 1
+      return False
+    self._obuffer.append(data)
+    self._obuffer_len += len(data)
+    if len(self._obuffer) == 1:
+      self._Flush()
+    if self._obuffer and not self._update_pending:
+      # Have the reactor wait for the socket to become writable.
+      self._update_pending = True
+      self._reactor.CallFromThread(self._UpdateInterest)
+    return True
+
+  def _UpdateInterest(self):
+    self._update_pending = False
+    self._reactor.UpdateHandler(self)
+
+  def Close(self):
+    """Closes the connection.  May be called from any thread."""
+    if self._closed:
+      return
+    self._closed = True
+    if self._reactor.IsReactorThread():
+      self._Teardown()
+    else:
+      self._reactor.CallFromThread(self._Teardown)
+
+  def _Teardown(self):
+    self._reactor.RemoveHandler(self)
+    self._sock.close()
+    self.OnClosed()
+
+  ### Hooks for subclasses
+  def HandleNotification(self, message_dict):
+    """Called for each JSON-framed message; decodes it for HandleEvent."""
+    try:
+      event = kbevent.DecodeEvent(message_dict)
+    except ValueError, e:
+      self._logger.warning('Dropping bad message: %s' % e)
+      return
+    self.HandleEvent(event)
+
+  def HandleEvent(self, event):
+    pass
+
+  def OnClosed(self):
+    pass
+
+
+class _AsyncoreClientChannel(KegnetProtocolHandler):
+  """asyncore transport for a KegnetClient."""
+  def __init__(self, client, sock):
+    KegnetProtocolHandler.__init__(self, sock)
+    self._client = client
+
+  def HandleNotification(self, message_dict):
+    self._client.HandleNotification(message_dict)
+
+  def IsConnected(self):
+    return self.connected
+
+  def GetSocketFamily(self):
+    return self.socket.family
+
+  def SendData(self, data):
+    self.push(data)
+    return True
+
+  def SendEvent(self, event):
+    return self.SendData(event.ToJson(indent=None) + MESSAGE_TERMINATOR)
+
+  def Serve(self, timeout=None):
+    if timeout is None:
+      timeout = 0.5
+    asyncore.loop(timeout=timeout, count=1)
+
+  def Wakeup(self):
+    pass
+
+  def Close(self):
+    self.stop()
+
+
+class _PollClientChannel(KegnetConnection):
+  """Reactor transport for a KegnetClient."""
+  def __init__(self, client, sock):
+    KegnetConnection.__init__(self, reactor.Reactor(), sock)
+    self._client = client
+    self._reactor.AddHandler(self)
+    if FLAGS.kegnet_binary_framing:
+      self.OfferBinaryFraming()
+
+  def HandleEvent(self, event):
+    self._client.HandleEvent(event)
+
+  def Serve(self, timeout=None):
+    self._reactor.RunOnce(timeout)
+
+  def Wakeup(self):
+    self._reactor.Wakeup()
+
+  def OnClosed(self):
+    self._reactor.Close()
+
+
+class KegnetClient(object):
+  """A client of the core's kegnet server.
+
+  If a spool.EventSpool is given, events which cannot be sent while the client
+  is disconnected are spooled, and sent by SendSpooledEvents after it
+  reconnects.  After reconnecting, the client also sends the last reading it
+  sent for each meter again, in case the core lost it.
+  """
   RECONNECT_BACKOFF = [5, 5, 10, 10, 20, 20, 60]
-  def __init__(self, addr=None):
+
+  # Number of spooled events taken from the spool at a time.
+  SPOOL_BATCH_SIZE = 256
+
+  def __init__(self, addr=None, transport=None, spool=None,
+      unix_socket_dir=None):
     if not addr:
       addr = FLAGS.kb_core_addr
     self._addr = util.str_to_addr(addr)
+    self._transport = transport
+    self._unix_path = None
+    if self._addr[0] in LOCAL_HOSTS:
+      self._unix_path = UnixSocketPath(self._addr[1], unix_socket_dir)
+    self._spool = spool
+    self._sent_readings = {}
+    self._send_lock = threading.Lock()
     self._last_reconnect = 0
     self._num_retries = 0
-    KegnetProtocolHandler.__init__(self)
+    self._channel = None
+    self._subscription = None
+    self._in_notifications = Queue.Queue()
+    self._logger = logging.getLogger('kegnet')
+    self._quit = False
+
+  def _NewChannel(self, sock):
+    transport = self._transport or FLAGS.kegnet_transport
+    if transport == 'asyncore':
+      return _AsyncoreClientChannel(self, sock)
+    return _PollClientChannel(self, sock)
+
+  def IsConnected(self):
+    return self._channel is not None and self._channel.IsConnected()
 
   def Reconnect(self, force=False):
     backoff_secs = self._ReconnectTimeout()
@@ -170,15 +589,16 @@ class KegnetClient(KegnetProtocolHandler):
       time.sleep(backoff_secs)
     self._last_reconnect = time.time()
 
-    if self.connected:
+    if self.IsConnected():
       return True
 
-    self._logger.info('Connecting to %s:%s' % self._addr)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     try:
-      sock.connect(self._addr)
-      self.set_socket(sock)
+      sock = self._Connect()
+      self._channel = self._NewChannel(sock)
+      if self._subscription:
+        self._channel.SendEvent(self._subscription)
+      if self._spool is not None:
+        self._ResendMeterReadings()
       self.onConnected()
       self._num_retries = 0
       return True
@@ -188,6 +608,153 @@ class KegnetClient(KegnetProtocolHandler):
           backoff_secs)
       return False
 
+  def _Connect(self):
+    """Returns a socket connected to the server.
+
+    The server's Unix domain socket is tried first if it is on this host, and
+    is owned by a user trusted to be running the core.
+    """
+    if self._unix_path and os.path.exists(self._unix_path) and \
+        not IsTrustedUnixSocket(self._unix_path):
+      self._logger.warning('Not using %s: it is not a socket owned by this '
+          'user or root; using TCP.' % self._unix_path)
+    elif self._unix_path and os.path.exists(self._unix_path):
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        sock.connect(self._unix_path)
+        self._logger.info('Connected to %s' % self._unix_path)
+        return sock
+      except socket.error, e:
+        sock.close()
+        self._logger.info('Could not connect to %s (%s); using TCP.' % (
+            self._unix_path, e))
+    self._logger.info('Connecting to %s:%s' % self._addr)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+      sock.connect(self._addr)
+    except socket.error:
+      sock.close()
+      raise
+    return sock
+
+  def IsUnixSocket(self):
+    """Returns True if connected over the Unix domain socket."""
+    return (self.IsConnected() and
+        self._channel.GetSocketFamily() == socket.AF_UNIX)
+
+  def stop(self):
+    self._quit = True
+    if self._channel:
+      self._channel.Close()
+
+  def HandleNotification(self, message_dict):
+    self._logger.debug('Received notification: %s' % message_dict)
+    self.HandleEvent(kbevent.DecodeEvent(message_dict))
+
+  def HandleEvent(self, event):
+    self._in_notifications.put(event)
+
+  def PopNotification(self, timeout=None):
+    return self._in_notifications.get(timeout=timeout)
+
+  def SendMessage(self, msg):
+    if self._spool is not None:
+      self._send_lock.acquire()
+      try:
+        return self._SendOrSpool(msg)
+      finally:
+        self._send_lock.release()
+    if not self._channel:
+      self._logger.warning('Not connected, dropping message.')
+      return False
+    return self._channel.SendEvent(msg)
+
+  def _SendEvent(self, event):
+    """Sends |event| on the current channel.  Requires _send_lock."""
+    if not self._channel.SendEvent(event):
+      return False
+    if isinstance(event, kbevent.MeterUpdate):
+      self._sent_readings[event.tap_name] = event.reading
+    return True
+
+  def _SendOrSpool(self, msg):
+    # Anything sent while the spool is non-empty must wait its turn.
+    if not self._spool.GetCount() and self.IsConnected():
+      if self._SendEvent(msg):
+        return True
+    if self._spool.Put(msg):
+      if self.IsConnected():
+        # Have the client thread send it.
+        self._channel.Wakeup()
+      return True
+    self._logger.warning('Not connected, dropping message.')
+    return False
+
+  def _ResendMeterReadings(self):
+    self._send_lock.acquire()
+    try:
+      for tap_name, reading in self._sent_readings.items():
+        self._SendEvent(kbevent.MeterUpdate(tap_name=tap_name,
+            reading=reading))
+    finally:
+      self._send_lock.release()
+
+  def SendSpooledEvents(self):
+    """Sends spooled events, oldest first.
+
+    Meter and temperature readings are sent with their event_time set to when
+    they were spooled, so that the core places them at the time they were
+    taken rather than when they arrive.
+
+    Stops when the spool is empty, or when the connection is lost or cannot
+    take any more.  Returns the number of events sent.
+    """
+    if self._spool is None:
+      return 0
+    num_sent = 0
+    self._send_lock.acquire()
+    try:
+      while self.IsConnected():
+        entries = self._spool.Peek(self.SPOOL_BATCH_SIZE)
+        if not entries:
+          break
+        sent = []
+        for entry in entries:
+          if 'event_time' in entry.event.class_fields and \
+              entry.event.event_time is None:
+            entry.event.event_time = datetime.datetime.fromtimestamp(
+                entry.create_time)
+          if not self._SendEvent(entry.event):
+            break
+          sent.append(entry)
+        self._spool.Remove(sent)
+        num_sent += len(sent)
+        if len(sent) < len(entries):
+          break
+    finally:
+      self._send_lock.release()
+    if num_sent:
+      self._logger.info('Sent %i spooled event(s), %i remaining.' % (num_sent,
+          self._spool.GetCount()))
+    return num_sent
+
+  def Subscribe(self, event_types, names=None):
+    """Asks the server to only send events of the given types.
+
+    |event_types| is a sequence of kbevent.Event subclasses.  If |names| is
+    given, it is a sequence of fnmatch patterns; events about a tap or relay
+    are then only sent if its name matches one of them.  The subscription is
+    sent again whenever the client reconnects.
+    """
+    message = kbevent.SubscribeEvent()
+    message.event_types = ','.join(cls.__name__ for cls in event_types)
+    message.names = ','.join(names or [])
+    self._subscription = message
+    if self.IsConnected():
+      return self.SendMessage(message)
+    return True
+
   def _ReconnectTimeout(self):
     if not self._last_reconnect:
       return 0
@@ -255,15 +822,15 @@ class SimpleKegnetClient(KegnetClient):
   def serve_forever(self):
     self.Reconnect()
     while not self._quit:
-      if not asyncore.socket_map:
+      if not self.IsConnected():
         self.onDisconnected()
         self.Reconnect()
         continue
-      asyncore.loop(timeout=0.5, count=1)
+      if self._spool is not None and self._spool.GetCount():
+        self.SendSpooledEvents()
+      self._channel.Serve()
 
-  def HandleNotification(self, message_dict):
-    self._logger.debug('Received notification: %s' % message_dict)
-    event = kbevent.DecodeEvent(message_dict)
+  def HandleEvent(self, event):
     if isinstance(event, kbevent.FlowUpdate):
       self.onFlowUpdate(event)
     elif isinstance(event, kbevent.DrinkCreatedEvent):
@@ -295,8 +862,93 @@ class KegnetClientThread(util.KegbotThread):
     self._client.serve_forever()
 
 
+def _SplitList(value):
+  if not value:
+    return []
+  return [v.strip() for v in value.split(',') if v.strip()]
+
+
+class SubscriptionIndex:
+  """Tracks which events each server connection has subscribed to.
+
+  A connection which has not sent a SubscribeEvent is sent every event, as
+  before subscriptions existed.  The recipients of each event type are cached,
+  and the cache is rebuilt when a connection comes, goes or subscribes.
+  """
+  def __init__(self):
+    self._logger = logging.getLogger('kegnet')
+    self._lock = threading.Lock()
+    # Maps connection to an (event types, name matcher) tuple, or None if it
+    # has not subscribed.
+    self._connections = {}
+    self._routes = {}
+
+  @util.synchronized
+  def Add(self, conn):
+    self._connections[conn] = None
+    self._routes = {}
+
+  @util.synchronized
+  def Remove(self, conn):
+    if conn in self._connections:
+      del self._connections[conn]
+      self._routes = {}
+
+  @util.synchronized
+  def Subscribe(self, conn, event):
+    """Replaces the subscription of |conn| with that in a SubscribeEvent."""
+    if conn not in self._connections:
+      return
+    event_types = set()
+    for type_name in _SplitList(event.event_types):
+      cls = kbevent.EVENT_NAME_TO_CLASS.get(type_name)
+      if cls is None:
+        self._logger.warning('Ignoring subscription to unknown event type: %s'
+            % type_name)
+        continue
+      event_types.add(cls)
+    matcher = None
+    patterns = _SplitList(event.names)
+    if patterns:
+      regex = '|'.join(fnmatch.translate(p) for p in patterns)
+      matcher = re.compile(regex).match
+    self._connections[conn] = (frozenset(event_types), matcher)
+    self._routes = {}
+
+  def GetSubscribedCount(self):
+    return len([s for s in self._connections.values() if s is not None])
+
+  @util.synchronized
+  def _BuildRoute(self, cls):
+    route = []
+    for conn, subscription in self._connections.iteritems():
+      if subscription is None:
+        route.append((conn, None))
+      elif cls in subscription[0]:
+        route.append((conn, subscription[1]))
+    self._routes[cls] = route
+    return route
+
+  def GetRecipients(self, event):
+    """Returns the connections which should be sent |event|."""
+    route = self._routes.get(event.__class__)
+    if route is None:
+      route = self._BuildRoute(event.__class__)
+    if not route:
+      return []
+    values = event._values
+    name = values.get('tap_name') or values.get('output_name')
+    if name is None:
+      return [conn for conn, matcher in route]
+    return [conn for conn, matcher in route if matcher is None or matcher(name)]
+
+
 class KegnetServer(asyncore.dispatcher):
   """asyncore server implementation for Kegnet protocol"""
+
+  # Serve() timeout used by the core's network thread.
+  SERVE_TIMEOUT = 0.5
+
   def __init__(self, name, kb_env, addr='', port=0, qsize=5):
     self._name = name
     self._kb_env = kb_env
@@ -304,6 +956,7 @@ class KegnetServer(asyncore.dispatcher):
     self._bind_address = util.str_to_addr(addr)
     self._qsize = qsize
     self._clients = set()
+    self._subscriptions = SubscriptionIndex()
     self._lock = threading.Lock()
     asyncore.dispatcher.__init__(self)
 
@@ -318,26 +971,43 @@ class KegnetServer(asyncore.dispatcher):
     self._logger.info("Stopping server")
     self.close()
 
+  def Serve(self, timeout=None):
+    asyncore.loop(timeout=timeout, count=1)
+
+  def Wakeup(self):
+    pass
+
+  def GetStatus(self):
+    return [
+      'Clients: %i' % len(self._clients),
+      'Subscribed clients: %i' % self._subscriptions.GetSubscribedCount(),
+    ]
+
   @util.synchronized
   def ChannelOpened(self, channel):
     self._logger.info('Remote host connected: %s:%i' % channel.addr)
     self._clients.add(channel)
+    self._subscriptions.Add(channel)
 
   @util.synchronized
   def ChannelClosed(self, channel):
     self._logger.info('Remote host closed: %s:%i' % channel.addr)
     self._clients.remove(channel)
+    self._subscriptions.Remove(channel)
+
+  def Subscribe(self, channel, event):
+    self._logger.info('Client %s:%i subscribed to %s' % (channel.addr +
+        (event.event_types,)))
+    self._subscriptions.Subscribe(channel, event)
 
   @util.synchronized
   def SendEventToClients(self, event):
-    # TODO(mikey): filter events -- should be based on subscriptions & exclude
-    # internal events.
-    if not self._clients:
+    # TODO(mikey): exclude internal events.
+    clients = self._subscriptions.GetRecipients(event)
+    if not clients:
       return
-    #self._logger.info('Sending event to %i client(s): %s' %
-    #  (len(self._clients), ProtoMessageToShortStr(event)))
     str_message = event.ToJson(indent=None)
-    for client in self._clients:
+    for client in clients:
       try:
         client.push(str_message + MESSAGE_TERMINATOR)
       except IndexError:
@@ -353,6 +1023,220 @@ class KegnetServer(asyncore.dispatcher):
     KegnetServerHandler(conn, self)
 
 
+class _PollListener:
+  """Accepts connections for a PollKegnetServer."""
+  def __init__(self, server, sock):
+    self._server = server
+    self._sock = sock
+    self._fileno = sock.fileno()
+
+  def fileno(self):
+    return self._fileno
+
+  def WantsRead(self):
+    return True
+
+  def WantsWrite(self):
+    return False
+
+  def HandleRead(self):
+    while True:
+      try:
+        conn, addr = self._sock.accept()
+      except socket.error, e:
+        if e.args[0] in _RETRY_ERRNOS:
+          return
+        raise
+      if conn.family == socket.AF_UNIX:
+        # Unix domain peers have no address; tell them apart by descriptor.
+        addr = ('unix', conn.fileno())
+      else:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      PollKegnetServerConnection(self._server, conn, addr)
+
+  def HandleWrite(self):
+    pass
+
+  def HandleClose(self):
+    pass
+
+  def Close(self):
+    if self._sock.family == socket.AF_UNIX:
+      path = self._sock.getsockname()
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+    self._sock.close()
+
+
+class PollKegnetServerConnection(KegnetConnection):
+  """A client connection to a PollKegnetServer."""
+  def __init__(self, server, sock, addr):
+    KegnetConnection.__init__(self, server.GetReactor(), sock,
+        server.GetMaxOutputBuffer())
+    self.addr = addr
+    self._server = server
+    self._server.ChannelOpened(self)
+    self._reactor.AddHandler(self)
+
+  def HandleEvent(self, event):
+    if isinstance(event, kbevent.SubscribeEvent):
+      self._server.Subscribe(self, event)
+      return
+    self._server._kb_env.GetEventHub().PublishEvent(event)
+
+  def OnClosed(self):
+    self._server.ChannelClosed(self)
+
+
+class PollKegnetServer:
+  """reactor.Reactor server implementation for Kegnet protocol.
+
+  The reactor runs on the core's network thread; SendEventToClients may be
+  called from any thread.  Each client has a bounded output buffer, and a
+  client which falls too far behind is disconnected rather than being allowed
+  to slow down delivery to the others.
+
+  Besides TCP, the server listens on a Unix domain socket (see
+  UnixSocketPath), which clients on the same host use in preference.
+  """
+
+  # Serve() timeout used by the core's network thread; Wakeup() interrupts it.
+  SERVE_TIMEOUT = None
+
+  def __init__(self, name, kb_env, addr='', port=0, qsize=5,
+      max_output_buffer=None, unix_socket_dir=None):
+    if max_output_buffer is None:
+      max_output_buffer = FLAGS.kegnet_max_output_buffer
+    if unix_socket_dir is None:
+      unix_socket_dir = FLAGS.kegnet_unix_socket_dir
+    self._name = name
+    self._kb_env = kb_env
+    self._logger = logging.getLogger(self._name)
+    self._bind_address = util.str_to_addr(addr)
+    self._qsize = qsize
+    self._max_output_buffer = max_output_buffer
+    self._unix_socket_dir = unix_socket_dir
+    self._reactor = reactor.Reactor()
+    self._listener = None
+    self._unix_listener = None
+    self._clients = set()
+    self._subscriptions = SubscriptionIndex()
+    self._num_slow_clients = 0
+    self._lock = threading.Lock()
+
+  def GetReactor(self):
+    return self._reactor
+
+  def GetMaxOutputBuffer(self):
+    return self._max_output_buffer
+
+  def GetAddress(self):
+    """Returns the (host, port) the server is listening on."""
+    return self._listener._sock.getsockname()
+
+  def GetUnixSocketPath(self):
+    """Returns the path of the server's Unix domain socket, or None."""
+    if not self._unix_listener:
+      return None
+    return self._unix_listener._sock.getsockname()
+
+  def GetStatus(self):
+    return [
+      'Clients: %i' % len(self._clients),
+      'Subscribed clients: %i' % self._subscriptions.GetSubscribedCount(),
+      'Slow clients disconnected: %i' % self._num_slow_clients,
+    ]
+
+  def StartServer(self):
+    self._logger.info("Starting server on %s" % str(self._bind_address,))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(self._bind_address)
+    sock.listen(self._qsize)
+    sock.setblocking(0)
+    self._listener = _PollListener(self, sock)
+    self._reactor.AddHandler(self._listener)
+    self._StartUnixListener()
+
+  def _StartUnixListener(self):
+    path = UnixSocketPath(self.GetAddress()[1], self._unix_socket_dir)
+    if not path:
+      return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      if os.path.exists(path):
+        # Left over from a server which did not exit cleanly.
+        os.unlink(path)
+      sock.bind(path)
+      sock.listen(self._qsize)
+    except (socket.error, OSError), e:
+      self._logger.warning('Could not listen on %s: %s' % (path, e))
+      sock.close()
+      return
+    self._logger.info("Listening on %s" % path)
+    sock.setblocking(0)
+    self._unix_listener = _PollListener(self, sock)
+    self._reactor.AddHandler(self._unix_listener)
+
+  def StopServer(self):
+    self._logger.info("Stopping server")
+    for listener in (self._listener, self._unix_listener):
+      if listener:
+        self._reactor.RemoveHandler(listener)
+        listener.Close()
+    self._listener = None
+    self._unix_listener = None
+    for client in list(self._clients):
+      client.Close()
+    self._reactor.RunOnce(0)
+
+  def Serve(self, timeout=None):
+    self._reactor.RunOnce(timeout)
+
+  def Wakeup(self):
+    self._reactor.Wakeup()
+
+  @util.synchronized
+  def ChannelOpened(self, channel):
+    self._logger.info('Remote host connected: %s:%i' % channel.addr)
+    self._clients.add(channel)
+    self._subscriptions.Add(channel)
+
+  @util.synchronized
+  def ChannelClosed(self, channel):
+    self._logger.info('Remote host closed: %s:%i' % channel.addr)
+    self._clients.discard(channel)
+    self._subscriptions.Remove(channel)
+
+  def Subscribe(self, channel, event):
+    self._logger.info('Client %s:%i subscribed to %s' % (channel.addr +
+        (event.event_types,)))
+    self._subscriptions.Subscribe(channel, event)
+
+  def SendEventToClients(self, event):
+    clients = self._subscriptions.GetRecipients(event)
+    if not clients:
+      return
+    encodings = {}
+    for client in clients:
+      if not client.SendEvent(event, encodings) and client.IsConnected():
+        self._logger.warning('Client %s:%i is not keeping up, disconnecting.' %
+            client.addr)
+        self._num_slow_clients += 1
+        client.Close()
+
+
+def NewKegnetServer(name, kb_env, addr='', transport=None):
+  """Returns a kegnet server using the given (or the default) transport."""
+  if transport is None:
+    transport = FLAGS.kegnet_transport
+  if transport == 'asyncore':
+    return KegnetServer(name=name, kb_env=kb_env, addr=addr)
+  return PollKegnetServer(name=name, kb_env=kb_env, addr=addr)
+
+
 if __name__ == '__main__':
   server = KegnetServer(name='kegnet', kb_env=None,
       addr=FLAGS.kb_core_bind_addr)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""Benchmark comparing the kegnet server transports.
+
+Connects NUM_CLIENTS subscribers to a server running on its own thread, as in
+the core, then repeatedly publishes an event and measures the time until every
+subscriber has received it.  A second phase has every client send
+MeterUpdates, and reports how quickly they reach the event hub.
+
+The last benchmark compares a co-located client connected over TCP loopback
+and over the server's Unix domain socket: the client sends a MeterUpdate, the
+server echoes it back to all clients (as the core does with flow updates), and
+the round trip time and CPU time used are reported.
+"""
+
+import select
+import socket
+import sys
+import threading
+import time
+
+import gflags
+
+from pykeg.core import kbevent
+from pykeg.core.net import kegnet
+
+FLAGS = gflags.FLAGS
+
+NUM_CLIENTS = 100
+NUM_ROUNDS = 500
+NUM_UPDATES_PER_CLIENT = 100
+NUM_ROUND_TRIPS = 5000
+
+
+class _CountingHub:
+  def __init__(self):
+    self.count = 0
+
+  def PublishEvent(self, event):
+    self.count += 1
+
+
+class _FakeEnv:
+  def __init__(self):
+    self.hub = _CountingHub()
+
+  def GetEventHub(self):
+    return self.hub
+
+
+class _ServerThread(threading.Thread):
+  def __init__(self, server):
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self._server = server
+    self._quit = False
+
+  def Quit(self):
+    self._quit = True
+    self._server.Wakeup()
+
+  def run(self):
+    while not self._quit:
+      self._server.Serve(timeout=self._server.SERVE_TIMEOUT)
+
+
+def _Percentile(values, pct):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def RunBenchmark(transport):
+  env = _FakeEnv()
+  server = kegnet.NewKegnetServer('kegnet', env, addr='127.0.0.1:0',
+      transport=transport)
+  server.StartServer()
+  if transport == 'asyncore':
+    addr = server.socket.getsockname()
+  else:
+    addr = server.GetAddress()
+  thr = _ServerThread(server)
+  thr.start()
+
+  socks = []
+  for i in xrange(NUM_CLIENTS):
+    sock = socket.create_connection(addr)
+    sock.setblocking(0)
+    socks.append(sock)
+  while len(server._clients) < NUM_CLIENTS:
+    time.sleep(0.01)
+
+  poller = select.poll()
+  by_fd = {}
+  for sock in socks:
+    poller.register(sock.fileno(), select.POLLIN)
+    by_fd[sock.fileno()] = sock
+
+  event = kbevent.MeterUpdate(tap_name='flow0', reading=0)
+  latencies = []
+  for i in xrange(NUM_ROUNDS):
+    event.reading = i
+    remaining = set(by_fd)
+    start = time.time()
+    server.SendEventToClients(event)
+    while remaining:
+      for fd, mask in poller.poll(1000):
+        data = by_fd[fd].recv(65536)
+        if data.endswith(kegnet.MESSAGE_TERMINATOR):
+          remaining.discard(fd)
+    latencies.append(time.time() - start)
+
+  message = kbevent.MeterUpdate(tap_name='flow0', reading=1).ToJson(
+      indent=None) + kegnet.MESSAGE_TERMINATOR
+  expected = NUM_CLIENTS * NUM_UPDATES_PER_CLIENT
+  start = time.time()
+  for i in xrange(NUM_UPDATES_PER_CLIENT):
+    for sock in socks:
+      sock.sendall(message)
+  while env.hub.count < expected and time.time() - start < 30:
+    time.sleep(0.001)
+  ingest_elapsed = time.time() - start
+
+  thr.Quit()
+  thr.join()
+  for sock in socks:
+    sock.close()
+  server.StopServer()
+
+  print '%8s: fan-out to %i clients: median %.2fms, p99 %.2fms; ' \
+      'ingest: %.0f msgs/sec' % (transport, NUM_CLIENTS,
+      _Percentile(latencies, 50) * 1000, _Percentile(latencies, 99) * 1000,
+      env.hub.count / ingest_elapsed)
+
+class _EchoEnv:
+  """Sends every event published by a client back to all clients."""
+  def __init__(self):
+    self.server = None
+
+  def GetEventHub(self):
+    return self
+
+  def PublishEvent(self, event):
+    self.server.SendEventToClients(event)
+
+
+def RunRoundTripBenchmark(family):
+  env = _EchoEnv()
+  env.server = kegnet.PollKegnetServer('kegnet', env, addr='127.0.0.1:0')
+  env.server.StartServer()
+  thr = _ServerThread(env.server)
+  thr.start()
+
+  unix_socket_dir = None
+  if family == 'tcp':
+    unix_socket_dir = ''
+  client = kegnet.KegnetClient(addr='127.0.0.1:%i' % env.server.GetAddress()[1],
+      transport='poll', unix_socket_dir=unix_socket_dir)
+  client.Reconnect()
+  assert client.IsUnixSocket() == (family == 'unix')
+  while not client._channel.IsBinary():
+    client._channel.Serve(timeout=0.1)
+
+  latencies = []
+  start_cpu = time.clock()
+  for i in xrange(NUM_ROUND_TRIPS):
+    start = time.time()
+    client.SendMeterUpdate('flow0', i)
+    while client._in_notifications.empty():
+      client._channel.Serve(timeout=1.0)
+    client.PopNotification(timeout=0)
+    latencies.append(time.time() - start)
+  cpu_elapsed = time.clock() - start_cpu
+
+  client.stop()
+  thr.Quit()
+  thr.join()
+  env.server.StopServer()
+
+  print '%8s: round trip: median %.1fus, p99 %.1fus; ' \
+      'cpu %.1fus per round trip' % (family,
+      _Percentile(latencies, 50) * 1e6, _Percentile(latencies, 99) * 1e6,
+      cpu_elapsed / NUM_ROUND_TRIPS * 1e6)
+
+def main():
+  FLAGS(sys.argv)
+  for transport in ('asyncore', 'poll'):
+    RunBenchmark(transport)
+  for family in ('tcp', 'unix'):
+    RunRoundTripBenchmark(family)
+
+if __name__ == '__main__':
+  main()
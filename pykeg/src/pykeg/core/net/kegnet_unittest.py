@@ -3,12 +3,18 @@
 """Unittest for kegnet module"""
 
 import asyncore
+import datetime
 import logging
+import os
+import socket
+import time
 import unittest
 
 import gflags
 
+from pykeg.core import kbevent
 from pykeg.core.net import kegnet
+from pykeg.core.net import spool
 
 FLAGS = gflags.FLAGS
 
@@ -34,6 +40,270 @@ class KegnetTestCase(unittest.TestCase):
     asyncore.loop(timeout=1, count=1)
     print 'Done'
 
+class _FakeEnv:
+  def __init__(self):
+    self._event_hub = kbevent.EventHub()
+
+  def GetEventHub(self):
+    return self._event_hub
+
+class PollKegnetTestCase(unittest.TestCase):
+  def setUp(self):
+    self.env = _FakeEnv()
+    self.server = kegnet.PollKegnetServer(name='kegnet', kb_env=self.env,
+        addr='127.0.0.1:0', max_output_buffer=4096)
+    self.server.StartServer()
+    host, port = self.server.GetAddress()
+    self.addr = '%s:%i' % (host, port)
+
+  def tearDown(self):
+    self.server.StopServer()
+
+  def _ServeUntil(self, predicate, timeout=2.0):
+    end = time.time() + timeout
+    while not predicate() and time.time() < end:
+      self.server.Serve(timeout=0.05)
+    return predicate()
+
+  def _Connect(self):
+    client = kegnet.KegnetClient(addr=self.addr, transport='poll')
+    self.assert_(client.Reconnect())
+    self.assert_(self._ServeUntil(lambda: len(self.server._clients) == 1))
+    return client
+
+  def testClientToServer(self):
+    client = self._Connect()
+    client.SendFlowStart('flow0')
+    client.SendMeterUpdate('flow0', 123)
+    hub = self.env.GetEventHub()
+    received = []
+    def _Received():
+      ev = hub._WaitForEvent(timeout=0)
+      if ev is not None:
+        received.append(ev)
+      return len(received) == 2
+    self.assert_(self._ServeUntil(_Received))
+    self.assert_(isinstance(received[0], kbevent.FlowRequest))
+    self.assertEqual(received[1].reading, 123)
+    client.stop()
+
+  def testUnixSocketPreferred(self):
+    self.assert_(self.server.GetUnixSocketPath())
+    client = self._Connect()
+    self.assert_(client.IsUnixSocket())
+    client.SendMeterUpdate('flow0', 1)
+    hub = self.env.GetEventHub()
+    received = []
+    def _Received():
+      ev = hub._WaitForEvent(timeout=0)
+      if ev is not None:
+        received.append(ev)
+      return received
+    self.assert_(self._ServeUntil(_Received))
+    self.assertEqual(received[0].reading, 1)
+    client.stop()
+
+    client = kegnet.KegnetClient(addr=self.addr, transport='poll',
+        unix_socket_dir='')
+    self.assert_(client.Reconnect())
+    self.assertFalse(client.IsUnixSocket())
+    client.stop()
+
+  def testUntrustedUnixSocket(self):
+    path = self.server.GetUnixSocketPath()
+    self.assert_(kegnet.IsTrustedUnixSocket(path))
+    plain_file = path + '.file'
+    open(plain_file, 'w').close()
+    self.assertFalse(kegnet.IsTrustedUnixSocket(plain_file))
+    os.unlink(plain_file)
+    if os.getuid() != 0:
+      return
+
+    # A socket owned by another user is not used.
+    os.chown(path, 12345, -1)
+    client = kegnet.KegnetClient(addr=self.addr, transport='poll')
+    self.assert_(client.Reconnect())
+    self.assertFalse(client.IsUnixSocket())
+    client.stop()
+
+  def testServerToClient(self):
+    client = self._Connect()
+    now = datetime.datetime(2010, 1, 1, 12, 0, 0)
+    event = kbevent.DrinkCreatedEvent(drink_id=7, tap_name='flow0',
+        start_time=now, end_time=now)
+    self.server.SendEventToClients(event)
+    end = time.time() + 2.0
+    while client._in_notifications.empty() and time.time() < end:
+      client._channel.Serve(timeout=0.05)
+    self.assertEqual(client.PopNotification(timeout=0).drink_id, 7)
+    client.stop()
+    self.assert_(self._ServeUntil(lambda: not self.server._clients))
+
+  def testBinaryFramingNegotiated(self):
+    client = self._Connect()
+    conn = list(self.server._clients)[0]
+    def _Negotiated():
+      client._channel.Serve(timeout=0)
+      return client._channel.IsBinary() and conn.IsBinary()
+    self.assert_(self._ServeUntil(_Negotiated))
+
+    now = datetime.datetime(2010, 1, 1, 12, 0, 0, 500)
+    self.server.SendEventToClients(kbevent.DrinkCreatedEvent(drink_id=7,
+        tap_name='flow0', start_time=now, end_time=now))
+    end = time.time() + 2.0
+    while client._in_notifications.empty() and time.time() < end:
+      client._channel.Serve(timeout=0.05)
+    event = client.PopNotification(timeout=0)
+    self.assertEqual(event.drink_id, 7)
+    self.assertEqual(event.start_time, now)
+
+    client.SendMeterUpdate('flow0', 99)
+    hub = self.env.GetEventHub()
+    received = []
+    def _Received():
+      ev = hub._WaitForEvent(timeout=0)
+      if ev is not None:
+        received.append(ev)
+      return received
+    self.assert_(self._ServeUntil(_Received))
+    self.assertEqual(received[0].reading, 99)
+    client.stop()
+
+  def testJsonClientOnSamePort(self):
+    # A client which never offers binary framing keeps getting JSON.
+    sock = socket.create_connection(self.server.GetAddress())
+    self.assert_(self._ServeUntil(lambda: len(self.server._clients) == 1))
+    sock.sendall(kbevent.MeterUpdate(tap_name='flow0', reading=5).ToJson(
+        indent=None) + kegnet.MESSAGE_TERMINATOR)
+    hub = self.env.GetEventHub()
+    received = []
+    def _Received():
+      ev = hub._WaitForEvent(timeout=0)
+      if ev is not None:
+        received.append(ev)
+      return received
+    self.assert_(self._ServeUntil(_Received))
+    self.assertEqual(received[0].reading, 5)
+
+    self.server.SendEventToClients(kbevent.Ping())
+    sock.settimeout(2.0)
+    data = sock.recv(4096)
+    self.assert_(data.startswith('{'))
+    self.assert_(data.endswith(kegnet.MESSAGE_TERMINATOR))
+    sock.close()
+
+  def testSlowClientDisconnected(self):
+    # A client which never reads eventually overflows its output buffer.
+    sock = socket.create_connection(self.server.GetAddress())
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    self.assert_(self._ServeUntil(lambda: len(self.server._clients) == 1))
+    event = kbevent.ThermoEvent(sensor_name='x' * 1000, sensor_value=1.0)
+    for i in xrange(10000):
+      self.server.SendEventToClients(event)
+      if not self.server._clients:
+        break
+    self.assert_(self._ServeUntil(lambda: not self.server._clients))
+    self.assertEqual(self.server._num_slow_clients, 1)
+    sock.close()
+
+  def testSubscription(self):
+    client = kegnet.KegnetClient(addr=self.addr, transport='poll')
+    client.Subscribe([kbevent.DrinkCreatedEvent], names=['flow1', 'tap.*'])
+    self.assert_(client.Reconnect())
+    self.assert_(self._ServeUntil(
+        lambda: self.server._subscriptions.GetSubscribedCount() == 1))
+
+    now = datetime.datetime(2010, 1, 1, 12, 0, 0)
+    self.server.SendEventToClients(kbevent.FlowUpdate(tap_name='flow1',
+        start_time=now, last_activity_time=now))
+    self.server.SendEventToClients(kbevent.DrinkCreatedEvent(drink_id=1,
+        tap_name='flow0', start_time=now, end_time=now))
+    self.server.SendEventToClients(kbevent.DrinkCreatedEvent(drink_id=2,
+        tap_name='flow1', start_time=now, end_time=now))
+    self.server.SendEventToClients(kbevent.DrinkCreatedEvent(drink_id=3,
+        tap_name='tap.two', start_time=now, end_time=now))
+    received = []
+    end = time.time() + 2.0
+    while len(received) < 2 and time.time() < end:
+      client._channel.Serve(timeout=0.05)
+      while not client._in_notifications.empty():
+        received.append(client.PopNotification(timeout=0))
+    self.assertEqual([e.drink_id for e in received], [2, 3])
+    client.stop()
+
+  def testSpoolWhileDisconnected(self):
+    client = kegnet.KegnetClient(addr=self.addr, transport='poll',
+        spool=spool.EventSpool())
+    self.assert_(client.SendMeterUpdate('flow0', 10))
+    self.assert_(client.SendThermoUpdate('thermo0', 20.5))
+    self.assert_(client.SendMeterUpdate('flow0', 30))
+    self.assertFalse(client.SendFlowStart('flow0'))
+
+    self.assert_(client.Reconnect())
+    self.assertEqual(client.SendSpooledEvents(), 2)
+    self.assert_(client.SendMeterUpdate('flow0', 40))
+    hub = self.env.GetEventHub()
+    received = []
+    def _Received():
+      ev = hub._WaitForEvent(timeout=0)
+      if ev is not None:
+        received.append(ev)
+      return len(received) == 3
+    self.assert_(self._ServeUntil(_Received))
+    self.assertEqual(received[0].sensor_value, 20.5)
+    self.assertEqual([e.reading for e in received[1:]], [30, 40])
+    # Spooled readings carry the time they were taken; live ones do not.
+    self.assert_(isinstance(received[0].event_time, datetime.datetime))
+    self.assert_(isinstance(received[1].event_time, datetime.datetime))
+    self.assertEqual(received[2].event_time, None)
+
+    # The last reading is sent again after reconnecting.
+    client._channel.Close()
+    client._channel.Serve(timeout=0)
+    self.assert_(self._ServeUntil(lambda: not self.server._clients))
+    client._last_reconnect = 0  # skip the reconnect backoff
+    self.assert_(client.Reconnect())
+    del received[:]
+    self.assert_(self._ServeUntil(lambda: _Received() or received))
+    self.assertEqual(received[0].reading, 40)
+    client.stop()
+
+
+class _FakeConnection:
+  pass
+
+class SubscriptionIndexTestCase(unittest.TestCase):
+  def testRecipients(self):
+    index = kegnet.SubscriptionIndex()
+    everything = _FakeConnection()
+    flows = _FakeConnection()
+    relays = _FakeConnection()
+    for conn in (everything, flows, relays):
+      index.Add(conn)
+    index.Subscribe(flows, kbevent.SubscribeEvent(event_types='FlowUpdate',
+        names=''))
+    index.Subscribe(relays, kbevent.SubscribeEvent(
+        event_types='SetRelayOutputEvent,Bogus', names='kegboard.*'))
+    self.assertEqual(index.GetSubscribedCount(), 2)
+
+    def _Recipients(event):
+      return set(index.GetRecipients(event))
+    self.assertEqual(_Recipients(kbevent.FlowUpdate(tap_name='flow0')),
+        set([everything, flows]))
+    self.assertEqual(_Recipients(kbevent.SetRelayOutputEvent(
+        output_name='kegboard.relay0')), set([everything, relays]))
+    self.assertEqual(_Recipients(kbevent.SetRelayOutputEvent(
+        output_name='other.relay0')), set([everything]))
+    self.assertEqual(_Recipients(kbevent.Ping()), set([everything]))
+
+    index.Remove(everything)
+    self.assertEqual(_Recipients(kbevent.Ping()), set())
+    index.Subscribe(flows, kbevent.SubscribeEvent(event_types='',
+        names=''))
+    self.assertEqual(_Recipients(kbevent.FlowUpdate(tap_name='flow0')),
+        set())
+
+
 if __name__ == '__main__':
   import sys
   logging.basicConfig(stream=sys.stderr)
@@ -0,0 +1,245 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A small poll()-based event loop.
+
+Unlike asyncore, the loop blocks until a socket is ready rather than waking
+on a fixed timeout, only asks the kernel about sockets which have something to
+do, and can be woken from other threads.
+
+Handlers are objects with the following methods:
+  fileno() - the file descriptor to watch
+  WantsRead(), WantsWrite() - whether the handler is interested in input or
+      output readiness
+  HandleRead(), HandleWrite() - called when the descriptor is ready
+  HandleClose() - called on hangup or error
+
+Handlers must only be added, removed or updated from the reactor's own thread;
+other threads should use CallFromThread.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import threading
+
+from pykeg.core import util
+
+READ_MASK = select.POLLIN | select.POLLPRI
+WRITE_MASK = select.POLLOUT
+ERROR_MASK = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+class _Waker:
+  """Wakes a blocked Reactor by writing to a pipe it is polling."""
+  def __init__(self):
+    self._read_fd, self._write_fd = os.pipe()
+    for fd in (self._read_fd, self._write_fd):
+      flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+      fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+  def fileno(self):
+    return self._read_fd
+
+  def WantsRead(self):
+    return True
+
+  def WantsWrite(self):
+    return False
+
+  def HandleRead(self):
+    try:
+      while os.read(self._read_fd, 4096):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def HandleWrite(self):
+    pass
+
+  def HandleClose(self):
+    pass
+
+  def Wake(self):
+    try:
+      os.write(self._write_fd, 'x')
+    except OSError, e:
+      # A full pipe will wake the reactor just as well.
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def Close(self):
+    os.close(self._read_fd)
+    os.close(self._write_fd)
+
+
+class _EpollPoller:
+  """Adapts select.epoll to the select.poll interface."""
+  def __init__(self):
+    self._epoll = select.epoll()
+
+  def register(self, fd, mask):
+    self._epoll.register(fd, mask)
+
+  def modify(self, fd, mask):
+    self._epoll.modify(fd, mask)
+
+  def unregister(self, fd):
+    self._epoll.unregister(fd)
+
+  def poll(self, timeout_ms=None):
+    if timeout_ms is None:
+      timeout = -1
+    else:
+      timeout = timeout_ms / 1000.0
+    return self._epoll.poll(timeout)
+
+
+def _NewPoller():
+  if hasattr(select, 'epoll'):
+    return _EpollPoller()
+  return select.poll()
+
+
+class Reactor:
+  """Dispatches readiness events on a set of handlers."""
+  def __init__(self):
+    self._logger = logging.getLogger('reactor')
+    self._poller = _NewPoller()
+    self._handlers = {}  # maps fd to (handler, registered mask)
+    self._lock = threading.Lock()
+    self._calls = []
+    self._waker = _Waker()
+    self._thread = None
+    self._closed = False
+    self.AddHandler(self._waker)
+
+  def GetHandlerCount(self):
+    return len(self._handlers) - 1
+
+  def _Mask(self, handler):
+    mask = ERROR_MASK
+    if handler.WantsRead():
+      mask |= READ_MASK
+    if handler.WantsWrite():
+      mask |= WRITE_MASK
+    return mask
+
+  def AddHandler(self, handler):
+    fd = handler.fileno()
+    mask = self._Mask(handler)
+    self._poller.register(fd, mask)
+    self._handlers[fd] = (handler, mask)
+
+  def RemoveHandler(self, handler):
+    fd = handler.fileno()
+    entry = self._handlers.get(fd)
+    if entry is None or entry[0] is not handler:
+      return
+    del self._handlers[fd]
+    self._poller.unregister(fd)
+
+  def UpdateHandler(self, handler):
+    """Re-reads a handler's WantsRead and WantsWrite."""
+    fd = handler.fileno()
+    entry = self._handlers.get(fd)
+    if entry is None or entry[0] is not handler:
+      return
+    mask = self._Mask(handler)
+    if mask != entry[1]:
+      self._poller.modify(fd, mask)
+      self._handlers[fd] = (handler, mask)
+
+  def IsReactorThread(self):
+    """Returns True if the caller may use the reactor directly.
+
+    That is the case on the thread running the loop, or on any thread if the
+    loop has not been run yet.
+    """
+    return self._thread is None or self._thread is threading.currentThread()
+
+  def CallFromThread(self, f, *args):
+    """Schedules f(*args) to be called on the reactor thread, and wakes it."""
+    self._lock.acquire()
+    try:
+      if self._closed:
+        return
+      self._calls.append((f, args))
+      self._waker.Wake()
+    finally:
+      self._lock.release()
+
+  def Wakeup(self):
+    self._lock.acquire()
+    try:
+      if not self._closed:
+        self._waker.Wake()
+    finally:
+      self._lock.release()
+
+  def _RunCalls(self):
+    self._lock.acquire()
+    calls = self._calls
+    self._calls = []
+    self._lock.release()
+    for f, args in calls:
+      f(*args)
+
+  def RunOnce(self, timeout=None):
+    """Waits up to |timeout| seconds (forever if None) and handles all ready
+    descriptors and scheduled calls."""
+    self._thread = threading.currentThread()
+    self._RunCalls()
+    if timeout is None:
+      timeout_ms = None
+    else:
+      timeout_ms = int(timeout * 1000)
+    try:
+      events = self._poller.poll(timeout_ms)
+    except (IOError, OSError, select.error), e:
+      if e.args[0] == errno.EINTR:
+        return
+      raise
+    for fd, mask in events:
+      entry = self._handlers.get(fd)
+      if entry is None:
+        continue
+      handler = entry[0]
+      try:
+        if mask & READ_MASK:
+          handler.HandleRead()
+        if mask & WRITE_MASK and fd in self._handlers:
+          handler.HandleWrite()
+        if mask & ERROR_MASK and not mask & READ_MASK and fd in self._handlers:
+          handler.HandleClose()
+      except Exception:
+        self._logger.error('Error in handler %s; closing it.' % handler)
+        util.LogTraceback(self._logger.error)
+        handler.HandleClose()
+      self.UpdateHandler(handler)
+    self._RunCalls()
+
+  def Close(self):
+    self._lock.acquire()
+    self._closed = True
+    self._lock.release()
+    self.RemoveHandler(self._waker)
+    self._waker.Close()
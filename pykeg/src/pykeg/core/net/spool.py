@@ -0,0 +1,304 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Spool of events which a kegnet client could not send to the core.
+
+While a client is disconnected, the events it would have sent are put in the
+spool, and are sent in their original order once it reconnects.  Meter readings
+are absolute counts, so a MeterUpdate replaces the previous spooled reading of
+the same meter, unless a TokenAuthEvent was spooled in between (the core needs
+to see the readings on either side of a token change).  The core discards a
+reading which jumps too far from the last one it saw, so readings are only
+replaced while the jump stays within --kegnet_spool_max_compacted_ticks; past
+that, the previous reading is kept and compaction starts again from it.
+
+If a path is given, the spool is also kept on disk, so spooled events survive
+a restart of the client.  The file is a log of records, in the same (length,
+crc32) framing as the event journal: each record either adds an event, with
+the time it was spooled, or removes one.  The log is rewritten when it grows
+much larger than the spool itself.
+"""
+
+import collections
+import cPickle
+import logging
+import os
+import threading
+import time
+import zlib
+
+import gflags
+
+from pykeg.core import journal
+from pykeg.core import kbevent
+from pykeg.core import util
+from pykeg.core.net import binproto
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('kegnet_spool_max_events', 100000,
+    'Maximum number of events kept in a kegnet client spool.  When the spool '
+    'is full, the oldest temperature readings are dropped first.')
+
+gflags.DEFINE_integer('kegnet_spool_max_compacted_ticks', 500,
+    'Largest jump in a meter\'s reading which spooled readings are compacted '
+    'into.  This must stay below the core\'s maximum tick delta for the tap '
+    '(500 mL worth of ticks), or the replayed reading will be discarded.')
+
+SPOOL_MAGIC = 'KBS1'
+
+# Record type codes.  These are stored on disk and must never be reused.
+RECORD_PUT = 1
+RECORD_REMOVE = 2
+
+SPOOLED_EVENT_TYPES = (kbevent.MeterUpdate, kbevent.ThermoEvent,
+    kbevent.TokenAuthEvent)
+
+# Rewrite the log once it holds this many more records than the spool.
+REWRITE_SLACK = 1024
+
+
+class SpoolEntry:
+  """An event waiting to be sent.
+
+  Attributes:
+    seqn: sequence number, giving the order entries are sent in
+    event: the kbevent.Event
+    create_time: time.time() when the event was spooled
+    base_reading: for a MeterUpdate, the reading the core will have seen
+      before this one
+  """
+  def __init__(self, seqn, event, create_time=None, base_reading=None):
+    if create_time is None:
+      create_time = time.time()
+    self.seqn = seqn
+    self.event = event
+    self.create_time = create_time
+    self.base_reading = base_reading
+
+  def __str__(self):
+    return '<SpoolEntry %i %s>' % (self.seqn, self.event.__class__.__name__)
+
+
+class EventSpool:
+  """A bounded FIFO of events, optionally mirrored to disk."""
+
+  def __init__(self, path=None, max_events=None, max_compacted_ticks=None):
+    if max_events is None:
+      max_events = FLAGS.kegnet_spool_max_events
+    if max_compacted_ticks is None:
+      max_compacted_ticks = FLAGS.kegnet_spool_max_compacted_ticks
+    self._path = path
+    self._max_events = max_events
+    self._max_compacted_ticks = max_compacted_ticks
+    self._logger = logging.getLogger('spool')
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()  # maps seqn to SpoolEntry
+    self._meter_entries = {}  # maps tap name to its replaceable MeterUpdate
+    self._last_readings = {}  # maps tap name to its last spooled reading
+    self._next_seqn = 0
+    self._fd = None
+    self._num_records = 0
+    self._num_compacted = 0
+    self._num_dropped = 0
+    if self._path:
+      self._Load()
+
+  def _Load(self):
+    if os.path.exists(self._path):
+      for op, values in self._ReadLog():
+        if op == RECORD_PUT:
+          # Records written before base readings were kept have no fourth
+          # value.
+          seqn, create_time, frame = values[:3]
+          base_reading = None
+          if len(values) > 3:
+            base_reading = values[3]
+          self._entries[seqn] = SpoolEntry(seqn, binproto.DecodeEvent(frame),
+              create_time, base_reading)
+          self._next_seqn = max(self._next_seqn, seqn + 1)
+        elif op == RECORD_REMOVE:
+          self._entries.pop(values, None)
+      for entry in self._entries.itervalues():
+        self._UpdateMeterEntries(entry)
+      if self._entries:
+        self._logger.info('Loaded %i spooled event(s).' % len(self._entries))
+    self._Rewrite()
+
+  def _ReadLog(self):
+    """Yields (op, values) for all intact records in the log."""
+    fd = open(self._path, 'rb')
+    try:
+      if fd.read(len(SPOOL_MAGIC)) != SPOOL_MAGIC:
+        self._logger.warning('Spool has a bad header, ignoring it.')
+        return
+      while True:
+        header = fd.read(journal.RECORD_HEADER.size)
+        if len(header) < journal.RECORD_HEADER.size:
+          return
+        length, crc = journal.RECORD_HEADER.unpack(header)
+        payload = fd.read(length)
+        if len(payload) < length or (zlib.crc32(payload) & 0xffffffff) != crc:
+          self._logger.warning('Spool has a corrupt record; ignoring the '
+              'rest of it.')
+          return
+        try:
+          yield cPickle.loads(payload)
+        except (EOFError, ValueError, cPickle.UnpicklingError):
+          self._logger.warning('Spool has an unreadable record; ignoring the '
+              'rest of it.')
+          return
+    finally:
+      fd.close()
+
+  def _PutRecord(self, entry):
+    return journal.EncodeRecord(RECORD_PUT, (entry.seqn, entry.create_time,
+        binproto.EncodeEvent(entry.event), entry.base_reading))
+
+  def _RemoveRecord(self, entry):
+    return journal.EncodeRecord(RECORD_REMOVE, entry.seqn)
+
+  def _Rewrite(self):
+    """Replaces the log with one holding just the current entries."""
+    records = [self._PutRecord(e) for e in self._entries.itervalues()]
+    tmp_path = self._path + '.tmp'
+    fd = open(tmp_path, 'wb')
+    try:
+      fd.write(SPOOL_MAGIC + ''.join(records))
+      fd.flush()
+      os.fsync(fd.fileno())
+    finally:
+      fd.close()
+    os.rename(tmp_path, self._path)
+    if self._fd:
+      self._fd.close()
+    self._fd = open(self._path, 'ab')
+    self._num_records = len(records)
+
+  def _WriteRecords(self, records):
+    if not self._path or not records:
+      return
+    if self._num_records + len(records) > len(self._entries) + REWRITE_SLACK:
+      self._Rewrite()
+      return
+    self._fd.write(''.join(records))
+    self._fd.flush()
+    os.fsync(self._fd.fileno())
+    self._num_records += len(records)
+
+  def _UpdateMeterEntries(self, entry):
+    event = entry.event
+    if isinstance(event, kbevent.MeterUpdate):
+      if entry.base_reading is None:
+        entry.base_reading = event.reading
+      self._meter_entries[event.tap_name] = entry
+      self._last_readings[event.tap_name] = event.reading
+    elif isinstance(event, kbevent.TokenAuthEvent):
+      self._meter_entries.clear()
+
+  def _CompactMeterUpdate(self, event, records):
+    """Removes the spooled reading which |event| supersedes, if it may.
+
+    Returns the reading the core will have seen before |event|.  The reading
+    the core saw before the first spooled one is not known, so that one is
+    assumed to be its own base; it is at most one report behind.
+    """
+    previous = self._meter_entries.get(event.tap_name)
+    if previous is not None:
+      base = previous.base_reading
+      if base <= event.reading <= base + self._max_compacted_ticks:
+        self._Remove(previous, records)
+        self._num_compacted += 1
+        return base
+    return self._last_readings.get(event.tap_name, event.reading)
+
+  def _Remove(self, entry, records):
+    del self._entries[entry.seqn]
+    if isinstance(entry.event, kbevent.MeterUpdate):
+      if self._meter_entries.get(entry.event.tap_name) is entry:
+        del self._meter_entries[entry.event.tap_name]
+    records.append(self._RemoveRecord(entry))
+
+  def _DropOldest(self, records):
+    victim = None
+    for entry in self._entries.itervalues():
+      if isinstance(entry.event, kbevent.ThermoEvent):
+        victim = entry
+        break
+    if victim is None:
+      victim = self._entries.itervalues().next()
+    self._logger.warning('Spool is full, dropping %s' % victim)
+    self._Remove(victim, records)
+    self._num_dropped += 1
+
+  def GetCount(self):
+    return len(self._entries)
+
+  def GetStatus(self):
+    ret = []
+    ret.append('Spooled events: %i' % len(self._entries))
+    ret.append('Compacted: %i, dropped: %i' % (self._num_compacted,
+        self._num_dropped))
+    return ret
+
+  @util.synchronized
+  def Put(self, event):
+    """Spools |event|.  Returns False if events of its type are not spooled."""
+    if not isinstance(event, SPOOLED_EVENT_TYPES):
+      return False
+    records = []
+    base_reading = None
+    if isinstance(event, kbevent.MeterUpdate):
+      base_reading = self._CompactMeterUpdate(event, records)
+    if len(self._entries) >= self._max_events:
+      self._DropOldest(records)
+    entry = SpoolEntry(self._next_seqn, event, base_reading=base_reading)
+    self._next_seqn += 1
+    self._entries[entry.seqn] = entry
+    self._UpdateMeterEntries(entry)
+    records.append(self._PutRecord(entry))
+    self._WriteRecords(records)
+    return True
+
+  @util.synchronized
+  def Peek(self, max_entries):
+    """Returns up to |max_entries| of the oldest entries, leaving them queued."""
+    ret = []
+    for entry in self._entries.itervalues():
+      if len(ret) >= max_entries:
+        break
+      ret.append(entry)
+    return ret
+
+  @util.synchronized
+  def Remove(self, entries):
+    """Removes entries which have been sent."""
+    records = []
+    for entry in entries:
+      if entry.seqn in self._entries:
+        self._Remove(entry, records)
+    if self._path and not self._entries:
+      self._Rewrite()
+    else:
+      self._WriteRecords(records)
+
+  @util.synchronized
+  def Close(self):
+    if self._fd:
+      self._fd.close()
+      self._fd = None
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Unittest for spool module"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pykeg.core import flow_meter
+from pykeg.core import kbevent
+from pykeg.core.net import spool
+
+def _Meter(tap_name, reading):
+  return kbevent.MeterUpdate(tap_name=tap_name, reading=reading)
+
+def _Token(status):
+  return kbevent.TokenAuthEvent(tap_name='flow0', auth_device_name='core.rfid',
+      token_value='1234', status=status)
+
+class EventSpoolTestCase(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'spool')
+    self.spool = spool.EventSpool(self.path, max_events=5,
+        max_compacted_ticks=500)
+
+  def tearDown(self):
+    self.spool.Close()
+    shutil.rmtree(self.dir)
+
+  def _Events(self, s=None):
+    if s is None:
+      s = self.spool
+    return [e.event for e in s.Peek(100)]
+
+  def testUnspooledTypeRejected(self):
+    self.assertFalse(self.spool.Put(kbevent.Ping()))
+    self.assertEqual(self.spool.GetCount(), 0)
+
+  def testMeterReadingsCompacted(self):
+    for reading in (10, 20, 30):
+      self.spool.Put(_Meter('flow0', reading))
+    self.spool.Put(_Meter('flow1', 5))
+    self.spool.Put(_Meter('flow0', 40))
+    self.assertEqual([(e.tap_name, e.reading) for e in self._Events()],
+        [('flow1', 5), ('flow0', 40)])
+
+  def testLongOutageReplayed(self):
+    # The core saw a reading of 0, then the client spooled 5000 ticks worth
+    # of readings; the core discards jumps of more than 1100 ticks.
+    s = spool.EventSpool(max_events=1000, max_compacted_ticks=500)
+    for reading in xrange(10, 5001, 10):
+      s.Put(_Meter('flow0', reading))
+    events = self._Events(s)
+    self.assert_(len(events) < 20)
+
+    meter = flow_meter.FlowMeter('flow0', max_delta=1100, start_ticks=0)
+    for event in events:
+      meter.SetTicks(event.reading)
+    self.assertEqual(meter.GetTicks(), 5000)
+
+    # A meter which went backwards is not compacted across the reset.
+    s.Put(_Meter('flow0', 5))
+    s.Put(_Meter('flow0', 15))
+    self.assertEqual([e.reading for e in self._Events(s)[-3:]],
+        [5000, 5, 15])
+
+  def testTokenEventsSeparateReadings(self):
+    self.spool.Put(_Meter('flow0', 10))
+    self.spool.Put(_Token(kbevent.TokenAuthEvent.TokenState.ADDED))
+    self.spool.Put(_Meter('flow0', 20))
+    self.spool.Put(_Meter('flow0', 30))
+    self.spool.Put(_Token(kbevent.TokenAuthEvent.TokenState.REMOVED))
+    events = self._Events()
+    self.assertEqual(len(events), 4)
+    self.assertEqual(events[0].reading, 10)
+    self.assertEqual(events[2].reading, 30)
+
+  def testFullSpoolDropsThermoFirst(self):
+    self.spool.Put(_Meter('flow0', 10))
+    self.spool.Put(kbevent.ThermoEvent(sensor_name='t0', sensor_value=1.0))
+    for i in xrange(4):
+      self.spool.Put(_Token(kbevent.TokenAuthEvent.TokenState.ADDED))
+    events = self._Events()
+    self.assertEqual(len(events), 5)
+    self.assertEqual(events[0].reading, 10)
+    self.assertFalse([e for e in events if isinstance(e, kbevent.ThermoEvent)])
+
+  def testReload(self):
+    self.spool.Put(_Meter('flow0', 10))
+    self.spool.Put(_Token(kbevent.TokenAuthEvent.TokenState.ADDED))
+    self.spool.Put(_Meter('flow0', 20))
+    self.spool.Put(_Meter('flow0', 30))
+    self.spool.Remove(self.spool.Peek(1))
+    self.spool.Close()
+
+    reloaded = spool.EventSpool(self.path, max_events=5,
+        max_compacted_ticks=500)
+    events = self._Events(reloaded)
+    self.assertEqual(len(events), 2)
+    self.assert_(isinstance(events[0], kbevent.TokenAuthEvent))
+    self.assertEqual(events[1].reading, 30)
+    self.assertEqual(reloaded.Peek(2)[1].base_reading, 10)
+
+    # Compaction continues where it left off.
+    reloaded.Put(_Meter('flow0', 40))
+    self.assertEqual(self._Events(reloaded)[-1].reading, 40)
+    self.assertEqual(reloaded.GetCount(), 2)
+    reloaded.Close()
+
+  def testTruncatedLog(self):
+    self.spool.Put(_Meter('flow0', 10))
+    self.spool.Put(_Meter('flow1', 20))
+    self.spool.Close()
+    fd = open(self.path, 'r+b')
+    fd.truncate(os.path.getsize(self.path) - 3)
+    fd.close()
+
+    reloaded = spool.EventSpool(self.path)
+    self.assertEqual([e.reading for e in self._Events(reloaded)], [10])
+    reloaded.Close()
+
+  def testLogRewrittenWhenEmpty(self):
+    self.spool.Put(_Meter('flow0', 10))
+    self.spool.Remove(self.spool.Peek(100))
+    self.assertEqual(os.path.getsize(self.path), len(spool.SPOOL_MAGIC))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,243 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Queue of completed flows waiting to be recorded by the backend.
+
+The DrinkManager puts each completed flow in the outbox instead of calling the
+backend directly; a sender thread then records them in order, retrying until
+the backend accepts each one.
+
+If a directory is given, each entry is also stored there as its own file
+(written to a temporary name, synced, and renamed into place) and deleted once
+the drink is recorded, so queued drinks survive a restart of the core.
+Entries the backend rejects outright are renamed with a '.failed' suffix and
+kept for inspection.
+"""
+
+import cPickle
+import logging
+import os
+import threading
+import time
+
+import gflags
+
+from pykeg.core import util
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string('drink_outbox_dir', '',
+    'Directory in which drinks waiting to be recorded by the backend are '
+    'stored. If empty, the outbox is kept in memory only, and drinks still '
+    'queued when the core exits are lost.')
+
+gflags.DEFINE_integer('drink_outbox_batch_size', 16,
+    'Maximum number of drinks sent to the backend in one pass of the outbox.')
+
+gflags.DEFINE_float('drink_outbox_max_backoff', 60.0,
+    'Maximum time, in seconds, between attempts to record a drink while the '
+    'backend is failing.')
+
+ENTRY_PREFIX = 'drink.'
+FAILED_SUFFIX = '.failed'
+TEMP_SUFFIX = '.tmp'
+
+
+class OutboxEntry:
+  """A completed flow waiting to be recorded.
+
+  Attributes:
+    seqn: sequence number, giving the order entries are sent in
+    flow_id: id of the flow this drink came from
+    drink_args: keyword arguments for Backend.RecordDrink
+    create_time: time.time() when the entry was queued
+    attempts: number of failed attempts to record the drink
+  """
+  def __init__(self, seqn, flow_id, drink_args, create_time=None):
+    if create_time is None:
+      create_time = time.time()
+    self.seqn = seqn
+    self.flow_id = flow_id
+    self.drink_args = drink_args
+    self.create_time = create_time
+    self.attempts = 0
+
+  def __str__(self):
+    return '<OutboxEntry %i flow=0x%08x tap=%s>' % (self.seqn, self.flow_id,
+        self.drink_args.get('tap_name'))
+
+  def GetAge(self, now=None):
+    if now is None:
+      now = time.time()
+    return max(0, now - self.create_time)
+
+  def Serialize(self):
+    return cPickle.dumps((self.flow_id, self.drink_args, self.create_time),
+        cPickle.HIGHEST_PROTOCOL)
+
+  @classmethod
+  def Deserialize(cls, seqn, data):
+    flow_id, drink_args, create_time = cPickle.loads(data)
+    return cls(seqn, flow_id, drink_args, create_time)
+
+
+class DrinkOutbox:
+  """A FIFO of OutboxEntry objects, optionally mirrored to disk."""
+
+  def __init__(self, path=None):
+    self._path = path
+    self._logger = logging.getLogger('outbox')
+    self._lock = threading.Lock()
+    self._cond = threading.Condition(self._lock)
+    self._entries = []
+    self._flow_ids = set()
+    self._next_seqn = 0
+    self._num_recorded = 0
+    self._num_rejected = 0
+    self._interrupted = False
+    if self._path:
+      self._Load()
+
+  def _EntryPath(self, seqn):
+    return os.path.join(self._path, '%s%012i' % (ENTRY_PREFIX, seqn))
+
+  def _Load(self):
+    if not os.path.isdir(self._path):
+      os.makedirs(self._path)
+      return
+    seqns = []
+    for name in os.listdir(self._path):
+      if not name.startswith(ENTRY_PREFIX):
+        continue
+      if name.endswith(TEMP_SUFFIX):
+        os.unlink(os.path.join(self._path, name))
+        continue
+      failed = name.endswith(FAILED_SUFFIX)
+      if failed:
+        name = name[:-len(FAILED_SUFFIX)]
+      try:
+        seqn = int(name[len(ENTRY_PREFIX):])
+      except ValueError:
+        continue
+      # Rejected entries are not loaded, but their seqns must not be reused,
+      # or Reject would rename another entry over them.
+      self._next_seqn = max(self._next_seqn, seqn + 1)
+      if not failed:
+        seqns.append(seqn)
+    seqns.sort()
+    for seqn in seqns:
+      path = self._EntryPath(seqn)
+      try:
+        entry = OutboxEntry.Deserialize(seqn, open(path, 'rb').read())
+      except (IOError, EOFError, ValueError, cPickle.UnpicklingError), e:
+        self._logger.error('Unreadable outbox entry %s (%s); skipping.' % (
+            path, e))
+        os.rename(path, path + FAILED_SUFFIX)
+        continue
+      self._entries.append(entry)
+      self._flow_ids.add(entry.flow_id)
+    if self._entries:
+      self._logger.info('Loaded %i queued drink(s).' % len(self._entries))
+
+  def _WriteEntry(self, entry):
+    path = self._EntryPath(entry.seqn)
+    tmp_path = path + TEMP_SUFFIX
+    fd = open(tmp_path, 'wb')
+    try:
+      fd.write(entry.Serialize())
+      fd.flush()
+      os.fsync(fd.fileno())
+    finally:
+      fd.close()
+    os.rename(tmp_path, path)
+
+  def GetStatus(self):
+    ret = []
+    depth, age = self.GetDepthAndAge()
+    ret.append('Queued drinks: %i (oldest %.1fs)' % (depth, age))
+    ret.append('Recorded: %i, rejected: %i' % (self._num_recorded,
+        self._num_rejected))
+    return ret
+
+  @util.synchronized
+  def GetDepthAndAge(self):
+    """Returns the number of queued entries and the age of the oldest one."""
+    if not self._entries:
+      return 0, 0.0
+    return len(self._entries), self._entries[0].GetAge()
+
+  @util.synchronized
+  def Put(self, flow_id, drink_args):
+    """Queues a drink.  Returns the new entry, or None if already queued."""
+    if flow_id in self._flow_ids:
+      self._logger.info('Flow 0x%08x is already queued.' % flow_id)
+      return None
+    entry = OutboxEntry(self._next_seqn, flow_id, drink_args)
+    self._next_seqn += 1
+    if self._path:
+      self._WriteEntry(entry)
+    self._entries.append(entry)
+    self._flow_ids.add(flow_id)
+    self._cond.notifyAll()
+    return entry
+
+  @util.synchronized
+  def Peek(self, max_entries=None):
+    """Returns up to |max_entries| of the oldest entries, leaving them queued."""
+    if max_entries is None:
+      max_entries = FLAGS.drink_outbox_batch_size
+    return self._entries[:max_entries]
+
+  @util.synchronized
+  def WaitForEntries(self, timeout=None):
+    """Blocks until the outbox is non-empty, or |timeout| seconds pass, or
+    Wakeup is called.
+
+    Returns True if there are entries queued.
+    """
+    if not self._entries and not self._interrupted:
+      self._cond.wait(timeout)
+    self._interrupted = False
+    return bool(self._entries)
+
+  @util.synchronized
+  def Wakeup(self):
+    """Causes a pending (or the next) WaitForEntries call to return."""
+    self._interrupted = True
+    self._cond.notifyAll()
+
+  def _Remove(self, entry):
+    self._entries.remove(entry)
+    self._flow_ids.discard(entry.flow_id)
+
+  @util.synchronized
+  def Ack(self, entry):
+    """Removes an entry which the backend has recorded."""
+    self._Remove(entry)
+    self._num_recorded += 1
+    if self._path:
+      os.unlink(self._EntryPath(entry.seqn))
+
+  @util.synchronized
+  def Reject(self, entry):
+    """Removes an entry which the backend will never accept."""
+    self._Remove(entry)
+    self._num_rejected += 1
+    if self._path:
+      path = self._EntryPath(entry.seqn)
+      os.rename(path, path + FAILED_SUFFIX)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""Unittest for outbox module"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pykeg.core import outbox
+
+class DrinkOutboxTestCase(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.outbox = outbox.DrinkOutbox(self.path)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def _Files(self):
+    return sorted(os.listdir(self.path))
+
+  def testPutPeekAck(self):
+    first = self.outbox.Put(100, {'tap_name': 'flow0', 'ticks': 10})
+    second = self.outbox.Put(101, {'tap_name': 'flow1', 'ticks': 20})
+    self.assertEqual(self.outbox.Peek(), [first, second])
+    self.assertEqual(self.outbox.Peek(1), [first])
+    self.assertEqual(len(self._Files()), 2)
+
+    self.outbox.Ack(first)
+    self.assertEqual(self.outbox.Peek(), [second])
+    self.assertEqual(len(self._Files()), 1)
+
+  def testDuplicateFlowIgnored(self):
+    self.assert_(self.outbox.Put(100, {'tap_name': 'flow0'}) is not None)
+    self.assertEqual(self.outbox.Put(100, {'tap_name': 'flow0'}), None)
+    self.assertEqual(self.outbox.GetDepthAndAge()[0], 1)
+
+  def testReload(self):
+    self.outbox.Put(100, {'tap_name': 'flow0', 'ticks': 10})
+    acked = self.outbox.Put(101, {'tap_name': 'flow0', 'ticks': 20})
+    self.outbox.Put(102, {'tap_name': 'flow1', 'ticks': 30})
+    self.outbox.Ack(acked)
+
+    reloaded = outbox.DrinkOutbox(self.path)
+    entries = reloaded.Peek()
+    self.assertEqual([e.flow_id for e in entries], [100, 102])
+    self.assertEqual(entries[1].drink_args, {'tap_name': 'flow1', 'ticks': 30})
+
+    # New entries are ordered after the reloaded ones.
+    new = reloaded.Put(103, {'tap_name': 'flow0'})
+    self.assert_(new.seqn > entries[-1].seqn)
+
+  def testRejectKeepsFile(self):
+    entry = self.outbox.Put(100, {'tap_name': 'flow0'})
+    self.outbox.Reject(entry)
+    self.assertEqual(self.outbox.Peek(), [])
+    files = self._Files()
+    self.assertEqual(len(files), 1)
+    self.assert_(files[0].endswith(outbox.FAILED_SUFFIX))
+    self.assertEqual(outbox.DrinkOutbox(self.path).Peek(), [])
+
+  def testRejectedSeqnNotReused(self):
+    rejected = self.outbox.Put(100, {'tap_name': 'flow0'})
+    self.outbox.Reject(rejected)
+    reloaded = outbox.DrinkOutbox(self.path)
+    entry = reloaded.Put(101, {'tap_name': 'flow0'})
+    self.assert_(entry.seqn > rejected.seqn)
+    reloaded.Reject(entry)
+    self.assertEqual(len(self._Files()), 2)
+
+  def testWaitForEntries(self):
+    memory_outbox = outbox.DrinkOutbox()
+    self.assertFalse(memory_outbox.WaitForEntries(timeout=0.01))
+    memory_outbox.Put(100, {'tap_name': 'flow0'})
+    self.assert_(memory_outbox.WaitForEntries(timeout=0.01))
+
+  def testWakeupBeforeWait(self):
+    memory_outbox = outbox.DrinkOutbox()
+    # A wakeup which comes before the wait is not lost.
+    memory_outbox.Wakeup()
+    self.assertFalse(memory_outbox.WaitForEntries(timeout=None))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""Benchmark of KegbotBackend.RecordDrink.
+
+Creates a test database with the engine configured in common_settings.py, so
+it can be run once with SQLite and once with MySQL.  Each phase records
+NUM_DRINKS drinks and reports drinks per second and queries per drink; the
+second phase runs after HISTORY_DRINKS more drinks have been recorded, to
+show that the cost of a drink does not grow with history.  Except on SQLite,
+whose test database is private to one connection, the last phase has
+NUM_THREADS threads pour on their own taps at once.
+"""
+
+import datetime
+import sys
+import threading
+import time
+
+import gflags
+
+from pykeg.core import importhacks
+from django.db import connection
+from django.test import simple
+from django.test import utils
+
+from pykeg.core import backend
+from pykeg.core import backend_unittest
+
+FLAGS = gflags.FLAGS
+
+NUM_DRINKS = 500
+HISTORY_DRINKS = 2000
+NUM_THREADS = 4
+
+
+class _Pourer:
+  def __init__(self, site, tap_name):
+    self._backend = backend.KegbotBackend(site=site)
+    self._tap_name = tap_name
+    self._pour_time = datetime.datetime(2011, 1, 1)
+
+  def Pour(self, count):
+    for i in xrange(count):
+      # Every tenth pour starts a new session.
+      self._pour_time += datetime.timedelta(minutes=i % 10 * 12)
+      self._backend.RecordDrink(self._tap_name, 100, volume_ml=10.0,
+          username='alice', pour_time=self._pour_time)
+
+  def PourInThread(self, count):
+    self.Pour(count)
+    connection.close()
+
+
+def RunPhase(name, pourers, count):
+  connection.queries = []
+  start = time.time()
+  if len(pourers) == 1:
+    pourers[0].Pour(count)
+  else:
+    threads = [threading.Thread(target=p.PourInThread,
+        args=(count / len(pourers),)) for p in pourers]
+    for thr in threads:
+      thr.start()
+    for thr in threads:
+      thr.join()
+  elapsed = time.time() - start
+  message = '%30s: %.0f drinks/sec' % (name, count / elapsed)
+  # Queries are only logged for the main thread's connection.
+  if len(pourers) == 1:
+    message += ', %.1f queries/drink' % (len(connection.queries) /
+        float(count))
+  print message
+
+
+def main():
+  FLAGS(sys.argv)
+  utils.setup_test_environment()
+  # Create the tables with South's migrations, as the test runner does.
+  from south.management.commands import patch_for_test_db_setup
+  patch_for_test_db_setup()
+  runner = simple.DjangoTestSuiteRunner(verbosity=0)
+  old_config = runner.setup_databases()
+  try:
+    connection.use_debug_cursor = True
+    tap_names = ['flow%i' % i for i in xrange(NUM_THREADS)]
+    site, keg = backend_unittest.CreateTestSite('benchmark', tap_names)
+    print 'Database: %s' % connection.vendor
+
+    pourer = _Pourer(site, tap_names[0])
+    RunPhase('empty database', [pourer], NUM_DRINKS)
+    pourer.Pour(HISTORY_DRINKS)
+    RunPhase('after %i drinks' % HISTORY_DRINKS, [pourer], NUM_DRINKS)
+    if connection.vendor != 'sqlite':
+      RunPhase('%i taps at once' % NUM_THREADS,
+          [_Pourer(site, name) for name in tap_names], NUM_DRINKS)
+  finally:
+    runner.teardown_databases(old_config)
+    utils.teardown_test_environment()
+
+if __name__ == '__main__':
+  main()
@@ -27,56 +27,154 @@ from pykeg.proto import models_pb2
 
 STAT_MAP = {}
 
+# The stats which map a key to a volume, and the name of their key in the
+# Stats proto.
+KEYED_STATS = {
+  'volume_by_day_of_week': 'weekday',
+  'volume_by_drinker': 'username',
+}
+
+# Weekday and drinker volumes left smaller than this by Subtract() are
+# dropped, as if they had been built without the drink.
+MIN_VOLUME_ML = 0.01
+
 def stat(statname):
   def decorate(f):
     setattr(f, 'statname', statname)
     return f
   return decorate
 
+def reverse_stat(statname):
+  """Marks the method which takes the builder's drink out of a stat."""
+  def decorate(f):
+    setattr(f, 'reverse_statname', statname)
+    return f
+  return decorate
+
+def UpgradeStats(stats):
+  """Keys the volume maps of stats stored as lists, as they once were."""
+  for statname, key in KEYED_STATS.iteritems():
+    values = stats.get(statname)
+    if isinstance(values, list):
+      stats[statname] = dict((v[key], v['volume_ml']) for v in values)
+  return stats
+
+def StatsToProto(stats):
+  """Converts stats, as built by a StatsBuilder, to a Stats message."""
+  ret = models_pb2.Stats()
+  for statname, value in UpgradeStats(stats).iteritems():
+    if statname in KEYED_STATS:
+      key = KEYED_STATS[statname]
+      messages = getattr(ret, statname)
+      for k in sorted(value):
+        message = messages.add()
+        setattr(message, key, k)
+        message.volume_ml = value[k]
+    elif value is not None:
+      setattr(ret, statname, value)
+  return ret
+
 class StatsBuilder:
+  """Builds the stats for a drink.
+
+  Stats are a dict from stat name to value, with the volume maps keyed by
+  weekday and username, so that adding a drink touches only its own keys.
+  They are stored as such, and only converted to a Stats message when served;
+  see StatsToProto.  To save copying them, Build() and Subtract() update the
+  volume maps of the previous stats in place.
+  """
+  _STAT_MAPS = {}  # maps a class to its (STAT_MAP, REVERSE_STAT_MAP)
+
   def __init__(self, drink, previous=None):
     self.drink = drink
     self.previous = previous
-    self.STAT_MAP = {}
-    for name, fn in inspect.getmembers(self, inspect.ismethod):
-      if hasattr(fn, 'statname'):
-        self.STAT_MAP[fn.statname] = fn
+    cls = self.__class__
+    if cls not in StatsBuilder._STAT_MAPS:
+      stat_map = {}
+      reverse_stat_map = {}
+      for name, fn in inspect.getmembers(cls, inspect.ismethod):
+        if hasattr(fn, 'statname'):
+          stat_map[fn.statname] = name
+        if hasattr(fn, 'reverse_statname'):
+          reverse_stat_map[fn.reverse_statname] = name
+      StatsBuilder._STAT_MAPS[cls] = (stat_map, reverse_stat_map)
+    stat_map, reverse_stat_map = StatsBuilder._STAT_MAPS[cls]
+    self.STAT_MAP = dict((k, getattr(self, v)) for k, v in stat_map.iteritems())
+    self.REVERSE_STAT_MAP = dict((k, getattr(self, v))
+        for k, v in reverse_stat_map.iteritems())
 
   def _AllDrinks(self):
     return []
 
   def Build(self):
-    self.stats = models_pb2.Stats()
+    self.stats = {}
     if not self.drink:
       return self.stats
-    self.drinks = self._AllDrinks()
+    self.last_drink_seqn = self.drink.seqn
     if self.previous:
-      self.stats.MergeFrom(self.previous)
+      self.stats.update(UpgradeStats(self.previous))
+    else:
+      # Only needed to build stats from scratch.
+      self.drinks = self._AllDrinks()
     for statname, fn in self.STAT_MAP.iteritems():
       fn()
     return self.stats
 
+  def Subtract(self):
+    """Returns the previous stats, less the drink.
+
+    The previous stats must include the drink.  Their last_drink_id is kept.
+    No queries are needed, except by SubtractGreatestVolume.
+    """
+    self.stats = dict(UpgradeStats(self.previous))
+    self.last_drink_seqn = int(self.previous['last_drink_id'])
+    for statname, fn in self.REVERSE_STAT_MAP.iteritems():
+      fn()
+    return self.stats
+
+  def _AddVolume(self, statname, key):
+    volumes = self.stats.setdefault(statname, {})
+    volumes[key] = volumes.get(key, 0.0) + self.drink.volume_ml
+
+  def _SubtractVolume(self, statname, key):
+    volumes = self.stats.get(statname, {})
+    if key in volumes:
+      volumes[key] -= self.drink.volume_ml
+      if volumes[key] < MIN_VOLUME_ML:
+        del volumes[key]
+
 
 class BaseStatsBuilder(StatsBuilder):
   """Builder which generates a variety of stats from object information."""
 
   @stat('last_drink_id')
   def LastDrinkId(self):
-    self.stats.last_drink_id = str(self.drink.seqn)
+    self.stats['last_drink_id'] = str(self.drink.seqn)
 
   @stat('total_volume_ml')
   def TotalVolume(self):
     if not self.previous:
-      self.stats.total_volume_ml = sum(drink.volume_ml for drink in self.drinks)
+      self.stats['total_volume_ml'] = sum(drink.volume_ml
+          for drink in self.drinks)
     else:
-      self.stats.total_volume_ml += self.drink.volume_ml
+      self.stats['total_volume_ml'] = self.previous.get('total_volume_ml',
+          0.0) + self.drink.volume_ml
 
   @stat('total_pours')
   def TotalPours(self):
     if not self.previous:
-      self.stats.total_pours = self.drinks.count()
+      self.stats['total_pours'] = self.drinks.count()
     else:
-      self.stats.total_pours += 1
+      self.stats['total_pours'] = self.previous.get('total_pours', 0) + 1
+
+  @reverse_stat('total_volume_ml')
+  def SubtractTotalVolume(self):
+    self.stats['total_volume_ml'] = max(0.0,
+        self.previous.get('total_volume_ml', 0.0) - self.drink.volume_ml)
+
+  @reverse_stat('total_pours')
+  def SubtractTotalPours(self):
+    self.stats['total_pours'] = max(0, self.previous.get('total_pours', 0) - 1)
 
   @stat('average_volume_ml')
   def AverageVolume(self):
@@ -85,13 +183,22 @@ class BaseStatsBuilder(StatsBuilder):
       average = 0.0
       if count:
         average = sum(drink.volume_ml for drink in self.drinks) / float(count)
-      self.stats.average_volume_ml = average
+      self.stats['average_volume_ml'] = average
     else:
-      vol = self.previous.total_volume_ml
-      count = self.previous.total_pours
+      vol = self.previous.get('total_volume_ml', 0.0)
+      count = self.previous.get('total_pours', 0)
       vol += self.drink.volume_ml
       count += 1
-      self.stats.average_volume_ml = vol / float(count)
+      self.stats['average_volume_ml'] = vol / float(count)
+
+  @reverse_stat('average_volume_ml')
+  def SubtractAverageVolume(self):
+    vol = self.previous.get('total_volume_ml', 0.0) - self.drink.volume_ml
+    count = self.previous.get('total_pours', 0) - 1
+    if count > 0:
+      self.stats['average_volume_ml'] = vol / float(count)
+    else:
+      self.stats['average_volume_ml'] = 0.0
 
   @stat('greatest_volume_ml')
   def GreatestVolume(self):
@@ -100,10 +207,10 @@ class BaseStatsBuilder(StatsBuilder):
       drinks = self.drinks.order_by('-volume_ml')
       if drinks.count():
         res = drinks[0].volume_ml
-      self.stats.greatest_volume_ml = res
+      self.stats['greatest_volume_ml'] = res
     else:
-      if self.drink.volume_ml > self.previous.greatest_volume_ml:
-        self.stats.greatest_volume_ml = self.drink.volume_ml
+      if self.drink.volume_ml > self.previous.get('greatest_volume_ml', 0):
+        self.stats['greatest_volume_ml'] = self.drink.volume_ml
 
   @stat('greatest_volume_id')
   def GreatestVolumeId(self):
@@ -112,14 +219,30 @@ class BaseStatsBuilder(StatsBuilder):
       drinks = self.drinks.order_by('-volume_ml')
       if drinks.count():
         res = drinks[0].seqn
-      self.stats.greatest_volume_id = str(res)
+      self.stats['greatest_volume_id'] = str(res)
+    else:
+      if self.drink.volume_ml > self.previous.get('greatest_volume_ml', 0):
+        self.stats['greatest_volume_id'] = str(self.drink.seqn)
+
+  @reverse_stat('greatest_volume_ml')
+  def SubtractGreatestVolume(self):
+    """Finds the greatest drink again, if it was the drink taken out.
+
+    This is the only reverse stat which may need a query.
+    """
+    if self.previous.get('greatest_volume_id') != str(self.drink.seqn):
+      return
+    drinks = self._AllDrinks().exclude(pk=self.drink.pk)
+    greatest = list(drinks.order_by('-volume_ml')[:1])
+    if greatest:
+      self.stats['greatest_volume_ml'] = greatest[0].volume_ml
+      self.stats['greatest_volume_id'] = str(greatest[0].seqn)
     else:
-      if self.drink.volume_ml > self.previous.greatest_volume_ml:
-        self.stats.greatest_volume_id = str(self.drink.seqn)
+      self.stats['greatest_volume_ml'] = 0
+      self.stats['greatest_volume_id'] = '0'
 
   @stat('volume_by_day_of_week')
   def VolumeByDayOfweek(self):
-    result = self.stats.volume_by_day_of_week
     if not self.previous:
       # Note: uses the session's starttime, rather than the drink's. This causes
       # late-night sessions to be reported for the day on which they were
@@ -127,60 +250,45 @@ class BaseStatsBuilder(StatsBuilder):
       volmap = {}
       for drink in self.drinks:
         weekday = drink.session.starttime.strftime('%w')
-        if weekday not in volmap:
-          volmap[weekday] = 0.0
-        volmap[weekday] += drink.volume_ml
-      for weekday, volume_ml in volmap.iteritems():
-        if volume_ml:
-          day = result.add()
-          day.weekday = weekday
-          day.volume_ml = volume_ml
+        volmap[weekday] = volmap.get(weekday, 0.0) + drink.volume_ml
+      self.stats['volume_by_day_of_week'] = dict((k, v)
+          for k, v in volmap.iteritems() if v)
     else:
-      drink_weekday = self.drink.session.starttime.strftime('%w')
-      for message in self.stats.volume_by_day_of_week:
-        if message.weekday == drink_weekday:
-          message.volume_ml += self.drink.volume_ml
-          return
-      message = result.add()
-      message.weekday = drink_weekday
-      message.volume_ml = self.drink.volume_ml
+      self._AddVolume('volume_by_day_of_week',
+          self.drink.session.starttime.strftime('%w'))
+
+  @reverse_stat('volume_by_day_of_week')
+  def SubtractVolumeByDayOfWeek(self):
+    self._SubtractVolume('volume_by_day_of_week',
+        self.drink.session.starttime.strftime('%w'))
+
+  def _DrinkerKey(self, drink):
+    if drink.user:
+      return drink.user.username
+    return ''
 
   @stat('volume_by_drinker')
   def VolumeByDrinker(self):
     if not self.previous:
-      result = self.stats.volume_by_drinker
       volmap = {}
       for drink in self.drinks:
-        if drink.user:
-          u = drink.user.username
-        else:
-          u = ''
+        u = self._DrinkerKey(drink)
         volmap[u] = volmap.get(u, 0) + drink.volume_ml
-      for username, volume_ml in volmap.iteritems():
-        if volume_ml:
-          record = result.add()
-          record.username = username
-          record.volume_ml = volume_ml
+      self.stats['volume_by_drinker'] = dict((k, v)
+          for k, v in volmap.iteritems() if v)
     else:
-      result = self.stats.volume_by_drinker
-      if self.drink.user:
-        u = self.drink.user.username
-      else:
-        u = ''
-      for message in result:
-        if message.username == u:
-          message.volume_ml += self.drink.volume_ml
-          return
-      message = result.add()
-      message.username = u
-      message.volume_ml = self.drink.volume_ml
+      self._AddVolume('volume_by_drinker', self._DrinkerKey(self.drink))
+
+  @reverse_stat('volume_by_drinker')
+  def SubtractVolumeByDrinker(self):
+    self._SubtractVolume('volume_by_drinker', self._DrinkerKey(self.drink))
 
 class SystemStatsBuilder(BaseStatsBuilder):
   """Builder of systemwide stats by drink."""
   REVISION = 5
 
   def _AllDrinks(self):
-    qs = self.drink.site.drinks.valid().filter(seqn__lte=self.drink.seqn)
+    qs = self.drink.site.drinks.valid().filter(seqn__lte=self.last_drink_seqn)
     qs = qs.order_by('seqn')
     return qs
 
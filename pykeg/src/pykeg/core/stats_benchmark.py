@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Benchmark of incremental stats updates as the number of drinkers grows.
+
+For each drinker count, builds stats covering that many drinkers, then adds
+NUM_DRINKS drinks by random drinkers to them the way _StatsModel.Update does:
+decoding the stored JSON, building, and encoding the result again as
+JSONField does.  Reports
+drinks/sec for the whole update and for the build alone.
+"""
+
+import datetime
+import random
+import sys
+import time
+
+import gflags
+
+from pykeg.core import kbjson
+from pykeg.core import stats
+from pykeg.core import util
+
+FLAGS = gflags.FLAGS
+
+DRINKER_COUNTS = (10, 100, 1000, 10000)
+NUM_DRINKS = 2000
+
+
+class _FakeDrink:
+  def __init__(self, seqn, username, volume_ml, session):
+    self.seqn = seqn
+    self.user = util.AttrDict(username=username)
+    self.volume_ml = volume_ml
+    self.session = session
+
+
+def RunBenchmark(num_drinkers):
+  session = util.AttrDict(starttime=datetime.datetime(2011, 1, 1, 18, 0))
+  usernames = ['drinker%i' % i for i in xrange(num_drinkers)]
+  previous = {
+    'last_drink_id': '0',
+    'total_volume_ml': 0.0,
+    'total_pours': 0,
+  }
+  for seqn, username in enumerate(usernames):
+    drink = _FakeDrink(seqn + 1, username, 100.0, session)
+    previous = stats.SystemStatsBuilder(drink, previous).Build()
+  stored = kbjson.dumps(previous, indent=None)
+
+  drinks = [_FakeDrink(num_drinkers + i + 1, random.choice(usernames),
+      random.uniform(50.0, 500.0), session) for i in xrange(NUM_DRINKS)]
+  build_time = 0.0
+  start = time.time()
+  for drink in drinks:
+    previous = kbjson.loads(stored)
+    build_start = time.time()
+    builder = stats.SystemStatsBuilder(drink, previous)
+    result = builder.Build()
+    build_time += time.time() - build_start
+    stored = kbjson.dumps(result, indent=None)
+  elapsed = time.time() - start
+
+  print '%6i drinkers: %8.0f drinks/sec, %8.0f drinks/sec building only' % (
+      num_drinkers, NUM_DRINKS / elapsed, NUM_DRINKS / build_time)
+
+def main():
+  FLAGS(sys.argv)
+  for num_drinkers in DRINKER_COUNTS:
+    RunBenchmark(num_drinkers)
+
+if __name__ == '__main__':
+  main()
@@ -16,14 +16,15 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
 import datetime
 
 from django.utils import unittest
 
 from pykeg.core import backend
+from pykeg.core import kbjson
 from pykeg.core import models
 from pykeg.core import stats
-from pykeg.proto import models_pb2
 from pykeg.proto.protoutil import ProtoMessageToDict
 
 class StatsTestCase(unittest.TestCase):
@@ -46,35 +47,23 @@ class StatsTestCase(unittest.TestCase):
     #        volume_ml=amt, username=user.username, do_postprocess=False)
     #    self.drinks.append(d)
 
-  def assertProtosEqual(self, m1, m2):
-    d1 = ProtoMessageToDict(m1)
-    d2 = ProtoMessageToDict(m2)
-    for k, v in d1.iteritems():
-      if k not in d2:
-        self.fail('Value for %s not present in m2' % k)
-      elif v != d2[k]:
-        self.fail('Values for %s differ: expected "%s", got "%s"' %
-            (k, v, d2[k]))
-    for k, v in d2.iteritems():
-      if k not in d1:
-        self.fail('Value for %s not present in m1' % k)
-
   def _getEmptyStats(self):
-    s = models_pb2.Stats()
-    s.last_drink_id = "0"
-    s.total_volume_ml = 0.0
-    s.total_pours = 0
-    s.average_volume_ml = 0.0
-    s.greatest_volume_ml = 0.0
-    s.greatest_volume_id = "0"
-    return s
+    return {
+      'last_drink_id': "0",
+      'total_volume_ml': 0.0,
+      'total_pours': 0,
+      'average_volume_ml': 0.0,
+      'greatest_volume_ml': 0.0,
+      'greatest_volume_id': "0",
+      'volume_by_day_of_week': {},
+      'volume_by_drinker': {},
+    }
 
   def testStuff(self):
     builder = stats.SystemStatsBuilder(None)
 
-    empty_stats = models_pb2.Stats()
     system_stats_d0 = builder.Build()
-    self.assertEquals(empty_stats, system_stats_d0)
+    self.assertEquals({}, system_stats_d0)
 
     # Record a new drink and verify stats.
     pour_time = datetime.datetime(2011, 05, 01, 12, 00)
@@ -84,21 +73,17 @@ class StatsTestCase(unittest.TestCase):
     drink1 = models.Drink.objects.get(seqn=1)
 
     expected = self._getEmptyStats()
-    expected.last_drink_id = "1"
-    expected.total_volume_ml = 100.0
-    expected.total_pours = 1
-    expected.average_volume_ml = 100.0
-    expected.greatest_volume_ml = 100.0
-    expected.greatest_volume_id = "1"
-    d = expected.volume_by_day_of_week.add()
-    d.weekday = "0"  # Sunday
-    d.volume_ml = 100
-    u = expected.volume_by_drinker.add()
-    u.username = "user1"
-    u.volume_ml = 100
+    expected['last_drink_id'] = "1"
+    expected['total_volume_ml'] = 100.0
+    expected['total_pours'] = 1
+    expected['average_volume_ml'] = 100.0
+    expected['greatest_volume_ml'] = 100.0
+    expected['greatest_volume_id'] = "1"
+    expected['volume_by_day_of_week']['0'] = 100.0  # Sunday
+    expected['volume_by_drinker']['user1'] = 100.0
 
     system_stats_d1 = stats.SystemStatsBuilder(drink1).Build()
-    self.assertProtosEqual(expected, system_stats_d1)
+    self.assertEquals(expected, system_stats_d1)
 
     # Pour another drink
     self.backend.RecordDrink('kegboard.flow0', ticks=200,
@@ -107,21 +92,58 @@ class StatsTestCase(unittest.TestCase):
     drink2 = models.Drink.objects.get(seqn=2)
 
     # Adjust stats
-    expected.last_drink_id = "2"
-    expected.total_volume_ml = 300.0
-    expected.total_pours = 2
-    expected.average_volume_ml = 150.0
-    expected.greatest_volume_ml = 200.0
-    expected.greatest_volume_id = "2"
-    d = expected.volume_by_day_of_week[0]
-    d.volume_ml += 200
-    u = expected.volume_by_drinker[0]
-    u.volume_ml += 200
+    expected['last_drink_id'] = "2"
+    expected['total_volume_ml'] = 300.0
+    expected['total_pours'] = 2
+    expected['average_volume_ml'] = 150.0
+    expected['greatest_volume_ml'] = 200.0
+    expected['greatest_volume_id'] = "2"
+    expected['volume_by_day_of_week']['0'] += 200
+    expected['volume_by_drinker']['user1'] += 200
 
     system_stats_d2 = stats.SystemStatsBuilder(drink2).Build()
-    self.assertProtosEqual(expected, system_stats_d2)
-
-    # Build the same stats incrementally and verify identical result.
-    system_stats_d2_inc = stats.SystemStatsBuilder(drink2, system_stats_d1).Build()
-    self.assertProtosEqual(system_stats_d2, system_stats_d2_inc)
-
+    self.assertEquals(expected, system_stats_d2)
+
+    # Build the same stats incrementally and verify identical result.  The
+    # builder updates the volume maps in place, so give it a copy.
+    system_stats_d2_inc = stats.SystemStatsBuilder(drink2,
+        copy.deepcopy(system_stats_d1)).Build()
+    self.assertEquals(system_stats_d2, system_stats_d2_inc)
+
+    # Take the second drink back out.  It was the greatest, so the first is
+    # found again.
+    expected = system_stats_d1
+    expected['last_drink_id'] = "2"
+    system_stats_d2_sub = stats.SystemStatsBuilder(drink2,
+        system_stats_d2).Subtract()
+    self.assertEquals(expected, system_stats_d2_sub)
+
+    # Cancel it, and take out the first as well.
+    drink2.status = 'deleted'
+    drink2.save()
+    expected = self._getEmptyStats()
+    expected['last_drink_id'] = "2"
+    system_stats_d2_sub = stats.SystemStatsBuilder(drink1,
+        system_stats_d2_sub).Subtract()
+    self.assertEquals(expected, system_stats_d2_sub)
+
+
+class StatsToProtoTestCase(unittest.TestCase):
+  def testStatsToProto(self):
+    values = {
+      'greatest_volume_id': '0',
+      'volume_by_drinker': {'user2': 20.0, 'user1': 10.0},
+    }
+    message = stats.StatsToProto(values)
+    self.assertEquals(message.greatest_volume_id, '0')
+    self.assertEquals([(v.username, v.volume_ml)
+        for v in message.volume_by_drinker], [('user1', 10.0), ('user2', 20.0)])
+
+    # Usernames are keys when stored, and are not mistaken for times.
+    stored = kbjson.loads(kbjson.dumps({'volume_by_drinker': {'overtime': 1.0}}))
+    self.assertEquals(stored['volume_by_drinker'], {'overtime': 1.0})
+
+    # Stats stored as lists are keyed when read.
+    old = ProtoMessageToDict(message)
+    self.assertEquals(stats.UpgradeStats(old)['volume_by_drinker'],
+        {'user1': 10.0, 'user2': 20.0})
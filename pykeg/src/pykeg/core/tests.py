@@ -25,27 +25,53 @@ routine to return a unittest.TestSuite.
 from django.utils import unittest
 
 from pykeg.core import alarm_unittest
+from pykeg.core import backend_unittest
 from pykeg.core import stats_unittest
 from pykeg.core import flow_meter_unittest
+from pykeg.core import journal_unittest
+from pykeg.core import kb_threads_unittest
+from pykeg.core import kbevent_unittest
 from pykeg.core import kegbot_unittest
+from pykeg.core import manager_unittest
 from pykeg.core import models_unittest
+from pykeg.core import outbox_unittest
+from pykeg.core import token_cache_unittest
 from pykeg.core import units_unittest
 from pykeg.core import util_unittest
+from pykeg.core.net import binproto_unittest
 from pykeg.core.net import kegnet_unittest
+from pykeg.core.net import spool_unittest
 from pykeg.hw.kegboard import kegboard_unittest
 from pykeg.hw.kegboard import crc16_unittest
+from pykeg.hw.kegboard import simulator_unittest
+from pykeg.hw.kegboard import capture_unittest
+from pykeg.hw.kegboard import filters_unittest
+from pykeg.web.api import krest_unittest
 
 ALL_TEST_MODULES = (
     alarm_unittest,
+    backend_unittest,
     stats_unittest,
     flow_meter_unittest,
+    journal_unittest,
+    kb_threads_unittest,
+    kbevent_unittest,
+    manager_unittest,
     models_unittest,
+    outbox_unittest,
+    token_cache_unittest,
     units_unittest,
     util_unittest,
+    binproto_unittest,
     kegnet_unittest,
+    spool_unittest,
     kegbot_unittest,
     kegboard_unittest,
     crc16_unittest,
+    simulator_unittest,
+    capture_unittest,
+    filters_unittest,
+    krest_unittest,
 )
 
 def suite():
@@ -0,0 +1,139 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of the users auth tokens are assigned to.
+
+Auth devices such as RFID readers report the same token over and over, and
+each report would otherwise cost a backend lookup: an HTTP request with the
+web backend.  The TokenCache remembers the result of each lookup, including
+tokens which are not assigned to anyone.  Entries expire after a while, but
+an expired entry is still used if the backend fails, so tokens keep working
+while it is down.  Kegweb sends a TokenChangedEvent when a token is changed,
+and the entry is then dropped at once.
+"""
+
+import logging
+import threading
+import time
+
+from pykeg.core import backend
+from pykeg.core import kb_common
+from pykeg.core import util
+
+
+class _Entry:
+  __slots__ = ('username', 'fetch_time')
+
+  def __init__(self, username, fetch_time):
+    self.username = username  # None if the token is not assigned
+    self.fetch_time = fetch_time
+
+
+class TokenCache:
+  def __init__(self, backend_obj, ttl=kb_common.AUTH_TOKEN_CACHE_SECS,
+      negative_ttl=kb_common.AUTH_TOKEN_NEGATIVE_CACHE_SECS, clock=time.time):
+    self._backend = backend_obj
+    self._ttl = ttl
+    self._negative_ttl = negative_ttl
+    self._clock = clock
+    self._entries = {}  # maps (auth_device, token_value) to _Entry
+    # Incremented by every invalidation, so that a lookup which raced with one
+    # does not store what may be an outdated result.
+    self._generation = 0
+    self._num_hits = 0
+    self._num_misses = 0
+    self._num_stale = 0
+    self._lock = threading.Lock()
+    self._logger = logging.getLogger('token-cache')
+
+  @util.synchronized
+  def GetStatus(self):
+    return ['Token cache: %i entries, %i hits, %i misses, %i stale' % (
+        len(self._entries), self._num_hits, self._num_misses, self._num_stale)]
+
+  def GetUsername(self, auth_device, token_value):
+    """Returns the username |token_value| is assigned to, or None."""
+    key = (auth_device, token_value)
+    entry, generation = self._Lookup(key)
+    if entry is not None:
+      return entry.username
+
+    try:
+      token = self._backend.GetAuthToken(auth_device, token_value)
+      username = token.username or None
+    except backend.NoTokenError:
+      username = None
+    except Exception, e:
+      return self._BackendFailed(key, e)
+    self._Store(key, username, generation)
+    return username
+
+  @util.synchronized
+  def _Lookup(self, key):
+    """Returns (fresh entry for |key| or None, current generation)."""
+    entry = self._entries.get(key)
+    if entry is not None:
+      ttl = self._ttl
+      if entry.username is None:
+        ttl = self._negative_ttl
+      if self._clock() - entry.fetch_time < ttl:
+        self._num_hits += 1
+        return entry, self._generation
+    self._num_misses += 1
+    return None, self._generation
+
+  @util.synchronized
+  def _Store(self, key, username, generation):
+    if generation == self._generation:
+      self._entries[key] = _Entry(username, self._clock())
+
+  @util.synchronized
+  def _BackendFailed(self, key, error):
+    entry = self._entries.get(key)
+    if entry is None:
+      self._logger.warning('Error fetching token %s=%s: %s' % (key + (error,)))
+      return None
+    self._logger.warning('Error fetching token %s=%s: %s; using cached '
+        'entry.' % (key + (error,)))
+    self._num_stale += 1
+    return entry.username
+
+  @util.synchronized
+  def Invalidate(self, auth_device=None, token_value=None):
+    """Drops the entry for a token, or every entry if none is given."""
+    self._generation += 1
+    if auth_device is None and token_value is None:
+      self._entries.clear()
+    else:
+      self._entries.pop((auth_device, token_value), None)
+
+  def Prefetch(self):
+    """Fills the cache with every token the backend has.
+
+    Returns the number of tokens fetched, or None if the backend cannot list
+    its tokens.
+    """
+    generation = self._generation
+    try:
+      tokens = self._backend.GetAllAuthTokens()
+    except NotImplementedError:
+      return None
+    for token in tokens:
+      self._Store((token.auth_device, token.token_value),
+          token.username or None, generation)
+    return len(tokens)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""Unittest for token_cache module"""
+
+import socket
+import unittest
+
+from pykeg.core import backend
+from pykeg.core import token_cache
+
+
+class _FakeToken:
+  def __init__(self, auth_device, token_value, username):
+    self.auth_device = auth_device
+    self.token_value = token_value
+    self.username = username
+
+
+class _FakeBackend(backend.Backend):
+  def __init__(self):
+    self.tokens = {}  # maps (auth_device, token_value) to username
+    self.num_lookups = 0
+    self.down = False
+
+  def GetAuthToken(self, auth_device, token_value):
+    self.num_lookups += 1
+    if self.down:
+      raise socket.error('down')
+    username = self.tokens.get((auth_device, token_value))
+    if username is None:
+      raise backend.NoTokenError
+    return _FakeToken(auth_device, token_value, username)
+
+  def GetAllAuthTokens(self):
+    return [_FakeToken(k[0], k[1], v) for k, v in self.tokens.iteritems()]
+
+
+class TokenCacheTestCase(unittest.TestCase):
+  def setUp(self):
+    self.now = 1000.0
+    self.backend = _FakeBackend()
+    self.backend.tokens[('rfid', 'aa')] = 'alice'
+    self.cache = token_cache.TokenCache(self.backend, ttl=600,
+        negative_ttl=60, clock=lambda: self.now)
+
+  def testCaching(self):
+    for i in xrange(3):
+      self.assertEqual(self.cache.GetUsername('rfid', 'aa'), 'alice')
+      self.assertEqual(self.cache.GetUsername('rfid', 'bb'), None)
+    self.assertEqual(self.backend.num_lookups, 2)
+
+    # Negative entries expire sooner.
+    self.now += 60
+    self.backend.tokens[('rfid', 'bb')] = 'bob'
+    self.assertEqual(self.cache.GetUsername('rfid', 'aa'), 'alice')
+    self.assertEqual(self.cache.GetUsername('rfid', 'bb'), 'bob')
+    self.assertEqual(self.backend.num_lookups, 3)
+
+    self.now += 600
+    self.assertEqual(self.cache.GetUsername('rfid', 'aa'), 'alice')
+    self.assertEqual(self.backend.num_lookups, 4)
+    self.assertEqual(self.cache.GetStatus(),
+        ['Token cache: 2 entries, 5 hits, 4 misses, 0 stale'])
+
+  def testInvalidate(self):
+    self.assertEqual(self.cache.GetUsername('rfid', 'aa'), 'alice')
+    self.assertEqual(self.cache.GetUsername('rfid', 'bb'), None)
+    self.backend.tokens[('rfid', 'aa')] = 'carol'
+    self.backend.tokens[('rfid', 'bb')] = 'bob'
+
+    self.cache.Invalidate('rfid', 'bb')
+    self.assertEqual(self.cache.GetUsername('rfid', 'aa'), 'alice')
+    self.assertEqual(self.cache.GetUsername('rfid', 'bb'), 'bob')
+
+    self.cache.Invalidate()
+    self.assertEqual(self.cache.GetUsername('rfid', 'aa'), 'carol')
+
+  def testBackendDown(self):
+    self.assertEqual(self.cache.GetUsername('rfid', 'aa'), 'alice')
+    self.backend.down = True
+    self.now += 1000
+    # Expired entries are used while the backend is down, but unknown tokens
+    # are not remembered as unassigned.
+    self.assertEqual(self.cache.GetUsername('rfid', 'aa'), 'alice')
+    self.assertEqual(self.cache.GetUsername('rfid', 'bb'), None)
+    self.backend.down = False
+    self.backend.tokens[('rfid', 'bb')] = 'bob'
+    self.assertEqual(self.cache.GetUsername('rfid', 'bb'), 'bob')
+
+  def testPrefetch(self):
+    self.backend.tokens[('rfid', 'bb')] = 'bob'
+    self.assertEqual(self.cache.Prefetch(), 2)
+    self.assertEqual(self.cache.GetUsername('rfid', 'aa'), 'alice')
+    self.assertEqual(self.cache.GetUsername('rfid', 'bb'), 'bob')
+    self.assertEqual(self.backend.num_lookups, 0)
+
+    cache = token_cache.TokenCache(backend.Backend())
+    self.assertEqual(cache.Prefetch(), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
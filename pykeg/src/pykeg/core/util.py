@@ -19,6 +19,8 @@
 """General purpose utilities, bits, and bobs"""
 
 import asyncore
+import ctypes
+import ctypes.util
 import datetime
 import errno
 import os
@@ -30,6 +32,36 @@ import time
 import traceback
 import logging
 
+### Time
+
+CLOCK_MONOTONIC = 1  # from <time.h> on Linux
+
+class _Timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _GetMonotonicClock():
+  """Returns a function giving the time in seconds from CLOCK_MONOTONIC, or
+  time.time where that is unavailable."""
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('rt') or
+        ctypes.util.find_library('c'))
+    clock_gettime = libc.clock_gettime
+  except (OSError, AttributeError):
+    return time.time
+  ts = _Timespec()
+  if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+    return time.time
+
+  def monotonic():
+    ts = _Timespec()
+    clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+  return monotonic
+
+# Seconds from an arbitrary start, unaffected by changes to the system clock.
+MonotonicTime = _GetMonotonicClock()
+
+
 ### Misc classes
 def Enum(*defs):
   """http://code.activestate.com/recipes/413486/"""
@@ -182,6 +214,8 @@ class DeclarativeMeta(type):
 
 class Declarative(object):
   __metaclass__ = DeclarativeMeta
+  __slots__ = ()
+
   def __classinit__(cls, new_attrs):
     pass
 
@@ -199,6 +233,8 @@ class BaseField(object):
 
 
 class BaseMessage(Declarative):
+  # Subclasses get an instance __dict__ unless they also declare __slots__.
+  __slots__ = ('_fields', '_values')
   class_fields = {}
 
   def __classinit__(cls, new_attrs):
@@ -219,8 +255,9 @@ class BaseMessage(Declarative):
     setattr(cls, name, property(getter, setter))
 
   def __init__(self, initial=None, **kwargs):
-    self._fields = self.class_fields.copy()
-    self._values = dict((k, None) for k in self.class_fields.keys())
+    # Shared with the class; must not be modified.
+    self._fields = self.class_fields
+    self._values = dict.fromkeys(self.class_fields)
 
     if initial is not None:
       self._UpdateFromDict(initial)
@@ -0,0 +1,198 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Capture and replay of the raw byte stream of a kegboard.
+
+A capture file starts with CAPTURE_HEADER: a magic string and the wall clock
+time the capture was started.  It is followed by one record per read from, or
+write to, the serial port: a RECORD_HEADER giving the time since the previous
+record in microseconds (from util.MonotonicTime, so captures are not disturbed
+by clock changes) and the length of the data, whose top bit is set for data
+sent to the kegboard; then the data itself.
+
+A CapturingPort records everything passing through a serial port.  A
+ReplayPort plays back the bytes received in a capture, at the original speed,
+some multiple of it, or as fast as they can be read.
+"""
+
+import os
+import struct
+import threading
+import time
+
+from pykeg.core import util
+
+CAPTURE_MAGIC = 'KBC1'
+CAPTURE_HEADER = struct.Struct('<4sd')
+RECORD_HEADER = struct.Struct('<IH')
+
+FLAG_TX = 0x8000
+MAX_RECORD_LEN = FLAG_TX - 1
+MAX_DELTA_MICROS = 0xffffffff
+
+# Buffered records are flushed to disk at least this often, in seconds.
+FLUSH_INTERVAL = 1.0
+
+
+class CaptureError(ValueError):
+  """Raised when a file is not a capture."""
+
+
+def NewCapturePath(capture_dir, board_name):
+  """Returns a path for a new capture of |board_name|."""
+  return os.path.join(capture_dir, '%s-%s.kbc' % (board_name,
+      time.strftime('%Y%m%d-%H%M%S')))
+
+
+class CaptureWriter:
+  """Appends records to a new capture file."""
+  def __init__(self, path, clock=util.MonotonicTime):
+    self._lock = threading.Lock()
+    self._clock = clock
+    self._fd = open(path, 'wb')
+    self._fd.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time()))
+    self._last_time = clock()
+    self._last_flush = self._last_time
+
+  @util.synchronized
+  def Write(self, data, is_tx=False):
+    if not self._fd:
+      return
+    now = self._clock()
+    delta = max(0, int((now - self._last_time) * 1000000))
+    self._last_time = now
+    flag = 0
+    if is_tx:
+      flag = FLAG_TX
+    # Gaps too long for one record are carried by empty ones.
+    while delta > MAX_DELTA_MICROS:
+      self._fd.write(RECORD_HEADER.pack(MAX_DELTA_MICROS, 0))
+      delta -= MAX_DELTA_MICROS
+    for pos in xrange(0, len(data), MAX_RECORD_LEN):
+      chunk = data[pos:pos+MAX_RECORD_LEN]
+      self._fd.write(RECORD_HEADER.pack(delta, flag | len(chunk)) + chunk)
+      delta = 0
+    if now - self._last_flush >= FLUSH_INTERVAL:
+      self._fd.flush()
+      self._last_flush = now
+
+  @util.synchronized
+  def Close(self):
+    if self._fd:
+      self._fd.close()
+      self._fd = None
+
+
+def ReadCaptureHeader(fd):
+  """Reads the header of a capture, returning the wall clock time at which it
+  was started.
+
+  Raises CaptureError if |fd| does not hold a capture.
+  """
+  header = fd.read(CAPTURE_HEADER.size)
+  if len(header) < CAPTURE_HEADER.size:
+    raise CaptureError('Not a kegboard capture.')
+  magic, start_time = CAPTURE_HEADER.unpack(header)
+  if magic != CAPTURE_MAGIC:
+    raise CaptureError('Not a kegboard capture.')
+  return start_time
+
+
+def ReadCapture(fd):
+  """Yields (seconds since the start, is_tx, data) for each record in a
+  capture.  A truncated last record, as left by a crash, is ignored.
+  """
+  ReadCaptureHeader(fd)
+  micros = 0
+  while True:
+    header = fd.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+      return
+    delta, flag_len = RECORD_HEADER.unpack(header)
+    length = flag_len & MAX_RECORD_LEN
+    data = fd.read(length)
+    if len(data) < length:
+      return
+    micros += delta
+    if data:
+      yield micros / 1000000.0, bool(flag_len & FLAG_TX), data
+
+
+class CapturingPort:
+  """Wraps a serial port, recording everything read from or written to it."""
+  def __init__(self, port, path):
+    self._port = port
+    self._writer = CaptureWriter(path)
+
+  def fileno(self):
+    return self._port.fileno()
+
+  def inWaiting(self):
+    return self._port.inWaiting()
+
+  def read(self, count):
+    data = self._port.read(count)
+    if data:
+      self._writer.Write(data)
+    return data
+
+  def write(self, data):
+    self._writer.Write(data, is_tx=True)
+    return self._port.write(data)
+
+  def StopCapture(self):
+    """Closes the capture; the port may still be used."""
+    self._writer.Close()
+
+  def close(self):
+    self.StopCapture()
+    self._port.close()
+
+
+class ReplayPort:
+  """A read-only port giving the bytes received in a capture.
+
+  Each read returns the next record, once it is due: at its original time
+  divided by |speed|, counted from the first read.  If |speed| is 0, records
+  are returned immediately.  Reads return '' at the end of the capture.
+  """
+  def __init__(self, fd, speed=1.0, clock=util.MonotonicTime,
+      sleep=time.sleep):
+    self._records = ReadCapture(fd)
+    self._speed = speed
+    self._clock = clock
+    self._sleep = sleep
+    self._start = None
+    self._pending = ''
+
+  def read(self, count):
+    if not self._pending:
+      for when, is_tx, data in self._records:
+        if not is_tx:
+          break
+      else:
+        return ''
+      if self._speed:
+        if self._start is None:
+          self._start = self._clock() - when / self._speed
+        delay = self._start + when / self._speed - self._clock()
+        if delay > 0:
+          self._sleep(delay)
+      self._pending = data
+    ret, self._pending = self._pending[:count], self._pending[count:]
+    return ret
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""Unittest for capture module"""
+
+import cStringIO
+import os
+import shutil
+import tempfile
+import unittest
+
+from pykeg.hw.kegboard import capture
+from pykeg.hw.kegboard import kegboard
+from pykeg.hw.kegboard import kegboard_unittest
+
+
+class _FakeClock:
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+
+class _FakePort:
+  """A serial port which has 64 bytes buffered at a time."""
+  def __init__(self, data):
+    self._fd = cStringIO.StringIO(data)
+    self._remain = len(data)
+    self.written = []
+
+  def inWaiting(self):
+    return min(self._remain, 64)
+
+  def read(self, count):
+    data = self._fd.read(count)
+    self._remain -= len(data)
+    return data
+
+  def write(self, data):
+    self.written.append(data)
+
+
+class CaptureTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'test.kbc')
+    self.clock = _FakeClock()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _Records(self):
+    return list(capture.ReadCapture(open(self.path, 'rb')))
+
+  def testRoundTrip(self):
+    writer = capture.CaptureWriter(self.path, clock=self.clock)
+    writer.Write('hello')
+    self.clock.now += 0.25
+    writer.Write('ping', is_tx=True)
+    self.clock.now += 5000  # longer than one record can carry
+    writer.Write('x' * 40000)
+    writer.Close()
+
+    records = self._Records()
+    self.assertEqual(records[0], (0.0, False, 'hello'))
+    self.assertEqual(records[1], (0.25, True, 'ping'))
+    self.assertEqual(len(records), 4)
+    self.assertAlmostEqual(records[2][0], 5000.25)
+    self.assertEqual(records[2][0], records[3][0])
+    self.assertEqual(records[2][2] + records[3][2], 'x' * 40000)
+
+    # A truncated record is ignored.
+    data = open(self.path, 'rb').read()
+    open(self.path, 'wb').write(data[:-10])
+    self.assertEqual(len(self._Records()), 3)
+
+    open(self.path, 'wb').write('bogus data')
+    self.assertRaises(capture.CaptureError, self._Records)
+
+  def testCapturingPort(self):
+    data = open(kegboard_unittest.CAP_FILE, 'rb').read()
+    serial_port = _FakePort(data)
+    port = capture.CapturingPort(serial_port, self.path)
+    reader = kegboard.KegboardReader(port)
+    messages = []
+    while True:
+      try:
+        messages.extend(reader.ReadMessages())
+      except EOFError:
+        break
+    reader.WriteMessage(kegboard.PingCommand())
+    port.StopCapture()
+    self.assertEqual(serial_port.written, [kegboard.PingCommand().ToBytes()])
+
+    records = self._Records()
+    self.assertEqual(''.join(r[2] for r in records if not r[1]), data)
+    self.assertEqual(records[-1][1:],
+        (True, kegboard.PingCommand().ToBytes()))
+
+    # Replaying the capture gives the same messages.
+    replay = capture.ReplayPort(open(self.path, 'rb'), speed=0)
+    reader = kegboard.KegboardReader(replay)
+    replayed = []
+    while True:
+      try:
+        replayed.extend(reader.ReadMessages())
+      except EOFError:
+        break
+    self.assertEqual(replayed, messages)
+
+  def testReplaySpeed(self):
+    writer = capture.CaptureWriter(self.path, clock=self.clock)
+    for i in xrange(3):
+      self.clock.now += 1.0
+      writer.Write(str(i))
+    writer.Close()
+
+    for speed, elapsed in ((1.0, 2.0), (4.0, 0.5), (0, 0)):
+      start = self.clock.now
+      port = capture.ReplayPort(open(self.path, 'rb'), speed=speed,
+          clock=self.clock, sleep=self.clock.sleep)
+      self.assertEqual([port.read(10) for i in xrange(4)], ['0', '1', '2', ''])
+      self.assertAlmostEqual(self.clock.now - start, elapsed)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,3 +1,4 @@
+import binascii
 import types
 
 _CRC16_CCITT_TABLE = []
@@ -23,10 +24,27 @@ def _get_crc16_ccitt_table():
     _CRC16_CCITT_TABLE = ret
   return _CRC16_CCITT_TABLE
 
-def crc16_ccitt(bytes):
+def _crc16_ccitt_python(bytes):
   table = _get_crc16_ccitt_table()
   crc = 0
   for byte in bytes:
     byte = ord(byte)
     crc = ((crc >> 8) ^ table[(crc ^ byte) & 0xff])
   return crc
+
+# Translation table reversing the bits of each byte.
+_BIT_REVERSE = ''.join(chr(int(bin(i)[2:].zfill(8)[::-1], 2))
+    for i in xrange(256))
+
+def crc16_ccitt(bytes):
+  """Returns the CRC of |bytes|, a str, bytearray or buffer.
+
+  This is the bit-reflected form of the CCITT CRC, as used by the kegboard.
+  It is computed with binascii.crc_hqx, which implements the unreflected form,
+  on the bit-reversed input; reversing its result gives the same value as the
+  byte-at-a-time table version, at a fraction of the cost.
+  """
+  if not isinstance(bytes, str):
+    bytes = str(bytes)
+  crc = binascii.crc_hqx(bytes.translate(_BIT_REVERSE), 0)
+  return (ord(_BIT_REVERSE[crc & 0xff]) << 8) | ord(_BIT_REVERSE[crc >> 8])
@@ -13,3 +13,11 @@ class CrcTestCase(unittest.TestCase):
     crc = crc16.crc16_ccitt(data)
     data += struct.pack('<H', crc)
     self.assertEqual(crc16.crc16_ccitt(data), 0)
+
+  def testMatchesTableImplementation(self):
+    data = ''.join(chr((i * 37) & 0xff) for i in xrange(300))
+    for end in xrange(len(data)):
+      self.assertEqual(crc16.crc16_ccitt(data[:end]),
+          crc16._crc16_ccitt_python(data[:end]))
+    self.assertEqual(crc16.crc16_ccitt(bytearray(data)),
+        crc16._crc16_ccitt_python(data))
@@ -0,0 +1,166 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Filters deciding which kegboard readings are worth sending to the core.
+
+A kegboard reports its meters and temperature sensors continuously, whether
+or not anything has changed.  A MeterFilter passes a meter reading only when
+it differs from the last one sent, or when the last one is getting old.  A
+ThermoFilter aggregates temperature readings, and passes their mean once it
+has moved out of a deadband around the last value sent, no more often than a
+minimum interval, and at least every maximum interval.
+"""
+
+import time
+
+import gflags
+
+from pykeg.core import kb_common
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_float('meter_resend_interval', 60.0,
+    'An unchanged meter reading is sent to the core again after this many '
+    'seconds.  If 0, every meter reading is sent.',
+    lower_bound=0)
+
+gflags.DEFINE_float('thermo_deadband', 0.1,
+    'Temperature readings within this many degrees C of the last one sent '
+    'are not sent to the core, until --thermo_max_interval has passed.',
+    lower_bound=0)
+
+gflags.DEFINE_float('thermo_min_interval', 10.0,
+    'Minimum interval between temperature readings sent to the core for a '
+    'sensor, in seconds.  Readings in between are averaged.',
+    lower_bound=0)
+
+gflags.DEFINE_float('thermo_max_interval', kb_common.THERMO_RECORD_DELTA_SECONDS,
+    'Maximum interval between temperature readings sent to the core for a '
+    'sensor, in seconds, however little the temperature has changed.  The core '
+    'warns about sensors silent for two minutes.',
+    lower_bound=0)
+
+
+class MeterFilter:
+  """Passes meter readings which have changed, or are due to be resent."""
+  def __init__(self, resend_interval=None):
+    if resend_interval is None:
+      resend_interval = FLAGS.meter_resend_interval
+    self._resend_interval = resend_interval
+    self._last_sent = {}  # maps meter name to (reading, time sent)
+    self._num_sent = 0
+    self._num_suppressed = 0
+
+  def GetStatus(self):
+    return ['Meter readings sent: %i, suppressed: %i' % (self._num_sent,
+        self._num_suppressed)]
+
+  def Filter(self, meter_name, reading, now=None):
+    """Returns True if |reading| should be sent."""
+    if now is None:
+      now = time.time()
+    last = self._last_sent.get(meter_name)
+    if last is not None and last[0] == reading and \
+        now - last[1] < self._resend_interval:
+      self._num_suppressed += 1
+      return False
+    self._last_sent[meter_name] = (reading, now)
+    self._num_sent += 1
+    return True
+
+
+class _ThermoWindow:
+  """Readings of one sensor since its last value was sent."""
+  def __init__(self):
+    self.last_value = None
+    self.last_time = None
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def Add(self, value):
+    self.count += 1
+    self.total += value
+    if self.count == 1:
+      self.min = self.max = value
+    else:
+      self.min = min(self.min, value)
+      self.max = max(self.max, value)
+
+  def Mean(self):
+    return self.total / self.count
+
+  def Reset(self, value, now):
+    self.last_value = value
+    self.last_time = now
+    self.count = 0
+    self.total = 0.0
+
+
+class ThermoFilter:
+  """Aggregates temperature readings, passing their mean when it is due.
+
+  The min and max of the readings averaged into the last value sent are kept
+  for GetStatus.
+  """
+  def __init__(self, deadband=None, min_interval=None, max_interval=None):
+    if deadband is None:
+      deadband = FLAGS.thermo_deadband
+    if min_interval is None:
+      min_interval = FLAGS.thermo_min_interval
+    if max_interval is None:
+      max_interval = FLAGS.thermo_max_interval
+    self._deadband = deadband
+    self._min_interval = min_interval
+    self._max_interval = max_interval
+    self._windows = {}  # maps sensor name to _ThermoWindow
+    self._last_summary = {}  # maps sensor name to (mean, min, max, count)
+    self._num_sent = 0
+    self._num_suppressed = 0
+
+  def GetStatus(self):
+    ret = ['Temperature readings sent: %i, suppressed: %i' % (self._num_sent,
+        self._num_suppressed)]
+    for name, (mean, low, high, count) in sorted(self._last_summary.items()):
+      ret.append('  %s: mean %.2f, min %.2f, max %.2f over %i reading(s)' % (
+          name, mean, low, high, count))
+    return ret
+
+  def Filter(self, sensor_name, value, now=None):
+    """Adds a reading; returns the value to send, or None."""
+    if now is None:
+      now = time.time()
+    window = self._windows.get(sensor_name)
+    if window is None:
+      window = self._windows[sensor_name] = _ThermoWindow()
+    window.Add(value)
+
+    if window.last_time is not None:
+      elapsed = now - window.last_time
+      if elapsed < self._min_interval or (elapsed < self._max_interval and
+          abs(window.Mean() - window.last_value) < self._deadband):
+        self._num_suppressed += 1
+        return None
+
+    mean = window.Mean()
+    self._last_summary[sensor_name] = (mean, window.min, window.max,
+        window.count)
+    window.Reset(mean, now)
+    self._num_sent += 1
+    return mean
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""Unittest for filters module"""
+
+import unittest
+
+from pykeg.hw.kegboard import filters
+
+
+class MeterFilterTestCase(unittest.TestCase):
+  def testFilter(self):
+    f = filters.MeterFilter(resend_interval=60)
+    self.assertTrue(f.Filter('flow0', 100, now=0))
+    self.assertFalse(f.Filter('flow0', 100, now=1))
+    self.assertTrue(f.Filter('flow1', 100, now=1))
+    self.assertTrue(f.Filter('flow0', 101, now=2))
+    self.assertFalse(f.Filter('flow0', 101, now=61))
+    self.assertTrue(f.Filter('flow0', 101, now=62))
+    # A reset board reports a lower reading.
+    self.assertTrue(f.Filter('flow0', 0, now=63))
+    self.assertEqual(f.GetStatus(), ['Meter readings sent: 5, suppressed: 2'])
+
+  def testNoResendInterval(self):
+    f = filters.MeterFilter(resend_interval=0)
+    for i in xrange(3):
+      self.assertTrue(f.Filter('flow0', 100, now=i))
+
+
+class ThermoFilterTestCase(unittest.TestCase):
+  def testFilter(self):
+    f = filters.ThermoFilter(deadband=0.5, min_interval=10, max_interval=60)
+    self.assertEqual(f.Filter('t0', 4.0, now=0), 4.0)
+
+    # Within the deadband, only sent after the maximum interval.
+    for now in xrange(1, 60):
+      self.assertEqual(f.Filter('t0', 4.0 + (now % 3) * 0.1, now=now), None)
+    self.assertAlmostEqual(f.Filter('t0', 4.1, now=60), 4.1, places=1)
+
+    # A step change is sent after the minimum interval, averaged.
+    self.assertEqual(f.Filter('t0', 6.0, now=65), None)
+    self.assertAlmostEqual(f.Filter('t0', 7.0, now=70), 6.5)
+    status = f.GetStatus()
+    self.assertEqual(status[0],
+        'Temperature readings sent: 3, suppressed: 60')
+    self.assertEqual(status[1],
+        '  t0: mean 6.50, min 6.00, max 7.00 over 2 reading(s)')
+
+    # Readings which average back into the deadband are not sent.
+    self.assertEqual(f.Filter('t0', 6.0, now=75), None)
+    self.assertEqual(f.Filter('t0', 6.5, now=80), None)
+
+  def testUnfiltered(self):
+    f = filters.ThermoFilter(deadband=0, min_interval=0, max_interval=0)
+    for i in xrange(3):
+      self.assertEqual(f.Filter('t0', 4.0, now=i), 4.0)
+
+
+if __name__ == '__main__':
+  unittest.main()
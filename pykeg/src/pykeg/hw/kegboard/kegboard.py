@@ -18,7 +18,7 @@
 
 """Python interfaces to a Kegboard device."""
 
-import cStringIO
+import collections
 import errno
 import logging
 import struct
@@ -42,6 +42,16 @@ KBSP_PREFIX = "KBSP v1:"
 KBSP_PAYLOAD_MAXLEN = 112
 KBSP_TRAILER = "\r\n"
 
+# Prefix, message id and payload length.
+KBSP_HEADER = struct.Struct('<8sHH')
+KBSP_HEADER_LEN = KBSP_HEADER.size
+# CRC and trailer.
+KBSP_FOOTER_LEN = 4
+
+# Tag and length of each payload field.
+FIELD_HEADER = struct.Struct('<BB')
+CRC_STRUCT = struct.Struct('<H')
+
 class KegboardError(Exception):
   """Generic error with Kegboard"""
 
@@ -77,15 +87,16 @@ class StructField(Field):
   _STRUCT_FORMAT = '<'
   def __init__(self, tagnum):
     Field.__init__(self, tagnum)
-    self._packed_size = struct.calcsize(self._STRUCT_FORMAT)
+    self._struct = struct.Struct(self._STRUCT_FORMAT)
+    self._packed_size = self._struct.size
 
   def ParseValue(self, value):
     if len(value) != self._packed_size:
       raise ValueError, "Bad length, must be exactly %i bytes" % (self._packed_size,)
-    return struct.unpack(self._STRUCT_FORMAT, value)[0]
+    return self._struct.unpack(value)[0]
 
   def ToBytes(self, value):
-    return struct.pack(self._STRUCT_FORMAT, value)
+    return self._struct.pack(value)
 
 
 class Uint8Field(StructField):
@@ -155,12 +166,32 @@ class TempField(Int32Field):
 
 ### Message types
 
+class _MessageMeta(util.DeclarativeMeta):
+  """Gives every Message subclass empty __slots__, so messages are only as big
+  as their field values."""
+  def __new__(meta, class_name, bases, new_attrs):
+    new_attrs.setdefault('__slots__', ())
+    return util.DeclarativeMeta.__new__(meta, class_name, bases, new_attrs)
+
+
 class Message(util.BaseMessage):
+  """A KBSP message.
+
+  When each subclass is created, its fields are compiled into tables used to
+  decode and encode payloads: _decoders maps a field tag to the field's name
+  and parser, and _encoders lists (tag, name, serializer) in tag order.
+  """
+  __metaclass__ = _MessageMeta
+
+  def __classinit__(cls, new_attrs):
+    util.BaseMessage.__classinit__.im_func(cls, new_attrs)
+    fields = sorted(cls.class_fields.values(), key=lambda f: f.tagnum)
+    cls._tag_to_field = dict((f.tagnum, f) for f in fields)
+    cls._decoders = dict((f.tagnum, (f.name, f.ParseValue)) for f in fields)
+    cls._encoders = tuple((f.tagnum, f.name, f.ToBytes) for f in fields)
+
   def __init__(self, initial=None, bytes=None, payload_bytes=None, **kwargs):
     util.BaseMessage.__init__(self, initial, **kwargs)
-    self._tag_to_field = {}
-    for field in self._fields.itervalues():
-      self._tag_to_field[field.tagnum] = field
     if bytes is not None:
       self.UnpackFromBytes(bytes)
     if payload_bytes is not None:
@@ -170,54 +201,39 @@ class Message(util.BaseMessage):
     if len(bytes) < 16:
       raise ValueError, "Not enough bytes"
 
-    header = bytes[:12]
-    payload = bytes[12:-4]
-    trailer = bytes[-4:]
-    crcd_bytes = bytes[:-2]
-
-    prefix, message_id, message_len = struct.unpack('<8sHH', header)
+    prefix, message_id, message_len = KBSP_HEADER.unpack_from(bytes)
+    payload = bytes[KBSP_HEADER_LEN:-KBSP_FOOTER_LEN]
 
     if len(payload) != message_len:
       raise ValueError, "Payload size does not match tag"
 
-    # TODO(mikey): assert checked_crc == 0
-    checked_crc = crc16.crc16_ccitt(crcd_bytes)
+    if crc16.crc16_ccitt(bytes[:-2]) != 0:
+      raise ValueError, "Bad CRC"
     self.UnpackFromPayload(payload)
 
   def UnpackFromPayload(self, payload):
+    values = self._values
+    decoders = self._decoders
     pos = 0
     payload_len = len(payload)
     while (pos + 2) <= payload_len:
-      fieldlen = self._ParseField(payload[pos:])
-      pos += 2 + fieldlen
-
-  def _ParseField(self, field_bytes):
-    tag, length = struct.unpack('<BB', field_bytes[:2])
-    data = field_bytes[2:2+length]
-    # If field number is known, set its value. (Ignore it otherwise.)
-    field = self._tag_to_field.get(tag)
-    if field:
-      setattr(self, field.name, data)
-    return length
+      data_pos = pos + 2
+      pos = data_pos + ord(payload[pos+1])
+      # If field number is known, set its value. (Ignore it otherwise.)
+      decoder = decoders.get(ord(payload[data_pos-2]))
+      if decoder:
+        values[decoder[0]] = decoder[1](payload[data_pos:pos])
 
   def ToBytes(self):
-    payload = cStringIO.StringIO()
-    for field_name, field in self._fields.iteritems():
-      field_bytes = field.ToBytes(self._values[field_name])
-      payload.write(struct.pack('<BB', field.tagnum, len(field_bytes)))
-      payload.write(field_bytes)
-
-    payload_str = payload.getvalue()
-    payload.close()
-
-    out = cStringIO.StringIO()
-    out.write(KBSP_PREFIX)
-    out.write(struct.pack('<HH', self.MESSAGE_ID, len(payload_str)))
-    out.write(payload_str)
-    crc = crc16.crc16_ccitt(out.getvalue())
-    out.write(struct.pack('<H', crc))
-    out.write('\r\n')
-    return out.getvalue()
+    values = self._values
+    parts = []
+    for tagnum, name, to_bytes in self._encoders:
+      field_bytes = to_bytes(values[name])
+      parts.append(FIELD_HEADER.pack(tagnum, len(field_bytes)))
+      parts.append(field_bytes)
+    payload = ''.join(parts)
+    frame = KBSP_HEADER.pack(KBSP_PREFIX, self.MESSAGE_ID, len(payload)) + payload
+    return frame + CRC_STRUCT.pack(crc16.crc16_ccitt(frame)) + KBSP_TRAILER
 
 class HelloMessage(Message):
   MESSAGE_ID = 0x01
@@ -299,9 +315,27 @@ def GetMessageById(message_id, payload_bytes=None):
 
 
 class KegboardReader(object):
+  """Reads and writes messages on a kegboard serial stream.
+
+  Input is read in chunks of whatever the port has buffered into a bytearray,
+  and every complete frame in it is decoded at once.  Frames with a bad length,
+  trailer or CRC are dropped, and the reader resynchronizes on the next
+  KBSP_PREFIX.
+  """
+  READ_SIZE = 4096
+
   def __init__(self, fd):
     self._logger = logging.getLogger('kegboard-reader')
     self._fd = fd
+    self._buf = bytearray()
+    self._messages = collections.deque()
+    self._framing_broken = False
+    self._num_frames = 0
+    self._num_bad_frames = 0
+
+  def GetStats(self):
+    """Returns the number of good and bad frames read."""
+    return self._num_frames, self._num_bad_frames
 
   def _read(self, count):
     """Wrapper for fd read which handles EAGAIN."""
@@ -316,63 +350,102 @@ class KegboardReader(object):
         raise e
     raise RuntimeError('Read caused EAGAIN too many times.')
 
+  def _ReadChunk(self):
+    """Reads what is available, blocking until there is at least a byte."""
+    count = self.READ_SIZE
+    in_waiting = getattr(self._fd, 'inWaiting', None)
+    if in_waiting is not None:
+      # A serial port's read() blocks until |count| bytes arrive.
+      count = max(1, min(count, in_waiting()))
+    return self._read(count)
+
   def WriteMessage(self, message):
     if not isinstance(message, Message):
       raise ValueError, "WriteMessage must be called with a Message instance"
     self._fd.write(message.ToBytes())
 
   def GetNextMessage(self):
-    header_pos = 0
-    header_len = len(KBSP_PREFIX)
+    """Returns the next message, blocking until one is read.
+
+    Raises EOFError at the end of the stream.
+    """
+    while not self._messages:
+      self._messages.extend(self.ReadMessages())
+    return self._messages.popleft()
+
+  def ReadMessages(self):
+    """Does a single read, and returns the (possibly zero) messages it
+    completes.
+
+    Raises EOFError at the end of the stream.
+    """
+    data = self._ReadChunk()
+    if not data:
+      raise EOFError('End of kegboard stream.')
+    self._buf.extend(data)
+    return self._ParseFrames()
+
+  def _BadFrame(self, reason):
+    self._num_bad_frames += 1
+    self._logger.warning('%s, skipping message' % reason)
+
+  def _ParseFrames(self):
+    buf = self._buf
+    buf_len = len(buf)
+    pos = 0
+    ret = []
     while True:
-      # Find the prefix, re-aligning the messages as needed.
-      logged_frame_error = False
-      while header_pos < header_len:
-        byte = self._read(1)
-        if byte == KBSP_PREFIX[header_pos]:
-          # Got the expected byte.
-          header_pos += 1
-          if logged_frame_error:
-            self._logger.info('Packet framing fixed.')
-            logged_frame_error = False
-        else:
-          # Wrong byte, log the error and start over.
-          if not logged_frame_error:
-            expected = KBSP_PREFIX[header_pos]
-            self._logger.info('Packet framing broken (found %s, expected %s); '
-                              'reframing.' % (repr(byte), repr(expected)))
-            logged_frame_error = True
-          if byte == KBSP_PREFIX[0]:
-            header_pos = 1
-          else:
-            header_pos = 0
-
-      # Read message type and message length.
-      header_bytes = self._read(4)
-      message_id, message_len = struct.unpack('<HH', header_bytes)
+      start = buf.find(KBSP_PREFIX, pos)
+      if start < 0:
+        # Keep what could be the start of a prefix.
+        skip_to = max(pos, buf_len - len(KBSP_PREFIX) + 1)
+        if skip_to > pos:
+          self._FramingBroken(buf[pos:skip_to])
+        pos = skip_to
+        break
+      if start > pos:
+        self._FramingBroken(buf[pos:start])
+      pos = start
+      if buf_len - start < KBSP_HEADER_LEN:
+        break
+      message_id, message_len = KBSP_HEADER.unpack_from(buf, start)[1:]
       if message_len > KBSP_PAYLOAD_MAXLEN:
-        self._logger.warning('Bogus message length (%i), skipping message' %
-                             message_len)
-        header_pos = 0
+        self._BadFrame('Bogus message length (%i)' % message_len)
+        pos = start + 1
         continue
-
-      # Read payload and trailer.
-      payload = self._read(message_len)
-      crc = self._read(2)
-      trailer = self._read(2)
-
-      if trailer != KBSP_TRAILER:
-        self._logger.warning('Bad trailer (%s), skipping message' %
-                             repr(trailer))
-        # Bogus trailer; start over.
-        header_pos = 0
+      end = start + KBSP_HEADER_LEN + message_len + KBSP_FOOTER_LEN
+      if end > buf_len:
+        break
+      if buf[end-2:end] != KBSP_TRAILER:
+        self._BadFrame('Bad trailer (%s)' % repr(str(buf[end-2:end])))
+        pos = start + 1
+        continue
+      # The CRC of a frame including its own CRC is zero.
+      if crc16.crc16_ccitt(buffer(buf, start, end - 2 - start)) != 0:
+        self._BadFrame('Bad CRC')
+        pos = start + 1
         continue
 
+      if self._framing_broken:
+        self._logger.info('Packet framing fixed.')
+        self._framing_broken = False
+      payload = str(buf[start+KBSP_HEADER_LEN:end-KBSP_FOOTER_LEN])
       if FLAGS.verbose:
-        rawstr = ''.join((header_bytes, payload, crc, trailer))
-        rawstr = bytes_to_hexstr(rawstr)
-        dumpstr = 'ID=%i PAYLOAD=%s' % (message_id, bytes_to_hexstr(payload))
-        self._logger.debug('RX: %s' % rawstr)
-        self._logger.debug(dumpstr)
-
-      return GetMessageById(message_id, payload)
+        self._logger.debug('RX: %s' % bytes_to_hexstr(str(buf[start:end])))
+        self._logger.debug('ID=%i PAYLOAD=%s' % (message_id,
+            bytes_to_hexstr(payload)))
+      pos = end
+      self._num_frames += 1
+      try:
+        ret.append(GetMessageById(message_id, payload))
+      except UnknownMessageError:
+        self._logger.warning('Read unknown message (id=%i), skipping' %
+            message_id)
+    del buf[:pos]
+    return ret
+
+  def _FramingBroken(self, skipped):
+    if not self._framing_broken:
+      self._logger.info('Packet framing broken (skipped %s); reframing.' %
+          repr(str(skipped[:16])))
+      self._framing_broken = True
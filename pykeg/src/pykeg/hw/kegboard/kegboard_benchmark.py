@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""Benchmark for KegboardReader.
+
+Decodes a stream of meter and temperature messages, like that sent by a busy
+kegboard, from a file-like object which counts read calls.  The reads are
+limited to what a serial port would have buffered, as with pyserial's
+inWaiting().  One frame in every hundred is corrupted.
+
+Also measures decode and encode throughput for each message type.
+"""
+
+import cStringIO
+import sys
+import time
+
+import gflags
+
+from pykeg.core import kb_app  # for --verbose
+from pykeg.hw.kegboard import kegboard
+
+FLAGS = gflags.FLAGS
+
+NUM_MESSAGES = 20000
+NUM_CODEC_ITERATIONS = 50000
+
+# Bytes buffered by the serial port between reads.
+BYTES_PER_READ = 256
+
+
+class _CountingSerial:
+  def __init__(self, data):
+    self._fd = cStringIO.StringIO(data)
+    self._remain = len(data)
+    self.num_reads = 0
+
+  def inWaiting(self):
+    return min(self._remain, BYTES_PER_READ)
+
+  def read(self, size):
+    self.num_reads += 1
+    data = self._fd.read(size)
+    self._remain -= len(data)
+    return data
+
+
+def _BuildStream():
+  frames = []
+  for i in xrange(NUM_MESSAGES):
+    if i % 2:
+      msg = kegboard.MeterStatusMessage()
+      msg.SetValue('meter_name', 'flow%i' % (i % 4))
+      msg.SetValue('meter_reading', i)
+    else:
+      msg = kegboard.TemperatureReadingMessage()
+      msg.SetValue('sensor_name', 'thermo-%016x' % i)
+      msg.SetValue('sensor_reading', 4500000)
+    frame = msg.ToBytes()
+    if i % 100 == 99:
+      frame = frame[:14] + chr(ord(frame[14]) ^ 0xff) + frame[15:]
+    frames.append(frame)
+  return ''.join(frames)
+
+
+def _SampleMessages():
+  ret = []
+  msg = kegboard.HelloMessage()
+  msg.SetValue('firmware_version', 7)
+  ret.append(msg)
+  msg = kegboard.MeterStatusMessage()
+  msg.SetValue('meter_name', 'flow0')
+  msg.SetValue('meter_reading', 123456)
+  ret.append(msg)
+  msg = kegboard.TemperatureReadingMessage()
+  msg.SetValue('sensor_name', 'thermo-0000000000000001')
+  msg.SetValue('sensor_reading', 4500000)
+  ret.append(msg)
+  msg = kegboard.AuthTokenMessage()
+  msg.SetValue('device', 'onewire')
+  msg.SetValue('token', '\x01\x02\x03\x04\x05\x06\x07\x08')
+  msg.SetValue('status', 1)
+  ret.append(msg)
+  msg = kegboard.SetOutputCommand()
+  msg.SetValue('output_id', 1)
+  msg.SetValue('output_mode', 1)
+  ret.append(msg)
+  return ret
+
+
+def RunCodecBenchmark():
+  for msg in _SampleMessages():
+    frame = msg.ToBytes()
+    payload = frame[kegboard.KBSP_HEADER.size:-4]
+    message_id = msg.MESSAGE_ID
+    start = time.time()
+    for i in xrange(NUM_CODEC_ITERATIONS):
+      kegboard.GetMessageById(message_id, payload)
+    decode_rate = NUM_CODEC_ITERATIONS / (time.time() - start)
+    start = time.time()
+    for i in xrange(NUM_CODEC_ITERATIONS):
+      msg.ToBytes()
+    encode_rate = NUM_CODEC_ITERATIONS / (time.time() - start)
+    print '%26s: decode %7.0f msgs/sec, encode %7.0f msgs/sec' % (
+        msg.__class__.__name__, decode_rate, encode_rate)
+
+
+def RunReaderBenchmark():
+  data = _BuildStream()
+  fd = _CountingSerial(data)
+  reader = kegboard.KegboardReader(fd)
+  num_messages = 0
+  start = time.time()
+  while True:
+    try:
+      reader.GetNextMessage()
+    except EOFError:
+      break
+    num_messages += 1
+  elapsed = time.time() - start
+  print '%i messages (%i bytes) in %.2fs: %.0f msgs/sec, %.1f reads/msg' % (
+      num_messages, len(data), elapsed, num_messages / elapsed,
+      float(fd.num_reads) / num_messages)
+
+def main():
+  FLAGS(sys.argv)
+  RunCodecBenchmark()
+  RunReaderBenchmark()
+
+if __name__ == '__main__':
+  main()
@@ -2,6 +2,7 @@
 
 """Unittest for kegboard module"""
 
+import cStringIO
 import os
 import unittest
 import struct
@@ -14,7 +15,7 @@ CAP_FILE = os.path.join(TESTDATA_PATH, 'one_flow_active.bin')
 
 class MessageTestCase(unittest.TestCase):
   def testMessageCreate(self):
-    hello_bytes = kegboard.KBSP_PREFIX + '\x01\x00\x04\x00\x01\x02\x03\x00\x3f\x29\r\n'
+    hello_bytes = kegboard.KBSP_PREFIX + '\x01\x00\x04\x00\x01\x02\x03\x00\x2e\x54\r\n'
     m = kegboard.HelloMessage(bytes=hello_bytes)
     self.assertEqual(m.firmware_version, 3)
 
@@ -22,6 +23,28 @@ class MessageTestCase(unittest.TestCase):
     self.assertEqual(m.firmware_version, 3)
     print m
 
+    bad_crc_bytes = hello_bytes[:-4] + '\x3f\x29\r\n'
+    self.assertRaises(ValueError, kegboard.HelloMessage, bytes=bad_crc_bytes)
+
+  def testRoundTrip(self):
+    m = kegboard.AuthTokenMessage()
+    m.SetValue('device', 'onewire')
+    m.SetValue('token', '\x01\x02\x00\x04')
+    m.SetValue('status', 1)
+    decoded = kegboard.GetMessageForBytes(m.ToBytes())
+    self.assertEqual(decoded, m)
+    self.assertEqual(decoded.token, '\x01\x02\x00\x04')
+
+    # Unknown fields are skipped.
+    payload = '\x09\x02ab\x01\x02\x07\x00'
+    m = kegboard.GetMessageById(kegboard.HelloMessage.MESSAGE_ID, payload)
+    self.assertEqual(m.firmware_version, 7)
+
+  def testMessagesHaveNoDict(self):
+    m = kegboard.MeterStatusMessage()
+    self.assertFalse(hasattr(m, '__dict__'))
+    self.assertRaises(AttributeError, setattr, m, 'bogus', 1)
+
 
 class KegboardReaderTestCase(unittest.TestCase):
   def testBasicUse(self):
@@ -48,7 +71,39 @@ class KegboardReaderTestCase(unittest.TestCase):
     self.assertEqual(message_bytes, new_message.ToBytes())
 
   def testAgainstBogusData(self):
-    pass
+    data = open(CAP_FILE, 'rb').read()
+    first_end = data.find(kegboard.KBSP_PREFIX, 1)
+    second_end = data.find(kegboard.KBSP_PREFIX, first_end + 1)
+    # Garbage, a truncated frame, a frame with a corrupted payload, then the
+    # rest of the capture.
+    corrupt = data[first_end:second_end]
+    corrupt = corrupt[:13] + chr(ord(corrupt[13]) ^ 0x01) + corrupt[14:]
+    stream = ('\x00garbage' + data[:first_end - 3] + corrupt +
+        data[second_end:])
+
+    kbr = kegboard.KegboardReader(cStringIO.StringIO(stream))
+    messages = []
+    while True:
+      try:
+        messages.append(kbr.GetNextMessage())
+      except EOFError:
+        break
+    self.assertEqual(len(messages), 22)
+    # The truncated frame fails its trailer check, the corrupt one its CRC.
+    self.assertEqual(kbr.GetStats(), (22, 2))
+
+  def testSmallReads(self):
+    data = open(CAP_FILE, 'rb').read()
+    class _ByteAtATime:
+      def __init__(self, data):
+        self._fd = cStringIO.StringIO(data)
+      def read(self, count):
+        return self._fd.read(1)
+    bulk = kegboard.KegboardReader(cStringIO.StringIO(data))
+    slow = kegboard.KegboardReader(_ByteAtATime(data))
+    for i in xrange(24):
+      self.assertEqual(bulk.GetNextMessage(), slow.GetNextMessage())
+    self.assertRaises(EOFError, bulk.GetNextMessage)
 
 if __name__ == '__main__':
   import logging
@@ -0,0 +1,414 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A simulated kegboard, for testing without hardware.
+
+A SimulatedKegboard speaks the Kegboard Serial Protocol on the master side of
+a pseudo-terminal (see OpenPty), so the kegboard daemon can be pointed at the
+slave side as if it were a serial port.  It answers PingCommand with a
+HelloMessage, and plays back a Script of events:
+
+  pour: a meter advances by some number of ticks over some number of seconds;
+      while it moves, its reading is sent every update interval, as the
+      firmware does.
+  temp: a TemperatureReadingMessage.
+  token: an AuthTokenMessage adding a token, and one removing it later.
+
+Scripts are read from a file (see ParseScript) or generated (see RandomScript).
+Noise can be injected into the stream to exercise the reader's reframing:
+garbage bytes between frames, frames with a flipped bit, and truncated frames.
+
+A board implements the reactor.Reactor handler interface; call Update
+regularly (see GetNextUpdateTime) to send the messages which are due.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import random
+import tty
+
+from pykeg.hw.kegboard import kegboard
+
+# Version reported in HelloMessage.
+FIRMWARE_VERSION = 10
+
+# Output which may be buffered while the other side is not reading, about what
+# a pty holds.  Frames sent beyond this are dropped, like a serial overrun.
+MAX_PENDING_BYTES = 65536
+
+
+class ScriptError(ValueError):
+  """Raised for a malformed script."""
+
+
+def OpenPty():
+  """Opens a pseudo-terminal in raw mode.
+
+  Returns:
+    (master fd, slave fd, slave path).  The slave fd should be kept open while
+    the board runs, so the master does not see a hangup whenever the daemon
+    closes the port.
+  """
+  master_fd, slave_fd = os.openpty()
+  tty.setraw(slave_fd)
+  flags = fcntl.fcntl(master_fd, fcntl.F_GETFL)
+  fcntl.fcntl(master_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+  return master_fd, slave_fd, os.ttyname(slave_fd)
+
+
+class Pour:
+  """A meter advancing |ticks| ticks at a steady rate from time |start|."""
+  def __init__(self, start, meter_name, ticks, duration):
+    self.start = start
+    self.meter_name = meter_name
+    self.ticks = ticks
+    self.duration = duration
+    self.end = start + duration
+
+  def __str__(self):
+    return '<Pour %s: %i ticks in %.1fs at %.1fs>' % (self.meter_name,
+        self.ticks, self.duration, self.start)
+
+  def TicksAt(self, when):
+    """Returns the ticks poured by time |when|."""
+    if when >= self.end:
+      return self.ticks
+    if when <= self.start:
+      return 0
+    return int(self.ticks * (when - self.start) / self.duration)
+
+
+class Script:
+  """Pours and one-off messages, with times in seconds from the start."""
+  def __init__(self):
+    self.pours = []
+    self.messages = []  # (time, kegboard.Message)
+
+  def _AddMessage(self, when, message):
+    self.messages.append((when, message))
+
+  def AddPour(self, start, meter_name, ticks, duration):
+    self.pours.append(Pour(start, meter_name, ticks, duration))
+
+  def AddTemperature(self, when, sensor_name, degrees):
+    message = kegboard.TemperatureReadingMessage()
+    message.SetValue('sensor_name', sensor_name)
+    message.SetValue('sensor_reading', int(degrees * 1000000))
+    self._AddMessage(when, message)
+
+  def AddToken(self, when, device, token, duration):
+    """Presents |token|, a str of bytes, for |duration| seconds."""
+    for status, offset in ((1, 0), (0, duration)):
+      message = kegboard.AuthTokenMessage()
+      message.SetValue('device', device)
+      message.SetValue('token', token)
+      message.SetValue('status', status)
+      self._AddMessage(when + offset, message)
+
+  def GetMeterNames(self):
+    return sorted(set(p.meter_name for p in self.pours))
+
+  def GetDuration(self):
+    ends = [p.end for p in self.pours] + [t for t, m in self.messages]
+    return max(ends or [0])
+
+
+def ParseScript(lines):
+  """Builds a Script from lines of text.
+
+  Each line is an event time in seconds, an event, and its arguments:
+
+    <time> pour <meter name> <ticks> <duration>
+    <time> temp <sensor name> <degrees C>
+    <time> token <device> <token, in hex> <duration>
+
+  Blank lines and lines starting with '#' are ignored.
+  """
+  script = Script()
+  for lineno, line in enumerate(lines):
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    args = line.split()
+    try:
+      when, event, args = float(args[0]), args[1], args[2:]
+      if event == 'pour' and len(args) == 3:
+        script.AddPour(when, args[0], int(args[1]), float(args[2]))
+      elif event == 'temp' and len(args) == 2:
+        script.AddTemperature(when, args[0], float(args[1]))
+      elif event == 'token' and len(args) == 3:
+        script.AddToken(when, args[0], args[1].decode('hex'), float(args[2]))
+      else:
+        raise ScriptError('Unknown event')
+    except (IndexError, TypeError, ValueError):
+      raise ScriptError('Bad script line %i: %s' % (lineno + 1, repr(line)))
+  return script
+
+
+def RandomScript(num_meters, duration, pour_interval=30.0, pour_ticks=2200,
+    pour_seconds=10.0, temp_interval=5.0, num_sensors=1, token_rate=0.0,
+    seed=None):
+  """Generates |duration| seconds of load.
+
+  Each of the meters flow0..flow<num_meters-1> starts a pour on average every
+  |pour_interval| seconds, of about |pour_ticks| ticks over about
+  |pour_seconds|; pours on one meter never overlap.  Each sensor reports every
+  |temp_interval| seconds, and |token_rate| of the pours are preceded by an
+  auth token.
+  """
+  rand = random.Random(seed)
+  script = Script()
+  for i in xrange(num_meters):
+    meter_name = 'flow%i' % i
+    when = rand.uniform(0, pour_interval)
+    while when < duration:
+      ticks = max(1, int(rand.gauss(pour_ticks, pour_ticks / 4.0)))
+      seconds = max(0.5, rand.gauss(pour_seconds, pour_seconds / 4.0))
+      if rand.random() < token_rate:
+        token = ''.join(chr(rand.randrange(256)) for j in xrange(8))
+        script.AddToken(when - 0.5, 'onewire', token, seconds + 1.0)
+      script.AddPour(when, meter_name, ticks, seconds)
+      when += seconds + rand.expovariate(1.0 / pour_interval)
+  if temp_interval:
+    for i in xrange(num_sensors):
+      sensor_name = 'thermo-%016x' % (i + 1)
+      when = rand.uniform(0, temp_interval)
+      while when < duration:
+        script.AddTemperature(when, sensor_name, rand.gauss(4.0, 0.5))
+        when += temp_interval
+  return script
+
+
+class SimulatedKegboard:
+  """A kegboard playing back a Script on a file descriptor.
+
+  Implements the reactor.Reactor handler interface for |fd|.
+  """
+  def __init__(self, fd, script, name='kegboard', update_interval=0.1,
+      firmware_version=FIRMWARE_VERSION, garbage_rate=0.0, corrupt_rate=0.0,
+      truncate_rate=0.0, seed=None):
+    self.name = name
+    self._fd = fd
+    self._update_interval = update_interval
+    self._firmware_version = firmware_version
+    self._garbage_rate = garbage_rate
+    self._corrupt_rate = corrupt_rate
+    self._truncate_rate = truncate_rate
+    self._rand = random.Random(seed)
+    self._logger = logging.getLogger('kegboard-sim.%s' % name)
+    self._reader = kegboard.KegboardReader(self)
+    self._out = bytearray()
+    self._closed = False
+
+    self._pours = sorted(script.pours, key=lambda p: p.start)
+    self._messages = sorted(script.messages, key=lambda m: m[0])
+    self._start_time = None
+    self._next_pour = 0
+    self._next_message = 0
+    self._active_pours = []
+    self._meter_base = dict((m, 0) for m in script.GetMeterNames())
+    self._meter_sent = dict(self._meter_base)
+    self._next_update = None
+
+    self.pinged = False
+    self.outputs = {}  # maps output id to mode, as set by SetOutputCommand
+    self.pour_start_times = {}  # maps meter name to start of its latest pour
+    self._num_frames = 0
+    self._num_bytes = 0
+    self._num_garbage = 0
+    self._num_corrupted = 0
+    self._num_truncated = 0
+    self._num_dropped = 0
+
+  def __str__(self):
+    return '<SimulatedKegboard %s>' % self.name
+
+  def GetStats(self):
+    """Returns a dict of counts of what has been sent."""
+    return {
+      'frames': self._num_frames,
+      'bytes': self._num_bytes,
+      'garbage': self._num_garbage,
+      'corrupted': self._num_corrupted,
+      'truncated': self._num_truncated,
+      'dropped': self._num_dropped,
+    }
+
+  def GetStatus(self):
+    stats = self.GetStats()
+    return ['%s: %i frames (%i bytes) sent; injected %i garbage, %i corrupted, '
+        '%i truncated; %i dropped' % (self.name, stats['frames'],
+        stats['bytes'], stats['garbage'], stats['corrupted'],
+        stats['truncated'], stats['dropped'])]
+
+  def GetMeterReading(self, meter_name):
+    """Returns the last reading sent for |meter_name|."""
+    return self._meter_sent[meter_name]
+
+  ### Script playback
+  def IsStarted(self):
+    return self._start_time is not None
+
+  def Start(self, now):
+    self._start_time = now
+    self._next_update = now
+
+  def IsDone(self):
+    return (self._start_time is not None and not self._active_pours
+        and self._next_pour == len(self._pours)
+        and self._next_message == len(self._messages))
+
+  def GetNextUpdateTime(self):
+    """Returns the time Update should next be called, or None when done."""
+    if self._start_time is None:
+      return None
+    candidates = []
+    if self._active_pours:
+      candidates.append(self._next_update)
+    if self._next_pour < len(self._pours):
+      candidates.append(self._start_time + self._pours[self._next_pour].start)
+    if self._next_message < len(self._messages):
+      candidates.append(self._start_time +
+          self._messages[self._next_message][0])
+    if not candidates:
+      return None
+    return min(candidates)
+
+  def Update(self, now):
+    """Sends the messages which are due at |now|."""
+    if self._start_time is None:
+      return
+    elapsed = now - self._start_time
+
+    messages = self._messages
+    while (self._next_message < len(messages) and
+        messages[self._next_message][0] <= elapsed):
+      self._Send(messages[self._next_message][1])
+      self._next_message += 1
+
+    pours = self._pours
+    while self._next_pour < len(pours) and pours[self._next_pour].start <= elapsed:
+      pour = pours[self._next_pour]
+      self._active_pours.append(pour)
+      self.pour_start_times[pour.meter_name] = now
+      self._next_pour += 1
+
+    if now < self._next_update or not self._active_pours:
+      return
+    self._next_update = now + self._update_interval
+
+    readings = {}
+    still_active = []
+    for pour in self._active_pours:
+      name = pour.meter_name
+      if name not in readings:
+        readings[name] = self._meter_base[name]
+      readings[name] += pour.TicksAt(elapsed)
+      if elapsed >= pour.end:
+        self._meter_base[name] += pour.ticks
+      else:
+        still_active.append(pour)
+    self._active_pours = still_active
+
+    for name, reading in sorted(readings.iteritems()):
+      if reading != self._meter_sent[name]:
+        self._meter_sent[name] = reading
+        message = kegboard.MeterStatusMessage()
+        message.SetValue('meter_name', name)
+        message.SetValue('meter_reading', reading)
+        self._Send(message)
+
+  ### Output, with injected noise
+  def _Send(self, message):
+    frame = message.ToBytes()
+    rand = self._rand
+    if self._garbage_rate and rand.random() < self._garbage_rate:
+      frame = ''.join(chr(rand.randrange(256))
+          for i in xrange(rand.randint(1, 16))) + frame
+      self._num_garbage += 1
+    if self._corrupt_rate and rand.random() < self._corrupt_rate:
+      pos = rand.randrange(len(kegboard.KBSP_PREFIX), len(frame))
+      frame = frame[:pos] + chr(ord(frame[pos]) ^ (1 << rand.randrange(8))) + \
+          frame[pos+1:]
+      self._num_corrupted += 1
+    elif self._truncate_rate and rand.random() < self._truncate_rate:
+      frame = frame[:rand.randrange(1, len(frame))]
+      self._num_truncated += 1
+    if len(self._out) + len(frame) > MAX_PENDING_BYTES:
+      self._num_dropped += 1
+      return
+    self._out.extend(frame)
+    self._num_frames += 1
+    self._num_bytes += len(frame)
+    self.HandleWrite()
+
+  def read(self, count):
+    """Reads commands from the other side, for the KegboardReader."""
+    return os.read(self._fd, count)
+
+  def _HandleCommand(self, message):
+    if isinstance(message, kegboard.PingCommand):
+      self.pinged = True
+      hello = kegboard.HelloMessage()
+      hello.SetValue('firmware_version', self._firmware_version)
+      self._Send(hello)
+    elif isinstance(message, kegboard.SetOutputCommand):
+      self._logger.info('Output %i set to %i' % (message.output_id,
+          message.output_mode))
+      self.outputs[message.output_id] = message.output_mode
+    else:
+      self._logger.warning('Ignoring command: %s' % message)
+
+  ### reactor.Reactor handler methods
+  def fileno(self):
+    return self._fd
+
+  def WantsRead(self):
+    return not self._closed
+
+  def WantsWrite(self):
+    return bool(self._out) and not self._closed
+
+  def HandleRead(self):
+    try:
+      messages = self._reader.ReadMessages()
+    except OSError, e:
+      if e.errno == errno.EAGAIN:
+        return
+      if e.errno != errno.EIO:
+        raise
+      # EIO means no process has the slave side open; wait for one.
+      return
+    for message in messages:
+      self._HandleCommand(message)
+
+  def HandleWrite(self):
+    if not self._out or self._closed:
+      return
+    try:
+      sent = os.write(self._fd, self._out)
+    except OSError, e:
+      if e.errno in (errno.EAGAIN, errno.EIO):
+        return
+      raise
+    del self._out[:sent]
+
+  def HandleClose(self):
+    self._closed = True
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""Unittest for simulator module"""
+
+import os
+import select
+import unittest
+
+from pykeg.hw.kegboard import kegboard
+from pykeg.hw.kegboard import simulator
+
+SCRIPT = """
+# A token, a pour under it, and a temperature reading.
+0.0 token onewire 0102030405060708 3.0
+0.5 pour flow0 1000 2.0
+1.0 temp thermo-0000000000000001 4.5
+"""
+
+
+class _SlavePort:
+  """The slave side of the pty, as the daemon would read it."""
+  def __init__(self, fd):
+    self._fd = fd
+
+  def read(self, count):
+    return os.read(self._fd, count)
+
+  def write(self, data):
+    os.write(self._fd, data)
+
+
+class SimulatorTestCase(unittest.TestCase):
+  def setUp(self):
+    self.master_fd, self.slave_fd, self.path = simulator.OpenPty()
+    self.port = _SlavePort(self.slave_fd)
+    self.reader = kegboard.KegboardReader(self.port)
+
+  def tearDown(self):
+    os.close(self.master_fd)
+    os.close(self.slave_fd)
+
+  def _ReadAll(self):
+    ret = []
+    while select.select([self.slave_fd], [], [], 0)[0]:
+      ret.extend(self.reader.ReadMessages())
+    return ret
+
+  def _Play(self, board, step=0.05):
+    """Runs |board|'s script on a simulated clock; returns what was read."""
+    board.Start(0)
+    messages = []
+    now = 0
+    while not board.IsDone():
+      board.Update(now)
+      messages.extend(self._ReadAll())
+      now += step
+    return messages
+
+  def testParseScript(self):
+    script = simulator.ParseScript(SCRIPT.splitlines())
+    self.assertEqual(script.GetMeterNames(), ['flow0'])
+    self.assertEqual(len(script.messages), 3)
+    self.assertEqual(script.GetDuration(), 3.0)
+    self.assertRaises(simulator.ScriptError, simulator.ParseScript,
+        ['1.0 pour flow0 lots 2.0'])
+    self.assertRaises(simulator.ScriptError, simulator.ParseScript,
+        ['1.0 spill flow0'])
+
+  def testPingAndPlayback(self):
+    board = simulator.SimulatedKegboard(self.master_fd,
+        simulator.ParseScript(SCRIPT.splitlines()))
+    self.assertFalse(board.pinged)
+    self.port.write(kegboard.PingCommand().ToBytes())
+    board.HandleRead()
+    self.assertTrue(board.pinged)
+    hello = self._ReadAll()
+    self.assertEqual(len(hello), 1)
+    self.assertEqual(hello[0].firmware_version, simulator.FIRMWARE_VERSION)
+
+    messages = self._Play(board)
+    types = [m.__class__ for m in messages]
+    self.assertEqual(types[0], kegboard.AuthTokenMessage)
+    self.assertEqual(messages[0].status, 1)
+    self.assertEqual(messages[0].token, '\x01\x02\x03\x04\x05\x06\x07\x08')
+    self.assertEqual(types[-1], kegboard.AuthTokenMessage)
+    self.assertEqual(messages[-1].status, 0)
+    self.assertEqual(types.count(kegboard.TemperatureReadingMessage), 1)
+
+    readings = [m.meter_reading for m in messages
+        if isinstance(m, kegboard.MeterStatusMessage)]
+    self.assertTrue(len(readings) > 10)
+    self.assertEqual(readings, sorted(readings))
+    self.assertEqual(readings[-1], 1000)
+    self.assertEqual(board.GetMeterReading('flow0'), 1000)
+
+  def testManyMeters(self):
+    script = simulator.RandomScript(16, 20.0, pour_interval=5.0,
+        pour_ticks=500, pour_seconds=2.0, temp_interval=0, seed=1)
+    board = simulator.SimulatedKegboard(self.master_fd, script)
+    last = {}
+    for m in self._Play(board, step=0.1):
+      last[m.meter_name] = m.meter_reading
+    self.assertEqual(len(last), 16)
+    for pour in script.pours:
+      last[pour.meter_name] -= pour.ticks
+    self.assertEqual(set(last.values()), set([0]))
+
+  def testNoise(self):
+    script = simulator.RandomScript(4, 20.0, pour_interval=2.0,
+        pour_seconds=2.0, temp_interval=0.5, seed=2)
+    board = simulator.SimulatedKegboard(self.master_fd, script,
+        garbage_rate=0.1, corrupt_rate=0.1, truncate_rate=0.1, seed=2)
+    messages = self._Play(board)
+    stats = board.GetStats()
+    self.assertTrue(stats['garbage'] > 0)
+    self.assertTrue(stats['corrupted'] > 0)
+    self.assertTrue(stats['truncated'] > 0)
+
+    # Every intact frame is read, and no damaged one.
+    num_good, num_bad = self.reader.GetStats()
+    self.assertEqual(len(messages), num_good)
+    self.assertEqual(num_good,
+        stats['frames'] - stats['corrupted'] - stats['truncated'])
+    self.assertTrue(num_bad > 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
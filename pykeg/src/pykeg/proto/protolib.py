@@ -25,6 +25,7 @@ from django.conf import settings
 from pykeg.beerdb import models as bdb_models
 from pykeg.contrib.soundserver import models as soundserver_models
 from pykeg.core import models
+from pykeg.core import stats
 from pykeg.core import util
 from pykeg.proto import api_pb2
 from pykeg.proto import models_pb2
@@ -310,11 +311,7 @@ def SessionChunkToProto(record, full=False):
 @converts(models.KegStats)
 @converts(models.SessionStats)
 def SystemStatsToProto(record, full=False):
-  stats = record.stats
-  ret = models_pb2.Stats()
-  for k, v  in stats.iteritems():
-    setattr(ret, k, v)
-  return ret
+  return stats.StatsToProto(record.stats)
 
 @converts(models.SystemEvent)
 def SystemEventToProto(record, full=False):
@@ -108,6 +108,13 @@ TWITTER_REQUEST_TOKEN_URL = 'https://api.twitter.com/oauth/request_token'
 TWITTER_ACCESS_TOKEN_URL = 'https://api.twitter.com/oauth/access_token'
 TWITTER_AUTHORIZATION_URL = 'https://api.twitter.com/oauth/authorize'
 
+### Kegbot core
+
+# Address (host:port) of the kegbot core, which is told when an authentication
+# token changes so that it drops the token from its cache.  If empty, the core
+# is not told, and only sees the change once its cached copy expires.
+KEGBOT_CORE_ADDR = ''
+
 #TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 SKIP_SOUTH_TESTS = True
 
@@ -16,12 +16,18 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Kegweb API client."""
+"""Kegweb API client.
+
+Requests are made over persistent HTTP/1.1 connections, kept open by a
+ConnectionPool which is shared by every KrestClient in the process.
+"""
 
 import datetime
+import errno
 import functools
 import socket
 import sys
+import threading
 import types
 
 from pykeg.core import kbjson
@@ -30,22 +36,20 @@ from pykeg.proto import models_pb2
 from pykeg.proto import protoutil
 
 try:
+  from http import client as httplib
   from urllib.parse import urlencode
-  from urllib.request import urlopen
-  from urllib.error import HTTPError
-  from urllib.error import URLError
+  from urllib.parse import urlsplit
 except ImportError:
+  import httplib
   from urllib import urlencode
-  from urllib2 import urlopen
-  from urllib2 import HTTPError
-  from urllib2 import URLError
+  from urlparse import urlsplit
 
 import gflags
 
 gflags.DEFINE_float('krest_timeout', 1.0,
-    'Socket timeout, in seconds, for Kegbot web API operations. '
-    'Note that this timeout only applies to blocking socket operations '
-    '(such as opening a connection) and not I/O.')
+    'Socket timeout, in seconds, for Kegbot web API operations: for opening '
+    'a connection, and for each read or write on it.  KrestClient can be '
+    'given longer or shorter timeouts for particular methods.')
 
 FLAGS = gflags.FLAGS
 
@@ -109,17 +113,170 @@ def ErrorCodeToException(code, message=None):
   cls = MAP_NAME_TO_EXCEPTION.get(code, Error)
   return cls(message)
 
+# Maximum number of operations in one request to the batch endpoint.
+MAX_BATCH_OPS = 100
+
 ### end common
 
+# Idle connections kept open per host by a ConnectionPool.
+MAX_IDLE_CONNECTIONS = 4
+
+# Times a request which fails on a reused connection, because the server had
+# closed it, is retried on a new connection.
+MAX_STALE_RETRIES = 2
+
+# Socket errors from a connection the server has closed.
+_STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+def _IsStaleConnectionError(e):
+  # BadStatusLine is raised when the server closes the connection without
+  # sending a response, as it may do with an idle connection.
+  if isinstance(e, httplib.BadStatusLine):
+    return True
+  return isinstance(e, socket.error) and e.errno in _STALE_ERRNOS
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+  def connect(self):
+    httplib.HTTPConnection.connect(self)
+    # Requests are small; do not hold them back waiting for acks.
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+  def connect(self):
+    httplib.HTTPSConnection.connect(self)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class ConnectionPool:
+  """Keeps HTTP connections open for reuse, keyed by scheme and host.
+
+  A connection is only returned to the pool once its response has been read
+  in full, and if the server has not asked for it to be closed.  A server may
+  close an idle connection at any time; a request which fails on a reused
+  connection as though it had been closed is retried on a new connection, up
+  to |max_retries| times.  Other errors, including timeouts, are not retried:
+  the server may have acted on the request.
+  """
+  def __init__(self, max_idle=MAX_IDLE_CONNECTIONS,
+      max_retries=MAX_STALE_RETRIES):
+    self._max_idle = max_idle
+    self._max_retries = max_retries
+    self._idle = {}  # maps (scheme, host) to a list of idle connections
+    self._lock = threading.Lock()
+    self._num_requests = 0
+    self._num_connects = 0
+    self._num_retries = 0
+
+  def GetStats(self):
+    """Returns (requests made, connections opened, requests retried)."""
+    return self._num_requests, self._num_connects, self._num_retries
+
+  def Close(self):
+    """Closes all idle connections."""
+    self._lock.acquire()
+    try:
+      for conns in self._idle.itervalues():
+        for conn in conns:
+          conn.close()
+      self._idle.clear()
+    finally:
+      self._lock.release()
+
+  def _GetConnection(self, key, timeout):
+    """Returns (connection, True if it was idle in the pool)."""
+    self._lock.acquire()
+    try:
+      self._num_requests += 1
+      conns = self._idle.get(key)
+      if conns:
+        conn = conns.pop()
+        conn.timeout = timeout
+        conn.sock.settimeout(timeout)
+        return conn, True
+      self._num_connects += 1
+    finally:
+      self._lock.release()
+    scheme, host = key
+    if scheme == 'https':
+      return _HTTPSConnection(host, timeout=timeout), False
+    return _HTTPConnection(host, timeout=timeout), False
+
+  def _PutConnection(self, key, conn):
+    self._lock.acquire()
+    try:
+      conns = self._idle.setdefault(key, [])
+      if len(conns) < self._max_idle:
+        conns.append(conn)
+        return
+    finally:
+      self._lock.release()
+    conn.close()
+
+  def Request(self, method, url, body=None, headers=None, timeout=None):
+    """Makes a request, returning (status, reason, response body).
+
+    Raises socket.error or httplib.HTTPException if the request fails.
+    """
+    if timeout is None:
+      timeout = FLAGS.krest_timeout
+    scheme, host, path, query, fragment = urlsplit(url)
+    if query:
+      path = '%s?%s' % (path, query)
+    key = (scheme, host)
+    retries = 0
+    while True:
+      conn, reused = self._GetConnection(key, timeout)
+      try:
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        data = response.read()
+      except (httplib.HTTPException, socket.error), e:
+        conn.close()
+        if not reused or retries >= self._max_retries or \
+            not _IsStaleConnectionError(e):
+          raise
+        retries += 1
+        self._num_retries += 1
+        continue
+      if response.will_close:
+        conn.close()
+      else:
+        self._PutConnection(key, conn)
+      return response.status, response.reason, data
+
+# Pool used by KrestClients which are not given one.
+_DEFAULT_POOL = ConnectionPool()
+
+
 class KrestClient:
-  """Kegweb RESTful API client."""
-  def __init__(self, api_url=None, api_key=None):
+  """Kegweb RESTful API client.
+
+  Each API method uses --krest_timeout, unless |timeouts| maps its name (such
+  as 'RecordDrink') to another timeout in seconds.
+  """
+  def __init__(self, api_url=None, api_key=None, timeouts=None, pool=None):
     if api_url is None:
       api_url = FLAGS.api_url
     if api_key is None:
       api_key = FLAGS.api_key
+    if pool is None:
+      pool = _DEFAULT_POOL
     self._api_url = api_url
     self._api_key = api_key
+    self._timeouts = dict(timeouts or {})
+    self._pool = pool
+
+  def _GetTimeout(self, method_name):
+    return self._timeouts.get(method_name)
+
+  def SetTimeout(self, method_name, timeout):
+    """Sets the timeout of an API method; None restores the default."""
+    if timeout is None:
+      self._timeouts.pop(method_name, None)
+    else:
+      self._timeouts[method_name] = timeout
 
   def _Encode(self, s):
     return unicode(s).encode('utf-8')
@@ -146,7 +303,7 @@ class KrestClient:
   def SetAuthToken(self, api_key):
     self._api_key = api_key
 
-  def DoGET(self, endpoint, out_msg, params=None):
+  def DoGET(self, endpoint, out_msg, params=None, timeout=None):
     """Issues a GET request to the endpoint, and retuns the result.
 
     Keyword arguments are passed to the endpoint as GET arguments.
@@ -158,9 +315,10 @@ class KrestClient:
     If there was an error contacting the server, or in parsing its response, a
     ServerError is raised.
     """
-    return self._FetchResponse(endpoint, out_msg, params=params)
+    return self._FetchResponse(endpoint, out_msg, params=params,
+        timeout=timeout)
 
-  def DoPOST(self, endpoint, out_msg, post_data, params=None):
+  def DoPOST(self, endpoint, out_msg, post_data, params=None, timeout=None):
     """Issues a POST request to the endpoint, and returns the result.
 
     For normal responses, the return value is the Python JSON-decoded 'result'
@@ -170,9 +328,11 @@ class KrestClient:
     If there was an error contacting the server, or in parsing its response, a
     ServerError is raised.
     """
-    return self._FetchResponse(endpoint, out_msg, params=params, post_data=post_data)
+    return self._FetchResponse(endpoint, out_msg, params=params,
+        post_data=post_data, timeout=timeout)
 
-  def _FetchResponse(self, endpoint, out_msg, params=None, post_data=None):
+  def _FetchResponse(self, endpoint, out_msg, params=None, post_data=None,
+      timeout=None):
     """Issues a POST or GET request, depending on the arguments."""
     if params is None:
       params = {}
@@ -190,16 +350,38 @@ class KrestClient:
     url = self._GetURL(endpoint, params=params)
     encoded_post_data = self._EncodePostData(post_data)
 
+    method = 'GET'
+    headers = {}
+    if encoded_post_data is not None:
+      method = 'POST'
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
     try:
-      # Issue a GET or POST (urlopen will decide based on encoded_post_data).
-      response_data = urlopen(url, data=encoded_post_data, timeout=FLAGS.krest_timeout).read()
-    except HTTPError, e:
-      raise ServerError('Caused by: %s' % e)
-    except URLError, e:
-      raise e.reason
+      status, reason, response_data = self._pool.Request(method, url,
+          body=encoded_post_data, headers=headers, timeout=timeout)
+    except httplib.HTTPException, e:
+      raise ServerError('Caused by: %r' % e)
+    if status != 200:
+      raise self._ErrorFromResponse(status, reason, response_data)
 
     return self._DecodeResponse(response_data, out_msg)
 
+  def _ErrorFromResponse(self, status, reason, response_data):
+    """Returns the Error for a response with a status other than 200.
+
+    The API sends its errors, such as NotFoundError, with a 4xx status and the
+    error in the body.  Any other response, including every 5xx, means the
+    server could not handle the request, and is a ServerError.
+    """
+    if 400 <= status < 500:
+      try:
+        err = kbjson.loads(response_data).get('error')
+      except (ValueError, AttributeError):
+        err = None
+      if isinstance(err, dict) and err.get('code'):
+        return ErrorCodeToException(err['code'], err.get('message'))
+    return ServerError('Caused by: HTTP Error %i: %s' % (status, reason))
+
   def _DecodeResponse(self, response_data, out_msg):
     """Decodes the string `response_data` as a JSON response.
 
@@ -212,11 +394,17 @@ class KrestClient:
       d = kbjson.loads(response_data)
     except ValueError, e:
       raise ServerError('Malformed response: %s' % e)
+    return self._DecodeResult(d, out_msg)
+
+  def _DecodeResult(self, d, out_msg):
+    """Decodes a decoded JSON response, or one entry of a batch response.
 
+    Returns the 'result' field as out_msg, or as is if out_msg is None.
+    """
     if 'error' in d:
       # Response had an error: translate to exception.
       err = d.get('error')
-      if type(err) != types.DictType:
+      if not isinstance(err, dict):
         raise ValueError('Invalid error response from server')
       code = err.get('code', 'Error')
       message = err.get('message', None)
@@ -228,14 +416,73 @@ class KrestClient:
       if out_msg:
         return protoutil.DictToProtoMessage(result, out_msg)
       else:
-        return None
+        return result
     else:
       # WTF?
       raise ValueError('Invalid response from server: missing result or error')
 
-  def RecordDrink(self, tap_name, ticks, volume_ml=None, username=None,
+  def Batch(self, ops, stop_on_error=False):
+    """Makes several calls in one request, run in one database transaction.
+
+    |ops| is a list of at most MAX_BATCH_OPS operations, as returned by the
+    methods named after an API method with an "Op" suffix, such as
+    RecordDrinkOp.  Returns a list with, for each operation in turn, the
+    result the API method would have returned, or the Error it would have
+    raised.  Raises an Error or socket.error if the request as a whole fails.
+
+    If |stop_on_error| is True, the server stops at the first operation which
+    fails, and the list ends with its Error.
+    """
+    post_data = {
+      'ops': kbjson.dumps([{'op': name, 'args': args}
+          for name, args, out_msg in ops], indent=None),
+    }
+    if stop_on_error:
+      post_data['stop_on_error'] = '1'
+    results = self.DoPOST('batch', None, post_data=post_data,
+        timeout=self._GetTimeout('Batch'))
+    if not isinstance(results, list) or len(results) > len(ops) or (
+        len(results) < len(ops) and not stop_on_error):
+      raise ServerError('Malformed batch response')
+    ret = []
+    for (name, args, out_msg), entry in zip(ops, results):
+      try:
+        ret.append(self._DecodeResult(entry, out_msg))
+      except Error, e:
+        ret.append(e)
+      except ValueError, e:
+        ret.append(ServerError('Malformed response: %s' % e))
+    return ret
+
+  def RecordDrinkOp(self, tap_name, ticks, volume_ml=None, username=None,
       pour_time=None, duration=0, auth_token=None, spilled=False):
-    endpoint = '/taps/%s' % tap_name
+    args = self._RecordDrinkArgs(tap_name, ticks, volume_ml, username,
+        pour_time, duration, auth_token, spilled)
+    return 'record_drink', args, models_pb2.Drink()
+
+  def CancelDrinkOp(self, seqn, spilled=False):
+    args = {
+      'id': seqn,
+      'spilled': spilled,
+    }
+    return 'cancel_drink', args, models_pb2.Drink()
+
+  def LogSensorReadingOp(self, sensor_name, temperature, when=None):
+    args = {
+      'sensor_name': sensor_name,
+      'temp_c': float(temperature),
+    }
+    return 'log_sensor_reading', args, models_pb2.ThermoLog()
+
+  def GetTokenOp(self, auth_device, token_value):
+    args = {
+      'auth_device': auth_device,
+      'token_value': token_value,
+    }
+    return 'get_auth_token', args, models_pb2.AuthenticationToken()
+
+  def _RecordDrinkArgs(self, tap_name, ticks, volume_ml, username, pour_time,
+      duration, auth_token, spilled):
     post_data = {
       'tap_name': tap_name,
       'ticks': ticks,
@@ -248,7 +495,15 @@ class KrestClient:
     if pour_time:
       post_data['pour_time'] = int(pour_time.strftime('%s'))
       post_data['now'] = int(datetime.datetime.now().strftime('%s'))
-    return self.DoPOST(endpoint, models_pb2.Drink(), post_data=post_data)
+    return post_data
+
+  def RecordDrink(self, tap_name, ticks, volume_ml=None, username=None,
+      pour_time=None, duration=0, auth_token=None, spilled=False):
+    endpoint = '/taps/%s' % tap_name
+    post_data = self._RecordDrinkArgs(tap_name, ticks, volume_ml, username,
+        pour_time, duration, auth_token, spilled)
+    return self.DoPOST(endpoint, models_pb2.Drink(), post_data=post_data,
+        timeout=self._GetTimeout('RecordDrink'))
 
   def CancelDrink(self, seqn, spilled=False):
     endpoint = '/cancel-drink'
@@ -256,7 +511,8 @@ class KrestClient:
       'id': seqn,
       'spilled': spilled,
     }
-    return self.DoPOST(endpoint, models_pb2.Drink(), post_data=post_data)
+    return self.DoPOST(endpoint, models_pb2.Drink(), post_data=post_data,
+        timeout=self._GetTimeout('CancelDrink'))
 
   def LogSensorReading(self, sensor_name, temperature, when=None):
     endpoint = '/thermo-sensors/%s' % (sensor_name,)
@@ -264,30 +520,33 @@ class KrestClient:
       'temp_c': float(temperature),
     }
     # TODO(mikey): include post data
-    return self.DoPOST(endpoint, models_pb2.ThermoLog(), post_data=post_data)
+    return self.DoPOST(endpoint, models_pb2.ThermoLog(), post_data=post_data,
+        timeout=self._GetTimeout('LogSensorReading'))
 
   def TapStatus(self):
     """Gets the status of all taps."""
-    return self.DoGET('taps', api_pb2.TapDetailSet())
+    return self.DoGET('taps', api_pb2.TapDetailSet(),
+        timeout=self._GetTimeout('TapStatus'))
 
   def GetToken(self, auth_device, token_value):
     url = 'auth-tokens/%s.%s' % (auth_device, token_value)
-    try:
-      return self.DoGET(url, models_pb2.AuthenticationToken())
-    except ServerError, e:
-      raise NotFoundError(e)
+    return self.DoGET(url, models_pb2.AuthenticationToken(),
+        timeout=self._GetTimeout('GetToken'))
 
   def LastDrinks(self):
     """Gets a list of the most recent drinks."""
-    return self.DoGET('last-drinks', api_pb2.DrinkSet())
+    return self.DoGET('last-drinks', api_pb2.DrinkSet(),
+        timeout=self._GetTimeout('LastDrinks'))
 
   def AllDrinks(self):
     """Gets a list of all drinks."""
-    return self.DoGET('drinks', api_pb2.DrinkSet())
+    return self.DoGET('drinks', api_pb2.DrinkSet(),
+        timeout=self._GetTimeout('AllDrinks'))
 
   def AllSoundEvents(self):
     """Gets a list of all drinks."""
-    return self.DoGET('sound-events', api_pb2.SoundEventSet())
+    return self.DoGET('sound-events', api_pb2.SoundEventSet(),
+        timeout=self._GetTimeout('AllSoundEvents'))
 
 
 def main():
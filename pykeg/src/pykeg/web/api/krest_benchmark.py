@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""Benchmark of KrestClient calls against a local stub server.
+
+Each phase makes NUM_CALLS requests to a StubServer (see krest_unittest.py)
+and reports calls per second and latency.  A pool which keeps no idle
+connections opens a new connection for every call, as krest did before it
+had a ConnectionPool; the default pool reuses one.  The last phase has
+NUM_THREADS threads share a client, as the core's threads share the backend.
+"""
+
+import sys
+import threading
+import time
+
+import gflags
+
+from pykeg.web.api import krest
+from pykeg.web.api import krest_unittest
+
+FLAGS = gflags.FLAGS
+
+NUM_CALLS = 2000
+NUM_THREADS = 4
+
+
+def _Percentile(values, pct):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def _MakeCalls(client, count, latencies):
+  for i in xrange(count):
+    start = time.time()
+    client.DoPOST('taps/flow0', None, post_data={'ticks': i})
+    latencies.append(time.time() - start)
+
+
+def RunBenchmark(name, max_idle, num_threads=1):
+  server = krest_unittest.StubServer()
+  pool = krest.ConnectionPool(max_idle=max_idle)
+  client = krest.KrestClient(api_url=server.GetURL(), api_key='key',
+      pool=pool)
+
+  latencies = []
+  threads = [threading.Thread(target=_MakeCalls,
+      args=(client, NUM_CALLS / num_threads, latencies))
+      for i in xrange(num_threads)]
+  start = time.time()
+  for thr in threads:
+    thr.start()
+  for thr in threads:
+    thr.join()
+  elapsed = time.time() - start
+
+  pool.Close()
+  server.Stop()
+
+  requests, connects, retries = pool.GetStats()
+  print '%20s: %.0f calls/sec, median %.2fms, p99 %.2fms; ' \
+      '%i connections' % (name, len(latencies) / elapsed,
+      _Percentile(latencies, 50) * 1000, _Percentile(latencies, 99) * 1000,
+      connects)
+
+def main():
+  FLAGS(sys.argv)
+  RunBenchmark('new connection', max_idle=0)
+  RunBenchmark('pooled', max_idle=krest.MAX_IDLE_CONNECTIONS)
+  RunBenchmark('pooled, %i threads' % NUM_THREADS,
+      max_idle=krest.MAX_IDLE_CONNECTIONS, num_threads=NUM_THREADS)
+
+if __name__ == '__main__':
+  main()
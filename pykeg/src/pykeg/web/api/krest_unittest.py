@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""Unittest for krest module"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import unittest
+import urlparse
+
+from pykeg.core import kbjson
+from pykeg.web.api import krest
+
+
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Send each response in one write, as a real server would.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    self.server.paths.append(self.path)
+    if 'missing' in self.path:
+      self._Respond(404, '{"error": {"code": "NotFoundError"}}')
+    elif 'broken' in self.path:
+      self._Respond(503, '<h1>Service Unavailable</h1>')
+    else:
+      self._Respond(200, '{"result": {}}')
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers['Content-Length']))
+    if not self.path.startswith('/api/batch/'):
+      self.do_GET()
+      return
+    self.server.paths.append(self.path)
+    form = urlparse.parse_qs(body)
+    ops = kbjson.loads(form['ops'][0])
+    stop_on_error = form.get('stop_on_error') == ['1']
+    self.server.batches.append(ops)
+    results = []
+    for op in ops:
+      args = op['args']
+      if args.get('tap_name') == 'missing':
+        results.append({'error': {'code': 'NotFoundError'}})
+        if stop_on_error:
+          break
+      elif args.get('tap_name') == 'broken':
+        results.append({'error': {'code': 'ServerError'}})
+        if stop_on_error:
+          break
+      elif op['op'] == 'record_drink':
+        results.append({'result': {'id': str(len(results)),
+            'ticks': args['ticks'], 'volume_ml': 0.0, 'session_id': '1',
+            'pour_time': '2010-01-01 00:00:00', 'status': 'valid'}})
+      else:
+        results.append({'result': {'id': str(len(results)), 'sensor_id': '1',
+            'temperature_c': args['temp_c'],
+            'record_time': '2010-01-01 00:00:00'}})
+    self._Respond(200, kbjson.dumps({'result': results}))
+
+  def _Respond(self, code, body):
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    # Drop idle connections without telling the client, as servers do.
+    self.server.num_responses += 1
+    if self.server.close_every and \
+        not self.server.num_responses % self.server.close_every:
+      self.close_connection = 1
+
+  def log_message(self, format, *args):
+    pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """An HTTP/1.1 server answering every request with an empty result.
+
+  Batch requests are recorded in |batches|; operations on a tap named
+  'missing' fail with a NotFoundError, and on a tap named 'broken' with a
+  ServerError.  Other requests fail with a
+  NotFoundError if their path contains 'missing', and with a 503 error page
+  if it contains 'broken'.
+
+  If |close_every| is given, the connection is closed after every
+  |close_every| responses, without a "Connection: close" header.
+  """
+  daemon_threads = True
+
+  def __init__(self, close_every=0):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StubHandler)
+    self.close_every = close_every
+    self.num_responses = 0
+    self.paths = []
+    self.batches = []
+    self._thread = threading.Thread(target=self.serve_forever)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def GetURL(self):
+    return 'http://127.0.0.1:%i/api' % self.server_address[1]
+
+  def Stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+class KrestClientTestCase(unittest.TestCase):
+  def tearDown(self):
+    self.pool.Close()
+    self.server.Stop()
+
+  def _NewClient(self, close_every=0):
+    self.server = StubServer(close_every=close_every)
+    self.pool = krest.ConnectionPool()
+    return krest.KrestClient(api_url=self.server.GetURL(), api_key='key',
+        pool=self.pool)
+
+  def testConnectionReuse(self):
+    client = self._NewClient()
+    for i in xrange(5):
+      client.DoGET('taps', None)
+      client.DoPOST('taps/flow0', None, post_data={'ticks': i})
+    self.assertEqual(self.pool.GetStats(), (10, 1, 0))
+    self.assertEqual(self.server.paths[:2], ['/api/taps/?api_key=key',
+        '/api/taps/flow0/'])
+    self.assertRaises(krest.NotFoundError, client.DoGET, 'missing', None)
+    self.assertRaises(krest.ServerError, client.DoGET, 'broken', None)
+
+  def testGetTokenErrors(self):
+    client = self._NewClient()
+    self.assertRaises(krest.NotFoundError, client.GetToken, 'rfid', 'missing')
+    self.assertRaises(krest.ServerError, client.GetToken, 'rfid', 'broken')
+
+  def testStaleConnection(self):
+    client = self._NewClient(close_every=2)
+    for i in xrange(6):
+      client.DoGET('taps', None)
+    # Requests 3 and 5 are retried on a new connection.
+    self.assertEqual(self.pool.GetStats(), (8, 3, 2))
+
+  def testBatch(self):
+    client = self._NewClient()
+    ops = [
+      client.RecordDrinkOp('flow0', 100),
+      client.RecordDrinkOp('missing', 100),
+      client.LogSensorReadingOp('thermo0', 4.5),
+    ]
+    results = client.Batch(ops)
+    self.assertEqual(len(results), 3)
+    self.assertEqual(results[0].ticks, 100)
+    self.assertTrue(isinstance(results[1], krest.NotFoundError))
+    self.assertEqual(results[2].temperature_c, 4.5)
+    self.assertEqual(self.server.batches, [[
+      {'op': 'record_drink', 'args': ops[0][1]},
+      {'op': 'record_drink', 'args': ops[1][1]},
+      {'op': 'log_sensor_reading', 'args': {'sensor_name': 'thermo0',
+          'temp_c': 4.5}},
+    ]])
+
+  def testBatchStopOnError(self):
+    client = self._NewClient()
+    ops = [
+      client.RecordDrinkOp('flow0', 100),
+      client.RecordDrinkOp('missing', 100),
+      client.RecordDrinkOp('flow1', 100),
+    ]
+    results = client.Batch(ops, stop_on_error=True)
+    self.assertEqual(len(results), 2)
+    self.assertEqual(results[0].ticks, 100)
+    self.assertTrue(isinstance(results[1], krest.NotFoundError))
+
+  def testTimeouts(self):
+    client = self._NewClient()
+    client.SetTimeout('TapStatus', 5.0)
+    self.assertEqual(client._GetTimeout('TapStatus'), 5.0)
+    self.assertEqual(client._GetTimeout('GetToken'), None)
+    client.SetTimeout('TapStatus', None)
+    self.assertEqual(client._GetTimeout('TapStatus'), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -25,6 +25,7 @@ import sys
 from decimal import Decimal
 
 from django.conf import settings
+from django.db import transaction
 from django.contrib.auth import login as auth_login
 from django.contrib.auth import logout as auth_logout
 from django.contrib.auth.forms import AuthenticationForm
@@ -320,6 +321,9 @@ def get_user_stats(request, username):
 @py_to_json
 @auth_required
 def get_auth_token(request, auth_device, token_value):
+  return _get_auth_token(request, auth_device, token_value)
+
+def _get_auth_token(request, auth_device, token_value):
   b = backend.KegbotBackend(site=request.kbsite)
   tok = b.GetAuthToken(auth_device, token_value)
   return FromProto(tok)
@@ -367,8 +371,11 @@ def thermo_sensor_get(request, sensor_name):
 @py_to_json
 @auth_required
 def thermo_sensor_post(request, sensor_name):
+  return _log_sensor_reading(request, sensor_name, request.POST)
+
+def _log_sensor_reading(request, sensor_name, data):
   sensor = _get_sensor_or_404(request, sensor_name)
-  form = forms.ThermoPostForm(request.POST)
+  form = forms.ThermoPostForm(data)
   if not form.is_valid():
     raise krest.BadRequestError, _form_errors(form)
   cd = form.cleaned_data
@@ -426,7 +433,10 @@ def tap_detail_get(request, tap_id):
 @py_to_json
 @auth_required
 def tap_detail_post(request, tap):
-  form = forms.DrinkPostForm(request.POST)
+  return _record_drink(request, tap, request.POST)
+
+def _record_drink(request, tap, data):
+  form = forms.DrinkPostForm(data)
   if not form.is_valid():
     raise krest.BadRequestError, _form_errors(form)
   cd = form.cleaned_data
@@ -460,7 +470,10 @@ def cancel_drink(request):
   #if request.method != 'POST':
   #  raise krest.BadRequestError, 'Method not supported at this endpoint'
   #form = forms.DrinkCancelForm(request.POST)
-  form = forms.CancelDrinkForm(request.GET)
+  return _cancel_drink(request, request.GET)
+
+def _cancel_drink(request, data):
+  form = forms.CancelDrinkForm(data)
   if not form.is_valid():
     raise krest.BadRequestError, _form_errors(form)
   cd = form.cleaned_data
@@ -471,6 +484,64 @@ def cancel_drink(request):
   except backend.BackendError, e:
     raise krest.ServerError(str(e))
 
+# Operations which may be sent to the batch endpoint, by name.  Each is called
+# with the request and the arguments given for the operation.
+BATCH_OPS = {
+  'record_drink': lambda request, args: _record_drink(request,
+      args.get('tap_name'), args),
+  'cancel_drink': _cancel_drink,
+  'log_sensor_reading': lambda request, args: _log_sensor_reading(request,
+      args.get('sensor_name'), args),
+  'get_auth_token': lambda request, args: _get_auth_token(request,
+      args.get('auth_device'), args.get('token_value')),
+}
+
+@py_to_json
+@auth_required
+@transaction.commit_on_success
+def batch(request):
+  """Runs a list of operations, in order, in one database transaction.
+
+  The operations are given as the JSON-encoded POST field 'ops': a list of
+  {'op': <name in BATCH_OPS>, 'args': <dict>}.  The result has an entry for
+  each operation, which is either {'result': ...} or {'error': ...}, as for a
+  single call.  A failed operation is rolled back to a savepoint, where the
+  database supports them, and does not stop the others, unless the POST field
+  'stop_on_error' is '1': then the result ends with the failed operation's
+  entry, and the operations after it are not run.
+  """
+  try:
+    ops = kbjson.loads(request.POST.get('ops', ''))
+  except ValueError:
+    raise krest.BadRequestError('ops must be a JSON list')
+  if not isinstance(ops, list):
+    raise krest.BadRequestError('ops must be a JSON list')
+  if len(ops) > krest.MAX_BATCH_OPS:
+    raise krest.BadRequestError('Too many ops; the limit is %i' %
+        krest.MAX_BATCH_OPS)
+  stop_on_error = request.POST.get('stop_on_error') == '1'
+
+  results = []
+  for op in ops:
+    handler = None
+    if isinstance(op, dict):
+      handler = BATCH_OPS.get(op.get('op'))
+    if not handler:
+      results.append(ToJsonError(krest.BadRequestError('Unknown op'))[0])
+      if stop_on_error:
+        break
+      continue
+    sid = transaction.savepoint()
+    try:
+      results.append({'result': handler(request, op.get('args') or {})})
+      transaction.savepoint_commit(sid)
+    except Exception, e:
+      transaction.savepoint_rollback(sid)
+      results.append(ToJsonError(e)[0])
+      if stop_on_error:
+        break
+  return results
+
 @csrf_exempt
 @py_to_json
 def login(request):
@@ -17,10 +17,19 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 from django.contrib.auth.models import User
 from django.contrib import admin
 
+from pykeg.core import kbevent
+from pykeg.core import models as core_models
+from pykeg.core.net import kegnet
+
 class Page(models.Model):
   STATUS_CHOICES = (
     ('published', 'published'),
@@ -44,3 +53,26 @@ class Page(models.Model):
   last_modified = models.DateTimeField(auto_now=True)
 
 admin.site.register(Page)
+
+
+def _token_changed(sender, instance, **kwargs):
+  """Tells the core to drop a changed token from its token cache.
+
+  Only done if KEGBOT_CORE_ADDR is set.  The event is sent from another
+  thread, so that saving a token never waits on the core.
+  """
+  addr = getattr(settings, 'KEGBOT_CORE_ADDR', '')
+  if not addr:
+    return
+  if kwargs.get('created') and not instance.user:
+    # A new unassigned token, as created by looking up an unknown one; the
+    # core already knows it is not assigned.
+    return
+  event = kbevent.TokenChangedEvent(auth_device_name=instance.auth_device,
+      token_value=instance.token_value)
+  thr = threading.Thread(target=kegnet.NotifyCore, args=(event, addr))
+  thr.setDaemon(True)
+  thr.start()
+
+post_save.connect(_token_changed, sender=core_models.AuthenticationToken)
+post_delete.connect(_token_changed, sender=core_models.AuthenticationToken)
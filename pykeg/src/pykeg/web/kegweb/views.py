@@ -34,6 +34,7 @@ from django.views.generic.list_detail import object_list
 from django.views.generic.simple import redirect_to
 
 from pykeg.core import models
+from pykeg.core import stats as kbstats
 from pykeg.core import units
 
 from pykeg.web.kegweb import forms
@@ -66,9 +67,8 @@ def system_stats(request):
   context['stats'] = stats
 
   top_drinkers = []
-  for drinkervol in stats.get('volume_by_drinker'):
-    username = str(drinkervol['username'])
-    vol = float(drinkervol['volume_ml'])
+  volume_by_drinker = kbstats.UpgradeStats(stats).get('volume_by_drinker', {})
+  for username, vol in volume_by_drinker.iteritems():
     try:
       user = models.User.objects.get(username=username)
     except models.User.DoesNotExist: